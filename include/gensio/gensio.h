@@ -87,6 +87,8 @@ void *gensio_get_user_data(struct gensio *io);
 
 void gensio_set_user_data(struct gensio *io, void *user_data);
 
+struct gensio_os_funcs *gensio_get_os_funcs(struct gensio *io);
+
 int gensio_write(struct gensio *io, gensiods *count,
 		 const void *buf, gensiods buflen,
 		 const char *const *auxdata);
@@ -159,6 +161,10 @@ int gensio_control(struct gensio *io, int depth, bool get,
 #define GENSIO_CONTROL_ARGS			12
 #define GENSIO_CONTROL_EXIT_CODE		13
 #define GENSIO_CONTROL_WAIT_TASK		14
+#define GENSIO_CONTROL_SESSION_RESUMED		15
+#define GENSIO_CONTROL_STATS			16
+#define GENSIO_CONTROL_PRIORITY			17
+#define GENSIO_CONTROL_WEIGHT			18
 
 const char *gensio_get_type(struct gensio *io, unsigned int depth);
 struct gensio *gensio_get_child(struct gensio *io, unsigned int depth);
@@ -171,6 +177,7 @@ bool gensio_is_message(struct gensio *io);
 
 int gensio_set_sync(struct gensio *io);
 int gensio_clear_sync(struct gensio *io);
+int gensio_set_sync_readahead(struct gensio *io, gensiods size);
 int gensio_read_s(struct gensio *io, gensiods *count,
 		  void *data, gensiods datalen,
 		  struct timeval *timeout);
@@ -260,6 +267,8 @@ int gensio_acc_control(struct gensio_accepter *accepter, int depth, bool get,
 /* Uses GENSIO_CONTROL_DEPTH_xxx options above. */
 #define GENSIO_ACC_CONTROL_LADDR	1
 #define GENSIO_ACC_CONTROL_LPORT	2
+#define GENSIO_ACC_CONTROL_RELOAD_CERTS	3
+#define GENSIO_ACC_CONTROL_STATS	4
 
 int gensio_acc_set_sync(struct gensio_accepter *acc);
 
@@ -37,6 +37,15 @@ typedef int (*gensio_ll_filter_data_handler)(void *cb_data,
  */
 #define GENSIO_FILTER_CB_START_TIMER	2
 
+/*
+ * Like GENSIO_FILTER_CB_START_TIMER, but if the timer is already
+ * running it is stopped and started again with the new timeout.  Use
+ * this when the filter needs the timeout sooner than the one that is
+ * currently running.
+ * timeout => data
+ */
+#define GENSIO_FILTER_CB_RESTART_TIMER	3
+
 typedef int (*gensio_filter_cb)(void *cb_data, int func, void *data);
 
 
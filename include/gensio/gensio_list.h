@@ -35,6 +35,9 @@ void gensio_list_add_next(struct gensio_list *list, struct gensio_link *curr,
 void gensio_list_add_prev(struct gensio_list *list, struct gensio_link *curr,
 			  struct gensio_link *link);
 void gensio_list_init(struct gensio_list *list);
+/* Static initializer for a list, like "struct gensio_list l = GENSIO_LIST_INIT(l);" */
+#define GENSIO_LIST_INIT(l) { .link = { .list = &(l), .next = &(l).link, \
+					.prev = &(l).link } }
 bool gensio_list_empty(struct gensio_list *list);
 
 #define gensio_list_first(list) ((list)->link.next)
@@ -271,6 +271,27 @@ struct gensio_os_funcs {
     int (*wait_intr_sigmask)(struct gensio_waiter *waiter, unsigned int count,
 			     struct timeval *timeout, sigset_t *sigmask);
 
+    /****** File Descriptor Handling ******/
+    /*
+     * Switch an fd with handlers set to edge-triggered mode.  The
+     * handlers must then read or write until there is no more data
+     * or room (EAGAIN) or disable the handler.  A handler is only
+     * called again when new data or room becomes available or when
+     * it is enabled again.  Returns true if the fd is now
+     * edge-triggered, false if it is still level-triggered.  This
+     * may be NULL if the OS handler doesn't support it.
+     */
+    bool (*set_fd_edge_triggered)(struct gensio_os_funcs *f, int fd);
+
+    /****** Sharding ******/
+    /*
+     * Return the OS handler that a new connection from an accepter
+     * using f should be allocated with.  This lets an accepter spread
+     * its connections over several OS handlers, each run by its own
+     * thread, so all the callbacks for a connection happen on one
+     * thread.  This may be NULL, in which case f is used.
+     */
+    struct gensio_os_funcs *(*get_shard)(struct gensio_os_funcs *f);
 };
 
 void gensio_vlog(struct gensio_os_funcs *o, enum gensio_log_levels level,
@@ -284,4 +305,21 @@ void gensio_log(struct gensio_os_funcs *o, enum gensio_log_levels level,
  */
 int gensio_default_os_hnd(int wake_sig, struct gensio_os_funcs **o);
 
+/*
+ * Allocate a new OS handler for the platform with its own selector.
+ * Unlike gensio_default_os_hnd(), this returns a new one each time,
+ * free it with free_funcs() when done with it.  The flags are options
+ * that can only be set when the handler is allocated, GE_INVAL is
+ * returned for an unknown flag.
+ */
+int gensio_alloc_os_funcs(int wake_sig, unsigned int flags,
+			  struct gensio_os_funcs **o);
+
+/*
+ * Keep timers in a timer wheel instead of a heap.  This makes starting
+ * and stopping timers faster if there are a lot of them, but timers
+ * may go off up to a millisecond late.
+ */
+#define GENSIO_OS_FUNCS_TIMER_WHEEL	(1 << 0)
+
 #endif /* GENSIO_OS_FUNCS */
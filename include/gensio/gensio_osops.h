@@ -43,6 +43,12 @@ int gensio_os_accept(struct gensio_os_funcs *o,
 		     int fd, struct sockaddr *addr, socklen_t *addrlen,
 		     int *newsock);
 
+/*
+ * Return the OS handler to allocate a new connection from an
+ * accepter using o with.  See get_shard in gensio_os_funcs.
+ */
+struct gensio_os_funcs *gensio_os_get_shard(struct gensio_os_funcs *o);
+
 int gensio_os_sctp_recvmsg(struct gensio_os_funcs *o,
 			   int fd, void *msg, gensiods len, gensiods *rcount,
 			   struct sctp_sndrcvinfo *sinfo, int *msg_flags);
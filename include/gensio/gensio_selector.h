@@ -14,6 +14,18 @@
 struct gensio_os_funcs *gensio_selector_alloc(struct selector_s *sel,
 					      int wake_sig);
 
+/*
+ * Add an OS handler to the set that new connections from accepters
+ * using o are spread over, round-robin.  Each shard should have its
+ * own selector and its own thread (or threads) calling service or
+ * wait on it, so the fds and timers for a connection are handled on
+ * that thread with no contention on the locks of the other shards.
+ * o itself may be added if it should get connections, too.  The
+ * shards must not be freed before o.  Returns GE_NOMEM on failure.
+ */
+int gensio_selector_add_shard(struct gensio_os_funcs *o,
+			      struct gensio_os_funcs *shard);
+
 /* For testing, do not use in normal code. */
 void gensio_sel_exit(int rv);
 
@@ -38,6 +38,28 @@ int sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
      NULL for all the values. */
 int sel_alloc_selector_nothread(struct selector_s **new_selector);
 
+/*
+ * Like sel_alloc_selector_thread(), but with flags for options that
+ * have to be chosen when the selector is created.  Pass NULL for the
+ * lock functions for a single-threaded selector.  Returns EINVAL for
+ * an unknown flag.
+ */
+int sel_alloc_selector_flags(struct selector_s **new_selector, int wake_sig,
+			     sel_lock_t *(*sel_lock_alloc)(void *cb_data),
+			     void (*sel_lock_free)(sel_lock_t *),
+			     void (*sel_lock)(sel_lock_t *),
+			     void (*sel_unlock)(sel_lock_t *),
+			     void *cb_data, unsigned int flags);
+
+/*
+ * Keep the timers in a hierarchical timing wheel instead of a heap.
+ * Starting and stopping a timer is O(1) instead of O(log n), which
+ * helps if there are a lot of timers that get restarted a lot, but
+ * timers have a resolution of a millisecond, they may go off up to a
+ * millisecond late.
+ */
+#define SEL_TIMER_WHEEL		(1 << 0)
+
 /* Used to destroy a selector. */
 int sel_free_selector(struct selector_s *new_selector);
 
@@ -164,9 +186,75 @@ int sel_select_loop(struct selector_s *sel,
 		    long            thread_id,
 		    void            *cb_data);
 
+/*
+ * Set the maximum number of fd events handled on each wakeup of the
+ * selector.  With epoll, up to this many ready fds are pulled from
+ * the kernel in one call and their handlers are all run before
+ * waiting again.  Setting this to 1 handles one fd per wakeup.  Note
+ * that with multiple threads in the selector, one thread will handle
+ * the whole batch, so a smaller value may spread the load better
+ * across threads.  Returns EINVAL if max_events is 0 or larger than
+ * SEL_MAX_FD_EVENTS.
+ */
+#define SEL_DEFAULT_FD_EVENTS	16
+#define SEL_MAX_FD_EVENTS	256
+int sel_set_max_fd_events(struct selector_s *sel, unsigned int max_events);
+
+/*
+ * Allow (or disallow if enable is 0) fds to be switched to
+ * edge-triggered mode with sel_set_fd_edge_triggered().  Returns
+ * ENOTSUP if the selector is not using epoll.
+ */
+int sel_set_edge_triggered(struct selector_s *sel, int enable);
+
+/*
+ * Switch an fd that has handlers set to edge-triggered mode.  This
+ * saves a system call to rearm the fd after each event, but the
+ * handlers must then read (or write) until they get EAGAIN, or
+ * disable the handler.  A handler will only be called again after
+ * new data arrives or after it is enabled again, enabling a handler
+ * causes the fd to be checked again.  The handlers for an fd are
+ * still never called concurrently.
+ *
+ * Setting new handlers on the fd returns it to level-triggered
+ * mode.  Returns ENOTSUP if the selector does not allow
+ * edge-triggered fds, in which case the fd is left level-triggered.
+ */
+int sel_set_fd_edge_triggered(struct selector_s *sel, int fd);
+
 /* Wake all threads in all select loops. */
 void sel_wake_all(struct selector_s *sel);
 
+/*
+ * Wake threads waiting in the selector with an eventfd (or a pipe if
+ * eventfd is not available) instead of sending them a signal.  A
+ * signal requires a handler for it in the process; the fd is just
+ * written.  Each thread that waits in the selector gets its own wake
+ * fd, it is waited on with the selector's fds and is consumed by the
+ * thread when it wakes, so waking one thread does not disturb the
+ * others.  With this, sel_run() wakes the waiting threads, so runners
+ * started from outside the selector run right away.  The send_sig
+ * callbacks passed to sel_select() are not used.  This should be
+ * called before any threads use the selector, and cannot be undone.
+ */
+int sel_use_wake_fd(struct selector_s *sel);
+
+/* Returns non-zero if sel_use_wake_fd() was done on the selector. */
+int sel_has_wake_fd(struct selector_s *sel);
+
+/*
+ * For code that waits in the selector for a condition, like waiters.
+ * sel_get_thread_wake() returns the calling thread's wake, it returns
+ * NULL if the selector does not use wake fds or it could not be
+ * allocated.  It belongs to the thread and is valid until the thread
+ * exits.  Another thread can call sel_wake_thread() on it to make the
+ * owning thread return from sel_select(), or, if the thread is not in
+ * sel_select(), make its next sel_select() call return right away.
+ */
+typedef struct sel_thread_wake_s sel_thread_wake_t;
+sel_thread_wake_t *sel_get_thread_wake(struct selector_s *sel);
+void sel_wake_thread(sel_thread_wake_t *wake);
+
 typedef void (*ipmi_sel_add_read_fds_cb)(struct selector_s *sel,
 					 int            *num_fds,
 					 fd_set         *fdset,
@@ -27,6 +27,8 @@
 #include <gensio/gensio_class.h>
 
 #include "utils.h"
+#include "gensio_filter_ssl.h"
+#include "gensio_filter_certauth.h"
 
 static unsigned int gensio_log_mask =
     (1 << GENSIO_LOG_FATAL) | (1 << GENSIO_LOG_ERR);
@@ -74,6 +76,38 @@ struct gensio_nocbwait {
 
 struct gensio_sync_io;
 
+/*
+ * Counters kept on every gensio, see GENSIO_CONTROL_STATS.  They are
+ * kept on every gensio all the time, so the hot paths must not take
+ * a lock just for them.  The read and write callback counters are
+ * updated in gensio_cb() under the gensio's lock, which it already
+ * holds.  The write and stall counters are updated with relaxed
+ * atomics.  Everything is read with gensio_stat_get().
+ */
+#define gensio_stat_get(v) __atomic_load_n(&(v), __ATOMIC_RELAXED)
+#define gensio_stat_set(v, n) __atomic_store_n(&(v), (n), __ATOMIC_RELAXED)
+#define gensio_stat_add(v, n) __atomic_fetch_add(&(v), (n), __ATOMIC_RELAXED)
+
+struct gensio_stats {
+    unsigned long long read_bytes;
+    unsigned long long read_msgs;
+    unsigned long long read_callbacks;
+    unsigned long long read_errs;
+    unsigned long long write_bytes;
+    unsigned long long write_msgs;
+    unsigned long long writes;
+    unsigned long long partial_writes;
+    unsigned long long write_callbacks;
+    unsigned long long write_errs;
+    unsigned long long read_stalls;
+    unsigned long long read_stall_usec;
+    unsigned long long opens;
+    unsigned long long open_errs;
+    unsigned long long open_usec;
+    unsigned long long closes;
+    unsigned long long close_usec;
+};
+
 struct gensio {
     struct gensio_os_funcs *o;
     void *user_data;
@@ -82,6 +116,32 @@ struct gensio {
     struct gensio_list waiters;
     struct gensio_lock *lock;
 
+    struct gensio_stats stats;
+
+    /*
+     * For timing read stalls.  read_state is one of the
+     * GENSIO_READ_xxx values below and is only changed with
+     * gensio_read_state_cas().  read_cbs is the number of read
+     * callbacks running, protected by the lock.  read_stall_start is
+     * the monotonic time in usec the stall started.
+     */
+    unsigned int read_state;
+    unsigned int read_cbs;
+    unsigned long long read_stall_start;
+
+    /*
+     * The user's open and close done callbacks are stored here
+     * while the operation is pending so the latency can be measured.
+     */
+    bool open_pending;
+    gensio_done_err open_done;
+    void *open_data;
+    struct timeval open_start;
+    bool close_pending;
+    gensio_done close_done;
+    void *close_data;
+    struct timeval close_start;
+
     struct gensio_classobj *classes;
 
     gensio_func func;
@@ -164,6 +224,87 @@ void gensio_set_cb(struct gensio *io, gensio_event cb, void *user_data)
     io->user_data = user_data;
 }
 
+/*
+ * Get the current monotonic time for the statistics.  Not all os
+ * handlers supply this, the times are not recorded if it is missing.
+ */
+static bool
+gensio_stats_now(struct gensio_os_funcs *o, struct timeval *now)
+{
+    if (!o->get_monotonic_time)
+	return false;
+    o->get_monotonic_time(o, now);
+    return true;
+}
+
+static unsigned long long
+gensio_stats_usec_since(struct gensio_os_funcs *o, struct timeval *start)
+{
+    struct timeval now;
+    long long diff;
+
+    if (!gensio_stats_now(o, &now))
+	return 0;
+    diff = ((long long) (now.tv_sec - start->tv_sec) * 1000000
+	    + (now.tv_usec - start->tv_usec));
+    if (diff < 0)
+	return 0;
+    return diff;
+}
+
+/*
+ * Read stall states.  Reads start out NEVER, disabling them doesn't
+ * count as a stall until they have been enabled once.  If reads are
+ * disabled in a read callback they go to OFF_CB, it's only a stall
+ * if they are still disabled when the callback returns, so the
+ * common disable and re-enable in a callback costs no clock reads.
+ * STARTING is held while the stall start time is set.
+ */
+#define GENSIO_READ_NEVER	0
+#define GENSIO_READ_ON		1
+#define GENSIO_READ_OFF_CB	2
+#define GENSIO_READ_STARTING	3
+#define GENSIO_READ_STALLED	4
+
+static bool
+gensio_read_state_cas(struct gensio *io, unsigned int old, unsigned int new)
+{
+    return __atomic_compare_exchange_n(&io->read_state, &old, new, false,
+				       __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE);
+}
+
+static unsigned long long
+gensio_stats_usec(struct gensio_os_funcs *o)
+{
+    struct timeval now;
+
+    if (!gensio_stats_now(o, &now))
+	return 0;
+    return (unsigned long long) now.tv_sec * 1000000 + now.tv_usec;
+}
+
+static unsigned long long
+gensio_read_stall_usec(struct gensio *io, unsigned long long start)
+{
+    unsigned long long now = gensio_stats_usec(io->o);
+
+    if (now < start)
+	return 0;
+    return now - start;
+}
+
+/* Start a read stall if the read state is still "from". */
+static void
+gensio_read_stall_start(struct gensio *io, unsigned int from)
+{
+    if (!gensio_read_state_cas(io, from, GENSIO_READ_STARTING))
+	return;
+    gensio_stat_add(io->stats.read_stalls, 1);
+    gensio_stat_set(io->read_stall_start, gensio_stats_usec(io->o));
+    /* If reads were enabled in the meantime this fails, that's fine. */
+    gensio_read_state_cas(io, GENSIO_READ_STARTING, GENSIO_READ_STALLED);
+}
+
 int
 gensio_cb(struct gensio *io, int event, int err,
 	  unsigned char *buf, gensiods *buflen, const char *const *auxdata)
@@ -175,9 +316,27 @@ gensio_cb(struct gensio *io, int event, int err,
 	return GE_NOTSUP;
     o->lock(io->lock);
     io->cb_count++;
+    if (event == GENSIO_EVENT_READ)
+	gensio_stat_set(io->read_cbs, io->read_cbs + 1);
     o->unlock(io->lock);
     rv = io->cb(io, io->user_data, event, err, buf, buflen, auxdata);
     o->lock(io->lock);
+    if (event == GENSIO_EVENT_READ) {
+	gensio_stat_set(io->read_cbs, io->read_cbs - 1);
+	if (io->read_cbs == 0 &&
+		gensio_stat_get(io->read_state) == GENSIO_READ_OFF_CB)
+	    gensio_read_stall_start(io, GENSIO_READ_OFF_CB);
+	io->stats.read_callbacks++;
+	if (err) {
+	    io->stats.read_errs++;
+	} else if (!rv && buflen) {
+	    io->stats.read_bytes += *buflen;
+	    if (io->is_packet)
+		io->stats.read_msgs++;
+	}
+    } else if (event == GENSIO_EVENT_WRITE_READY) {
+	io->stats.write_callbacks++;
+    }
     assert(io->cb_count > 0);
     io->cb_count--;
     if (io->cb_count == 0) {
@@ -233,6 +392,11 @@ struct gensio_accepter {
     bool sync;
     bool enabled;
 
+    /* See GENSIO_ACC_CONTROL_STATS, protected by the lock. */
+    unsigned long long accepts;
+    bool started;
+    struct timeval start_time;
+
     struct gensio_list pending_ios;
 
     struct gensio_list waiting_ios;
@@ -296,6 +460,11 @@ gensio_acc_get_gensio_data(struct gensio_accepter *acc)
 int
 gensio_acc_cb(struct gensio_accepter *acc, int event, void *data)
 {
+    if (event == GENSIO_ACC_EVENT_NEW_CONNECTION) {
+	acc->o->lock(acc->lock);
+	acc->accepts++;
+	acc->o->unlock(acc->lock);
+    }
     if (event == GENSIO_ACC_EVENT_NEW_CONNECTION && acc->sync) {
 	struct gensio *io = data;
 
@@ -378,8 +547,8 @@ gensio_scan_args(struct gensio_os_funcs *o,
 					 " \f\n\r\t\v,", ")", &str);
 	if (!err && (!str || (*str != ',' && *str)))
 	    err = GE_INVAL; /* Not a ',' or end of string after */
-	else
-	    str++;
+	else if (!err && *str)
+	    str++; /* skip the comma, but don't go past the end */
     } else {
 	if (*str)
 	    str += 1; /* skip the comma */
@@ -766,6 +935,12 @@ gensio_get_user_data(struct gensio *io)
     return io->user_data;
 }
 
+struct gensio_os_funcs *
+gensio_get_os_funcs(struct gensio *io)
+{
+    return io->o;
+}
+
 void
 gensio_set_user_data(struct gensio *io, void *user_data)
 {
@@ -785,7 +960,7 @@ gensio_write(struct gensio *io, gensiods *count,
     }
     sg.buf = buf;
     sg.buflen = buflen;
-    return io->func(io, GENSIO_FUNC_WRITE_SG, count, &sg, 1, NULL, auxdata);
+    return gensio_write_sg(io, count, &sg, 1, auxdata);
 }
 
 int
@@ -793,11 +968,32 @@ gensio_write_sg(struct gensio *io, gensiods *count,
 		const struct gensio_sg *sg, gensiods sglen,
 		const char *const *auxdata)
 {
+    gensiods i, total = 0, dummy_count;
+    int rv;
+
     if (sglen == 0) {
-	*count = 0;
+	if (count)
+	    *count = 0;
 	return 0;
     }
-    return io->func(io, GENSIO_FUNC_WRITE_SG, count, sg, sglen, NULL, auxdata);
+    if (!count)
+	count = &dummy_count;
+    rv = io->func(io, GENSIO_FUNC_WRITE_SG, count, sg, sglen, NULL, auxdata);
+
+    gensio_stat_add(io->stats.writes, 1);
+    if (rv) {
+	gensio_stat_add(io->stats.write_errs, 1);
+    } else {
+	for (i = 0; i < sglen; i++)
+	    total += sg[i].buflen;
+	gensio_stat_add(io->stats.write_bytes, *count);
+	if (*count < total)
+	    gensio_stat_add(io->stats.partial_writes, 1);
+	if (io->is_packet && *count > 0)
+	    gensio_stat_add(io->stats.write_msgs, 1);
+    }
+
+    return rv;
 }
 
 int
@@ -832,18 +1028,77 @@ gensio_remote_id(struct gensio *io, int *id)
     return io->func(io, GENSIO_FUNC_REMOTE_ID, NULL, NULL, 0, id, NULL);
 }
 
+static void
+gensio_open_stats_done(struct gensio *io, int err, void *cb_data)
+{
+    struct gensio *sio = cb_data;
+    struct gensio_os_funcs *o = sio->o;
+    gensio_done_err open_done;
+    void *open_data;
+
+    o->lock(sio->lock);
+    open_done = sio->open_done;
+    open_data = sio->open_data;
+    sio->open_pending = false;
+    if (err) {
+	sio->stats.open_errs++;
+    } else {
+	sio->stats.opens++;
+	sio->stats.open_usec = gensio_stats_usec_since(o, &sio->open_start);
+    }
+    o->unlock(sio->lock);
+
+    if (open_done)
+	open_done(io, err, open_data);
+}
+
+static int
+i_gensio_open(struct gensio *io, int func, gensio_done_err open_done,
+	      void *open_data)
+{
+    struct gensio_os_funcs *o = io->o;
+    int rv;
+
+    /*
+     * Without a done callback there is nothing to measure with, and
+     * the gensio must still see the NULL callback.  Those opens are
+     * not counted.
+     */
+    if (!open_done)
+	return io->func(io, func, NULL, NULL, 0, open_data, NULL);
+
+    o->lock(io->lock);
+    if (io->open_pending) {
+	/* Let the gensio report the error for the second open. */
+	o->unlock(io->lock);
+	return io->func(io, func, NULL, open_done, 0, open_data, NULL);
+    }
+    io->open_pending = true;
+    io->open_done = open_done;
+    io->open_data = open_data;
+    gensio_stats_now(o, &io->open_start);
+    o->unlock(io->lock);
+
+    rv = io->func(io, func, NULL, gensio_open_stats_done, 0, io, NULL);
+    if (rv) {
+	o->lock(io->lock);
+	io->open_pending = false;
+	o->unlock(io->lock);
+    }
+    return rv;
+}
+
 int
 gensio_open(struct gensio *io, gensio_done_err open_done, void *open_data)
 {
-    return io->func(io, GENSIO_FUNC_OPEN, NULL, open_done, 0, open_data, NULL);
+    return i_gensio_open(io, GENSIO_FUNC_OPEN, open_done, open_data);
 }
 
 int
 gensio_open_nochild(struct gensio *io, gensio_done_err open_done,
 		    void *open_data)
 {
-    return io->func(io, GENSIO_FUNC_OPEN_NOCHILD, NULL, open_done, 0,
-		    open_data, NULL);
+    return i_gensio_open(io, GENSIO_FUNC_OPEN_NOCHILD, open_done, open_data);
 }
 
 struct gensio_open_s_data {
@@ -914,12 +1169,103 @@ gensio_alloc_channel(struct gensio *io, const char * const args[],
     return rv;
 }
 
+static int
+gensio_stats_control(struct gensio *io, bool get, char *data,
+		     gensiods *datalen)
+{
+    struct gensio_os_funcs *o = io->o;
+    struct gensio_stats *st = &io->stats;
+    unsigned long long *v = (unsigned long long *) st;
+    unsigned long long stall_usec;
+    gensiods i, pos = 0, sublen = 0;
+
+    o->lock(io->lock);
+    if (!get) {
+	for (i = 0; i < sizeof(*st) / sizeof(*v); i++)
+	    gensio_stat_set(v[i], 0);
+	if (gensio_stat_get(io->read_state) == GENSIO_READ_STALLED)
+	    gensio_stat_set(io->read_stall_start, gensio_stats_usec(o));
+	o->unlock(io->lock);
+	/* Let the gensio reset its own statistics, too. */
+	io->func(io, GENSIO_FUNC_CONTROL, &sublen, &get, GENSIO_CONTROL_STATS,
+		 NULL, NULL);
+	return 0;
+    }
+
+    /* Include a stall that is in progress. */
+    stall_usec = gensio_stat_get(st->read_stall_usec);
+    if (gensio_stat_get(io->read_state) == GENSIO_READ_STALLED)
+	stall_usec += gensio_read_stall_usec(io,
+				gensio_stat_get(io->read_stall_start));
+
+    gensio_pos_snprintf(data, *datalen, &pos,
+			"read_bytes=%llu read_msgs=%llu read_callbacks=%llu"
+			" read_errs=%llu",
+			st->read_bytes, st->read_msgs, st->read_callbacks,
+			st->read_errs);
+    gensio_pos_snprintf(data, *datalen, &pos,
+			" write_bytes=%llu write_msgs=%llu writes=%llu"
+			" partial_writes=%llu write_callbacks=%llu"
+			" write_errs=%llu",
+			gensio_stat_get(st->write_bytes),
+			gensio_stat_get(st->write_msgs),
+			gensio_stat_get(st->writes),
+			gensio_stat_get(st->partial_writes),
+			st->write_callbacks,
+			gensio_stat_get(st->write_errs));
+    gensio_pos_snprintf(data, *datalen, &pos,
+			" read_stalls=%llu read_stall_usec=%llu",
+			gensio_stat_get(st->read_stalls), stall_usec);
+    gensio_pos_snprintf(data, *datalen, &pos,
+			" opens=%llu open_errs=%llu open_usec=%llu"
+			" closes=%llu close_usec=%llu",
+			st->opens, st->open_errs, st->open_usec,
+			st->closes, st->close_usec);
+    o->unlock(io->lock);
+
+    /*
+     * The gensio may append its own " name=value" pairs.  It gets the
+     * rest of the buffer and returns the length it wanted in sublen,
+     * like any other control.
+     */
+    if (pos < *datalen)
+	sublen = *datalen - pos;
+    if (io->func(io, GENSIO_FUNC_CONTROL, &sublen, &get, GENSIO_CONTROL_STATS,
+		 sublen ? data + pos : NULL, NULL) == 0)
+	pos += sublen;
+    *datalen = pos;
+
+    return 0;
+}
+
 int
 gensio_control(struct gensio *io, int depth, bool get,
 	       unsigned int option, char *data, gensiods *datalen)
 {
     struct gensio *c = io;
 
+    if (option == GENSIO_CONTROL_STATS) {
+	/* Kept by the generic code, so every gensio supports it. */
+	if (depth == GENSIO_CONTROL_DEPTH_ALL) {
+	    if (get)
+		return GE_INVAL;
+	    for (; c; c = c->child)
+		gensio_stats_control(c, get, data, datalen);
+	    return 0;
+	}
+	if (depth == GENSIO_CONTROL_DEPTH_FIRST)
+	    depth = 0;
+	if (depth < 0)
+	    return GE_INVAL;
+	while (depth > 0) {
+	    if (!c->child)
+		return GE_NOTFOUND;
+	    depth--;
+	    c = c->child;
+	}
+	return gensio_stats_control(c, get, data, datalen);
+    }
+
     if (depth == GENSIO_CONTROL_DEPTH_ALL) {
 	if (get)
 	    return GE_INVAL;
@@ -987,11 +1333,60 @@ gensio_get_child(struct gensio *io, unsigned int depth)
     return c;
 }
 
+static void
+gensio_close_stats_done(struct gensio *io, void *cb_data)
+{
+    struct gensio *sio = cb_data;
+    struct gensio_os_funcs *o = sio->o;
+    gensio_done close_done;
+    void *close_data;
+
+    o->lock(sio->lock);
+    close_done = sio->close_done;
+    close_data = sio->close_data;
+    sio->close_pending = false;
+    sio->stats.closes++;
+    sio->stats.close_usec = gensio_stats_usec_since(o, &sio->close_start);
+    o->unlock(sio->lock);
+
+    if (close_done)
+	close_done(io, close_data);
+}
+
 int
 gensio_close(struct gensio *io, gensio_done close_done, void *close_data)
 {
-    return io->func(io, GENSIO_FUNC_CLOSE, NULL, close_done, 0, close_data,
-		    NULL);
+    struct gensio_os_funcs *o = io->o;
+    int rv;
+
+    /* Reads are off after a close, it's not a stall. */
+    gensio_stat_set(io->read_state, GENSIO_READ_NEVER);
+
+    /* See i_gensio_open(), a NULL callback is passed as is. */
+    if (!close_done)
+	return io->func(io, GENSIO_FUNC_CLOSE, NULL, NULL, 0, close_data,
+			NULL);
+
+    o->lock(io->lock);
+    if (io->close_pending) {
+	o->unlock(io->lock);
+	return io->func(io, GENSIO_FUNC_CLOSE, NULL, close_done, 0, close_data,
+			NULL);
+    }
+    io->close_pending = true;
+    io->close_done = close_done;
+    io->close_data = close_data;
+    gensio_stats_now(o, &io->close_start);
+    o->unlock(io->lock);
+
+    rv = io->func(io, GENSIO_FUNC_CLOSE, NULL, gensio_close_stats_done, 0, io,
+		  NULL);
+    if (rv) {
+	o->lock(io->lock);
+	io->close_pending = false;
+	o->unlock(io->lock);
+    }
+    return rv;
 }
 
 struct gensio_close_s_data {
@@ -1045,6 +1440,34 @@ gensio_free(struct gensio *io)
 void
 gensio_set_read_callback_enable(struct gensio *io, bool enabled)
 {
+    unsigned int state;
+    unsigned long long start = 0;
+
+    /*
+     * Track the time the read side is disabled for flow control,
+     * see the GENSIO_READ_xxx states.  The clock is only read when a
+     * stall starts or ends.
+     */
+    state = gensio_stat_get(io->read_state);
+    if (enabled) {
+	while (state != GENSIO_READ_ON) {
+	    if (state == GENSIO_READ_STALLED)
+		start = gensio_stat_get(io->read_stall_start);
+	    if (gensio_read_state_cas(io, state, GENSIO_READ_ON)) {
+		if (state == GENSIO_READ_STALLED)
+		    gensio_stat_add(io->stats.read_stall_usec,
+				    gensio_read_stall_usec(io, start));
+		break;
+	    }
+	    state = gensio_stat_get(io->read_state);
+	}
+    } else if (state == GENSIO_READ_ON) {
+	if (gensio_stat_get(io->read_cbs))
+	    gensio_read_state_cas(io, GENSIO_READ_ON, GENSIO_READ_OFF_CB);
+	else
+	    gensio_read_stall_start(io, GENSIO_READ_ON);
+    }
+
     io->func(io, GENSIO_FUNC_SET_READ_CALLBACK, NULL, NULL, enabled, NULL,
 	     NULL);
 }
@@ -1159,6 +1582,9 @@ gensio_acc_set_callback(struct gensio_accepter *accepter,
 int
 gensio_acc_startup(struct gensio_accepter *accepter)
 {
+    accepter->o->lock(accepter->lock);
+    accepter->started = gensio_stats_now(accepter->o, &accepter->start_time);
+    accepter->o->unlock(accepter->lock);
     accepter->enabled = true;
     return accepter->func(accepter, GENSIO_ACC_FUNC_STARTUP, 0,
 			  NULL, NULL, NULL, NULL, NULL);
@@ -1248,12 +1674,58 @@ gensio_acc_disable(struct gensio_accepter *acc)
     }
 }
 
+static int
+gensio_acc_stats_control(struct gensio_accepter *acc, bool get, char *data,
+			 gensiods *datalen)
+{
+    struct gensio_os_funcs *o = acc->o;
+    unsigned long long uptime = 0;
+
+    o->lock(acc->lock);
+    if (!get) {
+	acc->accepts = 0;
+	if (acc->started)
+	    gensio_stats_now(o, &acc->start_time);
+	o->unlock(acc->lock);
+	return 0;
+    }
+    if (acc->started)
+	uptime = gensio_stats_usec_since(o, &acc->start_time);
+    *datalen = snprintf(data, *datalen, "accepts=%llu uptime_usec=%llu",
+			acc->accepts, uptime);
+    o->unlock(acc->lock);
+
+    return 0;
+}
+
 int
 gensio_acc_control(struct gensio_accepter *acc, int depth, bool get,
 		   unsigned int option, char *data, gensiods *datalen)
 {
     struct gensio_accepter *c = acc;
 
+    if (option == GENSIO_ACC_CONTROL_STATS) {
+	/* Kept by the generic code, so every accepter supports it. */
+	if (depth == GENSIO_CONTROL_DEPTH_ALL) {
+	    if (get)
+		return GE_INVAL;
+	    for (; c; c = c->child)
+		gensio_acc_stats_control(c, get, data, datalen);
+	    return 0;
+	}
+	if (depth == GENSIO_CONTROL_DEPTH_FIRST)
+	    depth = 0;
+	if (depth < 0)
+	    return GE_INVAL;
+	while (depth > 0) {
+	    if (!c->child)
+		return GE_NOTFOUND;
+	    depth--;
+	    c = c->child;
+	}
+	return gensio_acc_stats_control(c, get, data, datalen);
+    }
+
     if (depth == GENSIO_CONTROL_DEPTH_ALL) {
 	if (get)
 	    return GE_INVAL;
@@ -2216,6 +2688,8 @@ struct gensio_def_entry builtin_defaults[] = {
     { "cert",		GENSIO_DEFAULT_STR,	.def.strval = NULL },
     { "key",		GENSIO_DEFAULT_STR,	.def.strval = NULL },
     { "clientauth",	GENSIO_DEFAULT_BOOL,	.def.intval = false },
+    { "session-cache",	GENSIO_DEFAULT_BOOL,	.def.intval = true },
+    { "tickets",	GENSIO_DEFAULT_BOOL,	.def.intval = true },
     /* General authentication flags. */
     { "allow-authfail",	GENSIO_DEFAULT_BOOL,	.def.intval = false },
     { "username",	GENSIO_DEFAULT_STR,	.def.strval = NULL },
@@ -2277,6 +2751,9 @@ gensio_cleanup_mem(struct gensio_os_funcs *o)
 	g = g2;
     }
     reg_gensios = NULL;
+
+    gensio_ssl_cleanup_mem(o);
+    gensio_certauth_cleanup_mem(o);
 }
 
 static void
@@ -2866,10 +3343,104 @@ struct gensio_sync_io {
     struct gensio_list writeops;
     int err;
 
+    /*
+     * Optional read-ahead ring buffer.  If set, data is read into
+     * this while nobody is waiting in gensio_read_s(), and
+     * gensio_read_s() takes data from here first.
+     */
+    unsigned char *rbuf;
+    gensiods rbuf_size;
+    gensiods rbuf_start;
+    gensiods rbuf_len;
+
+    /* Waiters kept for reuse by gensio_read_s() and gensio_write_s(). */
+#define GENSIO_SYNC_WAITER_CACHE 4
+    struct gensio_waiter *waiter_cache[GENSIO_SYNC_WAITER_CACHE];
+    unsigned int nr_cached_waiters;
+
     struct gensio_lock *lock;
     struct gensio_waiter *close_waiter;
 };
 
+/* Must be called with the lock held, returns NULL if none are cached. */
+static struct gensio_waiter *
+gensio_sync_get_waiter(struct gensio_sync_io *sync_io)
+{
+    if (sync_io->nr_cached_waiters == 0)
+	return NULL;
+    return sync_io->waiter_cache[--sync_io->nr_cached_waiters];
+}
+
+/*
+ * Must be called with the lock held.  The waiter must not have a
+ * wakeup pending.  Returns false if the cache is full.
+ */
+static bool
+gensio_sync_put_waiter(struct gensio_sync_io *sync_io,
+		       struct gensio_waiter *waiter)
+{
+    if (sync_io->nr_cached_waiters >= GENSIO_SYNC_WAITER_CACHE)
+	return false;
+    sync_io->waiter_cache[sync_io->nr_cached_waiters++] = waiter;
+    return true;
+}
+
+static gensiods
+gensio_sync_rbuf_put(struct gensio_sync_io *sync_io,
+		     const unsigned char *buf, gensiods len)
+{
+    gensiods pos, n;
+
+    if (len > sync_io->rbuf_size - sync_io->rbuf_len)
+	len = sync_io->rbuf_size - sync_io->rbuf_len;
+    pos = (sync_io->rbuf_start + sync_io->rbuf_len) % sync_io->rbuf_size;
+    n = sync_io->rbuf_size - pos;
+    if (n > len)
+	n = len;
+    memcpy(sync_io->rbuf + pos, buf, n);
+    memcpy(sync_io->rbuf, buf + n, len - n);
+    sync_io->rbuf_len += len;
+
+    return len;
+}
+
+static gensiods
+gensio_sync_rbuf_get(struct gensio_sync_io *sync_io,
+		     unsigned char *buf, gensiods len)
+{
+    gensiods n;
+
+    if (len > sync_io->rbuf_len)
+	len = sync_io->rbuf_len;
+    n = sync_io->rbuf_size - sync_io->rbuf_start;
+    if (n > len)
+	n = len;
+    memcpy(buf, sync_io->rbuf + sync_io->rbuf_start, n);
+    memcpy(buf + n, sync_io->rbuf, len - n);
+    sync_io->rbuf_len -= len;
+    if (sync_io->rbuf_len == 0)
+	sync_io->rbuf_start = 0;
+    else
+	sync_io->rbuf_start = (sync_io->rbuf_start + len) % sync_io->rbuf_size;
+
+    return len;
+}
+
+/*
+ * Reads are enabled if someone is waiting for data or there is room
+ * in the read-ahead buffer.  Must be called with the lock held.
+ */
+static void
+gensio_sync_check_read_enable(struct gensio *io,
+			      struct gensio_sync_io *sync_io)
+{
+    bool enable = !gensio_list_empty(&sync_io->readops);
+
+    if (sync_io->rbuf && !sync_io->err)
+	enable = enable || sync_io->rbuf_len < sync_io->rbuf_size;
+    gensio_set_read_callback_enable(io, enable);
+}
+
 static void
 gensio_sync_flush_waiters(struct gensio_sync_io *sync_io,
 			  struct gensio_os_funcs *o)
@@ -2907,7 +3478,7 @@ gensio_syncio_event(struct gensio *io, void *user_data,
 {
     struct gensio_os_funcs *o = io->o;
     struct gensio_sync_io *sync_io = io->sync_io;
-    gensiods done_len;
+    gensiods pos;
 
     switch (event) {
     case GENSIO_EVENT_READ:
@@ -2918,31 +3489,27 @@ gensio_syncio_event(struct gensio *io, void *user_data,
 	    gensio_sync_flush_waiters(sync_io, o);
 	    goto read_unlock;
 	}
-	if (gensio_list_empty(&sync_io->readops)) {
-	    *buflen = 0;
-	    gensio_set_read_callback_enable(io, false);
-	    goto read_unlock;
-	}
-	done_len = *buflen;
-	while (*buflen && !gensio_list_empty(&sync_io->readops)) {
+	pos = 0;
+	while (pos < *buflen && !gensio_list_empty(&sync_io->readops)) {
 	    struct gensio_link *l = gensio_list_first(&sync_io->readops);
 	    struct gensio_sync_op *op = gensio_container_of(l,
 							struct gensio_sync_op,
 							link);
-	    gensiods len = done_len;
+	    gensiods len = *buflen - pos;
 
 	    if (len > op->len)
 		len = op->len;
-	    memcpy(op->buf, buf, len);
+	    memcpy(op->buf, buf + pos, len);
 	    op->len = len;
 	    gensio_list_rm(&sync_io->readops, l);
 	    op->queued = false;
 	    o->wake(op->waiter);
-	    done_len -= len;
+	    pos += len;
 	}
-	*buflen -= done_len;
-	if (done_len > 0)
-	    gensio_set_read_callback_enable(io, false);
+	if (pos < *buflen && sync_io->rbuf)
+	    pos += gensio_sync_rbuf_put(sync_io, buf + pos, *buflen - pos);
+	*buflen = pos;
+	gensio_sync_check_read_enable(io, sync_io);
     read_unlock:
 	o->unlock(sync_io->lock);
 	return 0;
@@ -3041,6 +3608,10 @@ gensio_clear_sync(struct gensio *io)
 
     io->cb = sync_io->old_cb;
 
+    if (sync_io->rbuf)
+	o->free(o, sync_io->rbuf);
+    while (sync_io->nr_cached_waiters)
+	o->free_waiter(sync_io->waiter_cache[--sync_io->nr_cached_waiters]);
     o->free_waiter(sync_io->close_waiter);
     o->free_lock(sync_io->lock);
     o->free(o, sync_io);
@@ -3049,6 +3620,52 @@ gensio_clear_sync(struct gensio *io)
     return 0;
 }
 
+int
+gensio_set_sync_readahead(struct gensio *io, gensiods size)
+{
+    struct gensio_os_funcs *o = io->o;
+    struct gensio_sync_io *sync_io = io->sync_io;
+    unsigned char *rbuf = NULL, *oldbuf;
+    gensiods len;
+
+    if (!sync_io)
+	return GE_NOTREADY;
+
+    if (size && io->is_packet)
+	/* The buffer would merge or split messages. */
+	return GE_NOTSUP;
+
+    if (size) {
+	rbuf = o->zalloc(o, size);
+	if (!rbuf)
+	    return GE_NOMEM;
+    }
+
+    o->lock(sync_io->lock);
+    if (sync_io->rbuf_len > size) {
+	/* Don't throw away data that was already read. */
+	o->unlock(sync_io->lock);
+	if (rbuf)
+	    o->free(o, rbuf);
+	return GE_TOOBIG;
+    }
+    len = 0;
+    if (sync_io->rbuf_len)
+	len = gensio_sync_rbuf_get(sync_io, rbuf, sync_io->rbuf_len);
+    oldbuf = sync_io->rbuf;
+    sync_io->rbuf = rbuf;
+    sync_io->rbuf_size = size;
+    sync_io->rbuf_start = 0;
+    sync_io->rbuf_len = len;
+    gensio_sync_check_read_enable(io, sync_io);
+    o->unlock(sync_io->lock);
+
+    if (oldbuf)
+	o->free(o, oldbuf);
+
+    return 0;
+}
+
 int
 gensio_read_s(struct gensio *io, gensiods *count, void *data, gensiods datalen,
 	      struct timeval *timeout)
@@ -3056,7 +3673,8 @@ gensio_read_s(struct gensio *io, gensiods *count, void *data, gensiods datalen,
     struct gensio_os_funcs *o = io->o;
     struct gensio_sync_io *sync_io = io->sync_io;
     struct gensio_sync_op op;
-    int rv = 0;
+    gensiods len;
+    int rv = 0, wrv = 0;
 
     if (!sync_io)
 	return GE_NOTREADY;
@@ -3071,20 +3689,38 @@ gensio_read_s(struct gensio *io, gensiods *count, void *data, gensiods datalen,
     op.buf = data;
     op.len = datalen;
     op.err = 0;
-    op.waiter = o->alloc_waiter(o);
-    if (!op.waiter)
-	return GE_NOMEM;
+    op.waiter = NULL;
     o->lock(sync_io->lock);
+ retry:
+    if (sync_io->rbuf_len) {
+	/* Data was read ahead, no need to wait. */
+	len = gensio_sync_rbuf_get(sync_io, data, datalen);
+	if (count)
+	    *count = len;
+	gensio_sync_check_read_enable(io, sync_io);
+	goto out_unlock;
+    }
     if (sync_io->err) {
 	rv = sync_io->err;
 	goto out_unlock;
     }
+    if (!op.waiter)
+	op.waiter = gensio_sync_get_waiter(sync_io);
+    if (!op.waiter) {
+	/* Data may arrive while allocating, so check again. */
+	o->unlock(sync_io->lock);
+	op.waiter = o->alloc_waiter(o);
+	if (!op.waiter)
+	    return GE_NOMEM;
+	o->lock(sync_io->lock);
+	goto retry;
+    }
     gensio_set_read_callback_enable(io, true);
     memset(&op.link, 0, sizeof(op.link));
     gensio_list_add_tail(&sync_io->readops, &op.link);
 
     o->unlock(sync_io->lock);
-    o->wait_intr(op.waiter, 1, timeout);
+    wrv = o->wait_intr(op.waiter, 1, timeout);
     o->lock(sync_io->lock);
     if (op.err) {
 	rv = op.err;
@@ -3095,11 +3731,17 @@ gensio_read_s(struct gensio *io, gensiods *count, void *data, gensiods datalen,
     } else if (count) {
 	*count = op.len;
     }
-    if (gensio_list_empty(&sync_io->readops))
-	gensio_set_read_callback_enable(io, false);
+    gensio_sync_check_read_enable(io, sync_io);
  out_unlock:
+    /*
+     * If the wait failed, a wakeup may still come in for the waiter,
+     * so it can't be reused.
+     */
+    if (op.waiter && !wrv && gensio_sync_put_waiter(sync_io, op.waiter))
+	op.waiter = NULL;
     o->unlock(sync_io->lock);
-    o->free_waiter(op.waiter);
+    if (op.waiter)
+	o->free_waiter(op.waiter);
 
     return rv;
 }
@@ -3112,8 +3754,8 @@ gensio_write_s(struct gensio *io, gensiods *count,
     struct gensio_os_funcs *o = io->o;
     struct gensio_sync_io *sync_io = io->sync_io;
     struct gensio_sync_op op;
-    int rv = 0;
-    gensiods origlen;
+    int rv = 0, wrv = 0;
+    gensiods origlen, len;
 
     if (!sync_io)
 	return GE_NOTREADY;
@@ -3129,20 +3771,42 @@ gensio_write_s(struct gensio *io, gensiods *count,
     op.buf = (void *) data;
     op.len = datalen;
     op.err = 0;
-    op.waiter = o->alloc_waiter(o);
-    if (!op.waiter)
-	return GE_NOMEM;
     o->lock(sync_io->lock);
+    op.waiter = gensio_sync_get_waiter(sync_io);
+    if (!op.waiter) {
+	o->unlock(sync_io->lock);
+	op.waiter = o->alloc_waiter(o);
+	if (!op.waiter)
+	    return GE_NOMEM;
+	o->lock(sync_io->lock);
+    }
     if (sync_io->err) {
 	rv = sync_io->err;
 	goto out_unlock;
     }
+    if (gensio_list_empty(&sync_io->writeops)) {
+	/*
+	 * Nothing is queued, so try to write directly.  Often the
+	 * lower layer can take it all and there is no need to wait.
+	 */
+	len = 0;
+	rv = gensio_write(io, &len, op.buf, op.len, NULL);
+	if (rv)
+	    goto out_unlock;
+	op.buf += len;
+	op.len -= len;
+	if (op.len == 0) {
+	    if (count)
+		*count = origlen;
+	    goto out_unlock;
+	}
+    }
     gensio_set_write_callback_enable(io, true);
     memset(&op.link, 0, sizeof(op.link));
     gensio_list_add_tail(&sync_io->writeops, &op.link);
 
     o->unlock(sync_io->lock);
-    o->wait_intr(op.waiter, 1, timeout);
+    wrv = o->wait_intr(op.waiter, 1, timeout);
     o->lock(sync_io->lock);
     if (op.queued)
 	gensio_list_rm(&sync_io->writeops, &op.link);
@@ -3153,8 +3817,12 @@ gensio_write_s(struct gensio *io, gensiods *count,
     if (gensio_list_empty(&sync_io->writeops))
 	gensio_set_write_callback_enable(io, false);
  out_unlock:
+    /* See gensio_read_s() for why the waiter is not always reused. */
+    if (!wrv && gensio_sync_put_waiter(sync_io, op.waiter))
+	op.waiter = NULL;
     o->unlock(sync_io->lock);
-    o->free_waiter(op.waiter);
+    if (op.waiter)
+	o->free_waiter(op.waiter);
 
     return rv;
 }
@@ -200,7 +200,7 @@ gensna_child_event(struct gensio_accepter *accepter, void *user_data,
 		   int event, void *data)
 {
     struct gensna_data *nadata = user_data;
-    struct gensio_os_funcs *o = nadata->o;
+    struct gensio_os_funcs *o;
     struct gensio_filter *filter = NULL;
     struct gensio_ll *ll = NULL;
     struct gensio *io = NULL, *child;
@@ -212,6 +212,8 @@ gensna_child_event(struct gensio_accepter *accepter, void *user_data,
 	return gensio_acc_cb(nadata->acc, event, data);
 
     child = data;
+    /* Run on the same OS handler as the child, it may be a shard. */
+    o = gensio_get_os_funcs(child);
     err = base_gensio_accepter_new_child_start(nadata->acc);
     if (err)
 	goto out_err_unlock;
@@ -1419,6 +1419,25 @@ basen_start_timer_op(void *cb_data, struct timeval *timeout)
     }
 }
 
+static void
+basen_restart_timer_op(void *cb_data, struct timeval *timeout)
+{
+    struct basen_data *ndata = cb_data;
+
+    if (ndata->state == BASEN_OPEN) {
+	if (ndata->o->stop_timer(ndata->timer) == 0) {
+	    /* The running timer's reference carries over to the new one. */
+	    if (ndata->o->start_timer(ndata->timer, timeout) != 0)
+		basen_deref(ndata);
+	} else {
+	    basen_start_timer(ndata, timeout);
+	}
+    } else {
+	ndata->timer_start_pending = true;
+	ndata->pending_timer = *timeout;
+    }
+}
+
 static int
 gensio_base_filter_cb(void *cb_data, int op, void *data)
 {
@@ -1431,6 +1450,10 @@ gensio_base_filter_cb(void *cb_data, int op, void *data)
 	basen_start_timer_op(cb_data, data);
 	return 0;
 
+    case GENSIO_FILTER_CB_RESTART_TIMER:
+	basen_restart_timer_op(cb_data, data);
+	return 0;
+
     default:
 	return GE_NOTSUP;
     }
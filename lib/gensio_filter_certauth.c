@@ -36,8 +36,15 @@ struct gensio_certauth_filter_data {
 #ifdef HAVE_OPENSSL
 
 #include <assert.h>
+#include <stdlib.h>
 #include <string.h>
 #include <sys/time.h>
+#include <sys/stat.h>
+#include <dirent.h>
+#include <fcntl.h>
+#ifdef USE_PTHREADS
+#include <pthread.h>
+#endif
 
 #include <openssl/x509.h>
 #include <openssl/x509_vfy.h>
@@ -48,6 +55,9 @@ struct gensio_certauth_filter_data {
 
 #if OPENSSL_VERSION_NUMBER < 0x10100000L
 #define X509_up_ref(x) CRYPTO_add(&x->references, 1, CRYPTO_LOCK_X509)
+#define X509_STORE_up_ref(x) \
+    CRYPTO_add(&x->references, 1, CRYPTO_LOCK_X509_STORE)
+#define EVP_PKEY_up_ref(x) CRYPTO_add(&x->references, 1, CRYPTO_LOCK_EVP_PKEY)
 static EVP_MD_CTX *EVP_MD_CTX_new(void)
 {
     EVP_MD_CTX *c = OPENSSL_malloc(sizeof(*c));
@@ -1579,13 +1589,15 @@ int gensio_cert_get_name(X509 *cert, char *data, gensiods *datalen);
 int gensio_cert_to_buf(X509 *cert, char *buf, gensiods *datalen);
 int gensio_cert_fingerprint(X509 *cert, char *buf, gensiods *buflen);
 
+static int certauth_cache_get_store(const char *CAfilepath,
+				    X509_STORE **rstore);
+
 static int
 certauth_filter_control(struct gensio_filter *filter, bool get, int op,
 			char *data, gensiods *datalen)
 {
     struct certauth_filter *sfilter = filter_to_certauth(filter);
     X509_STORE *store;
-    char *CApath = NULL, *CAfile = NULL;
 
     switch (op) {
     case GENSIO_CONTROL_GET_PEER_CERT_NAME:
@@ -1654,20 +1666,14 @@ certauth_filter_control(struct gensio_filter *filter, bool get, int op,
 	}
 	return 0;
 
-    case GENSIO_CONTROL_CERT_AUTH:
+    case GENSIO_CONTROL_CERT_AUTH: {
+	int rv;
+
 	if (get)
 	    return GE_NOTSUP;
-	store = X509_STORE_new();
-	if (!store)
-	    return GE_NOMEM;
-	if (data[strlen(data) - 1] == '/')
-	    CApath = data;
-	else
-	    CAfile = data;
-	if (!X509_STORE_load_locations(store, CAfile, CApath)) {
-	    X509_STORE_free(store);
-	    return GE_CERTNOTFOUND;
-	}
+	rv = certauth_cache_get_store(data, &store);
+	if (rv)
+	    return rv;
 
 	certauth_lock(sfilter);
 	if (sfilter->verify_store)
@@ -1675,6 +1681,7 @@ certauth_filter_control(struct gensio_filter *filter, bool get, int op,
 	sfilter->verify_store = store;
 	certauth_unlock(sfilter);
 	return 0;
+    }
 
     case GENSIO_CONTROL_CERT_FINGERPRINT:
 	if (!get)
@@ -2177,6 +2184,398 @@ read_private_key(const char *file, EVP_PKEY **rpkey)
     return 0;
 }
 
+/*
+ * A process-wide cache of verify stores, certificate chains, and
+ * private keys loaded from files, so they are not reloaded and
+ * reparsed for every connection.  Entries are keyed by the path and
+ * checked against the file's stat information on each use, if the
+ * file has changed it is loaded again.  A CA directory is checked
+ * against its own stat and the names and stat of everything in it,
+ * a certificate in it can change without the directory changing.
+ * Users get their own reference to the OpenSSL objects, so replacing
+ * an entry doesn't affect filters using the old one.
+ *
+ * The list is kept in most recently used order and is limited to
+ * CERTAUTH_CACHE_MAX entries, the least recently used is dropped.
+ * Files are loaded without holding the lock, so a slow load doesn't
+ * hold up other connections.
+ *
+ * Like the ssl session cache, this is shared by everything in the
+ * process no matter what os funcs it uses, so it uses its own lock
+ * and the plain allocator.
+ */
+#define CERTAUTH_CACHE_MAX 64
+
+enum certauth_cache_type {
+    CERTAUTH_CACHE_STORE,
+    CERTAUTH_CACHE_CHAIN,
+    CERTAUTH_CACHE_KEY
+};
+
+/* What a cache entry is checked against to see if it is current. */
+struct certauth_file_id {
+    dev_t dev;
+    ino_t ino;
+    off_t size;
+    struct timespec mtime;
+    struct timespec ctime;
+
+    /* For a directory, the number of entries and a hash of them. */
+    unsigned int dir_entries;
+    unsigned long long dir_hash;
+};
+
+struct certauth_cache_entry {
+    struct gensio_link link;
+    enum certauth_cache_type type;
+    char *path;
+
+    struct certauth_file_id id;
+
+    X509_STORE *store;
+    X509 *cert;
+    STACK_OF(X509) *sk_ca;
+    EVP_PKEY *pkey;
+};
+
+#ifdef USE_PTHREADS
+static pthread_mutex_t certauth_cache_lock = PTHREAD_MUTEX_INITIALIZER;
+#define CACHE_LOCK() pthread_mutex_lock(&certauth_cache_lock)
+#define CACHE_UNLOCK() pthread_mutex_unlock(&certauth_cache_lock)
+#else
+#define CACHE_LOCK() do { } while (false)
+#define CACHE_UNLOCK() do { } while (false)
+#endif
+static struct gensio_list certauth_cache = GENSIO_LIST_INIT(certauth_cache);
+static unsigned int certauth_cache_count;
+
+static void
+certauth_cache_entry_free(struct certauth_cache_entry *e)
+{
+    if (e->store)
+	X509_STORE_free(e->store);
+    if (e->sk_ca)
+	sk_X509_pop_free(e->sk_ca, X509_free);
+    if (e->cert)
+	X509_free(e->cert);
+    if (e->pkey)
+	EVP_PKEY_free(e->pkey);
+    if (e->path)
+	free(e->path);
+    free(e);
+}
+
+static int
+certauth_load_store(const char *CAfilepath, X509_STORE **rstore)
+{
+    X509_STORE *store;
+    const char *CAfile = NULL, *CApath = NULL;
+
+    store = X509_STORE_new();
+    if (!store)
+	return GE_NOMEM;
+
+    if (CAfilepath[strlen(CAfilepath) - 1] == '/')
+	CApath = CAfilepath;
+    else
+	CAfile = CAfilepath;
+    if (!X509_STORE_load_locations(store, CAfile, CApath)) {
+	X509_STORE_free(store);
+	return GE_CERTNOTFOUND;
+    }
+
+    *rstore = store;
+    return 0;
+}
+
+static int
+certauth_cache_load(struct certauth_cache_entry *e)
+{
+    switch (e->type) {
+    case CERTAUTH_CACHE_STORE:
+	return certauth_load_store(e->path, &e->store);
+
+    case CERTAUTH_CACHE_CHAIN:
+	return read_certificate_chain(e->path, &e->cert, &e->sk_ca);
+
+    case CERTAUTH_CACHE_KEY:
+	return read_private_key(e->path, &e->pkey);
+    }
+    return GE_INVAL;
+}
+
+/* Get references to the objects in e for the caller. */
+static int
+certauth_cache_ref(struct certauth_cache_entry *e, X509_STORE **rstore,
+		   X509 **rcert, STACK_OF(X509) **rca, EVP_PKEY **rpkey)
+{
+    STACK_OF(X509) *sk_ca;
+
+    switch (e->type) {
+    case CERTAUTH_CACHE_STORE:
+	X509_STORE_up_ref(e->store);
+	*rstore = e->store;
+	break;
+
+    case CERTAUTH_CACHE_CHAIN:
+	/* The filter owns its stack, so it needs its own copy. */
+	sk_ca = X509_chain_up_ref(e->sk_ca);
+	if (!sk_ca)
+	    return GE_NOMEM;
+	X509_up_ref(e->cert);
+	*rcert = e->cert;
+	*rca = sk_ca;
+	break;
+
+    case CERTAUTH_CACHE_KEY:
+	EVP_PKEY_up_ref(e->pkey);
+	*rpkey = e->pkey;
+	break;
+    }
+    return 0;
+}
+
+static void
+certauth_stat_to_id(struct stat *st, struct certauth_file_id *id)
+{
+    memset(id, 0, sizeof(*id));
+    id->dev = st->st_dev;
+    id->ino = st->st_ino;
+    id->size = st->st_size;
+#ifdef HAVE_STAT_ST_MTIM
+    id->mtime = st->st_mtim;
+    id->ctime = st->st_ctim;
+#else
+    id->mtime.tv_sec = st->st_mtime;
+    id->ctime.tv_sec = st->st_ctime;
+#endif
+}
+
+/* FNV-1a, to hash the directory entries. */
+static unsigned long long
+certauth_hash(unsigned long long h, const void *data, size_t len)
+{
+    const unsigned char *d = data;
+
+    while (len--) {
+	h ^= *d++;
+	h *= 1099511628211ULL;
+    }
+    return h;
+}
+
+/*
+ * Hash the name and stat information of everything in the directory.
+ * The entry hashes are added, so the order readdir returns them in
+ * doesn't matter.  Symbolic links (like the hash links from c_rehash)
+ * are followed.
+ */
+static int
+certauth_dir_id(const char *path, struct certauth_file_id *id)
+{
+    DIR *d;
+    struct dirent *de;
+    struct stat st;
+    struct certauth_file_id eid;
+    unsigned long long h;
+
+    d = opendir(path);
+    if (!d)
+	return GE_CERTNOTFOUND;
+    while ((de = readdir(d))) {
+	if (strcmp(de->d_name, ".") == 0 || strcmp(de->d_name, "..") == 0)
+	    continue;
+	if (fstatat(dirfd(d), de->d_name, &st, 0) != 0)
+	    memset(&st, 0, sizeof(st));
+	certauth_stat_to_id(&st, &eid);
+	h = certauth_hash(14695981039346656037ULL, de->d_name,
+			  strlen(de->d_name));
+	h = certauth_hash(h, &eid, sizeof(eid));
+	id->dir_hash += h;
+	id->dir_entries++;
+    }
+    closedir(d);
+    return 0;
+}
+
+static int
+certauth_file_id_get(enum certauth_cache_type type, const char *path,
+		     struct certauth_file_id *id)
+{
+    struct stat st;
+
+    if (stat(path, &st) != 0)
+	return GE_CERTNOTFOUND;
+    certauth_stat_to_id(&st, id);
+    if (S_ISDIR(st.st_mode)) {
+	if (type != CERTAUTH_CACHE_STORE)
+	    return GE_CERTNOTFOUND;
+	return certauth_dir_id(path, id);
+    }
+    return 0;
+}
+
+static bool
+certauth_cache_valid(struct certauth_cache_entry *e,
+		     struct certauth_file_id *id)
+{
+    return (e->id.dev == id->dev && e->id.ino == id->ino &&
+	    e->id.size == id->size &&
+	    e->id.mtime.tv_sec == id->mtime.tv_sec &&
+	    e->id.mtime.tv_nsec == id->mtime.tv_nsec &&
+	    e->id.ctime.tv_sec == id->ctime.tv_sec &&
+	    e->id.ctime.tv_nsec == id->ctime.tv_nsec &&
+	    e->id.dir_entries == id->dir_entries &&
+	    e->id.dir_hash == id->dir_hash);
+}
+
+/* Call with the lock held. */
+static struct certauth_cache_entry *
+certauth_cache_find(enum certauth_cache_type type, const char *path)
+{
+    struct gensio_link *l;
+    struct certauth_cache_entry *e;
+
+    gensio_list_for_each(&certauth_cache, l) {
+	e = gensio_container_of(l, struct certauth_cache_entry, link);
+	if (e->type == type && strcmp(e->path, path) == 0)
+	    return e;
+    }
+    return NULL;
+}
+
+/* Call with the lock held. */
+static void
+certauth_cache_rm(struct certauth_cache_entry *e)
+{
+    gensio_list_rm(&certauth_cache, &e->link);
+    certauth_cache_count--;
+    certauth_cache_entry_free(e);
+}
+
+static int
+certauth_cache_get(enum certauth_cache_type type,
+		   const char *path, X509_STORE **rstore,
+		   X509 **rcert, STACK_OF(X509) **rca, EVP_PKEY **rpkey)
+{
+    struct certauth_cache_entry *e, *ne, tmpe;
+    struct certauth_file_id id;
+    int rv;
+
+    /* If the file can't be looked at, let the load report the problem. */
+    if (certauth_file_id_get(type, path, &id))
+	goto load_uncached;
+
+    CACHE_LOCK();
+    e = certauth_cache_find(type, path);
+    if (e && certauth_cache_valid(e, &id)) {
+	rv = certauth_cache_ref(e, rstore, rcert, rca, rpkey);
+	if (!rv) {
+	    gensio_list_rm(&certauth_cache, &e->link);
+	    gensio_list_add_head(&certauth_cache, &e->link);
+	}
+	CACHE_UNLOCK();
+	return rv;
+    }
+    CACHE_UNLOCK();
+
+    ne = calloc(1, sizeof(*ne));
+    if (!ne)
+	return GE_NOMEM;
+    ne->type = type;
+    ne->id = id;
+    ne->path = strdup(path);
+    if (!ne->path) {
+	rv = GE_NOMEM;
+	goto out_free;
+    }
+    rv = certauth_cache_load(ne);
+    if (rv)
+	goto out_free;
+
+    CACHE_LOCK();
+    e = certauth_cache_find(type, path);
+    if (e && certauth_cache_valid(e, &id)) {
+	/* Someone else loaded it while we were, use theirs. */
+	rv = certauth_cache_ref(e, rstore, rcert, rca, rpkey);
+	CACHE_UNLOCK();
+	goto out_free;
+    }
+    rv = certauth_cache_ref(ne, rstore, rcert, rca, rpkey);
+    if (rv) {
+	CACHE_UNLOCK();
+	goto out_free;
+    }
+    if (e)
+	/* The file has changed, drop the old one. */
+	certauth_cache_rm(e);
+    gensio_list_add_head(&certauth_cache, &ne->link);
+    if (++certauth_cache_count > CERTAUTH_CACHE_MAX)
+	certauth_cache_rm(gensio_container_of(
+					gensio_list_last(&certauth_cache),
+					struct certauth_cache_entry, link));
+    CACHE_UNLOCK();
+    return 0;
+
+ out_free:
+    certauth_cache_entry_free(ne);
+    return rv;
+
+ load_uncached:
+    /* The loaded objects are handed straight to the caller. */
+    memset(&tmpe, 0, sizeof(tmpe));
+    tmpe.type = type;
+    tmpe.path = (char *) path;
+    rv = certauth_cache_load(&tmpe);
+    if (rv)
+	return rv;
+    if (rstore)
+	*rstore = tmpe.store;
+    if (rcert) {
+	*rcert = tmpe.cert;
+	*rca = tmpe.sk_ca;
+    }
+    if (rpkey)
+	*rpkey = tmpe.pkey;
+    return 0;
+}
+
+static int
+certauth_cache_get_store(const char *CAfilepath, X509_STORE **rstore)
+{
+    return certauth_cache_get(CERTAUTH_CACHE_STORE, CAfilepath, rstore,
+			      NULL, NULL, NULL);
+}
+
+static int
+certauth_cache_get_chain(const char *file,
+			 X509 **rcert, STACK_OF(X509) **rca)
+{
+    return certauth_cache_get(CERTAUTH_CACHE_CHAIN, file, NULL,
+			      rcert, rca, NULL);
+}
+
+static int
+certauth_cache_get_key(const char *file, EVP_PKEY **rpkey)
+{
+    return certauth_cache_get(CERTAUTH_CACHE_KEY, file, NULL,
+			      NULL, NULL, rpkey);
+}
+
+void
+gensio_certauth_cleanup_mem(struct gensio_os_funcs *o)
+{
+    struct gensio_link *l, *l2;
+    struct certauth_cache_entry *e;
+
+    CACHE_LOCK();
+    gensio_list_for_each_safe(&certauth_cache, l, l2) {
+	e = gensio_container_of(l, struct certauth_cache_entry, link);
+	certauth_cache_rm(e);
+    }
+    CACHE_UNLOCK();
+}
+
 int
 gensio_certauth_filter_alloc(struct gensio_certauth_filter_data *data,
 			     struct gensio_filter **rfilter)
@@ -2189,30 +2588,23 @@ gensio_certauth_filter_alloc(struct gensio_certauth_filter_data *data,
     STACK_OF(X509) *sk_ca = NULL;
     int rv = GE_INVAL;
 
-    store = X509_STORE_new();
-    if (!store) {
-	rv = GE_NOMEM;
-	goto err;
-    }
-
     if (data->CAfilepath) {
-	char *CAfile = NULL, *CApath = NULL;
-
-	if (data->CAfilepath[strlen(data->CAfilepath) - 1] == '/')
-	    CApath = data->CAfilepath;
-	else
-	    CAfile = data->CAfilepath;
-	if (!X509_STORE_load_locations(store, CAfile, CApath)) {
-	    rv = GE_CERTNOTFOUND;
+	rv = certauth_cache_get_store(data->CAfilepath, &store);
+	if (rv)
+	    goto err;
+    } else {
+	store = X509_STORE_new();
+	if (!store) {
+	    rv = GE_NOMEM;
 	    goto err;
 	}
     }
 
     if (data->certfile) {
-	rv = read_certificate_chain(data->certfile, &cert, &sk_ca);
+	rv = certauth_cache_get_chain(data->certfile, &cert, &sk_ca);
 	if (rv)
 	    goto err;
-	rv = read_private_key(data->keyfile, &pkey);
+	rv = certauth_cache_get_key(data->keyfile, &pkey);
 	if (rv)
 	    goto err;
     }
@@ -2266,4 +2658,9 @@ gensio_certauth_filter_alloc(struct gensio_certauth_filter_data *data,
     return GE_NOTSUP;
 }
 
+void
+gensio_certauth_cleanup_mem(struct gensio_os_funcs *o)
+{
+}
+
 #endif /* HAVE_OPENSSL */
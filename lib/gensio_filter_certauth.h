@@ -24,4 +24,7 @@ bool gensio_certauth_filter_config_allow_unencrypted(
 int gensio_certauth_filter_alloc(struct gensio_certauth_filter_data *data,
 				 struct gensio_filter **rfilter);
 
+/* Free the cached stores, certificates, and keys. */
+void gensio_certauth_cleanup_mem(struct gensio_os_funcs *o);
+
 #endif /* GENSIO_FILTER_CERTAUTH_H */
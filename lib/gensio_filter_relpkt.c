@@ -23,6 +23,17 @@ unsigned int curr_drop;
 #endif
 #include "utils.h"
 
+/*
+ * There are two versions of the protocol.  Version 0 has 8-bit
+ * sequence numbers and reports lost packets with resend messages.
+ * Version 1 has 16-bit sequence numbers (shown as two fields below,
+ * msb first), a 16-bit receive window, and reports lost packets with
+ * a bitmap of received packets in its acks (SACK).  Each end sends
+ * the highest version it supports in its init, and both use the
+ * lower of the two.
+ */
+#define RELPKT_VERSION		1
+
 enum relpkt_msgs {
     /*
      * Request a connection be established.
@@ -34,6 +45,12 @@ enum relpkt_msgs {
      * | pktlen msb     |    pktlen lsb  |
      * +----------------+----------------+
      * A - response bit, 1 if a response, 0 if not.
+     *
+     * Version 1 adds the receive window as 16 bits, the 8-bit
+     * value is the window for version 0.  Version 0 ignores these.
+     * +----------------+----------------+
+     * | window msb     |   window lsb   |
+     * +----------------+----------------+
      */
     RELPKT_MSG_INIT = 1,
 
@@ -45,6 +62,9 @@ enum relpkt_msgs {
      * |   2   |reserv|A| next expected  |  msg seq       |
      * +----------------+----------------+----------------+
      * A - eom bit, if 1 end of message, if 0 not.
+     *
+     * In version 1 the sequence numbers are 16 bits, and acks are
+     * sent with RELPKT_MSG_SACK, not with an empty data message.
      */
     RELPKT_MSG_DATA = 2,
 
@@ -52,6 +72,7 @@ enum relpkt_msgs {
      * Request resending data from starting at the first sequence
      * number up to and including the last sequence number.
      * Data after the header is more resend requests in pairs.
+     * Version 0 only.
      * 
      * +----------------+----------------+----------------+
      * |   3   |reserved|first seq resend|last seq resend |
@@ -66,7 +87,21 @@ enum relpkt_msgs {
      * |   4   |reserved|   error msb    |   error lsb    |
      * +----------------+----------------+----------------+
      */
-    RELPKT_MSG_CLOSE = 4
+    RELPKT_MSG_CLOSE = 4,
+
+    /*
+     * An ack with selective acknowledgement, version 1 only.  The
+     * header is followed by a bitmap of packets that have been
+     * received, starting at next expected in the lsb of the first
+     * byte.  Trailing zero bytes are not sent.  The receive window is
+     * limited so the bitmap always fits in a packet, so every packet
+     * missing in the window is reported.
+     *
+     * +----------------+----------------+----------------+
+     * |   5   |reserved|next exp msb    | next exp lsb   |
+     * +----------------+----------------+----------------+
+     */
+    RELPKT_MSG_SACK = 5
 };
 
 enum relpkt_state {
@@ -245,6 +280,26 @@ struct pkt {
 
     bool sent; /* If true, packet does not need to be sent. */
 
+    /*
+     * Transmit only.  The number of times the packet has been sent,
+     * an RTT sample is only taken from packets sent once (Karn's
+     * algorithm).  fast_resend is set if the remote end asked for
+     * the packet again, it goes out even if the congestion window
+     * is full.
+     */
+    unsigned int xmits;
+    bool fast_resend;
+    struct timeval send_time;
+
+    /*
+     * Transmit only, version 1.  sacked is set if the remote end
+     * reported it has the packet, so it need not be sent again.
+     * xmit_order is the order the packet was last sent in, if a
+     * packet sent after it by enough has been sacked, it's lost.
+     */
+    bool sacked;
+    unsigned long xmit_order;
+
     bool ready; /* If true, packet is ready to deliver to the user. */
     bool eom; /* If true, report end of message. */
 
@@ -270,28 +325,75 @@ struct relpkt_filter {
     gensiods max_pktsize;
     unsigned int max_pkt; /* Our set value. */
 
-    uint8_t next_expected_seq; /* Next seq we expect from the remote. */
-    uint8_t next_deliver_seq; /* Next seq we will deliver to the user. */
-    uint8_t deliver_recvpkt; /* Pos in recvpkts of next_deliver_seq. */
+    /*
+     * The negotiated protocol version, and the sequence number mask,
+     * sequence number size and data header size for it.
+     */
+    unsigned int max_version; /* Highest version we will use. */
+    unsigned int version;
+    uint16_t seq_mask;
+    unsigned int seqlen;
+    unsigned int hdrlen;
+
+    uint16_t next_expected_seq; /* Next seq we expect from the remote. */
+    uint16_t next_deliver_seq; /* Next seq we will deliver to the user. */
+    unsigned int deliver_recvpkt; /* Pos in recvpkts of next_deliver_seq. */
+    unsigned int recv_window; /* What we told the remote end. */
     struct pkt *recvpkts;
 
     /*
      * The other end is supposed to send an ack or data at least once
-     * a second, keep track of how long since we've seen one to know
-     * if the other end went belly up.
+     * a second, keep track of when we last saw one to know if the
+     * other end went belly up, and when we last sent something to
+     * know when we need to send a keepalive.
      */
-    unsigned int timeouts_since_ack;
-    bool send_since_timeout;
+    struct timeval last_recv_time;
+    struct timeval last_send_time;
+
+    /* When the currently running timer will go off. */
+    struct timeval timer_expire;
+
+    /*
+     * Retransmit timer, from the round trip time as in RFC 6298.
+     * All times are in microseconds.  If rto_running is set,
+     * unacked data will be resent if no ack moves the window before
+     * rto_deadline.
+     */
+    bool rtt_valid;
+    unsigned long srtt;
+    unsigned long rttvar;
+    unsigned long rto;
+    unsigned long min_rto;
+    bool rto_running;
+    struct timeval rto_deadline;
+
+    /*
+     * AIMD congestion control, all in packets.  Only the first cwnd
+     * packets after next_acked_seq may be sent.  cwnd_count counts
+     * acked packets for the additive increase.  When a loss is
+     * reported, cwnd is not reduced again until the recovery_left
+     * packets that were outstanding then have been acked.
+     */
+    unsigned int cwnd;
+    unsigned int ssthresh;
+    unsigned int cwnd_count;
+    unsigned int recovery_left;
 
     unsigned int max_xmit_pktsize;
     unsigned int max_xmitpkt; /* Set from remote end by init packet. */
-    uint8_t next_acked_seq; /* Seq for next packet that is unacked. */
-    uint8_t next_send_seq; /* Seq for next packet we will send. */
-    uint8_t first_xmitpkt; /* Pos in xmitpkts of where next_ack_seq is. */
+    uint16_t next_acked_seq; /* Seq for next packet that is unacked. */
+    uint16_t next_send_seq; /* Seq for next packet we will send. */
+    unsigned int first_xmitpkt; /* Pos in xmitpkts of where next_ack_seq is. */
     struct pkt *xmitpkts;
     unsigned int nr_waiting_xmitpkt; /* nr in xmitpkt unsent */
+    /*
+     * Counts every data packet send, and the highest count of the
+     * sacked packets, for SACK loss detection.
+     */
+    unsigned long xmit_order;
+    unsigned long max_sacked_order;
 
-    char init_pkt[5];
+    char init_pkt[7];
     bool send_init_pkt;
     unsigned int init_retry_count;
 
@@ -299,22 +401,45 @@ struct relpkt_filter {
     bool send_close_pkt;
     unsigned int close_retry_count;
 
-    char ack_pkt[3];
+    /* Room for a SACK bitmap of the whole receive window. */
+    unsigned char *ack_pkt;
     bool send_ack_pkt;
 
     char resend_pkt[51];
     bool send_resend_pkt;
     uint16_t resend_pkt_len;
 
-    uint8_t last_timeout_ack; /* next_acked_seq on the last timeout. */
-    unsigned int timeout_ack_count; /* nr timeouts last_timeout_ack same. */
+    /* Statistics, see GENSIO_CONTROL_STATS. */
+    unsigned long long retransmits;
+    unsigned long long fast_retransmits;
+    unsigned long long rto_expires;
 };
 
+/* Initial retransmit timeout before we have an RTT sample. */
+#define RELPKT_INITIAL_RTO	1000000
+#define RELPKT_DEFAULT_MIN_RTO	200000
+#define RELPKT_MAX_RTO		4000000
+/* How often to send something if there is nothing else to send. */
+#define RELPKT_KEEPALIVE_TIME	1000000
+/* If nothing is received for this long, the remote end is gone. */
+#define RELPKT_DEAD_TIME	6000000
+#define RELPKT_INITIAL_CWND	4
+
+/*
+ * The largest data header.  The largest window, it must be less
+ * than half the version 1 sequence space.
+ */
+#define RELPKT_MAX_HDR		5
+#define RELPKT_MAX_WINDOW	32767
+/* Packets sacked after a missing one before it is counted as lost. */
+#define RELPKT_SACK_DUPTHRESH	3
+
 #define filter_to_relpkt(v) ((struct relpkt_filter *) \
 			     gensio_filter_get_user_data(v))
 #define link_to_pkt(v) gensio_container_of(v, struct pkt, link);
 
-static void i_relpkt_filter_timeout(struct relpkt_filter *rfilter);
+static void i_relpkt_filter_timeout(struct relpkt_filter *rfilter,
+				    struct timeval *timeout);
 
 static void
 relpkt_lock(struct relpkt_filter *rfilter)
@@ -328,71 +453,194 @@ relpkt_unlock(struct relpkt_filter *rfilter)
     rfilter->o->unlock(rfilter->lock);
 }
 
+/* Returns a - b in the sequence space. */
+static unsigned int
+seq_diff(struct relpkt_filter *rfilter, uint16_t a, uint16_t b)
+{
+    return (uint16_t) (a - b) & rfilter->seq_mask;
+}
+
+static uint16_t
+seq_add(struct relpkt_filter *rfilter, uint16_t seq, unsigned int n)
+{
+    return (seq + n) & rfilter->seq_mask;
+}
+
 /*
  * Returns true if seq >= first and seq < next, taking into account
  * wrapping.  If first == next, this will always return false.
  */
 static bool
-seq_inside(uint8_t seq, uint8_t first, uint8_t next)
+seq_inside(struct relpkt_filter *rfilter, uint16_t seq, uint16_t first,
+	   uint16_t next)
+{
+    return seq_diff(rfilter, seq, first) < seq_diff(rfilter, next, first);
+}
+
+static uint16_t
+get_seq(struct relpkt_filter *rfilter, const unsigned char *buf)
+{
+    if (rfilter->seqlen == 2)
+	return buf[0] << 8 | buf[1];
+    return buf[0];
+}
+
+static void
+put_seq(struct relpkt_filter *rfilter, unsigned char *buf, uint16_t seq)
+{
+    if (rfilter->seqlen == 2) {
+	buf[0] = seq >> 8;
+	buf[1] = seq & 0xff;
+    } else {
+	buf[0] = seq;
+    }
+}
+
+static void
+relpkt_set_version(struct relpkt_filter *rfilter, unsigned int version)
+{
+    rfilter->version = version;
+    if (version >= 1) {
+	rfilter->seq_mask = 0xffff;
+	rfilter->seqlen = 2;
+    } else {
+	rfilter->seq_mask = 0xff;
+	rfilter->seqlen = 1;
+    }
+    rfilter->hdrlen = 1 + 2 * rfilter->seqlen;
+}
+
+/* The receive window we advertise for a version. */
+static unsigned int
+relpkt_recv_window(struct relpkt_filter *rfilter, unsigned int version)
+{
+    unsigned int window = rfilter->max_pkt;
+
+    if (version == 0) {
+	if (window > 255)
+	    window = 255;
+    } else if (window > rfilter->max_pktsize * 8) {
+	/* Keep the SACK bitmap inside one packet. */
+	window = rfilter->max_pktsize * 8;
+    }
+    return window;
+}
+
+static void
+relpkt_now(struct relpkt_filter *rfilter, struct timeval *now)
+{
+    rfilter->o->get_monotonic_time(rfilter->o, now);
+}
+
+/* Returns end - start in microseconds, zero if end is before start. */
+static unsigned long
+tv_usec_diff(struct timeval *end, struct timeval *start)
+{
+    long long diff;
+
+    diff = ((long long) (end->tv_sec - start->tv_sec) * 1000000
+	    + (end->tv_usec - start->tv_usec));
+    if (diff < 0)
+	return 0;
+    return diff;
+}
+
+static void
+usec_to_tv(struct timeval *tv, unsigned long usec)
 {
-    if (first <= next)
-	/* not wrapped */
-	return seq >= first && seq < next;
-    else
-	/* wrapped */
-	return seq >= first || seq < next;
+    tv->tv_sec = usec / 1000000;
+    tv->tv_usec = usec % 1000000;
 }
 
-static uint8_t
-recvpkt_pos(struct relpkt_filter *rfilter, uint8_t pos)
+static void
+tv_add_usec(struct timeval *tv, unsigned long usec)
+{
+    struct timeval add;
+
+    usec_to_tv(&add, usec);
+    add_to_timeval(tv, &add);
+}
+
+static unsigned int
+recvpkt_pos(struct relpkt_filter *rfilter, unsigned int pos)
 {
     return (rfilter->deliver_recvpkt + pos) % rfilter->max_pkt;
 }
 
-static uint8_t
-xmitpkt_pos(struct relpkt_filter *rfilter, uint8_t pos)
+static unsigned int
+xmitpkt_pos(struct relpkt_filter *rfilter, unsigned int pos)
 {
     return (rfilter->first_xmitpkt + pos) % rfilter->max_xmitpkt;
 }
 
-static void
-resend_packets(struct relpkt_filter *rfilter, uint8_t first, uint8_t last)
+/*
+ * Mark the packets from first up to (but not including) last to be
+ * sent again.  Returns the number of packets that had been sent.
+ */
+static unsigned int
+resend_packets(struct relpkt_filter *rfilter, uint16_t first, uint16_t last,
+	       bool fast)
 {
-    uint8_t seq;
-    unsigned int i, pos;
+    uint16_t seq;
+    unsigned int i, pos, count = 0;
+    struct pkt *p;
 
-    for (seq = first, i = first - rfilter->next_acked_seq; seq != last; i++) {
+    i = seq_diff(rfilter, first, rfilter->next_acked_seq);
+    for (seq = first; seq != last; i++, seq = seq_add(rfilter, seq, 1)) {
 	pos = xmitpkt_pos(rfilter, i);
-	if (rfilter->xmitpkts[pos].sent) {
-	    rfilter->xmitpkts[pos].sent = false;
+	p = &(rfilter->xmitpkts[pos]);
+	if (p->sacked)
+	    /* The remote end has it. */
+	    continue;
+	if (p->sent) {
+	    p->sent = false;
 	    rfilter->nr_waiting_xmitpkt++;
+	    count++;
 	}
-	seq++;
+	p->fast_resend = fast;
     }
+    return count;
 }
 
+/*
+ * Find the next packet to send.  A packet is only sent if it is
+ * inside the congestion window or if the remote end asked for it.
+ */
 static struct pkt *
-first_xmitpkt_to_send(struct relpkt_filter *rfilter)
+xmitpkt_to_send(struct relpkt_filter *rfilter)
 {
-    uint8_t seq = rfilter->next_acked_seq;
+    uint16_t seq = rfilter->next_acked_seq;
     unsigned int i, pos;
+    struct pkt *p;
 
-    for (i = 0; seq != rfilter->next_send_seq; i++, seq++) {
+    if (rfilter->nr_waiting_xmitpkt == 0)
+	return NULL;
+    for (i = 0; seq != rfilter->next_send_seq;
+	 i++, seq = seq_add(rfilter, seq, 1)) {
 	pos = xmitpkt_pos(rfilter, i);
-	if (!rfilter->xmitpkts[pos].sent)
-	    return &(rfilter->xmitpkts[pos]);
+	p = &(rfilter->xmitpkts[pos]);
+	if (!p->sent && (i < rfilter->cwnd || p->fast_resend))
+	    return p;
     }
-    assert(0);
+    return NULL;
 }
 
 static void
 send_init(struct relpkt_filter *rfilter, bool response)
 {
+    unsigned int window = relpkt_recv_window(rfilter, 1);
+
+    /*
+     * Before the version is known (not a response) this is the
+     * highest version we do.
+     */
     rfilter->init_pkt[0] = (RELPKT_MSG_INIT << 4) | (uint8_t) response;
-    rfilter->init_pkt[1] = 0; /* version */
-    rfilter->init_pkt[2] = rfilter->max_pkt;
+    rfilter->init_pkt[1] = response ? rfilter->version : rfilter->max_version;
+    rfilter->init_pkt[2] = relpkt_recv_window(rfilter, 0);
     rfilter->init_pkt[3] = rfilter->max_pktsize >> 8;
     rfilter->init_pkt[4] = rfilter->max_pktsize & 0xff;
+    rfilter->init_pkt[5] = window >> 8;
+    rfilter->init_pkt[6] = window & 0xff;
     rfilter->send_init_pkt = true;
 }
 
@@ -408,14 +656,53 @@ send_close(struct relpkt_filter *rfilter)
 static void
 send_ack(struct relpkt_filter *rfilter)
 {
-    rfilter->ack_pkt[0] = RELPKT_MSG_DATA << 4;
-    /* seq will be filled in at send time. */
-    rfilter->ack_pkt[2] = 0;
+    /* The contents are filled in at send time. */
     rfilter->send_ack_pkt = true;
 }
 
+/*
+ * Build an ack, returning its length.  For version 1 this includes
+ * the SACK bitmap.
+ */
+static unsigned int
+relpkt_build_ack(struct relpkt_filter *rfilter)
+{
+    unsigned char *ack = rfilter->ack_pkt;
+    unsigned int i, nrpkts, len = 3;
+
+    if (rfilter->version == 0) {
+	ack[0] = RELPKT_MSG_DATA << 4;
+	ack[1] = rfilter->next_deliver_seq;
+	ack[2] = 0;
+	return 3;
+    }
+
+    ack[0] = RELPKT_MSG_SACK << 4;
+    put_seq(rfilter, ack + 1, rfilter->next_deliver_seq);
+    nrpkts = seq_diff(rfilter, rfilter->next_expected_seq,
+		      rfilter->next_deliver_seq);
+    for (i = 0; i < nrpkts; i++) {
+	if (i % 8 == 0)
+	    ack[3 + i / 8] = 0;
+	if (rfilter->recvpkts[recvpkt_pos(rfilter, i)].ready) {
+	    ack[3 + i / 8] |= 1 << (i % 8);
+	    len = 3 + i / 8 + 1;
+	}
+    }
+    return len;
+}
+
+/* Is there anything received out of order that needs a SACK? */
+static bool
+relpkt_sack_pending(struct relpkt_filter *rfilter)
+{
+    return rfilter->version >= 1 &&
+	seq_diff(rfilter, rfilter->next_expected_seq,
+		 rfilter->next_deliver_seq) > 1;
+}
+
 static void
-request_resend(struct relpkt_filter *rfilter, uint8_t first, uint8_t last)
+request_resend(struct relpkt_filter *rfilter, uint16_t first, uint16_t last)
 {
     if (!rfilter->send_resend_pkt) {
 	rfilter->resend_pkt_len = 1;
@@ -426,51 +713,340 @@ request_resend(struct relpkt_filter *rfilter, uint8_t first, uint8_t last)
 	return; /* No space left, let transmit timeout get it. */
     rfilter->resend_pkt[rfilter->resend_pkt_len++] = first;
     rfilter->resend_pkt[rfilter->resend_pkt_len++] = last;
-    rfilter->timeout_ack_count = 0;
+}
+
+static void
+relpkt_restart_timer(struct relpkt_filter *rfilter, struct timeval *now,
+		     unsigned long usec)
+{
+    struct timeval timeout;
+
+    usec_to_tv(&timeout, usec);
+    rfilter->timer_expire = *now;
+    add_to_timeval(&rfilter->timer_expire, &timeout);
+    rfilter->filter_cb(rfilter->filter_cb_data,
+		       GENSIO_FILTER_CB_RESTART_TIMER, &timeout);
+}
+
+/*
+ * Start the retransmit timer if it is not running, it is started when
+ * the first unacked packet is sent.  If the timer is set to go off
+ * after the retransmit time, move it up.
+ */
+static void
+relpkt_start_rto(struct relpkt_filter *rfilter, struct timeval *now)
+{
+    if (rfilter->rto_running)
+	return;
+    rfilter->rto_running = true;
+    rfilter->rto_deadline = *now;
+    tv_add_usec(&rfilter->rto_deadline, rfilter->rto);
+    if (cmp_timeval(&rfilter->rto_deadline, &rfilter->timer_expire) < 0)
+	relpkt_restart_timer(rfilter, now, rfilter->rto);
+}
+
+/* Take a round trip time sample and calculate a new RTO, per RFC 6298. */
+static void
+relpkt_rtt_sample(struct relpkt_filter *rfilter, unsigned long rtt)
+{
+    unsigned long diff;
+
+    if (!rfilter->rtt_valid) {
+	rfilter->srtt = rtt;
+	rfilter->rttvar = rtt / 2;
+	rfilter->rtt_valid = true;
+    } else {
+	if (rtt > rfilter->srtt)
+	    diff = rtt - rfilter->srtt;
+	else
+	    diff = rfilter->srtt - rtt;
+	rfilter->rttvar = (3 * rfilter->rttvar + diff) / 4;
+	rfilter->srtt = (7 * rfilter->srtt + rtt) / 8;
+    }
+    /* 1ms is the clock granularity (G in the RFC) we assume. */
+    rfilter->rto = rfilter->srtt + (rfilter->rttvar * 4 > 1000 ?
+				    rfilter->rttvar * 4 : 1000);
+    if (rfilter->rto < rfilter->min_rto)
+	rfilter->rto = rfilter->min_rto;
+    if (rfilter->rto > RELPKT_MAX_RTO)
+	rfilter->rto = RELPKT_MAX_RTO;
+}
+
+static unsigned int
+relpkt_nr_in_flight(struct relpkt_filter *rfilter)
+{
+    unsigned int nrqueued = seq_diff(rfilter, rfilter->next_send_seq,
+				     rfilter->next_acked_seq);
+
+    return nrqueued - rfilter->nr_waiting_xmitpkt;
+}
+
+/*
+ * A packet was lost, cut the congestion window in half.  This is only
+ * done once for all the packets that were outstanding when the loss
+ * was reported.
+ */
+static void
+relpkt_congestion(struct relpkt_filter *rfilter)
+{
+    if (rfilter->recovery_left)
+	return;
+    rfilter->ssthresh = relpkt_nr_in_flight(rfilter) / 2;
+    if (rfilter->ssthresh < 2)
+	rfilter->ssthresh = 2;
+    rfilter->cwnd = rfilter->ssthresh;
+    rfilter->cwnd_count = 0;
+    rfilter->recovery_left = seq_diff(rfilter, rfilter->next_send_seq,
+				      rfilter->next_acked_seq);
+}
+
+/* Open the congestion window for a newly acked packet. */
+static void
+relpkt_cwnd_acked(struct relpkt_filter *rfilter)
+{
+    if (rfilter->recovery_left) {
+	rfilter->recovery_left--;
+	return;
+    }
+    if (rfilter->cwnd >= rfilter->max_xmitpkt)
+	return;
+    if (rfilter->cwnd < rfilter->ssthresh) {
+	/* Slow start */
+	rfilter->cwnd++;
+    } else if (++rfilter->cwnd_count >= rfilter->cwnd) {
+	/* Congestion avoidance, one more packet per round trip. */
+	rfilter->cwnd++;
+	rfilter->cwnd_count = 0;
+    }
 }
 
 /* Returns true on a protocol error. */
 static bool
-handle_ack(struct relpkt_filter *rfilter, uint8_t seq)
+handle_ack(struct relpkt_filter *rfilter, uint16_t seq)
 {
+    unsigned int nracked = seq_diff(rfilter, seq, rfilter->next_acked_seq);
+    unsigned int nrqueued = seq_diff(rfilter, rfilter->next_send_seq,
+				     rfilter->next_acked_seq);
+    struct timeval now;
     unsigned int pos;
+    struct pkt *p = NULL;
+    bool timeit = true;
 
     /*
      * The last received message on the other end is in seq, but we
-     * keep the next thing that should be acked, thus the +1.
+     * keep the next thing that should be acked.  An ack from before
+     * next_acked_seq is old, it may have been passed by a newer one,
+     * so ignore it.
      */
-    if (!seq_inside(seq, rfilter->next_acked_seq,
-		    rfilter->next_send_seq + 1))
+    if (nracked > nrqueued) {
+	if (seq_diff(rfilter, rfilter->next_acked_seq, seq) <=
+		rfilter->max_xmitpkt)
+	    return false;
 	return true;
+    }
+    if (nracked == 0)
+	return false;
+
+    relpkt_now(rfilter, &now);
     while (rfilter->next_acked_seq != seq) {
 	pos = rfilter->first_xmitpkt;
-	if (!rfilter->xmitpkts[pos].sent) {
+	p = &(rfilter->xmitpkts[pos]);
+	if (!p->sent) {
 	    /*
 	     * Packets wasn't sent yet, but we got an ack.  Could
 	     * happen on a retransmit or some other error.  Just act
 	     * like it was transmitted.
 	     */
-	    rfilter->xmitpkts[pos].sent = true;
+	    p->sent = true;
 	    assert(rfilter->nr_waiting_xmitpkt > 0);
 	    rfilter->nr_waiting_xmitpkt--;
 	}
+	/*
+	 * If anything in the range was resent, or already timed by a
+	 * SACK, the ack may have waited for something else.
+	 */
+	if (p->xmits != 1 || p->sacked)
+	    timeit = false;
+	if (p->xmit_order > rfilter->max_sacked_order)
+	    rfilter->max_sacked_order = p->xmit_order;
+	p->fast_resend = false;
+	p->sacked = false;
 	rfilter->first_xmitpkt = xmitpkt_pos(rfilter, 1);
-	rfilter->next_acked_seq++;
+	rfilter->next_acked_seq = seq_add(rfilter, rfilter->next_acked_seq, 1);
+	relpkt_cwnd_acked(rfilter);
     }
-    rfilter->timeouts_since_ack = 0;
+
+    /* Only time packets that were not resent, we can't tell which one
+       the ack was for. */
+    if (timeit)
+	relpkt_rtt_sample(rfilter, tv_usec_diff(&now, &p->send_time));
+
+    /* The window moved, restart the retransmit timer. */
+    rfilter->rto_running = false;
+    if (rfilter->next_acked_seq != rfilter->next_send_seq &&
+		relpkt_nr_in_flight(rfilter) > 0)
+	relpkt_start_rto(rfilter, &now);
 
     return false;
 }
 
+/*
+ * Handle the bitmap from a SACK.  The bitmap starts at ack, which has
+ * already been handled by handle_ack().  Packets the remote end has
+ * need not be sent again.  A packet that is missing when enough
+ * packets after it have arrived is taken as lost and resent now.
+ */
+static void
+handle_sack(struct relpkt_filter *rfilter, uint16_t ack,
+	    const unsigned char *bitmap, gensiods len)
+{
+    unsigned int nrqueued = seq_diff(rfilter, rfilter->next_send_seq,
+				     rfilter->next_acked_seq);
+    unsigned int i, lost = 0;
+    unsigned long later;
+    struct pkt *p, *timep = NULL;
+    struct timeval now;
+
+    if (ack != rfilter->next_acked_seq)
+	/* An old ack, the bitmap is stale. */
+	return;
+
+    for (i = 0; i < len * 8 && i < nrqueued; i++) {
+	if (!(bitmap[i / 8] & (1 << (i % 8))))
+	    continue;
+	p = &(rfilter->xmitpkts[xmitpkt_pos(rfilter, i)]);
+	if (!p->sacked) {
+	    p->sacked = true;
+	    if (p->xmits == 1)
+		timep = p;
+	    if (p->xmit_order > rfilter->max_sacked_order)
+		rfilter->max_sacked_order = p->xmit_order;
+	    if (!p->sent) {
+		/* Waiting to be resent, no need now. */
+		p->sent = true;
+		assert(rfilter->nr_waiting_xmitpkt > 0);
+		rfilter->nr_waiting_xmitpkt--;
+	    }
+	}
+    }
+
+    if (timep) {
+	/* The remote end sends a SACK as soon as a packet arrives. */
+	relpkt_now(rfilter, &now);
+	relpkt_rtt_sample(rfilter, tv_usec_diff(&now, &timep->send_time));
+    }
+
+    /*
+     * A packet is lost if packets sent enough after it have been
+     * sacked or acked.  This goes by send order, not sequence number, so a
+     * resent packet that is lost again is found the same way.  If
+     * only a few packets were sent after it, there may never be
+     * enough sacked to reach the threshold, so lower it (like TCP's
+     * early retransmit).
+     */
+    for (i = 0; i < nrqueued; i++) {
+	p = &(rfilter->xmitpkts[xmitpkt_pos(rfilter, i)]);
+	if (p->sacked || !p->sent)
+	    continue;
+	later = rfilter->xmit_order - p->xmit_order;
+	if (later > RELPKT_SACK_DUPTHRESH)
+	    later = RELPKT_SACK_DUPTHRESH;
+	if (later && rfilter->max_sacked_order >= p->xmit_order + later) {
+	    p->sent = false;
+	    p->fast_resend = true;
+	    rfilter->nr_waiting_xmitpkt++;
+	    lost++;
+	}
+    }
+
+    if (lost)
+	relpkt_congestion(rfilter);
+}
+
+static void
+relpkt_next_timeout(struct relpkt_filter *rfilter, struct timeval *now,
+		    struct timeval *timeout)
+{
+    unsigned long usec = RELPKT_KEEPALIVE_TIME, rto_left;
+
+    if (rfilter->rto_running) {
+	rto_left = tv_usec_diff(&rfilter->rto_deadline, now);
+	if (rto_left < usec)
+	    usec = rto_left;
+    }
+    usec_to_tv(timeout, usec);
+    rfilter->timer_expire = *now;
+    add_to_timeval(&rfilter->timer_expire, timeout);
+}
+
 static void
 relpkt_filter_start_timer(struct relpkt_filter *rfilter)
 {
-    struct timeval timeout = { 1, 0 };
+    struct timeval now, timeout;
 
+    relpkt_now(rfilter, &now);
+    relpkt_next_timeout(rfilter, &now, &timeout);
     rfilter->filter_cb(rfilter->filter_cb_data,
 		       GENSIO_FILTER_CB_START_TIMER, &timeout);
 }
 
+/*
+ * Take the version, window and packet size from an init from the
+ * remote end.  Returns true if it is invalid.
+ */
+static bool
+relpkt_handle_init(struct relpkt_filter *rfilter, const unsigned char *buf,
+		   gensiods buflen)
+{
+    unsigned int version = buf[1], window;
+
+    if (version > rfilter->max_version)
+	version = rfilter->max_version;
+    if (version >= 1) {
+	if (buflen < 7)
+	    return true;
+	window = buf[5] << 8 | buf[6];
+    } else {
+	window = buf[2];
+    }
+    if (window == 0)
+	return true;
+    relpkt_set_version(rfilter, version);
+    rfilter->recv_window = relpkt_recv_window(rfilter, version);
+    rfilter->max_xmitpkt = window;
+    if (rfilter->max_xmitpkt > rfilter->max_pkt)
+	rfilter->max_xmitpkt = rfilter->max_pkt;
+    rfilter->max_xmit_pktsize = buf[3] << 8 | buf[4];
+    if (rfilter->max_xmit_pktsize > rfilter->max_pktsize)
+	rfilter->max_xmit_pktsize = rfilter->max_pktsize;
+    return false;
+}
+
+static void
+relpkt_clear_sacks(struct relpkt_filter *rfilter)
+{
+    unsigned int i, nrqueued = seq_diff(rfilter, rfilter->next_send_seq,
+					rfilter->next_acked_seq);
+    struct pkt *p;
+
+    for (i = 0; i < nrqueued; i++) {
+	p = &(rfilter->xmitpkts[xmitpkt_pos(rfilter, i)]);
+	p->sacked = false;
+    }
+}
+
+static void
+relpkt_set_open(struct relpkt_filter *rfilter)
+{
+    rfilter->state = RELPKT_OPEN;
+    rfilter->last_send_time = rfilter->last_recv_time;
+    rfilter->cwnd = RELPKT_INITIAL_CWND;
+    if (rfilter->cwnd > rfilter->max_xmitpkt)
+	rfilter->cwnd = rfilter->max_xmitpkt;
+    rfilter->ssthresh = rfilter->max_xmitpkt;
+    relpkt_filter_start_timer(rfilter);
+}
+
 static void
 relpkt_set_callbacks(struct relpkt_filter *rfilter,
 		     gensio_filter_cb cb, void *cb_data)
@@ -490,7 +1066,7 @@ relpkt_ul_read_pending(struct relpkt_filter *rfilter)
 static bool
 relpkt_ll_write_pending(struct relpkt_filter *rfilter)
 {
-    return rfilter->nr_waiting_xmitpkt || rfilter->send_init_pkt ||
+    return xmitpkt_to_send(rfilter) || rfilter->send_init_pkt ||
 	rfilter->send_close_pkt || rfilter->send_resend_pkt ||
 	rfilter->send_ack_pkt;
 }
@@ -609,9 +1185,7 @@ relpkt_try_disconnect(struct relpkt_filter *rfilter, struct timeval *timeout,
 	if (rfilter->err) {
 	    rv = rfilter->err;
 	} else if (was_timeout) {
-	    i_relpkt_filter_timeout(rfilter);
-	    timeout->tv_sec = 1;
-	    timeout->tv_usec = 0;
+	    i_relpkt_filter_timeout(rfilter, timeout);
 	    rv = GE_RETRY;
 	} else {
 	    rv = GE_INPROGRESS;
@@ -657,7 +1231,8 @@ relpkt_ul_write(struct relpkt_filter *rfilter,
     bool finish_close = false;
 
     relpkt_lock(rfilter);
-    nrqueued = rfilter->next_send_seq - rfilter->next_acked_seq;
+    nrqueued = seq_diff(rfilter, rfilter->next_send_seq,
+			rfilter->next_acked_seq);
     if (sglen == 0 || nrqueued >= rfilter->max_xmitpkt) {
 	if (rcount)
 	    *rcount = 0;
@@ -677,7 +1252,7 @@ relpkt_ul_write(struct relpkt_filter *rfilter,
 		inlen = rfilter->max_xmit_pktsize - p->len;
 		trunc = true;
 	    }
-	    memcpy(p->data + p->len + 3, buf, inlen);
+	    memcpy(p->data + p->len + rfilter->hdrlen, buf, inlen);
 	    writelen += inlen;
 	    p->len += inlen;
 	    if (p->len == rfilter->max_xmit_pktsize)
@@ -690,33 +1265,37 @@ relpkt_ul_write(struct relpkt_filter *rfilter,
 	    if (!trunc && gensio_str_in_auxdata(auxdata, "eom"))
 		p->eom = true;
 	    p->data[0] = (RELPKT_MSG_DATA << 4) | (uint8_t) p->eom;
-	    /* Ack (byte 1) will be filled in on transmit. */
-	    p->data[2] = rfilter->next_send_seq;
-	    rfilter->next_send_seq++;
+	    /* Ack (after byte 0) will be filled in on transmit. */
+	    put_seq(rfilter, p->data + 1 + rfilter->seqlen,
+		    rfilter->next_send_seq);
+	    rfilter->next_send_seq = seq_add(rfilter, rfilter->next_send_seq, 1);
 	    p->sent = false;
-	    p->len += 3; /* For the header. */
+	    p->xmits = 0;
+	    p->fast_resend = false;
+	    p->sacked = false;
+	    p->len += rfilter->hdrlen; /* For the header. */
 	    rfilter->nr_waiting_xmitpkt++;
 	}
     }
 
     if (rfilter->send_init_pkt) {
 	rsg.buf = rfilter->init_pkt;
-	rsg.buflen = 5;
+	rsg.buflen = sizeof(rfilter->init_pkt);
 	endbool = &rfilter->send_init_pkt;
-    } else if (rfilter->nr_waiting_xmitpkt) {
-	p = first_xmitpkt_to_send(rfilter);
+    } else if ((p = xmitpkt_to_send(rfilter))) {
 	rsg.buf = p->data;
 	rsg.buflen = p->len;
-	p->data[1] = rfilter->next_deliver_seq; /* Add the ack */
-	rfilter->send_ack_pkt = false;
+	put_seq(rfilter, p->data + 1, rfilter->next_deliver_seq); /* The ack */
+	/* A data packet carries no SACK, still send that if needed. */
+	if (!relpkt_sack_pending(rfilter))
+	    rfilter->send_ack_pkt = false;
     } else if (rfilter->send_resend_pkt) {
 	rsg.buf = rfilter->resend_pkt;
 	rsg.buflen = rfilter->resend_pkt_len;
 	endbool = &rfilter->send_resend_pkt;
     } else if (rfilter->send_ack_pkt) {
-	rfilter->ack_pkt[1] = rfilter->next_deliver_seq;
 	rsg.buf = rfilter->ack_pkt;
-	rsg.buflen = 3;
+	rsg.buflen = relpkt_build_ack(rfilter);
 	endbool = &rfilter->send_ack_pkt;
     } else if (rfilter->send_close_pkt) {
 	rsg.buf = rfilter->close_pkt;
@@ -753,11 +1332,24 @@ relpkt_ul_write(struct relpkt_filter *rfilter,
 		 */
 		err = GE_TOOBIG;
 	    } else if (count != 0) {
+		struct timeval now;
+
+		relpkt_now(rfilter, &now);
+		rfilter->last_send_time = now;
 		if (p) {
 		    p->sent = true;
 		    assert(rfilter->nr_waiting_xmitpkt);
 		    rfilter->nr_waiting_xmitpkt--;
-		    rfilter->send_since_timeout = true;
+		    if (p->xmits > 0) {
+			rfilter->retransmits++;
+			if (p->fast_resend)
+			    rfilter->fast_retransmits++;
+		    }
+		    p->xmits++;
+		    p->xmit_order = ++rfilter->xmit_order;
+		    p->fast_resend = false;
+		    p->send_time = now;
+		    relpkt_start_rto(rfilter, &now);
 		} else {
 		    *endbool = false;
 		    if (finish_close) {
@@ -783,8 +1375,8 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
     int err = 0;
     static const char *eomaux[2] = { "eom", NULL };
     bool response;
-    uint8_t seq, endseq, pos, ppos;
-    unsigned int i;
+    uint16_t seq, endseq;
+    unsigned int i, pos, ppos;
     struct pkt *p;
 
 #ifdef DEBUG_MSG
@@ -808,6 +1400,7 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 	goto protocol_err;
 
     *rcount = buflen;
+    relpkt_now(rfilter, &rfilter->last_recv_time);
 
     switch (buf[0] >> 4) {
     case RELPKT_MSG_INIT:
@@ -823,39 +1416,29 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 
 	case RELPKT_WAITING_INIT:
 	    if (!response) {
-		rfilter->max_xmitpkt = buf[2];
-		if (rfilter->max_xmitpkt == 0)
+		if (relpkt_handle_init(rfilter, buf, buflen))
 		    goto protocol_err;
-		if (rfilter->max_xmitpkt > rfilter->max_pkt)
-		    rfilter->max_xmitpkt = rfilter->max_pkt;
-		rfilter->max_xmit_pktsize = buf[3] << 8 | buf[4];
-		if (rfilter->max_xmit_pktsize > rfilter->max_pktsize)
-		    rfilter->max_xmit_pktsize = rfilter->max_pktsize;
 		send_init(rfilter, true);
-		rfilter->state = RELPKT_OPEN;
-		relpkt_filter_start_timer(rfilter);
+		relpkt_set_open(rfilter);
 	    }
 	    break;
 
 	case RELPKT_WAITING_INIT_RSP:
 	    if (response) {
-		rfilter->max_xmitpkt = buf[2];
-		if (rfilter->max_xmitpkt > rfilter->max_pkt)
-		    rfilter->max_xmitpkt = rfilter->max_pkt;
-		rfilter->max_xmit_pktsize = buf[3] << 8 | buf[4];
-		if (rfilter->max_xmit_pktsize > rfilter->max_pktsize)
-		    rfilter->max_xmit_pktsize = rfilter->max_pktsize;
-		rfilter->state = RELPKT_OPEN;
-		relpkt_filter_start_timer(rfilter);
+		if (relpkt_handle_init(rfilter, buf, buflen))
+		    goto protocol_err;
+		relpkt_set_open(rfilter);
 	    }
 	    break;
 
 	case RELPKT_OPEN:
 	case RELPKT_WAITING_CLOSE_CLEAR:
 	    if (!response) {
+		/* The remote end restarted, it has none of our data. */
 		send_init(rfilter, true);
+		relpkt_clear_sacks(rfilter);
 		resend_packets(rfilter, rfilter->next_acked_seq,
-			       rfilter->next_send_seq);
+			       rfilter->next_send_seq, false);
 	    }
 	    break;
 
@@ -875,9 +1458,11 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 
 	case RELPKT_OPEN:
 	case RELPKT_WAITING_CLOSE_CLEAR:
-	    if (buflen > rfilter->max_pktsize + 3)
+	    if (buflen > rfilter->max_pktsize + rfilter->hdrlen)
+		goto protocol_err;
+	    if (buflen < rfilter->hdrlen)
 		goto protocol_err;
-	    if (handle_ack(rfilter, buf[1]))
+	    if (handle_ack(rfilter, get_seq(rfilter, buf + 1)))
 		goto protocol_err;
 	    if (rfilter->state != RELPKT_OPEN) {
 		/* Only deliver data in open state */
@@ -889,24 +1474,37 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 		}
 		break;
 	    }
-	    if (buflen == 3) /* Just an ack */
+	    if (buflen == rfilter->hdrlen) /* Just an ack */
 		break;
-	    seq = buf[2];
-	    pos = seq - rfilter->next_deliver_seq;
-	    if (seq - rfilter->next_deliver_seq > rfilter->max_pkt)
-		break; /* Ignore it */
+	    seq = get_seq(rfilter, buf + 1 + rfilter->seqlen);
+	    pos = seq_diff(rfilter, seq, rfilter->next_deliver_seq);
+	    if (pos >= rfilter->recv_window) {
+		/*
+		 * Already delivered, probably resent because our ack
+		 * was lost, or outside the window.  Ignore it, but let
+		 * the sender know where we are.
+		 */
+		send_ack(rfilter);
+		break;
+	    }
 	    ppos = recvpkt_pos(rfilter, pos);
-	    if (seq == rfilter->next_expected_seq) {
-		rfilter->next_expected_seq++;
-	    } else if (!seq_inside(seq, rfilter->next_deliver_seq,
-				  rfilter->next_expected_seq)) {
-		request_resend(rfilter, rfilter->next_expected_seq, seq - 1);
-		rfilter->next_expected_seq = seq + 1;
+	    if (!seq_inside(rfilter, seq, rfilter->next_deliver_seq,
+			    rfilter->next_expected_seq)) {
+		/*
+		 * Past anything we have seen, ask for anything
+		 * skipped.  Version 1 reports it in the SACK.
+		 */
+		if (seq != rfilter->next_expected_seq &&
+			rfilter->version == 0)
+		    request_resend(rfilter, rfilter->next_expected_seq,
+				   (seq - 1) & rfilter->seq_mask);
+		rfilter->next_expected_seq = seq_add(rfilter, seq, 1);
 	    }
 	    p = &(rfilter->recvpkts[ppos]);
 	    if (!p->ready) {
-		memcpy(p->data, buf + 3, buflen - 3);
-		p->len = buflen - 3;
+		memcpy(p->data, buf + rfilter->hdrlen,
+		       buflen - rfilter->hdrlen);
+		p->len = buflen - rfilter->hdrlen;
 		p->start = 0;
 		p->ready = true;
 		p->eom = buf[0] & 1;
@@ -930,20 +1528,29 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 	case RELPKT_OPEN:
 	case RELPKT_WAITING_CLOSE_CLEAR:
 	case RELPKT_WAITING_CLOSE_RSP:
+	    if (rfilter->version != 0)
+		goto protocol_err;
 	    buf++;
 	    buflen--;
 	    if (buflen % 2 != 0) /* Should be pairs of sequence numbers. */
 		goto protocol_err;
 	    for (i = 0; i < buflen; i += 2) {
 		seq = buf[i];
-		endseq = buf[i + 1];
-		if (!seq_inside(seq, rfilter->next_acked_seq,
-				rfilter->next_send_seq))
-		    goto protocol_err;
-		if (!seq_inside(endseq, rfilter->next_acked_seq,
+		endseq = seq_add(rfilter, buf[i + 1], 1);
+		if (!seq_inside(rfilter, buf[i + 1], rfilter->next_acked_seq,
 				rfilter->next_send_seq))
-		    goto protocol_err;
-		resend_packets(rfilter, seq, endseq + 1);
+		    /* Already acked, the request is old. */
+		    continue;
+		if (!seq_inside(rfilter, seq, rfilter->next_acked_seq, endseq))
+		    /* Part of it has been acked. */
+		    seq = rfilter->next_acked_seq;
+		/*
+		 * The remote end saw a later packet, so these were
+		 * lost.  Send them now (fast retransmit) instead of
+		 * waiting for the retransmit timer.
+		 */
+		if (resend_packets(rfilter, seq, endseq, true))
+		    relpkt_congestion(rfilter);
 	    }
 	    break;
 
@@ -978,6 +1585,36 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 	}
 	break;
 
+    case RELPKT_MSG_SACK:
+	switch (rfilter->state) {
+	case RELPKT_CLOSED:
+	case RELPKT_WAITING_INIT:
+	case RELPKT_WAITING_INIT_RSP:
+	case RELPKT_WAITING_CLOSE_RSP:
+	case RELPKT_REMCLOSED:
+	    break;
+
+	case RELPKT_OPEN:
+	case RELPKT_WAITING_CLOSE_CLEAR:
+	    if (rfilter->version == 0)
+		goto protocol_err;
+	    seq = get_seq(rfilter, buf + 1);
+	    if (handle_ack(rfilter, seq))
+		goto protocol_err;
+	    handle_sack(rfilter, seq, buf + 3, buflen - 3);
+	    if (rfilter->state == RELPKT_WAITING_CLOSE_CLEAR &&
+			rfilter->next_acked_seq == rfilter->next_send_seq) {
+		/* No more data, we can close. */
+		rfilter->state = RELPKT_WAITING_CLOSE_RSP;
+		send_close(rfilter);
+	    }
+	    break;
+
+	default:
+	    assert(0);
+	}
+	break;
+
     default:
 	goto protocol_err;
     }
@@ -995,7 +1632,10 @@ relpkt_ll_write(struct relpkt_filter *rfilter,
 	    if (count >= p->len - p->start) {
 		p->ready = false;
 		rfilter->deliver_recvpkt = recvpkt_pos(rfilter, 1);
-		rfilter->next_deliver_seq++;
+		rfilter->next_deliver_seq = seq_add(rfilter,
+						    rfilter->next_deliver_seq, 1);
+		/* Tell the sender there is more room. */
+		send_ack(rfilter);
 	    } else {
 		p->start += count;
 	    }
@@ -1026,17 +1666,23 @@ relpkt_filter_cleanup(struct relpkt_filter *rfilter)
     rfilter->next_expected_seq = 0;
     rfilter->next_deliver_seq = 0;
     rfilter->deliver_recvpkt = 0;
-    rfilter->timeouts_since_ack = 0;
     rfilter->next_acked_seq = 0;
     rfilter->next_send_seq = 0;
     rfilter->first_xmitpkt = 0;
     rfilter->nr_waiting_xmitpkt = 0;
+    rfilter->xmit_order = 0;
+    rfilter->max_sacked_order = 0;
     rfilter->send_init_pkt = false;
     rfilter->init_retry_count = 0;
     rfilter->send_close_pkt = false;
     rfilter->close_retry_count = 0;
     rfilter->send_resend_pkt = false;
     rfilter->send_ack_pkt = false;
+    rfilter->rtt_valid = false;
+    rfilter->rto = RELPKT_INITIAL_RTO;
+    rfilter->rto_running = false;
+    rfilter->cwnd_count = 0;
+    rfilter->recovery_left = 0;
     for (i = 0; i < rfilter->max_pkt; i++) {
 	struct pkt *p = &rfilter->recvpkts[i];
 
@@ -1052,6 +1698,8 @@ relpkt_free(struct relpkt_filter *rfilter)
 
     if (rfilter->lock)
 	o->free_lock(rfilter->lock);
+    if (rfilter->ack_pkt)
+	o->free(o, rfilter->ack_pkt);
     if (rfilter->recvpkts) {
 	for (i = 0; i < rfilter->max_pkt; i++) {
 	    if (rfilter->recvpkts[i].data)
@@ -1072,50 +1720,100 @@ relpkt_free(struct relpkt_filter *rfilter)
     rfilter->o->free(rfilter->o, rfilter);
 }
 
+/*
+ * Handle a timer expiry and return the time until the next one in
+ * timeout.
+ */
 static void
-i_relpkt_filter_timeout(struct relpkt_filter *rfilter)
+i_relpkt_filter_timeout(struct relpkt_filter *rfilter,
+			struct timeval *timeout)
 {
-    rfilter->timeouts_since_ack++;
-    if (rfilter->timeouts_since_ack > 5) {
+    struct timeval now;
+
+    relpkt_now(rfilter, &now);
+
+    if (tv_usec_diff(&now, &rfilter->last_recv_time) >= RELPKT_DEAD_TIME) {
 	rfilter->err = GE_TIMEDOUT;
 	goto out;
     }
 
-    if (rfilter->send_since_timeout)
-	rfilter->send_since_timeout = false;
-    else
+    if (tv_usec_diff(&now, &rfilter->last_send_time) >= RELPKT_KEEPALIVE_TIME)
 	send_ack(rfilter);
 
-    if (rfilter->next_acked_seq != rfilter->next_send_seq) {
-	if (rfilter->next_acked_seq == rfilter->last_timeout_ack) {
-	    rfilter->timeout_ack_count++;
-	    if (rfilter->timeout_ack_count > 1) {
-		/* 
-		 * We haven't received an ack for something we sent.
-		 * The packet must have been dropped.  Resend.
-		 */
-		resend_packets(rfilter, rfilter->next_acked_seq,
-			       rfilter->next_send_seq);
-		rfilter->timeout_ack_count = 0;
-	    }
-	} else {
-	    rfilter->timeout_ack_count = 0;
-	    rfilter->last_timeout_ack = rfilter->next_acked_seq;
+    if (rfilter->rto_running &&
+		cmp_timeval(&now, &rfilter->rto_deadline) >= 0) {
+	/*
+	 * We haven't received an ack for something we sent in the
+	 * retransmit time.  Assume everything outstanding was lost,
+	 * shrink the window to one packet and send it all again.
+	 * Back off the timer in case the problem is a long delay.
+	 */
+	rfilter->rto_running = false;
+	if (rfilter->next_acked_seq != rfilter->next_send_seq) {
+	    rfilter->rto_expires++;
+	    rfilter->ssthresh = relpkt_nr_in_flight(rfilter) / 2;
+	    if (rfilter->ssthresh < 2)
+		rfilter->ssthresh = 2;
+	    rfilter->cwnd = 1;
+	    rfilter->cwnd_count = 0;
+	    rfilter->recovery_left = 0;
+	    rfilter->rto *= 2;
+	    if (rfilter->rto > RELPKT_MAX_RTO)
+		rfilter->rto = RELPKT_MAX_RTO;
+	    resend_packets(rfilter, rfilter->next_acked_seq,
+			   rfilter->next_send_seq, false);
 	}
-	
     }
  out:
-    relpkt_filter_start_timer(rfilter);
+    relpkt_next_timeout(rfilter, &now, timeout);
 }
 
 static void
 relpkt_filter_timeout(struct relpkt_filter *rfilter)
 {
+    struct timeval timeout;
+
     relpkt_lock(rfilter);
-    i_relpkt_filter_timeout(rfilter);
+    i_relpkt_filter_timeout(rfilter, &timeout);
+    if (!rfilter->err)
+	rfilter->filter_cb(rfilter->filter_cb_data,
+			   GENSIO_FILTER_CB_START_TIMER, &timeout);
     relpkt_unlock(rfilter);
 }
 
+static int
+relpkt_filter_control(struct relpkt_filter *rfilter, bool get, int op,
+		      char *data, gensiods *datalen)
+{
+    gensiods pos = 0;
+
+    switch (op) {
+    case GENSIO_CONTROL_STATS:
+	/* Appended to the generic statistics. */
+	relpkt_lock(rfilter);
+	if (!get) {
+	    rfilter->retransmits = 0;
+	    rfilter->fast_retransmits = 0;
+	    rfilter->rto_expires = 0;
+	    relpkt_unlock(rfilter);
+	    return 0;
+	}
+	gensio_pos_snprintf(data, *datalen, &pos,
+			    " retransmits=%llu fast_retransmits=%llu"
+			    " rto_expires=%llu srtt_usec=%lu rto_usec=%lu"
+			    " cwnd=%u",
+			    rfilter->retransmits, rfilter->fast_retransmits,
+			    rfilter->rto_expires, rfilter->srtt, rfilter->rto,
+			    rfilter->cwnd);
+	relpkt_unlock(rfilter);
+	*datalen = pos;
+	return 0;
+
+    default:
+	return GE_NOTSUP;
+    }
+}
+
 static int gensio_relpkt_filter_func(struct gensio_filter *filter, int op,
 				     const void *func, void *data,
 				     gensiods *count,
@@ -1172,7 +1870,8 @@ static int gensio_relpkt_filter_func(struct gensio_filter *filter, int op,
 	return 0;
 
     case GENSIO_FILTER_FUNC_CONTROL:
-	return GE_NOTSUP;
+	return relpkt_filter_control(rfilter, *((bool *) cbuf), buflen, data,
+				     count);
 
     default:
 	return GE_NOTSUP;
@@ -1182,6 +1881,7 @@ static int gensio_relpkt_filter_func(struct gensio_filter *filter, int op,
 static struct gensio_filter *
 gensio_relpkt_filter_raw_alloc(struct gensio_os_funcs *o,
 			       gensiods max_pktsize, gensiods max_packets,
+			       gensiods min_rto, unsigned int max_version,
 			       bool server)
 {
     struct relpkt_filter *rfilter;
@@ -1200,6 +1900,15 @@ gensio_relpkt_filter_raw_alloc(struct gensio_os_funcs *o,
 
     rfilter->max_pkt = max_packets;
     rfilter->max_pktsize = max_pktsize;
+    rfilter->min_rto = min_rto * 1000;
+    rfilter->rto = RELPKT_INITIAL_RTO;
+    rfilter->max_version = max_version;
+    relpkt_set_version(rfilter, max_version);
+
+    /* The header and the bitmap, see relpkt_recv_window(). */
+    rfilter->ack_pkt = o->zalloc(o, 3 + max_pktsize);
+    if (!rfilter->ack_pkt)
+	goto out_nomem;
 
     rfilter->recvpkts = o->zalloc(o, sizeof(struct pkt) * max_packets);
     if (!rfilter->recvpkts)
@@ -1214,7 +1923,7 @@ gensio_relpkt_filter_raw_alloc(struct gensio_os_funcs *o,
     if (!rfilter->xmitpkts)
 	goto out_nomem;
     for (i = 0; i < max_packets; i++) {
-	rfilter->xmitpkts[i].data = o->zalloc(o, max_pktsize + 3);
+	rfilter->xmitpkts[i].data = o->zalloc(o, max_pktsize + RELPKT_MAX_HDR);
 	if (!rfilter->xmitpkts[i].data)
 	    goto out_nomem;
     }
@@ -1240,6 +1949,8 @@ gensio_relpkt_filter_alloc(struct gensio_os_funcs *o,
     unsigned int i;
     gensiods max_pktsize = 123; /* FIXME - magic number. */
     gensiods max_packets = 16;
+    gensiods min_rto = RELPKT_DEFAULT_MIN_RTO / 1000;
+    unsigned int version = RELPKT_VERSION;
     char *str = NULL;
     int rv;
 
@@ -1267,14 +1978,22 @@ gensio_relpkt_filter_alloc(struct gensio_os_funcs *o,
 	    continue;
 	if (gensio_check_keyds(args[i], "max_packets", &max_packets) > 0)
 	    continue;
+	if (gensio_check_keyds(args[i], "min_rto", &min_rto) > 0)
+	    continue;
+	if (gensio_check_keyuint(args[i], "version", &version) > 0)
+	    continue;
 	if (gensio_check_keyboolv(args[i], "mode", "server", "client",
 				  &server) > 0)
 	    continue;
 	return GE_INVAL;
     }
 
+    if (max_packets == 0 || max_packets > RELPKT_MAX_WINDOW ||
+		version > RELPKT_VERSION)
+	return GE_INVAL;
+
     filter = gensio_relpkt_filter_raw_alloc(o, max_pktsize, max_packets,
-					    server);
+					    min_rto, version, server);
     if (!filter)
 	return GE_NOMEM;
 
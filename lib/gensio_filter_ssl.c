@@ -15,7 +15,11 @@
 #ifdef HAVE_OPENSSL
 
 #include <assert.h>
+#include <stdlib.h>
 #include <string.h>
+#ifdef USE_PTHREADS
+#include <pthread.h>
+#endif
 
 #include <openssl/ssl.h>
 #include <openssl/bio.h>
@@ -31,12 +35,64 @@ struct gensio_ssl_filter_data {
     gensiods max_write_size;
     bool allow_authfail;
     bool clientauth;
+    bool session_cache;
+    bool tickets;
+
+    /*
+     * The SSL context is built from the above on the first filter
+     * allocation and shared by all the filters allocated from this,
+     * each filter holds a reference to it.  Protected by lock.
+     */
+    struct gensio_lock *lock;
+    SSL_CTX *ctx;
 };
 
+#if OPENSSL_VERSION_NUMBER < 0x10100000L
+#define SSL_CTX_up_ref(ctx) \
+    CRYPTO_add(&(ctx)->references, 1, CRYPTO_LOCK_SSL_CTX)
+#define SSL_SESSION_up_ref(sess) \
+    CRYPTO_add(&(sess)->references, 1, CRYPTO_LOCK_SSL_SESSION)
+#endif
+
+/* Used to find the filter from the SSL, since the context is shared. */
+static int gensio_ssl_ex_idx = -1;
+
+/*
+ * Sessions from servers that clients have connected to, so a new
+ * connection to the same place can resume the session instead of
+ * doing a full handshake.  The most recently used is first in the
+ * list.
+ *
+ * This is shared by everything in the process, no matter what os
+ * funcs it uses, and an os funcs may be freed while the sessions are
+ * still here.  So this uses its own lock and the plain allocator, not
+ * anything from an os funcs.
+ */
+#define GENSIO_SSL_MAX_SESSIONS 64
+
+struct gensio_ssl_session {
+    struct gensio_link link;
+    char *key;
+    SSL_SESSION *sess;
+};
+
+#ifdef USE_PTHREADS
+static pthread_mutex_t gensio_ssl_session_lock = PTHREAD_MUTEX_INITIALIZER;
+#define SESSION_LOCK() pthread_mutex_lock(&gensio_ssl_session_lock)
+#define SESSION_UNLOCK() pthread_mutex_unlock(&gensio_ssl_session_lock)
+#else
+#define SESSION_LOCK() do { } while (false)
+#define SESSION_UNLOCK() do { } while (false)
+#endif
+static struct gensio_list gensio_ssl_sessions =
+    GENSIO_LIST_INIT(gensio_ssl_sessions);
+static unsigned int gensio_ssl_num_sessions;
+
 static void
 gensio_do_ssl_init(void *cb_data)
 {
     SSL_library_init();
+    gensio_ssl_ex_idx = SSL_get_ex_new_index(0, NULL, NULL, NULL, NULL);
 }
 
 static struct gensio_once gensio_ssl_init_once;
@@ -44,7 +100,111 @@ static struct gensio_once gensio_ssl_init_once;
 static void
 gensio_ssl_initialize(struct gensio_os_funcs *o)
 {
-    o->call_once(o, &gensio_ssl_init_once, gensio_do_ssl_init, NULL);
+    o->call_once(o, &gensio_ssl_init_once, gensio_do_ssl_init, o);
+}
+
+/* Allocate "s1;s2" for a session key. */
+static char *
+gssl_key_alloc(struct gensio_os_funcs *o, const char *s1, const char *s2)
+{
+    gensiods len = strlen(s1) + strlen(s2) + 2;
+    char *key;
+
+    key = o->zalloc(o, len);
+    if (key)
+	snprintf(key, len, "%s;%s", s1, s2);
+    return key;
+}
+
+static void
+gensio_ssl_session_free(struct gensio_ssl_session *s)
+{
+    gensio_list_rm(&gensio_ssl_sessions, &s->link);
+    gensio_ssl_num_sessions--;
+    SSL_SESSION_free(s->sess);
+    free(s->key);
+    free(s);
+}
+
+static struct gensio_ssl_session *
+gensio_ssl_session_find(const char *key)
+{
+    struct gensio_link *l;
+    struct gensio_ssl_session *s;
+
+    gensio_list_for_each(&gensio_ssl_sessions, l) {
+	s = gensio_container_of(l, struct gensio_ssl_session, link);
+	if (strcmp(s->key, key) == 0)
+	    return s;
+    }
+    return NULL;
+}
+
+/*
+ * Return a reference to the saved session for key, or NULL if there
+ * is none.
+ */
+static SSL_SESSION *
+gensio_ssl_session_get(const char *key)
+{
+    struct gensio_ssl_session *s;
+    SSL_SESSION *sess = NULL;
+
+    SESSION_LOCK();
+    s = gensio_ssl_session_find(key);
+    if (s) {
+	gensio_list_rm(&gensio_ssl_sessions, &s->link);
+	gensio_list_add_head(&gensio_ssl_sessions, &s->link);
+	sess = s->sess;
+	SSL_SESSION_up_ref(sess);
+    }
+    SESSION_UNLOCK();
+
+    return sess;
+}
+
+/*
+ * Save the session for key, replacing any session already saved.
+ * This takes over the caller's reference to sess on success.
+ */
+static bool
+gensio_ssl_session_save(const char *key, SSL_SESSION *sess)
+{
+    struct gensio_ssl_session *s;
+    bool rv = false;
+
+    SESSION_LOCK();
+    s = gensio_ssl_session_find(key);
+    if (s) {
+	SSL_SESSION_free(s->sess);
+	s->sess = sess;
+	gensio_list_rm(&gensio_ssl_sessions, &s->link);
+	gensio_list_add_head(&gensio_ssl_sessions, &s->link);
+	rv = true;
+	goto out_unlock;
+    }
+
+    s = calloc(1, sizeof(*s));
+    if (!s)
+	goto out_unlock;
+    s->key = strdup(key);
+    if (!s->key) {
+	free(s);
+	goto out_unlock;
+    }
+    s->sess = sess;
+    gensio_list_add_head(&gensio_ssl_sessions, &s->link);
+    gensio_ssl_num_sessions++;
+    if (gensio_ssl_num_sessions > GENSIO_SSL_MAX_SESSIONS) {
+	s = gensio_container_of(gensio_list_last(&gensio_ssl_sessions),
+				struct gensio_ssl_session, link);
+	gensio_ssl_session_free(s);
+    }
+    rv = true;
+ out_unlock:
+    SESSION_UNLOCK();
+
+    return rv;
 }
 
 struct ssl_filter {
@@ -65,6 +225,16 @@ struct ssl_filter {
     bool expect_peer_cert;
     bool allow_authfail;
 
+    /*
+     * For a client that saves sessions, session_cfg identifies the
+     * configuration.  session_key is that plus the remote address, it
+     * is the key for the saved session and is set when the connection
+     * is started.
+     */
+    struct gensio *io;
+    char *session_cfg;
+    char *session_key;
+
     /* This is data from SSL_read() that is waiting to be sent to the user. */
     unsigned char *read_data;
     gensiods read_data_pos;
@@ -80,8 +250,13 @@ struct ssl_filter {
     gensiods max_write_size;
     gensiods write_data_len;
 
-    /* This is data from BIO_read() waiting to be sent to the lower layer. */
-    unsigned char xmit_buf[1024];
+    /*
+     * This is data from BIO_read() waiting to be sent to the lower
+     * layer.  It is big enough to hold a whole record of write_data,
+     * so an SSL_write() is normally one write to the lower layer.
+     */
+    unsigned char *xmit_buf;
+    gensiods xmit_buf_size;
     gensiods xmit_buf_pos;
     gensiods xmit_buf_len;
 
@@ -279,12 +454,59 @@ ssl_check_open_done(struct gensio_filter *filter, struct gensio *io)
     return rv;
 }
 
+/*
+ * The remote address is not available until the lower layer is open,
+ * so this is done when the connection starts.
+ */
+static void
+ssl_session_resume(struct ssl_filter *sfilter)
+{
+    struct gensio_os_funcs *o = sfilter->o;
+    char raddr[200];
+    char *key;
+    SSL_SESSION *sess;
+    int err;
+
+    err = gensio_raddr_to_str(sfilter->io, NULL, raddr, sizeof(raddr));
+    if (err)
+	return;
+
+    key = gssl_key_alloc(o, raddr, sfilter->session_cfg);
+    if (!key)
+	return;
+
+    ssl_lock(sfilter);
+    sfilter->session_key = key;
+    sess = gensio_ssl_session_get(key);
+    if (sess) {
+	SSL_set_session(sfilter->ssl, sess);
+	SSL_SESSION_free(sess);
+    }
+    ssl_unlock(sfilter);
+}
+
+/* Called by OpenSSL for clients when the server gives a new session. */
+static int
+gensio_ssl_new_session(SSL *ssl, SSL_SESSION *sess)
+{
+    struct ssl_filter *sfilter = SSL_get_ex_data(ssl, gensio_ssl_ex_idx);
+
+    if (!sfilter || !sfilter->session_key)
+	return 0;
+
+    /* Returning 1 means we keep the reference to sess. */
+    return gensio_ssl_session_save(sfilter->session_key, sess);
+}
+
 static int
 ssl_try_connect(struct gensio_filter *filter, struct timeval *timeout)
 {
     struct ssl_filter *sfilter = filter_to_ssl(filter);
     int rv, success, err;
 
+    if (sfilter->session_cfg && !sfilter->session_key)
+	ssl_session_resume(sfilter);
+
     ssl_lock(sfilter);
     sfilter->want_read = false;
     sfilter->want_write = false;
@@ -445,7 +667,7 @@ ssl_ul_write(struct gensio_filter *filter,
 
     if (!err && sfilter->xmit_buf_len == 0) {
 	int rdlen = BIO_read(sfilter->io_bio, sfilter->xmit_buf,
-			     sizeof(sfilter->xmit_buf));
+			     sfilter->xmit_buf_size);
 
 	if (rdlen <= 0) {
 	    if (!BIO_should_retry(sfilter->io_bio)) {
@@ -569,10 +791,17 @@ ssl_setup(struct gensio_filter *filter, struct gensio *io)
     int success;
     gensiods bio_size = sfilter->max_read_size * 2;
 
+    sfilter->io = io;
     sfilter->ssl = SSL_new(sfilter->ctx);
     if (!sfilter->ssl)
 	return GE_NOMEM;
 
+    if (!SSL_set_ex_data(sfilter->ssl, gensio_ssl_ex_idx, sfilter)) {
+	SSL_free(sfilter->ssl);
+	sfilter->ssl = NULL;
+	return GE_NOMEM;
+    }
+
     /* The BIO has to be large enough to hold a full SSL key transaction. */
     if (bio_size < 4096)
 	bio_size = 4096;
@@ -605,6 +834,9 @@ ssl_cleanup(struct gensio_filter *filter)
     if (sfilter->remcert)
 	X509_free(sfilter->remcert);
     sfilter->remcert = NULL;
+    if (sfilter->session_key)
+	sfilter->o->free(sfilter->o, sfilter->session_key);
+    sfilter->session_key = NULL;
     if (sfilter->ssl)
 	SSL_free(sfilter->ssl);
     sfilter->ssl = NULL;
@@ -634,6 +866,10 @@ sfilter_free(struct ssl_filter *sfilter)
 	BIO_free(sfilter->io_bio);
     if (sfilter->ctx)
 	SSL_CTX_free(sfilter->ctx);
+    if (sfilter->session_cfg)
+	sfilter->o->free(sfilter->o, sfilter->session_cfg);
+    if (sfilter->session_key)
+	sfilter->o->free(sfilter->o, sfilter->session_key);
     if (sfilter->lock)
 	sfilter->o->free_lock(sfilter->lock);
     if (sfilter->read_data) {
@@ -642,6 +878,8 @@ sfilter_free(struct ssl_filter *sfilter)
     }
     if (sfilter->write_data)
 	sfilter->o->free(sfilter->o, sfilter->write_data);
+    if (sfilter->xmit_buf)
+	sfilter->o->free(sfilter->o, sfilter->xmit_buf);
     if (sfilter->filter)
 	gensio_filter_free_data(sfilter->filter);
     sfilter->o->free(sfilter->o, sfilter);
@@ -848,6 +1086,21 @@ ssl_filter_control(struct gensio_filter *filter, bool get, int op, char *data,
 			    (unsigned long) sfilter->max_write_size);
 	return 0;
 
+    case GENSIO_CONTROL_SESSION_RESUMED: {
+	int rv = 0;
+
+	if (!get)
+	    return GE_NOTSUP;
+	ssl_lock(sfilter);
+	if (!sfilter->ssl || !sfilter->connected)
+	    rv = GE_NOTREADY;
+	else
+	    *datalen = snprintf(data, *datalen, "%d",
+				(int) SSL_session_reused(sfilter->ssl));
+	ssl_unlock(sfilter);
+	return rv;
+    }
+
     default:
 	return GE_NOTSUP;
     }
@@ -918,11 +1171,16 @@ static int gensio_ssl_filter_func(struct gensio_filter *filter, int op,
 static int
 gensio_ssl_cert_verify(X509_STORE_CTX *ctx, void *cb_data)
 {
-    struct ssl_filter *sfilter = cb_data;
+    int ssl_ex_idx = SSL_get_ex_data_X509_STORE_CTX_idx();
+    SSL *s = X509_STORE_CTX_get_ex_data(ctx, ssl_ex_idx);
+    struct ssl_filter *sfilter = SSL_get_ex_data(s, gensio_ssl_ex_idx);
     X509_STORE_CTX *nctx = NULL;
     X509 *cert = X509_STORE_CTX_get0_cert(ctx);
     int rv;
 
+    if (!sfilter)
+	return 0;
+
     sfilter->remcert = cert;
 
     /*
@@ -938,8 +1196,6 @@ gensio_ssl_cert_verify(X509_STORE_CTX *ctx, void *cb_data)
 
     if (sfilter->verify_store) {
 	STACK_OF(X509) *cert_chain = X509_STORE_CTX_get0_chain(ctx);
-	int ssl_ex_idx = SSL_get_ex_data_X509_STORE_CTX_idx();
-	SSL *s = X509_STORE_CTX_get_ex_data(ctx, ssl_ex_idx);
 	X509_VERIFY_PARAM *param;
 
 	rv = -1;
@@ -985,6 +1241,7 @@ gensio_ssl_filter_raw_alloc(struct gensio_os_funcs *o,
 			    SSL_CTX *ctx,
 			    bool expect_peer_cert,
 			    bool allow_authfail,
+			    const char *session_cfg,
 			    gensiods max_read_size,
 			    gensiods max_write_size)
 {
@@ -1001,12 +1258,16 @@ gensio_ssl_filter_raw_alloc(struct gensio_os_funcs *o,
     sfilter->expect_peer_cert = expect_peer_cert;
     sfilter->allow_authfail = allow_authfail;
 
-    SSL_CTX_set_cert_verify_callback(ctx, gensio_ssl_cert_verify, sfilter);
-
     sfilter->lock = o->alloc_lock(o);
     if (!sfilter->lock)
 	goto out_nomem;
 
+    if (session_cfg) {
+	sfilter->session_cfg = gensio_strdup(o, session_cfg);
+	if (!sfilter->session_cfg)
+	    goto out_nomem;
+    }
+
     sfilter->read_data = o->zalloc(o, max_read_size);
     if (!sfilter->read_data)
 	goto out_nomem;
@@ -1015,6 +1276,15 @@ gensio_ssl_filter_raw_alloc(struct gensio_os_funcs *o,
     if (!sfilter->write_data)
 	goto out_nomem;
 
+    sfilter->xmit_buf_size = max_write_size;
+    if (sfilter->xmit_buf_size > SSL3_RT_MAX_PLAIN_LENGTH)
+	sfilter->xmit_buf_size = SSL3_RT_MAX_PLAIN_LENGTH;
+    sfilter->xmit_buf_size += (SSL3_RT_HEADER_LENGTH +
+			       SSL3_RT_MAX_ENCRYPTED_OVERHEAD);
+    sfilter->xmit_buf = o->zalloc(o, sfilter->xmit_buf_size);
+    if (!sfilter->xmit_buf)
+	goto out_nomem;
+
     sfilter->filter = gensio_filter_alloc_data(o, gensio_ssl_filter_func,
 					       sfilter);
     if (!sfilter->filter)
@@ -1022,7 +1292,8 @@ gensio_ssl_filter_raw_alloc(struct gensio_os_funcs *o,
 
     /*
      * Delay setting this so that it's not freed if there is a memory
-     * allocation error.  The caller passed it in, they should free it.
+     * allocation error.  The caller passed in a reference, they should
+     * free it.
      */
     sfilter->ctx = ctx;
     return sfilter->filter;
@@ -1061,6 +1332,16 @@ gensio_ssl_filter_config(struct gensio_os_funcs *o,
     if (rv)
 	return rv;
     data->clientauth = ival;
+    rv = gensio_get_default(o, "ssl", "session-cache", false,
+			    GENSIO_DEFAULT_BOOL, NULL, &ival);
+    if (rv)
+	return rv;
+    data->session_cache = ival;
+    rv = gensio_get_default(o, "ssl", "tickets", false,
+			    GENSIO_DEFAULT_BOOL, NULL, &ival);
+    if (rv)
+	return rv;
+    data->tickets = ival;
 
     rv = gensio_get_default(o, "ssl", "mode", false,
 			    GENSIO_DEFAULT_STR, &str, NULL);
@@ -1114,6 +1395,11 @@ gensio_ssl_filter_config(struct gensio_os_funcs *o,
 	if (gensio_check_keybool(args[i], "clientauth",
 				 &data->clientauth) > 0)
 	    continue;
+	if (gensio_check_keybool(args[i], "session-cache",
+				 &data->session_cache) > 0)
+	    continue;
+	if (gensio_check_keybool(args[i], "tickets", &data->tickets) > 0)
+	    continue;
 	rv = GE_INVAL;
 	goto out_err;
     }
@@ -1152,6 +1438,12 @@ gensio_ssl_filter_config(struct gensio_os_funcs *o,
 	}
     }
 
+    data->lock = o->alloc_lock(o);
+    if (!data->lock) {
+	rv = GE_NOMEM;
+	goto out_err;
+    }
+
     *rdata = data;
 
     return 0;
@@ -1175,6 +1467,10 @@ gensio_ssl_filter_config_free(struct gensio_ssl_filter_data *data)
 	return;
 
     o = data->o;
+    if (data->ctx)
+	SSL_CTX_free(data->ctx);
+    if (data->lock)
+	o->free_lock(data->lock);
     if (data->CAfilepath)
 	o->free(o, data->CAfilepath);
     if (data->keyfile)
@@ -1184,29 +1480,47 @@ gensio_ssl_filter_config_free(struct gensio_ssl_filter_data *data)
     o->free(o, data);
 }
 
-int
-gensio_ssl_filter_alloc(struct gensio_ssl_filter_data *data,
-			struct gensio_filter **rfilter)
+static int
+gensio_ssl_ctx_alloc(struct gensio_ssl_filter_data *data, SSL_CTX **rctx)
 {
-    struct gensio_os_funcs *o = data->o;
-    SSL_CTX *ctx = NULL;
-    struct gensio_filter *filter;
-    bool expect_peer_cert;
+    SSL_CTX *ctx;
     int rv = GE_INVAL;
 
-    gensio_ssl_initialize(o);
-
-    if (data->is_client) {
-	expect_peer_cert = true;
+    if (data->is_client)
 	ctx = SSL_CTX_new(SSLv23_client_method());
-    } else {
-	expect_peer_cert = data->clientauth;
+    else
 	ctx = SSL_CTX_new(SSLv23_server_method());
-    }
     if (!ctx)
 	return GE_NOMEM;
 
-    if (!data->is_client && expect_peer_cert)
+    /* The filter is fetched from the SSL, so this can be shared. */
+    SSL_CTX_set_cert_verify_callback(ctx, gensio_ssl_cert_verify, NULL);
+
+    if (!data->session_cache) {
+	SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_OFF);
+	SSL_CTX_set_options(ctx, SSL_OP_NO_TICKET);
+#if OPENSSL_VERSION_NUMBER >= 0x10101000L
+	if (!data->is_client)
+	    SSL_CTX_set_num_tickets(ctx, 0);
+#endif
+    } else if (data->is_client) {
+	/* Sessions are saved by remote address, not in the context. */
+	SSL_CTX_set_session_cache_mode(ctx, (SSL_SESS_CACHE_CLIENT |
+					     SSL_SESS_CACHE_NO_INTERNAL_STORE));
+	SSL_CTX_sess_set_new_cb(ctx, gensio_ssl_new_session);
+    } else {
+	/*
+	 * Sessions are only valid in the context they were created
+	 * in, but OpenSSL refuses to resume them with client
+	 * certificate verification if this is not set.
+	 */
+	SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_SERVER);
+	SSL_CTX_set_session_id_context(ctx, (unsigned char *) "gensio", 6);
+    }
+    if (!data->tickets)
+	SSL_CTX_set_options(ctx, SSL_OP_NO_TICKET);
+
+    if (!data->is_client && data->clientauth)
 	/*
 	 * In server mode, the certificate will not be requested unless
 	 * mode is SSL_VERIFY_PEER.  But in that mode, it terminates
@@ -1247,24 +1561,127 @@ gensio_ssl_filter_alloc(struct gensio_ssl_filter_data *data,
 	}
     }
 
+    *rctx = ctx;
+    return 0;
+
+ err:
+    SSL_CTX_free(ctx);
+    return rv;
+}
+
+/*
+ * Get a reference to the shared SSL context, building it if this is
+ * the first time.  The caller must free the reference.
+ */
+static int
+gensio_ssl_filter_get_ctx(struct gensio_ssl_filter_data *data, SSL_CTX **rctx)
+{
+    struct gensio_os_funcs *o = data->o;
+    int rv = 0;
+
+    o->lock(data->lock);
+    if (!data->ctx)
+	rv = gensio_ssl_ctx_alloc(data, &data->ctx);
+    if (!rv) {
+	SSL_CTX_up_ref(data->ctx);
+	*rctx = data->ctx;
+    }
+    o->unlock(data->lock);
+
+    return rv;
+}
+
+int
+gensio_ssl_filter_reload(struct gensio_ssl_filter_data *data)
+{
+    struct gensio_os_funcs *o = data->o;
+    SSL_CTX *ctx, *old_ctx;
+    int rv;
+
+    gensio_ssl_initialize(o);
+
+    rv = gensio_ssl_ctx_alloc(data, &ctx);
+    if (rv)
+	return rv;
+
+    /* Filters using the old context keep their reference to it. */
+    o->lock(data->lock);
+    old_ctx = data->ctx;
+    data->ctx = ctx;
+    o->unlock(data->lock);
+
+    if (old_ctx)
+	SSL_CTX_free(old_ctx);
+
+    return 0;
+}
+
+int
+gensio_ssl_filter_alloc(struct gensio_ssl_filter_data *data,
+			struct gensio_filter **rfilter)
+{
+    struct gensio_os_funcs *o = data->o;
+    SSL_CTX *ctx = NULL;
+    struct gensio_filter *filter;
+    bool expect_peer_cert;
+    char *session_cfg = NULL;
+    int rv;
+
+    gensio_ssl_initialize(o);
+
+    if (data->is_client)
+	expect_peer_cert = true;
+    else
+	expect_peer_cert = data->clientauth;
+
+    if (data->is_client && data->session_cache) {
+	/*
+	 * A session is only good for the same trust and identity, so
+	 * the CA and certificate are part of the key.
+	 */
+	session_cfg = gssl_key_alloc(o,
+				     data->CAfilepath ? data->CAfilepath : "",
+				     data->certfile ? data->certfile : "");
+	if (!session_cfg)
+	    return GE_NOMEM;
+    }
+
+    rv = gensio_ssl_filter_get_ctx(data, &ctx);
+    if (rv)
+	goto out;
+
     filter = gensio_ssl_filter_raw_alloc(o, data->is_client, ctx,
 					 expect_peer_cert,
 					 data->allow_authfail,
+					 session_cfg,
 					 data->max_read_size,
 					 data->max_write_size);
     if (!filter) {
+	SSL_CTX_free(ctx);
 	rv = GE_NOMEM;
-	goto err;
+	goto out;
     }
 
-
     *rfilter = filter;
-    return 0;
-
- err:
-    SSL_CTX_free(ctx);
+ out:
+    if (session_cfg)
+	o->free(o, session_cfg);
     return rv;
 }
+
+void
+gensio_ssl_cleanup_mem(struct gensio_os_funcs *o)
+{
+    struct gensio_link *l, *l2;
+    struct gensio_ssl_session *s;
+
+    SESSION_LOCK();
+    gensio_list_for_each_safe(&gensio_ssl_sessions, l, l2) {
+	s = gensio_container_of(l, struct gensio_ssl_session, link);
+	gensio_ssl_session_free(s);
+    }
+    SESSION_UNLOCK();
+}
 #else /* HAVE_OPENSSL */
 
 int
@@ -1281,6 +1698,12 @@ gensio_ssl_filter_config_free(struct gensio_ssl_filter_data *data)
 {
 }
 
+int
+gensio_ssl_filter_reload(struct gensio_ssl_filter_data *data)
+{
+    return GE_NOTSUP;
+}
+
 int
 gensio_ssl_filter_alloc(struct gensio_ssl_filter_data *data,
 			struct gensio_filter **rfilter)
@@ -1288,4 +1711,9 @@ gensio_ssl_filter_alloc(struct gensio_ssl_filter_data *data,
     return GE_NOTSUP;
 }
 
+void
+gensio_ssl_cleanup_mem(struct gensio_os_funcs *o)
+{
+}
+
 #endif /* HAVE_OPENSSL */
@@ -19,7 +19,18 @@ int gensio_ssl_filter_config(struct gensio_os_funcs *o,
 
 void gensio_ssl_filter_config_free(struct gensio_ssl_filter_data *data);
 
+/*
+ * Rebuild the SSL context shared by filters allocated from data,
+ * rereading the certificate, key, and CA files.  New filters use the
+ * new context, existing ones keep the one they have.  On failure the
+ * old context is kept.
+ */
+int gensio_ssl_filter_reload(struct gensio_ssl_filter_data *data);
+
 int gensio_ssl_filter_alloc(struct gensio_ssl_filter_data *data,
 			    struct gensio_filter **rfilter);
 
+/* Free the sessions saved for clients, for gensio_cleanup_mem(). */
+void gensio_ssl_cleanup_mem(struct gensio_os_funcs *o);
+
 #endif /* GENSIO_FILTER_SSL_H */
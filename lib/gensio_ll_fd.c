@@ -70,6 +70,12 @@ struct fd_ll {
 
     int fd;
 
+    /*
+     * The fd is edge-triggered in the selector, so reads must be done
+     * until no more data is available.
+     */
+    bool edge_triggered;
+
     enum fd_state state;
 
     bool read_enabled;
@@ -111,6 +117,12 @@ struct fd_ll {
 
 #define ll_to_fd(v) ((struct fd_ll *) gensio_ll_get_user_data(v))
 
+/*
+ * Maximum number of reads done on an edge-triggered fd before letting
+ * other things run.
+ */
+#define FD_MAX_EDGE_READS 16
+
 static void
 fd_lock(struct fd_ll *fdll)
 {
@@ -360,27 +372,54 @@ fd_handle_incoming(struct fd_ll *fdll,
 {
     int err = 0;
     gensiods count;
+    unsigned int reads = 0;
+    bool drained;
 
     fd_lock_and_ref(fdll);
-    fdll->o->set_read_handler(fdll->o, fdll->fd, false);
-    fdll->o->set_except_handler(fdll->o, fdll->fd, false);
+    /*
+     * An edge-triggered fd is left enabled while reading, it doesn't
+     * need to be rearmed and changing it would cost a system call.
+     */
+    if (!fdll->edge_triggered || fdll->in_read ||
+		fdll->state == FD_ERR_WAIT) {
+	fdll->o->set_read_handler(fdll->o, fdll->fd, false);
+	fdll->o->set_except_handler(fdll->o, fdll->fd, false);
+    }
     if (fdll->in_read || fdll->state == FD_ERR_WAIT)
 	goto out;
     fdll->in_read = true;
     fd_unlock(fdll);
 
+ next_read:
+    drained = false;
     if (!fdll->read_data_len) {
 	err = doread(fdll->fd, fdll->read_data, fdll->read_data_size, &count,
 		     auxdata, cb_data);
 	if (!err) {
 	    fdll->read_data_len = count;
 	    fdll->auxdata = auxdata;
+	    drained = count == 0;
 	}
     }
 
     fd_deliver_read_data(fdll, err);
 
     fd_lock(fdll);
+    if (!err && fdll->edge_triggered && !drained &&
+		fdll->state == FD_OPEN && fdll->read_enabled &&
+		!fdll->read_data_len) {
+	/*
+	 * No more events will come for data already in the fd, so
+	 * keep reading until it is empty.  If data keeps coming, give
+	 * other things a chance to run and have the selector check
+	 * the fd again.
+	 */
+	if (++reads < FD_MAX_EDGE_READS) {
+	    fd_unlock(fdll);
+	    goto next_read;
+	}
+	fdll->o->set_read_handler(fdll->o, fdll->fd, false);
+    }
     if (err) {
 	switch(fdll->state) {
 	case FD_IN_OPEN:
@@ -406,6 +445,13 @@ fd_handle_incoming(struct fd_ll *fdll,
     if (fdll->state == FD_OPEN && fdll->read_enabled) {
 	fdll->o->set_read_handler(fdll->o, fdll->fd, true);
 	fdll->o->set_except_handler(fdll->o, fdll->fd, true);
+    } else if (fdll->edge_triggered) {
+	/*
+	 * Data may be left in the fd, disable the handlers so that
+	 * enabling them again checks for it.
+	 */
+	fdll->o->set_read_handler(fdll->o, fdll->fd, false);
+	fdll->o->set_except_handler(fdll->o, fdll->fd, false);
     }
  out:
     fd_deref_and_unlock(fdll);
@@ -632,6 +678,8 @@ fd_setup_handlers(struct fd_ll *fdll)
 				 fd_write_ready, fd_except_ready,
 				 fd_cleared))
 	return GE_NOMEM;
+    fdll->edge_triggered = (fdll->o->set_fd_edge_triggered &&
+			    fdll->o->set_fd_edge_triggered(fdll->o, fdll->fd));
     return 0;
 }
 
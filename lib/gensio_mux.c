@@ -11,6 +11,7 @@
 #include <gensio/gensio_class.h>
 #include <gensio/gensio_acc_gensio.h>
 
+#include <stdio.h>
 #include <string.h>
 #include <stdlib.h>
 #include <assert.h>
@@ -149,6 +150,26 @@ static unsigned int mux_msg_hdr_sizes[] = { 0, 1, 2, 3, 2, 2 };
 #define MUX_MAX_HDR_SIZE	12
 #define MUX_MIN_SEND_WINDOW_SIZE	128
 
+/*
+ * Messages waiting to be sent on all channels are collected into one
+ * scatter-gather write to the child, up to this many messages and
+ * (by default) about this many bytes.  Each message is a header and
+ * up to two pieces of data, as the data may wrap in the buffer.
+ */
+#define MUX_MAX_XMIT_FRAMES		64
+#define MUX_MAX_XMIT_SG			(MUX_MAX_XMIT_FRAMES * 3)
+#define MUX_DEFAULT_WRITE_BATCH		16384
+
+/*
+ * Channels waiting to write are kept in a list per priority, and
+ * higher priorities are always sent first.  Channels with the same
+ * priority take turns, each sending about its weight times
+ * MUX_DRR_QUANTUM bytes per turn (deficit round robin).
+ */
+#define MUX_NR_PRIORITIES		8
+#define MUX_MAX_WEIGHT			1000
+#define MUX_DRR_QUANTUM			1024
+
 #ifdef ENABLE_INTERNAL_TRACE
 #define MUX_TRACING
 #endif
@@ -194,6 +215,11 @@ struct mux_inst {
     unsigned int id;
     unsigned int remote_id;
     enum mux_inst_state state;
+
+    /* Link in the mux's remote id hash table, see mux_set_remote_id(). */
+    struct mux_inst *remote_next;
+    bool in_remote_hash;
+
     int errcode; /* If an error occurs, it is stored here. */
     bool send_new_channel;
     bool send_close;
@@ -235,12 +261,12 @@ struct mux_inst {
     bool deferred_op_pending;
     struct gensio_runner *deferred_op_runner;
 
-    /* Used for current message being transmitted. */
-    unsigned char hdr[MUX_MAX_HDR_SIZE];
-    struct gensio_sg sg[3];
-    unsigned int sgpos;
-    unsigned int sglen;
-    gensiods cur_msg_len;
+    /*
+     * Number of messages for this channel in the transmit batch, and
+     * the number of bytes of write_data they use.
+     */
+    unsigned int xmit_frames;
+    gensiods write_data_queued;
 
     gensio_done_err open_done;
     void *open_data;
@@ -252,11 +278,21 @@ struct mux_inst {
 
     /* Link for list of channels waiting write. */
     struct gensio_link wrlink;
-    bool wr_ready; /* Also true if chan == muxdata->sending_chan. */
+    bool wr_ready; /* Also true if chan has messages in the batch. */
 
     bool in_wrlist;
     bool in_open_chan;
 
+    /*
+     * Transmit scheduling, see MUX_NR_PRIORITIES.  deficit is the
+     * number of bytes left in the current turn, it may go negative
+     * if the last message was larger than what was left.
+     */
+    unsigned int priority;
+    unsigned int weight;
+    long deficit;
+    bool in_turn;
+
     struct gensio_link link;
 };
 
@@ -270,13 +306,6 @@ chan_next_write_pos(struct mux_inst *chan, unsigned int count)
     return rv;
 }
 
-static void
-chan_incr_write_pos(struct mux_inst *chan, unsigned int count)
-{
-    chan->write_data_pos = chan_next_write_pos(chan, count);
-    chan->write_data_len -= count;
-}
-
 static void
 chan_addwrbuf(struct mux_inst *chan, const unsigned char *data, gensiods len)
 {
@@ -345,6 +374,9 @@ struct gensio_mux_config {
     struct gensio_os_funcs *o;
     gensiods max_read_size;
     gensiods max_write_size;
+    gensiods max_write_batch;
+    unsigned int priority;
+    unsigned int weight;
     char *service;
     unsigned int service_len;
     unsigned int max_channels;
@@ -407,6 +439,14 @@ struct mux_trace_info {
 #define MUX_TRACE_SIZE 256
 #endif
 
+/* A message in the transmit batch. */
+struct mux_xmit_frame {
+    struct mux_inst *chan;
+    unsigned char hdr[MUX_MAX_HDR_SIZE];
+    gensiods len; /* Bytes of the message not yet written. */
+    gensiods data_len; /* Bytes of chan->write_data in the message. */
+};
+
 struct mux_data {
     struct gensio *child;
     struct gensio_os_funcs *o;
@@ -415,6 +455,7 @@ struct mux_data {
 
     gensiods max_read_size;
     gensiods max_write_size;
+    gensiods max_write_batch;
 
     int exit_err;
     enum mux_state exit_state;
@@ -443,9 +484,17 @@ struct mux_data {
     void *acc_open_data;
 
     /*
-     * Channel I am currently sending data on.
+     * Messages being sent, possibly from many channels, written to
+     * the child in one call.  xmit_frame_pos and xmit_sgpos are where
+     * the next write starts if the last one was partial.
      */
-    struct mux_inst *sending_chan;
+    struct mux_xmit_frame xmit_frames[MUX_MAX_XMIT_FRAMES];
+    unsigned int nr_xmit_frames;
+    unsigned int xmit_frame_pos;
+    struct gensio_sg xmit_sg[MUX_MAX_XMIT_SG];
+    unsigned int xmit_sglen;
+    unsigned int xmit_sgpos;
+    gensiods xmit_batch_len;
 
     enum mux_state state;
 
@@ -470,19 +519,42 @@ struct mux_data {
      */
     struct mux_inst *curr_chan;
 
-    /* The last id we chose for a channel. */
-    unsigned int last_id;
+    /*
+     * Channels indexed by their local id, max_channels entries.  The
+     * other end sends our id in every message for a channel, so this
+     * is how incoming messages find their channel.
+     */
+    struct mux_inst **chan_table;
+
+    /*
+     * Free local ids, a ring of max_channels entries.  Ids are taken
+     * from the head and returned to the tail, so ids rotate through
+     * the whole space and a recently closed id is not immediately
+     * reused.  Id 0 is not kept here, it is always the automatic
+     * channel and is handled specially, see mux_new_channel().
+     */
+    unsigned int *free_ids;
+    unsigned int free_ids_head;
+    unsigned int free_ids_count;
+
+    /*
+     * Channels hashed by the id the remote end uses for them, to
+     * check for duplicate new channel requests.  remote_hash_mask + 1
+     * buckets, a power of two.
+     */
+    struct mux_inst **remote_hash;
+    unsigned int remote_hash_mask;
 
     /* Mux instances with write pending. */
-    struct gensio_list wrchans;
+    struct gensio_list wrchans[MUX_NR_PRIORITIES];
 
     /* Muxes waiting to open. */
     struct gensio_list openchans;
     unsigned int opencount;
 
     /*
-     * All the channels in the mux.  The channels are kept in id
-     * order.
+     * All the channels in the mux.  Channel 0, if it exists, is
+     * always first.
      */
     struct gensio_list chans;
 
@@ -551,6 +623,7 @@ static int muxc_gensio_handler(struct gensio *io, int func, gensiods *count,
 			       const void *cbuf, gensiods buflen, void *buf,
 			       const char *const *auxdata);
 static void muxc_add_to_wrlist(struct mux_inst *chan);
+static void mux_xmit_clear(struct mux_data *muxdata);
 static void mux_shutdown_channels(struct mux_data *muxdata, int err);
 
 static void
@@ -568,6 +641,12 @@ muxdata_free(struct mux_data *muxdata)
 {
     assert(gensio_list_empty(&muxdata->chans));
 
+    if (muxdata->chan_table)
+	muxdata->o->free(muxdata->o, muxdata->chan_table);
+    if (muxdata->free_ids)
+	muxdata->o->free(muxdata->o, muxdata->free_ids);
+    if (muxdata->remote_hash)
+	muxdata->o->free(muxdata->o, muxdata->remote_hash);
     if (muxdata->lock)
 	muxdata->o->free_lock(muxdata->lock);
     if (muxdata->child)
@@ -672,6 +751,52 @@ static void i_chan_ref(struct mux_inst *chan)
     chan->refcount++;
 }
 
+static void
+mux_remote_hash_rm(struct mux_data *muxdata, struct mux_inst *chan)
+{
+    struct mux_inst **p;
+
+    if (!chan->in_remote_hash)
+	return;
+    p = &muxdata->remote_hash[chan->remote_id & muxdata->remote_hash_mask];
+    while (*p != chan)
+	p = &(*p)->remote_next;
+    *p = chan->remote_next;
+    chan->remote_next = NULL;
+    chan->in_remote_hash = false;
+}
+
+static void
+mux_set_remote_id(struct mux_data *muxdata, struct mux_inst *chan,
+		  unsigned int remote_id)
+{
+    struct mux_inst **p;
+
+    mux_remote_hash_rm(muxdata, chan);
+    chan->remote_id = remote_id;
+    p = &muxdata->remote_hash[remote_id & muxdata->remote_hash_mask];
+    chan->remote_next = *p;
+    *p = chan;
+    chan->in_remote_hash = true;
+}
+
+static void
+mux_free_id(struct mux_data *muxdata, struct mux_inst *chan)
+{
+    unsigned int pos;
+
+    assert(muxdata->chan_table[chan->id] == chan);
+    muxdata->chan_table[chan->id] = NULL;
+    if (chan->id == 0)
+	return;
+    assert(muxdata->free_ids_count < muxdata->max_channels);
+    pos = muxdata->free_ids_head + muxdata->free_ids_count;
+    if (pos >= muxdata->max_channels)
+	pos -= muxdata->max_channels;
+    muxdata->free_ids[pos] = chan->id;
+    muxdata->free_ids_count++;
+}
+
 static bool i_chan_deref(struct mux_inst *chan)
 {
     assert(chan->refcount > 0);
@@ -679,6 +804,8 @@ static bool i_chan_deref(struct mux_inst *chan)
 	struct mux_data *mux = chan->mux;
 
 	gensio_list_rm(&mux->chans, &chan->link);
+	mux_free_id(mux, chan);
+	mux_remote_hash_rm(mux, chan);
 	chan_free(chan);
 	mux_deref(mux);
 	return true;
@@ -1023,13 +1150,39 @@ chan_sched_deferred_op(struct mux_inst *chan)
     }
 }
 
+static struct mux_inst *
+mux_next_wrchan(struct mux_data *muxdata)
+{
+    unsigned int i;
+
+    for (i = MUX_NR_PRIORITIES; i > 0; i--) {
+	if (!gensio_list_empty(&muxdata->wrchans[i - 1]))
+	    return gensio_container_of(
+			gensio_list_first(&muxdata->wrchans[i - 1]),
+			struct mux_inst, wrlink);
+    }
+    return NULL;
+}
+
+/*
+ * Take the channel off the list of channels waiting to write, ending
+ * its turn.
+ */
+static void
+mux_wrlist_rm(struct mux_data *muxdata, struct mux_inst *chan)
+{
+    gensio_list_rm(&muxdata->wrchans[chan->priority], &chan->wrlink);
+    chan->in_wrlist = false;
+    chan->in_turn = false;
+}
+
 static void
 muxc_add_to_wrlist(struct mux_inst *chan)
 {
     struct mux_data *muxdata = chan->mux;
 
-    if (!chan->wr_ready && !muxdata->err_shutdown) {
-	gensio_list_add_tail(&muxdata->wrchans, &chan->wrlink);
+    if (!chan->in_wrlist && !muxdata->err_shutdown) {
+	gensio_list_add_tail(&muxdata->wrchans[chan->priority], &chan->wrlink);
 	chan->wr_ready = true;
 	chan->in_wrlist = true;
 	if (muxdata->state != MUX_CLOSED)
@@ -1096,7 +1249,11 @@ muxc_write(struct mux_inst *chan, gensiods *count,
 	truncated = true;
     }
 
-    /* FIXME - consolidate writes if possible. */
+    if (tot_len > 0xffff + 3) {
+	/* The message length is 16 bits. */
+	tot_len = 0xffff + 3;
+	truncated = true;
+    }
 
     /* Construct the header and put it in first. */
     hdr[0] = 0; /* flags */
@@ -1162,24 +1319,6 @@ muxc_set_write_callback_enable(struct mux_inst *chan, bool enabled)
     mux_unlock(chan->mux);
 }
 
-static void
-chan_send_close(struct mux_inst *chan)
-{
-    chan->hdr[0] = (MUX_CLOSE_CHANNEL << 4) | 0x2;
-    chan->hdr[1] = 0;
-    gensio_u16_to_buf(&chan->hdr[2], chan->remote_id);
-    if (chan->errcode == GE_REMCLOSE)
-	gensio_u16_to_buf(&chan->hdr[4], 0);
-    else
-	gensio_u16_to_buf(&chan->hdr[4], chan->errcode);
-    gensio_u16_to_buf(&chan->hdr[6], 0);
-    chan->sg[0].buf = chan->hdr;
-    chan->sg[0].buflen = 8;
-    chan->sglen = 1;
-    chan->cur_msg_len = 0; /* Data isn't in chan->write_data. */
-    muxc_add_to_wrlist(chan);
-}
-
 static int
 muxc_close_nolock(struct mux_inst *chan,
 		  gensio_done close_done, void *close_data)
@@ -1281,15 +1420,6 @@ muxc_disable(struct mux_inst *chan)
     return 0;
 }
 
-static unsigned int
-next_chan_id(struct mux_data *muxdata, unsigned int num)
-{
-    if (num >= muxdata->max_channels - 1)
-	return 0;
-    else
-	return num + 1;
-}
-
 static int
 mux_new_channel(struct mux_data *muxdata, gensio_event cb, void *user_data,
 		bool is_client, struct mux_inst **new_mux)
@@ -1325,6 +1455,7 @@ mux_new_channel(struct mux_data *muxdata, gensio_event cb, void *user_data,
     chan->is_client = is_client;
     chan->max_read_size = muxdata->max_read_size;
     chan->max_write_size = muxdata->max_write_size;
+    chan->weight = 1;
     chan->read_data = o->zalloc(o, chan->max_read_size);
     if (!chan->read_data)
 	goto out_free;
@@ -1333,53 +1464,41 @@ mux_new_channel(struct mux_data *muxdata, gensio_event cb, void *user_data,
 	goto out_free;
 
     /*
-     * We maintain the list in number order and rotate through the
-     * numbers.  So we start after the last number used and rotate
-     * through the entries until we find an empty spot.
+     * Channel 0 is always the automatic channel, it is used when
+     * there are no other channels.  Otherwise take the next id off
+     * the free ring, and only reuse id 0 if that is empty.
      */
     if (gensio_list_empty(&muxdata->chans)) {
-	id = 0; /* This is always the automatic channel. */
+	id = 0;
+	muxdata->chan_table[id] = chan;
 	gensio_list_add_tail(&muxdata->chans, &chan->link);
 	/* Note that we do not claim a ref here, there is already one. */
     } else {
-	struct gensio_link *l, *p = &muxdata->chans.link, *f;
-	struct mux_inst *tchan = NULL;
-
-	/* First find the place at or before where the last number starts. */
-	id = muxdata->last_id;
-	gensio_list_for_each(&muxdata->chans, l) {
-	    tchan = gensio_container_of(l, struct mux_inst, link);
-	    if (tchan->id > id)
-		break;
-	    p = l;
-	}
+	if (muxdata->free_ids_count > 0) {
+	    id = muxdata->free_ids[muxdata->free_ids_head];
+	    if (++muxdata->free_ids_head >= muxdata->max_channels)
+		muxdata->free_ids_head = 0;
+	    muxdata->free_ids_count--;
+	} else if (!muxdata->chan_table[0]) {
+	    id = 0;
+	} else {
+	    err = GE_INUSE;
 
-	id = next_chan_id(muxdata, id);
-	l = gensio_list_next_wrap(&muxdata->chans, p);
-	f = l;
-	do {
-	    tchan = gensio_container_of(l, struct mux_inst, link);
-	    if (id != tchan->id)
-		goto found;
-	    id = next_chan_id(muxdata, id);
-	    p = l;
-	    l = gensio_list_next_wrap(&muxdata->chans, p);
-	} while (f != l);
-
-	err = GE_INUSE;
-
-    out_free:
-	/* Didn't find a free number. */
-	chan_free(chan);
-	return err;
+	out_free:
+	    /* Didn't find a free number. */
+	    chan_free(chan);
+	    return err;
+	}
 
-    found:
-	tchan = gensio_container_of(p, struct mux_inst, link);
-	chan->id = id;
-	muxdata->last_id = id;
-	gensio_list_add_next(&muxdata->chans, p, &chan->link);
+	assert(!muxdata->chan_table[id]);
+	muxdata->chan_table[id] = chan;
+	if (id == 0)
+	    gensio_list_add_head(&muxdata->chans, &chan->link);
+	else
+	    gensio_list_add_tail(&muxdata->chans, &chan->link);
 	mux_ref(muxdata);
     }
+    chan->id = id;
 
     *new_mux = chan;
     return 0;
@@ -1411,6 +1530,8 @@ muxc_alloc_channel_data(struct mux_data *muxdata,
 	}
 	chan->service_len = data->service_len;
     }
+    chan->priority = data->priority;
+    chan->weight = data->weight;
 
     muxc_set_state(chan, MUX_INST_CLOSED);
 
@@ -1440,9 +1561,26 @@ gensio_mux_config(struct gensio_os_funcs *o,
 	    continue;
 	if (gensio_check_keyds(args[i], "writebuf", &data->max_write_size) > 0)
 	    continue;
+	if (gensio_check_keyds(args[i], "writebatch",
+			       &data->max_write_batch) > 0)
+	    continue;
 	if (gensio_check_keyboolv(args[i], "mode", "client", "server",
 				  &data->is_client) > 0)
 	    continue;
+	if (gensio_check_keyuint(args[i], "priority", &data->priority) > 0) {
+	    if (data->priority >= MUX_NR_PRIORITIES) {
+		rv = GE_INVAL;
+		goto out_err;
+	    }
+	    continue;
+	}
+	if (gensio_check_keyuint(args[i], "weight", &data->weight) > 0) {
+	    if (data->weight > MUX_MAX_WEIGHT || data->weight < 1) {
+		rv = GE_INVAL;
+		goto out_err;
+	    }
+	    continue;
+	}
 	if (gensio_check_keyuint(args[i], "max_channels",
 				 &data->max_channels) > 0) {
 	    if (data->max_channels > 65536 || data->max_channels < 1) {
@@ -1526,6 +1664,7 @@ muxc_alloc_channel(struct mux_data *muxdata,
     data.max_read_size = muxdata->max_read_size;
     data.max_write_size = muxdata->max_write_size;
     data.max_channels = muxdata->max_channels;
+    data.weight = 1;
     data.is_client = true;
     err = get_default_mode(muxdata->o, &data.is_client);
     if (err)
@@ -1601,7 +1740,10 @@ muxc_reinit(struct mux_inst *chan)
     chan->in_write_ready = false;
     chan->sent_unacked = 0;
     chan->deferred_op_pending = false;
-    chan->cur_msg_len = 0;
+    chan->xmit_frames = 0;
+    chan->write_data_queued = 0;
+    chan->deficit = 0;
+    chan->in_turn = false;
     chan->close_done = NULL;
     chan->wr_ready = false;
     chan->close_called = false;
@@ -1616,7 +1758,7 @@ muxc_open(struct mux_inst *chan, gensio_done_err open_done, void *open_data,
 
     mux_lock(muxdata);
     if (muxdata->state == MUX_CLOSED) {
-	muxdata->sending_chan = NULL;
+	mux_xmit_clear(muxdata);
 	muxdata->in_hdr = true;
 	muxdata->hdr_pos = 0;
 	muxdata->hdr_size = 0;
@@ -1694,6 +1836,7 @@ muxc_control(struct mux_inst *chan, bool get, int op,
 {
     struct mux_data *muxdata = chan->mux;
     int err = 0;
+    unsigned long val;
 
     mux_lock(muxdata);
     switch (op) {
@@ -1726,6 +1869,40 @@ muxc_control(struct mux_inst *chan, bool get, int op,
 	}
 	break;
 
+    case GENSIO_CONTROL_PRIORITY:
+	if (get) {
+	    *datalen = snprintf(data, *datalen, "%u", chan->priority);
+	} else {
+	    val = strtoul(data, NULL, 0);
+	    if (val >= MUX_NR_PRIORITIES) {
+		err = GE_INVAL;
+		goto out;
+	    }
+	    if (chan->in_wrlist) {
+		/* Move it to the end of the new priority's list. */
+		mux_wrlist_rm(muxdata, chan);
+		chan->priority = val;
+		gensio_list_add_tail(&muxdata->wrchans[val], &chan->wrlink);
+		chan->in_wrlist = true;
+	    } else {
+		chan->priority = val;
+	    }
+	}
+	break;
+
+    case GENSIO_CONTROL_WEIGHT:
+	if (get) {
+	    *datalen = snprintf(data, *datalen, "%u", chan->weight);
+	} else {
+	    val = strtoul(data, NULL, 0);
+	    if (val < 1 || val > MUX_MAX_WEIGHT) {
+		err = GE_INVAL;
+		goto out;
+	    }
+	    chan->weight = val;
+	}
+	break;
+
     default:
 	err = GE_NOTSUP;
 	break;
@@ -1799,6 +1976,7 @@ mux_shutdown_channels(struct mux_data *muxdata, int err)
     struct mux_inst *chan;
 
     muxdata->err_shutdown = true;
+    mux_xmit_clear(muxdata);
 
     mux_set_state(muxdata, MUX_CLOSED);
     if (muxdata->acc_open_done &&
@@ -1818,10 +1996,14 @@ mux_shutdown_channels(struct mux_data *muxdata, int err)
     gensio_list_for_each_safe(&muxdata->chans, l, l2) {
 	chan = gensio_container_of(l, struct mux_inst, link);
 	if (chan->in_wrlist) {
-	    gensio_list_rm(&muxdata->wrchans, &chan->wrlink);
+	    gensio_list_rm(&muxdata->wrchans[chan->priority], &chan->wrlink);
 	    chan->in_wrlist = false;
 	}
+	chan->in_turn = false;
+	chan->deficit = 0;
 	chan->wr_ready = false;
+	chan->xmit_frames = 0;
+	chan->write_data_queued = 0;
 	if (chan->in_open_chan) {
 	    gensio_list_rm(&muxdata->openchans, &chan->wrlink);
 	    chan->in_open_chan = false;
@@ -1870,89 +2052,285 @@ mux_shutdown_channels(struct mux_data *muxdata, int err)
 	mux_set_state(muxdata, MUX_CLOSED);
 }
 
+/*
+ * Add a piece of a message to the transmit batch.
+ */
+static void
+mux_xmit_add_sg(struct mux_data *muxdata, struct mux_xmit_frame *f,
+		const void *buf, gensiods buflen)
+{
+    struct gensio_sg *sg = &muxdata->xmit_sg[muxdata->xmit_sglen++];
+
+    assert(muxdata->xmit_sglen <= MUX_MAX_XMIT_SG);
+    sg->buf = buf;
+    sg->buflen = buflen;
+    f->len += buflen;
+}
+
 static void
-chan_setup_send_new_channel(struct mux_inst *chan)
-{
-    chan->hdr[0] = (MUX_NEW_CHANNEL << 4) | 0x2;
-    chan->hdr[1] = 0;
-    gensio_u16_to_buf(&chan->hdr[2], chan->id);
-    gensio_u32_to_buf(&chan->hdr[4], chan->max_read_size);
-    gensio_u16_to_buf(&chan->hdr[8], chan->service_len);
-    chan->sg[0].buf = chan->hdr;
-    chan->sg[0].buflen = 10;
-    chan->sglen = 1;
+chan_setup_send_new_channel(struct mux_inst *chan, struct mux_xmit_frame *f)
+{
+    struct mux_data *muxdata = chan->mux;
+
+    f->hdr[0] = (MUX_NEW_CHANNEL << 4) | 0x2;
+    f->hdr[1] = 0;
+    gensio_u16_to_buf(&f->hdr[2], chan->id);
+    gensio_u32_to_buf(&f->hdr[4], chan->max_read_size);
+    gensio_u16_to_buf(&f->hdr[8], chan->service_len);
+    mux_xmit_add_sg(muxdata, f, f->hdr, 10);
     if (chan->service_len) {
-	chan->sg[1].buf = chan->service;
-	chan->sg[1].buflen = chan->service_len;
-	chan->sglen++;
+	mux_xmit_add_sg(muxdata, f, chan->service, chan->service_len);
 	chan->sent_unacked = chan->service_len;
     }
-    chan->cur_msg_len = 0; /* Data isn't in chan->write_data. */
 }
 
+static void
+chan_setup_send_close(struct mux_inst *chan, struct mux_xmit_frame *f)
+{
+    f->hdr[0] = (MUX_CLOSE_CHANNEL << 4) | 0x2;
+    f->hdr[1] = 0;
+    gensio_u16_to_buf(&f->hdr[2], chan->remote_id);
+    if (chan->errcode == GE_REMCLOSE)
+	gensio_u16_to_buf(&f->hdr[4], 0);
+    else
+	gensio_u16_to_buf(&f->hdr[4], chan->errcode);
+    gensio_u16_to_buf(&f->hdr[6], 0);
+    mux_xmit_add_sg(chan->mux, f, f->hdr, 8);
+}
+
+/*
+ * Set up the next data message in write_data that is not already in
+ * the batch, or just an ack if there is no data or the remote end's
+ * window is full.  Returns false if there is nothing to send.
+ */
 static bool
-chan_setup_send_data(struct mux_inst *chan)
+chan_setup_send_data(struct mux_inst *chan, struct mux_xmit_frame *f)
 {
-    unsigned char flags = 0;
-    gensiods pos;
+    struct mux_data *muxdata = chan->mux;
+    gensiods pos, msg_len, len;
     gensiods window_left = chan->send_window_size - chan->sent_unacked;
+    gensiods queued = chan->write_data_queued;
 
-    chan->hdr[0] = (MUX_DATA << 4) | 0x2;
-    chan->hdr[1] = 0;
-    gensio_u16_to_buf(chan->hdr + 2, chan->remote_id);
-    gensio_u32_to_buf(chan->hdr + 4, chan->received_unacked);
+    f->hdr[0] = (MUX_DATA << 4) | 0x2;
+    f->hdr[1] = 0;
+    gensio_u16_to_buf(f->hdr + 2, chan->remote_id);
+    gensio_u32_to_buf(f->hdr + 4, chan->received_unacked);
     chan->ack_pending = false;
 
-    chan->sg[0].buf = chan->hdr;
-    chan->sg[0].buflen = 8;
-
-    if (chan->write_data_len == 0) {
+    if (chan->write_data_len == queued) {
     check_send_ack:
 	if (chan->received_unacked == 0)
 	    return false;
 	chan->received_unacked = 0;
 	/* Just sending an ack. */
-	gensio_u16_to_buf(chan->hdr + 8, 0);
-	chan->sg[0].buflen = 10;
-	chan->sglen = 1;
+	gensio_u16_to_buf(f->hdr + 8, 0);
+	mux_xmit_add_sg(muxdata, f, f->hdr, 10);
 	return true;
     }
-    assert(chan->write_data_len > 3);
+    assert(chan->write_data_len - queued > 3);
 
-    pos = chan_next_write_pos(chan, 1);
-    chan->cur_msg_len = chan->write_data[pos] << 8;
-    pos = chan_next_write_pos(chan, 2);
-    chan->cur_msg_len |= chan->write_data[pos];
-    chan->cur_msg_len += 2;
+    /* The message is the flags, then the length and data to send. */
+    pos = chan_next_write_pos(chan, queued + 1);
+    msg_len = chan->write_data[pos] << 8;
+    pos = chan_next_write_pos(chan, queued + 2);
+    msg_len |= chan->write_data[pos];
+    msg_len += 2;
 
-    if (chan->cur_msg_len > window_left) {
-	chan->cur_msg_len = 0;
+    if (msg_len > window_left)
 	goto check_send_ack;
-    }
 
     chan->received_unacked = 0;
 
-    flags = chan->write_data[chan->write_data_pos];
-    chan_incr_write_pos(chan, 1);
-    chan->hdr[1] = flags;
-
-    if (chan->write_data_pos + chan->cur_msg_len > chan->max_write_size) {
-	/* Buffer wraps, need three parts for scatter/gatter. */
-	chan->sglen = 3;
-	chan->sg[1].buf = chan->write_data + chan->write_data_pos;
-	chan->sg[1].buflen = chan->max_write_size - chan->write_data_pos;
-	chan->sg[2].buf = chan->write_data;
-	chan->sg[2].buflen = chan->cur_msg_len - chan->sg[1].buflen;
+    f->hdr[1] = chan->write_data[chan_next_write_pos(chan, queued)];
+    mux_xmit_add_sg(muxdata, f, f->hdr, 8);
+
+    pos = chan_next_write_pos(chan, queued + 1);
+    if (pos + msg_len > chan->max_write_size) {
+	/* Buffer wraps, need two parts for the data. */
+	len = chan->max_write_size - pos;
+	mux_xmit_add_sg(muxdata, f, chan->write_data + pos, len);
+	mux_xmit_add_sg(muxdata, f, chan->write_data, msg_len - len);
     } else {
-	chan->sglen = 2;
-	chan->sg[1].buf = chan->write_data + chan->write_data_pos;
-	chan->sg[1].buflen = chan->cur_msg_len;
+	mux_xmit_add_sg(muxdata, f, chan->write_data + pos, msg_len);
     }
-    chan->sent_unacked += chan->cur_msg_len + 1;
+    f->data_len = msg_len + 1;
+    chan->write_data_queued += f->data_len;
+    chan->sent_unacked += msg_len + 1;
 
     return true;
 }
 
+static bool
+chan_xmit_pending(struct mux_inst *chan)
+{
+    return (chan->send_new_channel || chan->ack_pending || chan->send_close ||
+	    chan->write_data_len > chan->write_data_queued);
+}
+
+/*
+ * Collect messages from the channels waiting to write into the
+ * transmit batch.  The first channel in the highest priority list
+ * that has channels goes next.  It keeps sending messages until it
+ * has used its weight's worth of bytes, then goes to the back of its
+ * list if it has more, so the channels share the batch.  Acks go in
+ * the data message header, or in their own message in the batch if
+ * there is no data.
+ */
+static void
+mux_build_xmit_batch(struct mux_data *muxdata)
+{
+    struct mux_inst *chan;
+    struct mux_xmit_frame *f;
+    bool sending;
+
+    while (muxdata->nr_xmit_frames < MUX_MAX_XMIT_FRAMES &&
+	   (muxdata->nr_xmit_frames == 0 ||
+	    muxdata->xmit_batch_len < muxdata->max_write_batch)) {
+	chan = mux_next_wrchan(muxdata);
+	if (!chan)
+	    break;
+	if (!chan->in_turn) {
+	    chan->deficit += chan->weight * MUX_DRR_QUANTUM;
+	    chan->in_turn = true;
+	    if (chan->deficit <= 0) {
+		/* Still paying off a big message, skip this turn. */
+		mux_wrlist_rm(muxdata, chan);
+		gensio_list_add_tail(&muxdata->wrchans[chan->priority],
+				     &chan->wrlink);
+		chan->in_wrlist = true;
+		continue;
+	    }
+	}
+
+	f = &muxdata->xmit_frames[muxdata->nr_xmit_frames];
+	f->chan = chan;
+	f->len = 0;
+	f->data_len = 0;
+	if (chan->send_new_channel) {
+	    chan_setup_send_new_channel(chan, f);
+	    chan->send_new_channel = false;
+	    sending = true;
+	} else if (chan->write_data_len > chan->write_data_queued ||
+		   chan->ack_pending) {
+	    sending = chan_setup_send_data(chan, f);
+	} else if (chan->send_close) {
+	    /* Do the close last so all data is sent. */
+	    chan_setup_send_close(chan, f);
+	    chan->send_close = false;
+	    sending = true;
+	} else {
+	    sending = false;
+	}
+
+	if (!sending) {
+	    mux_wrlist_rm(muxdata, chan);
+	    chan->deficit = 0;
+	    if (chan->xmit_frames == 0)
+		chan->wr_ready = false;
+	    continue;
+	}
+
+	muxdata->nr_xmit_frames++;
+	muxdata->xmit_batch_len += f->len;
+	chan->xmit_frames++;
+	chan->deficit -= f->len;
+	if (!chan_xmit_pending(chan)) {
+	    mux_wrlist_rm(muxdata, chan);
+	    chan->deficit = 0;
+	} else if (chan->deficit <= 0) {
+	    /* Turn is over, go to the back of the line. */
+	    mux_wrlist_rm(muxdata, chan);
+	    gensio_list_add_tail(&muxdata->wrchans[chan->priority],
+				 &chan->wrlink);
+	    chan->in_wrlist = true;
+	}
+    }
+}
+
+/*
+ * A message has been completely written, release its data.
+ */
+static void
+mux_xmit_frame_done(struct mux_data *muxdata, struct mux_xmit_frame *f)
+{
+    struct mux_inst *chan = f->chan;
+
+    chan->write_data_pos = chan_next_write_pos(chan, f->data_len);
+    chan->write_data_len -= f->data_len;
+    chan->write_data_queued -= f->data_len;
+    assert(chan->xmit_frames > 0);
+    chan->xmit_frames--;
+    if (chan->xmit_frames > 0 || chan->in_wrlist)
+	return;
+
+    if (chan_xmit_pending(chan)) {
+	/* More messages to send, add it to the tail for fairness. */
+	gensio_list_add_tail(&muxdata->wrchans[chan->priority], &chan->wrlink);
+	chan->in_wrlist = true;
+    } else {
+	chan->wr_ready = false;
+	if (chan->state == MUX_INST_IN_CLOSE_FINAL &&
+		!full_msg_ready(chan, NULL))
+	    /* Run the close in the deferred op handling. */
+	    chan_sched_deferred_op(chan);
+    }
+}
+
+static void
+mux_xmit_clear(struct mux_data *muxdata)
+{
+    muxdata->nr_xmit_frames = 0;
+    muxdata->xmit_frame_pos = 0;
+    muxdata->xmit_sglen = 0;
+    muxdata->xmit_sgpos = 0;
+    muxdata->xmit_batch_len = 0;
+}
+
+static int
+mux_write_xmit_batch(struct mux_data *muxdata)
+{
+    struct mux_xmit_frame *f;
+    struct gensio_sg *sg;
+    gensiods rcount, count;
+    int err;
+
+    err = gensio_write_sg(muxdata->child, &rcount,
+			  muxdata->xmit_sg + muxdata->xmit_sgpos,
+			  muxdata->xmit_sglen - muxdata->xmit_sgpos, NULL);
+    if (err)
+	return err;
+
+    count = rcount;
+    while (count > 0) {
+	sg = &muxdata->xmit_sg[muxdata->xmit_sgpos];
+	if (sg->buflen <= count) {
+	    count -= sg->buflen;
+	    muxdata->xmit_sgpos++;
+	} else {
+	    sg->buflen -= count;
+	    sg->buf = ((const unsigned char *) sg->buf) + count;
+	    count = 0;
+	}
+    }
+
+    while (rcount > 0) {
+	f = &muxdata->xmit_frames[muxdata->xmit_frame_pos];
+	if (f->len <= rcount) {
+	    rcount -= f->len;
+	    f->len = 0;
+	    muxdata->xmit_frame_pos++;
+	    mux_xmit_frame_done(muxdata, f);
+	} else {
+	    f->len -= rcount;
+	    rcount = 0;
+	}
+    }
+
+    if (muxdata->xmit_sgpos >= muxdata->xmit_sglen)
+	mux_xmit_clear(muxdata);
+    return 0;
+}
+
 static void
 mux_on_err_close(struct gensio *child, void *close_data)
 {
@@ -1967,7 +2345,6 @@ static int
 mux_child_write_ready(struct mux_data *muxdata)
 {
     int err = 0;
-    struct mux_inst *chan;
     gensiods rcount;
 
     mux_lock_and_ref(muxdata);
@@ -1978,47 +2355,14 @@ mux_child_write_ready(struct mux_data *muxdata)
 	return 0;
     }
 
-    /* Finish any pending channel data. */
-    if (muxdata->sending_chan) {
-	chan = muxdata->sending_chan;
-    next_channel:
-	err = gensio_write_sg(muxdata->child, &rcount, chan->sg + chan->sgpos,
-			      chan->sglen - chan->sgpos, NULL);
+    /* Finish any pending batch. */
+    if (muxdata->xmit_sgpos < muxdata->xmit_sglen) {
+	err = mux_write_xmit_batch(muxdata);
 	if (err)
 	    goto out_write_err;
-	while (rcount > 0) {
-	    if (chan->sg[chan->sgpos].buflen <= rcount) {
-		rcount -= chan->sg[chan->sgpos].buflen;
-		chan->sgpos++;
-		assert(chan->sgpos <= 3);
-	    } else {
-		chan->sg[chan->sgpos].buflen -= rcount;
-		chan->sg[chan->sgpos].buf += rcount;
-		rcount = 0;
-	    }
-	}
-	if (chan->sgpos >= chan->sglen) {
-	    /* Finished sending one message. */
-	    chan->write_data_pos = chan_next_write_pos(chan, chan->cur_msg_len);
-	    chan->write_data_len -= chan->cur_msg_len;
-	    chan->cur_msg_len = 0;
-	    muxdata->sending_chan = NULL;
-	    if (chan->write_data_len > 0 || chan->send_new_channel ||
-			chan->send_close) {
-		/* More messages to send, add it to the tail for fairness. */
-		gensio_list_add_tail(&muxdata->wrchans, &chan->wrlink);
-		chan->in_wrlist = true;
-	    } else {
-		chan->wr_ready = false;
-		if (chan->state == MUX_INST_IN_CLOSE_FINAL &&
-		       !full_msg_ready(chan, NULL))
-		    /* Run the close in the deferred op handling. */
-		    chan_sched_deferred_op(chan);
-	    }
-	} else {
+	if (muxdata->xmit_sgpos < muxdata->xmit_sglen)
 	    /* Couldn't send all the data. */
 	    goto out;
-	}
     }
 
     /* Handle data not associated with an existing channel. */
@@ -2040,40 +2384,21 @@ mux_child_write_ready(struct mux_data *muxdata)
 	}
     }
 
-    /* Now look for a new channel to send. */
- check_next_channel:
-    if (!gensio_list_empty(&muxdata->wrchans)) {
-	chan = gensio_container_of(gensio_list_first(&muxdata->wrchans),
-				   struct mux_inst, wrlink);
-	gensio_list_rm(&muxdata->wrchans, &chan->wrlink);
-	chan->in_wrlist = false;
-	chan->sgpos = 0;
-
-	if (chan->send_new_channel) {
-	    chan_setup_send_new_channel(chan);
-	    chan->send_new_channel = false;
-	    muxdata->sending_chan = chan;
-	} else if (chan->write_data_len || chan->ack_pending) {
-	    if (!chan_setup_send_data(chan)) {
-		chan->wr_ready = false;
-		goto check_next_channel;
-	    }
-	    muxdata->sending_chan = chan;
-	} else if (chan->send_close) {
-	    /* Do the close last so all data is sent. */
-	    chan_send_close(chan);
-	    chan->send_close = false;
-	    muxdata->sending_chan = chan;
-	} else {
-	    muxdata->sending_chan = NULL;
-	    chan->wr_ready = false;
-	    goto check_next_channel;
-	}
-	goto next_channel;
+    /* Now send what the channels have. */
+    for (;;) {
+	mux_build_xmit_batch(muxdata);
+	if (muxdata->nr_xmit_frames == 0)
+	    break;
+	err = mux_write_xmit_batch(muxdata);
+	if (err)
+	    goto out_write_err;
+	if (muxdata->xmit_sgpos < muxdata->xmit_sglen)
+	    break;
     }
  out:
     gensio_set_write_callback_enable(muxdata->child,
-		muxdata->sending_chan || !gensio_list_empty(&muxdata->wrchans));
+		muxdata->xmit_sgpos < muxdata->xmit_sglen ||
+		mux_next_wrchan(muxdata));
     mux_deref_and_unlock(muxdata);
     return 0;
 
@@ -2093,26 +2418,20 @@ mux_child_write_ready(struct mux_data *muxdata)
 static struct mux_inst *
 mux_get_channel(struct mux_data *muxdata)
 {
-    struct gensio_link *l;
     unsigned int id = gensio_buf_to_u16(muxdata->hdr + 2);
 
-    gensio_list_for_each(&muxdata->chans, l) {
-	struct mux_inst *chan = gensio_container_of(l, struct mux_inst, link);
-
-	if (chan->id == id)
-	    return chan;
-    }
-    return NULL;
+    if (id >= muxdata->max_channels)
+	return NULL;
+    return muxdata->chan_table[id];
 }
 
 static bool
 mux_find_remote_id(struct mux_data *muxdata, unsigned int id)
 {
-    struct gensio_link *l;
-
-    gensio_list_for_each(&muxdata->chans, l) {
-	struct mux_inst *chan = gensio_container_of(l, struct mux_inst, link);
+    struct mux_inst *chan;
 
+    chan = muxdata->remote_hash[id & muxdata->remote_hash_mask];
+    for (; chan; chan = chan->remote_next) {
 	if (chan->remote_id == id &&
 		chan->state != MUX_INST_PENDING_OPEN &&
 		chan->state != MUX_INST_IN_OPEN &&
@@ -2181,6 +2500,7 @@ mux_child_read(struct mux_data *muxdata, int ierr,
 	    if (buflen + muxdata->hdr_pos < muxdata->hdr_size) {
 		/* The header is not completely received, partial copy. */
 		memcpy(muxdata->hdr + muxdata->hdr_pos, buf, buflen);
+		muxdata->hdr_pos += buflen;
 		processed += buflen;
 		goto out_unlock;
 	    }
@@ -2238,7 +2558,7 @@ mux_child_read(struct mux_data *muxdata, int ierr,
 			proto_err_str = "Invalid send window size";
 			goto protocol_err;
 		    }
-		    chan->remote_id = remote_id;
+		    mux_set_remote_id(muxdata, chan, remote_id);
 		    muxdata->data_pos = 0;
 		    muxdata->in_hdr = false; /* Receive the service data */
 		}
@@ -2263,14 +2583,14 @@ mux_child_read(struct mux_data *muxdata, int ierr,
 		    proto_err_str = "New channel response in bad state";
 		    goto protocol_err;
 		}
-		chan->remote_id = gensio_buf_to_u16(muxdata->hdr + 8);
+		mux_set_remote_id(muxdata, chan,
+				  gensio_buf_to_u16(muxdata->hdr + 8));
 		chan->send_window_size = gensio_buf_to_u32(muxdata->hdr + 4);
 		if (chan->send_window_size <= MUX_MIN_SEND_WINDOW_SIZE) {
 		    proto_err_str = "Invalid send window size";
 		    goto protocol_err;
 		}
 		chan->errcode = gensio_buf_to_u16(muxdata->hdr + 10);
-		muxdata->sending_chan = NULL;
 
 		assert(muxdata->opencount > 0);
 		muxdata->opencount--;
@@ -2579,6 +2899,7 @@ mux_gensio_alloc_data(struct gensio *child, struct gensio_mux_config *data,
 {
     struct gensio_os_funcs *o = data->o;
     struct mux_data *muxdata;
+    unsigned int i;
     int rv;
 
     if (data->max_write_size < MUX_MIN_SEND_WINDOW_SIZE ||
@@ -2597,10 +2918,32 @@ mux_gensio_alloc_data(struct gensio *child, struct gensio_mux_config *data,
     muxdata->in_hdr = true;
     muxdata->max_write_size = data->max_write_size;
     muxdata->max_read_size = data->max_read_size;
+    muxdata->max_write_batch = data->max_write_batch;
     muxdata->max_channels = data->max_channels;
     gensio_list_init(&muxdata->chans);
     gensio_list_init(&muxdata->openchans);
-    gensio_list_init(&muxdata->wrchans);
+    for (i = 0; i < MUX_NR_PRIORITIES; i++)
+	gensio_list_init(&muxdata->wrchans[i]);
+
+    muxdata->chan_table = o->zalloc(o, sizeof(*muxdata->chan_table) *
+				    data->max_channels);
+    if (!muxdata->chan_table)
+	goto out_nomem;
+    muxdata->free_ids = o->zalloc(o, sizeof(*muxdata->free_ids) *
+				  data->max_channels);
+    if (!muxdata->free_ids)
+	goto out_nomem;
+    /* Id 0 is handled specially, see mux_new_channel(). */
+    for (i = 1; i < data->max_channels; i++)
+	muxdata->free_ids[muxdata->free_ids_count++] = i;
+    /* Remote ids are 16 bits, so no more than 65536 buckets. */
+    for (i = 1; i < data->max_channels && i < 65536; i <<= 1)
+	;
+    muxdata->remote_hash_mask = i - 1;
+    muxdata->remote_hash = o->zalloc(o, sizeof(*muxdata->remote_hash) * i);
+    if (!muxdata->remote_hash)
+	goto out_nomem;
+
     muxdata->lock = o->alloc_lock(o);
     if (!muxdata->lock)
 	goto out_nomem;
@@ -2624,6 +2967,12 @@ mux_gensio_alloc_data(struct gensio *child, struct gensio_mux_config *data,
 	chan_deref(gensio_container_of(
 				gensio_list_first(&muxdata->chans),
 				struct mux_inst, link));
+    if (muxdata->chan_table)
+	o->free(o, muxdata->chan_table);
+    if (muxdata->free_ids)
+	o->free(o, muxdata->free_ids);
+    if (muxdata->remote_hash)
+	o->free(o, muxdata->remote_hash);
     if (muxdata->lock)
 	o->free_lock(muxdata->lock);
     o->free(o, muxdata);
@@ -2649,6 +2998,8 @@ mux_gensio_alloc(struct gensio *child, const char *const args[],
     memset(&data, 0, sizeof(data));
     data.max_read_size = GENSIO_DEFAULT_BUF_SIZE;
     data.max_write_size = GENSIO_DEFAULT_BUF_SIZE;
+    data.max_write_batch = MUX_DEFAULT_WRITE_BATCH;
+    data.weight = 1;
     data.max_channels = 1000;
     err = gensio_get_default(o, "mux", "max-channels", false,
 			     GENSIO_DEFAULT_INT, NULL, &ival);
@@ -2795,6 +3146,8 @@ mux_gensio_accepter_alloc(struct gensio_accepter *child,
 
     nadata->data.max_read_size = GENSIO_DEFAULT_BUF_SIZE;
     nadata->data.max_write_size = GENSIO_DEFAULT_BUF_SIZE;
+    nadata->data.max_write_batch = MUX_DEFAULT_WRITE_BATCH;
+    nadata->data.weight = 1;
     nadata->data.max_channels = 1000;
     err = gensio_get_default(o, "mux", "max-channels", false,
 			     GENSIO_DEFAULT_INT, NULL, &ival);
@@ -455,6 +455,12 @@ str_to_unix_gensio(const char *str, const char * const args[],
     return err;
 }
 
+/*
+ * Maximum number of connections accepted on an edge-triggered fd
+ * before letting other things run.
+ */
+#define NETNA_MAX_EDGE_ACCEPTS 16
+
 struct netna_data;
 
 struct netna_data {
@@ -479,6 +485,13 @@ struct netna_data {
     unsigned int   nr_acceptfds;
     unsigned int   nr_accept_close_waiting;
 
+    /*
+     * The accept fds are edge-triggered, so accept must be called
+     * until there are no more connections.
+     */
+    bool edge_triggered;
+    bool accept_enabled;
+
     bool istcp;
 
     /* Remove the socket file if it exists. */
@@ -516,11 +529,29 @@ netna_fd_cleared(int fd, void *cbdata)
 	nadata->shutdown_done(nadata->acc, NULL);
 }
 
+static bool
+netna_set_edge_triggered(struct netna_data *nadata)
+{
+    struct gensio_os_funcs *o = nadata->o;
+    unsigned int i;
+    bool rv = false;
+
+    if (!o->set_fd_edge_triggered)
+	return false;
+    /* Draining a level-triggered fd is harmless, so any will do. */
+    for (i = 0; i < nadata->nr_acceptfds; i++) {
+	if (o->set_fd_edge_triggered(o, nadata->acceptfds[i].fd))
+	    rv = true;
+    }
+    return rv;
+}
+
 static void
 netna_set_fd_enables(struct netna_data *nadata, bool enable)
 {
     unsigned int i;
 
+    nadata->accept_enabled = enable;
     for (i = 0; i < nadata->nr_acceptfds; i++)
 	nadata->o->set_read_handler(nadata->o, nadata->acceptfds[i].fd, enable);
 }
@@ -533,15 +564,19 @@ netna_finish_server_open(struct gensio *net, int err, void *cb_data)
     base_gensio_server_open_done(nadata->acc, net, err);
 }
 
-static void
-netna_readhandler(int fd, void *cbdata)
+/*
+ * Accept a single connection.  Returns false if there was nothing to
+ * accept or accept failed.
+ */
+static bool
+netna_accept_one(struct netna_data *nadata, int fd)
 {
-    struct netna_data *nadata = cbdata;
     int new_fd = -1;
     struct sockaddr_storage addr;
     socklen_t addrlen = sizeof(addr);
     struct net_data *tdata = NULL;
     struct gensio *io = NULL;
+    struct gensio_os_funcs *o;
     int err;
 
     err = gensio_os_accept(nadata->o,
@@ -552,15 +587,18 @@ netna_readhandler(int fd, void *cbdata)
 	    gensio_acc_log(nadata->acc, GENSIO_LOG_ERR,
 			   "Error accepting net gensio: %s",
 			   gensio_err_to_str(err));
-	return;
+	return false;
     }
 
     err = base_gensio_accepter_new_child_start(nadata->acc);
     if (err) {
 	close(new_fd);
-	return;
+	return true;
     }
 
+    /* The new connection may be handled by another OS handler. */
+    o = gensio_os_get_shard(nadata->o);
+
     if (nadata->istcp) {
 	if (gensio_check_tcpd_ok(new_fd)) {
 	    gensio_acc_log(nadata->acc, GENSIO_LOG_INFO,
@@ -570,7 +608,7 @@ netna_readhandler(int fd, void *cbdata)
 	}
     }
 
-    tdata = nadata->o->zalloc(nadata->o, sizeof(*tdata));
+    tdata = o->zalloc(o, sizeof(*tdata));
     if (!tdata) {
 	gensio_acc_log(nadata->acc, GENSIO_LOG_INFO,
 		       "Error accepting net gensio: out of memory");
@@ -578,7 +616,7 @@ netna_readhandler(int fd, void *cbdata)
 	goto out_err;
     }
 
-    tdata->o = nadata->o;
+    tdata->o = o;
     tdata->raddr = (struct sockaddr *) &tdata->remote;
     memcpy(tdata->raddr, &addr, addrlen);
     tdata->raddrlen = addrlen;
@@ -591,7 +629,7 @@ netna_readhandler(int fd, void *cbdata)
 	goto out_err;
     }
 
-    tdata->ll = fd_gensio_ll_alloc(nadata->o, new_fd, &net_server_fd_ll_ops,
+    tdata->ll = fd_gensio_ll_alloc(o, new_fd, &net_server_fd_ll_ops,
 				   tdata, nadata->max_read_size, false);
     if (!tdata->ll) {
 	gensio_acc_log(nadata->acc, GENSIO_LOG_ERR,
@@ -600,7 +638,7 @@ netna_readhandler(int fd, void *cbdata)
 	goto out_err;
     }
 
-    io = base_gensio_server_alloc(nadata->o, tdata->ll, NULL, NULL,
+    io = base_gensio_server_alloc(o, tdata->ll, NULL, NULL,
 				  nadata->istcp ? "tcp" : "unix",
 				  netna_finish_server_open, nadata);
     if (!io) {
@@ -614,7 +652,7 @@ netna_readhandler(int fd, void *cbdata)
     if (err)
 	goto out_err;
     base_gensio_accepter_new_child_end(nadata->acc, io, 0);
-    return;
+    return true;
 
  out_err:
     base_gensio_accepter_new_child_end(nadata->acc, NULL, err);
@@ -630,6 +668,29 @@ netna_readhandler(int fd, void *cbdata)
 		close(new_fd);
 	}
     }
+    return true;
+}
+
+static void
+netna_readhandler(int fd, void *cbdata)
+{
+    struct netna_data *nadata = cbdata;
+    unsigned int count = 0;
+
+    /*
+     * If edge-triggered, there will be no more events for connections
+     * already waiting, so accept until there are none left.  If
+     * connections keep coming, give other things a chance to run and
+     * have the selector check the fd again.
+     */
+    while (netna_accept_one(nadata, fd) && nadata->edge_triggered &&
+	   nadata->accept_enabled) {
+	if (++count < NETNA_MAX_EDGE_ACCEPTS)
+	    continue;
+	nadata->o->set_read_handler(nadata->o, fd, false);
+	nadata->o->set_read_handler(nadata->o, fd, true);
+	break;
+    }
 }
 
 static int
@@ -648,8 +709,10 @@ netna_startup(struct gensio_accepter *accepter, struct netna_data *nadata)
     rv = gensio_open_socket(nadata->o, nadata->ai,
 			    netna_readhandler, NULL, netna_fd_cleared, nadata,
 			    &nadata->acceptfds, &nadata->nr_acceptfds);
-    if (!rv)
+    if (!rv) {
+	nadata->edge_triggered = netna_set_edge_triggered(nadata);
 	netna_set_fd_enables(nadata, true);
+    }
     return rv;
 }
 
@@ -693,6 +756,7 @@ netna_set_accept_callback_enable(struct gensio_accepter *accepter,
     unsigned int i;
 
     nadata->cb_en_done = done;
+    nadata->accept_enabled = enabled;
     for (i = 0; i < nadata->nr_acceptfds; i++)
 	nadata->o->set_read_handler(nadata->o, nadata->acceptfds[i].fd,
 				    enabled);
@@ -193,6 +193,14 @@ gensio_os_accept(struct gensio_os_funcs *o,
     return gensio_os_err_to_err(o, errno);
 }
 
+struct gensio_os_funcs *
+gensio_os_get_shard(struct gensio_os_funcs *o)
+{
+    if (o->get_shard)
+	return o->get_shard(o);
+    return o;
+}
+
 #ifdef HAVE_LIBSCTP
 int
 gensio_os_sctp_recvmsg(struct gensio_os_funcs *o,
@@ -694,6 +694,7 @@ sctpna_readhandler(int fd, void *cbdata)
     socklen_t addrlen = sizeof(addr);
     struct sctp_data *tdata = NULL;
     struct gensio *io = NULL;
+    struct gensio_os_funcs *o;
     int err;
 
     err = gensio_os_accept(nadata->o,
@@ -713,7 +714,10 @@ sctpna_readhandler(int fd, void *cbdata)
 	return;
     }
 
-    tdata = nadata->o->zalloc(nadata->o, sizeof(*tdata));
+    /* The new connection may be handled by another OS handler. */
+    o = gensio_os_get_shard(nadata->o);
+
+    tdata = o->zalloc(o, sizeof(*tdata));
     if (!tdata) {
 	gensio_acc_log(nadata->acc, GENSIO_LOG_INFO,
 		       "Error accepting net gensio: out of memory");
@@ -721,7 +725,7 @@ sctpna_readhandler(int fd, void *cbdata)
 	goto out_err;
     }
 
-    tdata->o = nadata->o;
+    tdata->o = o;
     tdata->fd = new_fd;
     tdata->nodelay = nadata->nodelay;
 
@@ -735,7 +739,7 @@ sctpna_readhandler(int fd, void *cbdata)
 	goto out_err;
     }
 
-    tdata->ll = fd_gensio_ll_alloc(nadata->o, new_fd, &sctp_server_fd_ll_ops,
+    tdata->ll = fd_gensio_ll_alloc(o, new_fd, &sctp_server_fd_ll_ops,
 				   tdata, nadata->max_read_size, false);
     if (!tdata->ll) {
 	gensio_acc_log(nadata->acc, GENSIO_LOG_ERR,
@@ -744,7 +748,7 @@ sctpna_readhandler(int fd, void *cbdata)
 	goto out_err;
     }
 
-    io = base_gensio_server_alloc(nadata->o, tdata->ll, NULL, NULL, "sctp",
+    io = base_gensio_server_alloc(o, tdata->ll, NULL, NULL, "sctp",
 				  sctpna_finish_server_open, nadata);
     if (!io) {
 	gensio_acc_log(nadata->acc, GENSIO_LOG_ERR,
@@ -22,6 +22,13 @@
 struct gensio_data {
     struct selector_s *sel;
     int wake_sig;
+    bool free_sel; /* Allocated by gensio_alloc_os_funcs(). */
+
+    /* See gensio_selector_add_shard(). */
+    lock_type shard_lock;
+    struct gensio_os_funcs **shards;
+    unsigned int nr_shards;
+    unsigned int next_shard;
 };
 
 #ifdef ENABLE_INTERNAL_TRACE
@@ -294,6 +301,14 @@ gensio_sel_set_except_handler(struct gensio_os_funcs *f, int fd, bool enable)
     sel_set_fd_except_handler(d->sel, fd, op);
 }
 
+static bool
+gensio_sel_set_fd_edge_triggered(struct gensio_os_funcs *f, int fd)
+{
+    struct gensio_data *d = f->user_data;
+
+    return sel_set_fd_edge_triggered(d->sel, fd) == 0;
+}
+
 struct gensio_timer {
     struct gensio_os_funcs *f;
     void (*handler)(struct gensio_timer *t, void *cb_data);
@@ -600,10 +615,57 @@ gensio_sel_service(struct gensio_os_funcs *f, struct timeval *timeout)
 static void
 gensio_sel_free_funcs(struct gensio_os_funcs *f)
 {
+    struct gensio_data *d = f->user_data;
+
+    LOCK_DESTROY(&d->shard_lock);
+    if (d->shards)
+	free(d->shards);
+    if (d->free_sel)
+	sel_free_selector(d->sel);
     free(f->user_data);
     free(f);
 }
 
+static struct gensio_os_funcs *
+gensio_sel_get_shard(struct gensio_os_funcs *f)
+{
+    struct gensio_data *d = f->user_data;
+    struct gensio_os_funcs *rv = f;
+
+    LOCK(&d->shard_lock);
+    if (d->nr_shards) {
+	rv = d->shards[d->next_shard];
+	if (++d->next_shard >= d->nr_shards)
+	    d->next_shard = 0;
+    }
+    UNLOCK(&d->shard_lock);
+    return rv;
+}
+
+int
+gensio_selector_add_shard(struct gensio_os_funcs *o,
+			  struct gensio_os_funcs *shard)
+{
+    struct gensio_data *d = o->user_data;
+    struct gensio_os_funcs **shards;
+
+    LOCK(&d->shard_lock);
+    shards = malloc((d->nr_shards + 1) * sizeof(*shards));
+    if (!shards) {
+	UNLOCK(&d->shard_lock);
+	return GE_NOMEM;
+    }
+    if (d->shards) {
+	memcpy(shards, d->shards, d->nr_shards * sizeof(*shards));
+	free(d->shards);
+    }
+    shards[d->nr_shards++] = shard;
+    d->shards = shards;
+    UNLOCK(&d->shard_lock);
+
+    return 0;
+}
+
 static lock_type once_lock = LOCK_INITIALIZER;
 
 static void
@@ -657,6 +719,7 @@ gensio_selector_alloc(struct selector_s *sel, int wake_sig)
     o->user_data = d;
     d->sel = sel;
     d->wake_sig = wake_sig;
+    LOCK_INIT(&d->shard_lock);
 
     o->zalloc = gensio_sel_zalloc;
     o->free = gensio_sel_free;
@@ -690,6 +753,8 @@ gensio_selector_alloc(struct selector_s *sel, int wake_sig)
     o->get_monotonic_time = gensio_sel_get_monotonic_time;
     o->handle_fork = gensio_handle_fork;
     o->wait_intr_sigmask = gensio_sel_wait_intr_sigmask;
+    o->set_fd_edge_triggered = gensio_sel_set_fd_edge_triggered;
+    o->get_shard = gensio_sel_get_shard;
 
     return o;
 }
@@ -775,6 +840,42 @@ gensio_default_os_hnd(int wake_sig, struct gensio_os_funcs **o)
     return 0;
 }
 
+int
+gensio_alloc_os_funcs(int wake_sig, unsigned int flags,
+		      struct gensio_os_funcs **o)
+{
+    struct selector_s *sel;
+    struct gensio_os_funcs *no;
+    unsigned int sel_flags = 0;
+    int rv;
+
+    if (flags & ~GENSIO_OS_FUNCS_TIMER_WHEEL)
+	return GE_INVAL;
+    if (flags & GENSIO_OS_FUNCS_TIMER_WHEEL)
+	sel_flags |= SEL_TIMER_WHEEL;
+
+#ifdef USE_PTHREADS
+    rv = sel_alloc_selector_flags(&sel, wake_sig, defsel_lock_alloc,
+				  defsel_lock_free, defsel_lock,
+				  defsel_unlock, NULL, sel_flags);
+#else
+    rv = sel_alloc_selector_flags(&sel, wake_sig, NULL, NULL, NULL, NULL,
+				  NULL, sel_flags);
+#endif
+    if (rv)
+	return GE_NOMEM;
+
+    no = gensio_selector_alloc(sel, wake_sig);
+    if (!no) {
+	sel_free_selector(sel);
+	return GE_NOMEM;
+    }
+    ((struct gensio_data *) no->user_data)->free_sel = true;
+
+    *o = no;
+    return 0;
+}
+
 void
 gensio_sel_exit(int rv)
 {
@@ -150,6 +150,23 @@ sslna_finish_parent(void *acc_data, void *finish_data, struct gensio *io)
     return 0;
 }
 
+static int
+sslna_control(void *acc_data, bool get, unsigned int option,
+	      char *data, gensiods *datalen)
+{
+    struct sslna_data *nadata = acc_data;
+
+    switch (option) {
+    case GENSIO_ACC_CONTROL_RELOAD_CERTS:
+	if (get)
+	    return GE_NOTSUP;
+	return gensio_ssl_filter_reload(nadata->data);
+
+    default:
+	return GE_NOTSUP;
+    }
+}
+
 static int
 gensio_gensio_acc_ssl_cb(void *acc_data, int op, void *data1, void *data2,
 			 void *data3, const void *data4)
@@ -168,6 +185,10 @@ gensio_gensio_acc_ssl_cb(void *acc_data, int op, void *data1, void *data2,
 	sslna_free(acc_data);
 	return 0;
 
+    case GENSIO_GENSIO_ACC_CONTROL:
+	return sslna_control(acc_data, *((bool *) data1),
+			     *((unsigned int *) data4), data2, data3);
+
     default:
 	return GE_NOTSUP;
     }
@@ -34,6 +34,12 @@
  */
 #define GENSIO_DEFAULT_UDP_BUF_SIZE	65536
 
+/*
+ * Maximum number of packets read on an edge-triggered fd before
+ * letting other things run.
+ */
+#define UDPNA_MAX_EDGE_READS		16
+
 struct udpna_data;
 
 enum udpn_state {
@@ -141,6 +147,12 @@ struct udpna_data {
     bool in_write;
     unsigned int read_disable_count;
     bool read_disabled;
+
+    /*
+     * The fds are edge-triggered, so reads must be done until there
+     * is no more data.
+     */
+    bool edge_triggered;
     unsigned int write_enable_count;
 
 #ifdef LOCK_TRACING
@@ -230,6 +242,23 @@ static void udpn_add_to_list(struct gensio_list *list, struct udpn_data *ndata)
     gensio_list_add_tail(list, &ndata->link);
 }
 
+static bool
+udpna_set_edge_triggered(struct udpna_data *nadata)
+{
+    struct gensio_os_funcs *o = nadata->o;
+    unsigned int i;
+    bool rv = false;
+
+    if (!o->set_fd_edge_triggered)
+	return false;
+    /* Draining a level-triggered fd is harmless, so any will do. */
+    for (i = 0; i < nadata->nr_fds; i++) {
+	if (o->set_fd_edge_triggered(o, nadata->fds[i].fd))
+	    rv = true;
+    }
+    return rv;
+}
+
 static void
 udpna_enable_read(struct udpna_data *nadata)
 {
@@ -482,7 +511,8 @@ udpn_finish_read(struct udpn_data *ndata)
  retry:
     udpna_unlock(nadata);
     count = nadata->data_pending_len;
-    gensio_cb(io, GENSIO_EVENT_READ, 0, nadata->read_data, &count, NULL);
+    gensio_cb(io, GENSIO_EVENT_READ, 0, nadata->read_data + nadata->data_pos,
+	      &count, NULL);
     udpna_lock(nadata);
 
     if (ndata->state == UDPN_IN_CLOSE) {
@@ -924,15 +954,19 @@ udp_alloc_gensio(struct udpna_data *nadata, int fd, struct sockaddr *addr,
     return ndata;
 }
 
-static void
-udpna_readhandler(int fd, void *cbdata)
+/*
+ * Read and handle a single packet.  Returns true if the fd is
+ * edge-triggered and more packets should be read.
+ */
+static bool
+udpna_read_one(struct udpna_data *nadata, int fd)
 {
-    struct udpna_data *nadata = cbdata;
     struct udpn_data *ndata;
     struct udpna_waiters *waiters = NULL, *next;
     struct sockaddr_storage addr;
     socklen_t addrlen = sizeof(addr);
     gensiods datalen;
+    bool again = false;
     int err;
 
     udpna_lock_and_ref(nadata);
@@ -946,6 +980,8 @@ udpna_readhandler(int fd, void *cbdata)
     if (err) {
 	gensio_acc_log(nadata->acc, GENSIO_LOG_ERR,
 		       "Could not accept on UDP: %s", gensio_err_to_str(err));
+	/* The error has been consumed, more data may be waiting. */
+	again = true;
 	goto out_unlock;
     }
     if (datalen == 0)
@@ -963,9 +999,15 @@ udpna_readhandler(int fd, void *cbdata)
     nadata->data_pos = 0;
 
     ndata = udpn_find(&nadata->udpns, (struct sockaddr *) &addr, addrlen);
-    if (ndata)
-	/* Data belongs to an existing connection. */
+    if (ndata) {
+	/*
+	 * Data belongs to an existing connection.  If it doesn't take
+	 * it all now, it must be able to get the rest when it enables
+	 * read again.
+	 */
+	nadata->pending_data_owner = ndata;
 	goto got_ndata;
+    }
 
     if (nadata->closed || !nadata->enabled) {
 	nadata->data_pending_len = 0;
@@ -1029,7 +1071,9 @@ udpna_readhandler(int fd, void *cbdata)
 		   "Out of memory allocating for udp port");
  out_unlock_enable:
     udpna_fd_read_enable(nadata);
+    again = true;
  out_unlock:
+    again = again && nadata->edge_triggered && !nadata->read_disabled;
     udpna_deref_and_unlock(nadata);
 
     while (waiters) {
@@ -1039,7 +1083,32 @@ udpna_readhandler(int fd, void *cbdata)
 	waiters = next;
     }
 
-    return;
+    return again;
+}
+
+static void
+udpna_readhandler(int fd, void *cbdata)
+{
+    struct udpna_data *nadata = cbdata;
+    unsigned int count = 0;
+
+    /*
+     * If edge-triggered, there will be no more events for packets
+     * already waiting, so read until there are none left.  If
+     * packets keep coming, give other things a chance to run and
+     * have the selector check the fd again.
+     */
+    while (udpna_read_one(nadata, fd)) {
+	if (++count < UDPNA_MAX_EDGE_READS)
+	    continue;
+	udpna_lock(nadata);
+	if (!nadata->read_disabled) {
+	    nadata->o->set_read_handler(nadata->o, fd, false);
+	    nadata->o->set_read_handler(nadata->o, fd, true);
+	}
+	udpna_unlock(nadata);
+	break;
+    }
 }
 
 static int
@@ -1056,6 +1125,7 @@ udpna_startup(struct gensio_accepter *accepter)
 				&nadata->fds, &nadata->nr_fds);
 	if (rv)
 	    goto out_unlock;
+	nadata->edge_triggered = udpna_set_edge_triggered(nadata);
     }
 
     nadata->enabled = true;
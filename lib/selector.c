@@ -26,6 +26,15 @@
 #include <signal.h>
 #include <string.h>
 #include <assert.h>
+#include <fcntl.h>
+#include <stddef.h>
+#include <stdint.h>
+#ifdef USE_PTHREADS
+#include <pthread.h>
+#endif
+#ifdef HAVE_SYS_EVENTFD_H
+#include <sys/eventfd.h>
+#endif
 #ifdef HAVE_EPOLL_PWAIT
 #include <sys/epoll.h>
 #else
@@ -114,6 +123,11 @@ typedef struct fd_state_s
     void              *done_cbdata;
 } fd_state_t;
 
+/* Bits for the handlers enabled on an fd, see fd_control_t. */
+#define SEL_FD_READ	(1 << 0)
+#define SEL_FD_WRITE	(1 << 1)
+#define SEL_FD_EXCEPT	(1 << 2)
+
 /* The control structure for each file descriptor. */
 typedef struct fd_control_s
 {
@@ -125,11 +139,34 @@ typedef struct fd_control_s
     sel_fd_handler_t handle_read;
     sel_fd_handler_t handle_write;
     sel_fd_handler_t handle_except;
+
+    /* Which handlers are enabled, a combination of SEL_FD_xxx bits. */
+    unsigned int     enabled;
+
+    /* The value of fd_del_count the last time this fd was deleted or
+       had its handlers replaced.  Used to detect stale events. */
+    unsigned long del_count;
 #ifdef HAVE_EPOLL_PWAIT
     uint32_t saved_events;
+
+    /*
+     * Set if the fd is registered edge-triggered, see
+     * sel_set_fd_edge_triggered().  et_pending holds events that
+     * came in while et_running was set, the thread running the
+     * handlers will handle them.
+     */
+    int edge_triggered;
+    int et_running;
+    uint32_t et_pending;
 #endif
 } fd_control_t;
 
+/* A link in the lists of the timer wheel. */
+typedef struct sel_wheel_link_s
+{
+    struct sel_wheel_link_s *next, *prev;
+} sel_wheel_link_t;
+
 typedef struct heap_val_s
 {
     /* Set this to the function to call when the timeout occurs. */
@@ -159,6 +196,16 @@ typedef struct heap_val_s
 
     sel_timeout_handler_t done_handler;
     void *done_cb_data;
+
+    /*
+     * If the selector uses a timer wheel, this is used instead of the
+     * heap.  wheel_tick is the timeout in msecs, wheel_level and
+     * wheel_idx are the list the timer is in, see sel_wheel_add().
+     */
+    sel_wheel_link_t wheel_link;
+    uint64_t wheel_tick;
+    int wheel_level;
+    unsigned int wheel_idx;
 } heap_val_t;
 
 typedef struct theap_s theap_t;
@@ -195,6 +242,359 @@ heap_cmp_key(heap_val_t *v1, heap_val_t *v2)
 
 #include "heap.h"
 
+/*
+ * A hierarchical timing wheel, an alternative to the heap for
+ * selectors with lots of timers that are started and stopped all the
+ * time.  Adding and removing a timer is O(1), the heap is O(log n).
+ *
+ * Time is in msec ticks of the monotonic clock.  Level 0 has a slot
+ * for each of the next SEL_WHEEL_L0_SIZE ticks, each higher level
+ * has SEL_WHEEL_LN_SIZE slots that each cover a whole rotation of the
+ * level below it.  When level 0 wraps, the next slot of level 1 is
+ * "cascaded", its timers are moved down to level 0, and so on up the
+ * levels.  Timers past the end of the top level go in its last slot
+ * and are cascaded again until they fit.  Timers that are due are
+ * moved to the expired list, where process_timers() takes them from.
+ *
+ * Timeouts are rounded up to the next msec, so a timer never goes off
+ * early, but may go off up to a msec late.
+ */
+#define SEL_WHEEL_L0_BITS	8
+#define SEL_WHEEL_L0_SIZE	(1 << SEL_WHEEL_L0_BITS)
+#define SEL_WHEEL_L0_MASK	(SEL_WHEEL_L0_SIZE - 1)
+#define SEL_WHEEL_LN_BITS	6
+#define SEL_WHEEL_LN_SIZE	(1 << SEL_WHEEL_LN_BITS)
+#define SEL_WHEEL_LN_MASK	(SEL_WHEEL_LN_SIZE - 1)
+#define SEL_WHEEL_LEVELS	3 /* Not counting level 0. */
+
+/* wheel_level for a timer in the expired list. */
+#define SEL_WHEEL_EXPIRED	-1
+
+typedef struct sel_wheel_s
+{
+    /* The next tick to process, everything before it is done. */
+    uint64_t clk;
+
+    /*
+     * The earliest tick that threads waiting in the selector will
+     * wake up at.  Adding a timer before this sets wake, to tell
+     * wake_timer_sel_thread() to wake them.
+     */
+    uint64_t next_tick;
+    int wake;
+
+    /* Number of timers in the slots, not counting expired ones. */
+    unsigned int count;
+
+    sel_wheel_link_t expired;
+    sel_wheel_link_t l0[SEL_WHEEL_L0_SIZE];
+    sel_wheel_link_t ln[SEL_WHEEL_LEVELS][SEL_WHEEL_LN_SIZE];
+
+    /* Bitmaps of the non-empty slots, to quickly skip empty ones. */
+    uint64_t l0_map[SEL_WHEEL_L0_SIZE / 64];
+    uint64_t ln_map[SEL_WHEEL_LEVELS];
+} sel_wheel_t;
+
+#define wheel_link_to_timer(l) \
+    ((sel_timer_t *) (((char *) (l)) - offsetof(sel_timer_t, val.wheel_link)))
+
+/* Return the lowest set bit in v, or -1 if none are set. */
+static int
+sel_wheel_ffs(uint64_t v)
+{
+#ifdef __GNUC__
+    return v ? __builtin_ctzll(v) : -1;
+#else
+    int i;
+
+    for (i = 0; i < 64; i++) {
+	if (v & (1ULL << i))
+	    return i;
+    }
+    return -1;
+#endif
+}
+
+static uint64_t
+sel_wheel_tick(const struct timeval *tv)
+{
+    /* Round up so a timer never goes off early. */
+    return (uint64_t) tv->tv_sec * 1000 + (tv->tv_usec + 999) / 1000;
+}
+
+static void
+sel_wheel_list_init(sel_wheel_link_t *list)
+{
+    list->next = list;
+    list->prev = list;
+}
+
+static void
+sel_wheel_list_add(sel_wheel_link_t *list, sel_wheel_link_t *link)
+{
+    link->next = list;
+    link->prev = list->prev;
+    list->prev->next = link;
+    list->prev = link;
+}
+
+static void
+sel_wheel_init(sel_wheel_t *w, uint64_t now)
+{
+    unsigned int i, j;
+
+    w->clk = now;
+    w->next_tick = UINT64_MAX;
+    sel_wheel_list_init(&w->expired);
+    for (i = 0; i < SEL_WHEEL_L0_SIZE; i++)
+	sel_wheel_list_init(&w->l0[i]);
+    for (i = 0; i < SEL_WHEEL_LEVELS; i++) {
+	for (j = 0; j < SEL_WHEEL_LN_SIZE; j++)
+	    sel_wheel_list_init(&w->ln[i][j]);
+    }
+}
+
+static void
+sel_wheel_set_next(sel_wheel_t *w, uint64_t tick)
+{
+    if (tick < w->next_tick) {
+	w->next_tick = tick;
+	w->wake = 1;
+    }
+}
+
+static void
+sel_wheel_add_expired(sel_wheel_t *w, sel_timer_t *timer)
+{
+    timer->val.wheel_level = SEL_WHEEL_EXPIRED;
+    sel_wheel_list_add(&w->expired, &timer->val.wheel_link);
+    sel_wheel_set_next(w, 0);
+}
+
+/* Put a timer in the right slot for its wheel_tick. */
+static void
+sel_wheel_add(sel_wheel_t *w, sel_timer_t *timer)
+{
+    uint64_t tick = timer->val.wheel_tick, delta;
+    unsigned int shift = SEL_WHEEL_L0_BITS, idx;
+    int level;
+
+    if (tick < w->clk) {
+	sel_wheel_add_expired(w, timer);
+	return;
+    }
+
+    delta = tick - w->clk;
+    if (delta < SEL_WHEEL_L0_SIZE) {
+	idx = tick & SEL_WHEEL_L0_MASK;
+	w->l0_map[idx / 64] |= 1ULL << (idx % 64);
+	sel_wheel_list_add(&w->l0[idx], &timer->val.wheel_link);
+	level = 0;
+    } else {
+	for (level = 0; level < SEL_WHEEL_LEVELS - 1; level++) {
+	    if (delta < 1ULL << (shift + SEL_WHEEL_LN_BITS))
+		break;
+	    shift += SEL_WHEEL_LN_BITS;
+	}
+	if (delta >= 1ULL << (shift + SEL_WHEEL_LN_BITS))
+	    /* Too far out, it will be cascaded until it fits. */
+	    tick = w->clk + (1ULL << (shift + SEL_WHEEL_LN_BITS)) - 1;
+	idx = (tick >> shift) & SEL_WHEEL_LN_MASK;
+	w->ln_map[level] |= 1ULL << idx;
+	sel_wheel_list_add(&w->ln[level][idx], &timer->val.wheel_link);
+	level++;
+    }
+    timer->val.wheel_level = level;
+    timer->val.wheel_idx = idx;
+    w->count++;
+    sel_wheel_set_next(w, timer->val.wheel_tick);
+}
+
+static void
+sel_wheel_remove(sel_wheel_t *w, sel_timer_t *timer)
+{
+    sel_wheel_link_t *link = &timer->val.wheel_link;
+    int level = timer->val.wheel_level;
+    unsigned int idx = timer->val.wheel_idx;
+
+    link->next->prev = link->prev;
+    link->prev->next = link->next;
+    if (level == SEL_WHEEL_EXPIRED)
+	return;
+    w->count--;
+    if (level == 0) {
+	if (w->l0[idx].next == &w->l0[idx])
+	    w->l0_map[idx / 64] &= ~(1ULL << (idx % 64));
+    } else {
+	if (w->ln[level - 1][idx].next == &w->ln[level - 1][idx])
+	    w->ln_map[level - 1] &= ~(1ULL << idx);
+    }
+}
+
+/* Move the timers in a slot of level 1 or higher down the wheel. */
+static void
+sel_wheel_cascade(sel_wheel_t *w, int level, unsigned int idx)
+{
+    sel_wheel_link_t *list = &w->ln[level][idx];
+
+    while (list->next != list) {
+	sel_timer_t *timer = wheel_link_to_timer(list->next);
+
+	sel_wheel_remove(w, timer);
+	sel_wheel_add(w, timer);
+    }
+}
+
+/* Find the first non-empty level 0 slot at or after start. */
+static int
+sel_wheel_l0_next(sel_wheel_t *w, unsigned int start)
+{
+    unsigned int i = start / 64;
+    uint64_t v;
+    int bit;
+
+    if (start >= SEL_WHEEL_L0_SIZE)
+	return -1;
+    v = w->l0_map[i] & ~((1ULL << (start % 64)) - 1);
+    for (;;) {
+	bit = sel_wheel_ffs(v);
+	if (bit >= 0)
+	    return i * 64 + bit;
+	if (++i >= SEL_WHEEL_L0_SIZE / 64)
+	    return -1;
+	v = w->l0_map[i];
+    }
+}
+
+/* Move all timers due at or before now to the expired list. */
+static void
+sel_wheel_advance(sel_wheel_t *w, uint64_t now)
+{
+    unsigned int idx, level, shift;
+    uint64_t target;
+    int next;
+
+    while (w->clk <= now) {
+	if (w->count == 0) {
+	    /* Nothing in the wheel, just jump ahead. */
+	    w->clk = now + 1;
+	    break;
+	}
+
+	idx = w->clk & SEL_WHEEL_L0_MASK;
+	if (idx == 0) {
+	    shift = SEL_WHEEL_L0_BITS;
+	    for (level = 0; level < SEL_WHEEL_LEVELS; level++) {
+		unsigned int lidx = (w->clk >> shift) & SEL_WHEEL_LN_MASK;
+
+		sel_wheel_cascade(w, level, lidx);
+		if (lidx != 0)
+		    break;
+		shift += SEL_WHEEL_LN_BITS;
+	    }
+	}
+
+	while (w->l0[idx].next != &w->l0[idx]) {
+	    sel_timer_t *timer = wheel_link_to_timer(w->l0[idx].next);
+
+	    sel_wheel_remove(w, timer);
+	    sel_wheel_add_expired(w, timer);
+	}
+
+	/* Skip the empty slots, but stop at the next cascade. */
+	next = sel_wheel_l0_next(w, idx + 1);
+	if (next < 0)
+	    next = SEL_WHEEL_L0_SIZE;
+	target = (w->clk & ~((uint64_t) SEL_WHEEL_L0_MASK)) + next;
+	w->clk = target > now + 1 ? now + 1 : target;
+    }
+}
+
+/*
+ * Return the earliest tick any timer may go off at in tick, or false
+ * if there are no timers.  For timers above level 0 this is the tick
+ * its slot is cascaded at.
+ */
+static int
+sel_wheel_next(sel_wheel_t *w, uint64_t *tick)
+{
+    uint64_t best, cand, cur, below;
+    unsigned int idx, level, shift;
+    int next;
+
+    if (w->expired.next != &w->expired) {
+	*tick = 0;
+	return 1;
+    }
+    if (w->count == 0)
+	return 0;
+
+    idx = w->clk & SEL_WHEEL_L0_MASK;
+    next = sel_wheel_l0_next(w, idx);
+    if (next >= 0) {
+	/* Anything else is after the next cascade. */
+	*tick = (w->clk & ~((uint64_t) SEL_WHEEL_L0_MASK)) + next;
+	return 1;
+    }
+
+    best = UINT64_MAX;
+    next = sel_wheel_l0_next(w, 0);
+    if (next >= 0)
+	best = (w->clk & ~((uint64_t) SEL_WHEEL_L0_MASK)) + SEL_WHEEL_L0_SIZE
+	    + next;
+
+    shift = SEL_WHEEL_L0_BITS;
+    for (level = 0; level < SEL_WHEEL_LEVELS; level++) {
+	uint64_t map = w->ln_map[level];
+
+	if (map) {
+	    cur = w->clk >> shift;
+	    idx = cur & SEL_WHEEL_LN_MASK;
+	    /*
+	     * The slot for cur has already been cascaded, anything in
+	     * it is a whole rotation away.
+	     */
+	    below = (2ULL << idx) - 1;
+	    if (map & ~below)
+		next = sel_wheel_ffs(map & ~below) - idx;
+	    else
+		next = sel_wheel_ffs(map & below) + SEL_WHEEL_LN_SIZE - idx;
+	    cand = (cur + next) << shift;
+	    if (cand < best)
+		best = cand;
+	}
+	shift += SEL_WHEEL_LN_BITS;
+    }
+    *tick = best;
+    return 1;
+}
+
+static void
+sel_wheel_free_list(sel_wheel_link_t *list)
+{
+    while (list->next != list) {
+	sel_wheel_link_t *link = list->next;
+
+	list->next = link->next;
+	free(wheel_link_to_timer(link));
+    }
+}
+
+static void
+sel_wheel_free(sel_wheel_t *w)
+{
+    unsigned int i, j;
+
+    sel_wheel_free_list(&w->expired);
+    for (i = 0; i < SEL_WHEEL_L0_SIZE; i++)
+	sel_wheel_free_list(&w->l0[i]);
+    for (i = 0; i < SEL_WHEEL_LEVELS; i++) {
+	for (j = 0; j < SEL_WHEEL_LN_SIZE; j++)
+	    sel_wheel_free_list(&w->ln[i][j]);
+    }
+    free(w);
+}
+
 /* Used to build a list of threads that may need to be woken if a
    timer on the top of the heap changes, or an FD is added/removed.
    See i_wake_sel_thread() for more info. */
@@ -207,21 +607,27 @@ typedef struct sel_wait_list_s
     sel_send_sig_cb send_sig;
     void            *send_sig_cb_data;
 
+    /* With a wake fd, the thread's wake, used instead of send_sig. */
+    sel_thread_wake_t *wake;
+
     struct sel_wait_list_s *next, *prev;
 } sel_wait_list_t;
 
+/* Initial size of the fd table, it is grown as needed. */
+#define SEL_INITIAL_FDS 64
+
 struct selector_s
 {
-    /* This is an array of all the file descriptors possible.  This is
-       moderately wasteful of space, but easy to do.  Hey, memory is
-       cheap. */
-    volatile fd_control_t fds[FD_SETSIZE];
-
-    /* These are the offical fd_sets used to track what file descriptors
-       need to be monitored. */
-    volatile fd_set read_set;
-    volatile fd_set write_set;
-    volatile fd_set except_set;
+    /*
+     * This is an array of control structures indexed by file
+     * descriptor.  It holds max_fds entries and is grown when a larger
+     * fd is registered.  With epoll it can grow without bound, with
+     * select it is limited to FD_SETSIZE.  It may be reallocated
+     * whenever fd_lock is not held, so pointers into it must not be
+     * kept across dropping the lock.
+     */
+    fd_control_t *fds;
+    unsigned int max_fds;
 
     volatile int maxfd; /* The largest file descriptor registered with
 			   this code. */
@@ -236,6 +642,9 @@ struct selector_s
     /* The timer heap. */
     theap_t timer_heap;
 
+    /* If not NULL, timers are kept in this instead of the heap. */
+    sel_wheel_t *timer_wheel;
+
     /* This is a list of items waiting to be woken up because they are
        sitting in a select.  See i_wake_sel_thread() for more info. */
     sel_wait_list_t wait_list;
@@ -247,8 +656,26 @@ struct selector_s
 
     int wake_sig;
 
+    /*
+     * If set, threads are woken with their own wake fd instead of by
+     * sending them wake_sig, see sel_thread_wake_s.
+     */
+    int use_wake_fd;
+
 #ifdef HAVE_EPOLL_PWAIT
     int epollfd;
+
+    /*
+     * Unique for each epollfd created, so a thread's wake epoll can
+     * tell if it has this selector's epollfd, see sel_thread_wake_s.
+     */
+    unsigned long epoll_id;
+
+    /* Maximum number of events to pull from epoll on each wakeup. */
+    unsigned int max_fd_events;
+
+    /* Can fds be switched to edge-triggered? */
+    int edge_triggered;
 #endif
     sel_lock_t *(*sel_lock_alloc)(void *cb_data);
     void (*sel_lock_free)(sel_lock_t *);
@@ -284,6 +711,238 @@ sel_fd_unlock(struct selector_s *sel)
 	sel->sel_unlock(sel->fd_lock);
 }
 
+/*
+ * Each thread that waits in a selector with use_wake_fd set has its
+ * own wake fd, an eventfd (or a pipe if eventfd is not available).
+ * It is written to wake the thread, and the thread reads it when it
+ * sees it, so a wake is consumed by the thread it was for.  If the
+ * thread is not waiting yet, it stays readable and the thread returns
+ * right away from its next wait.  The fd is not registered with the
+ * selector, the thread adds it to what it waits on itself, so no
+ * other thread ever sees it.
+ *
+ * With epoll, the thread has its own epoll set holding its wake fd
+ * and the epoll fd of the selector it waits in, so it blocks in one
+ * epoll_pwait() for both.  If the selector's epoll fd is ready it
+ * gets the events from it without waiting.  Since that is two calls
+ * per wakeup, after a wakeup that got events the thread first looks
+ * for more events without waiting, so a busy thread only does one
+ * call per wakeup.  A wake that comes in meanwhile stays until the
+ * next time the thread blocks.
+ *
+ * This is per thread, not per selector, since a thread only waits in
+ * one selector at a time.  It is freed when the thread exits.
+ */
+struct sel_thread_wake_s
+{
+    int fds[2]; /* fds[1] is written, it is the same as fds[0] for eventfd */
+#ifdef HAVE_EPOLL_PWAIT
+    int epollfd; /* -1 until the thread waits with epoll. */
+    unsigned long epoll_id; /* The selector epoll in epollfd, 0 if none. */
+    int sel_epollfd;
+    int busy; /* The last wait got fd events. */
+#endif
+};
+
+static int
+sel_open_wake_fd(int fds[2])
+{
+    int i;
+
+#ifdef HAVE_SYS_EVENTFD_H
+    fds[0] = eventfd(0, EFD_CLOEXEC | EFD_NONBLOCK);
+    if (fds[0] != -1) {
+	fds[1] = fds[0];
+	return 0;
+    }
+#endif
+    if (pipe(fds) == -1)
+	return errno;
+    for (i = 0; i < 2; i++) {
+	if (fcntl(fds[i], F_SETFD, FD_CLOEXEC) == -1 ||
+		fcntl(fds[i], F_SETFL, O_NONBLOCK) == -1) {
+	    i = errno;
+	    close(fds[0]);
+	    close(fds[1]);
+	    return i;
+	}
+    }
+    return 0;
+}
+
+static void
+sel_close_wake_fd(int fds[2])
+{
+    close(fds[0]);
+    if (fds[1] != fds[0])
+	close(fds[1]);
+    fds[0] = -1;
+    fds[1] = -1;
+}
+
+static void
+sel_thread_wake_free(void *data)
+{
+    sel_thread_wake_t *w = data;
+
+    sel_close_wake_fd(w->fds);
+#ifdef HAVE_EPOLL_PWAIT
+    if (w->epollfd != -1)
+	close(w->epollfd);
+#endif
+    free(w);
+}
+
+#ifdef USE_PTHREADS
+static pthread_key_t sel_thread_wake_key;
+static pthread_once_t sel_thread_wake_once = PTHREAD_ONCE_INIT;
+static int sel_thread_wake_key_err;
+
+static void
+sel_thread_wake_key_alloc(void)
+{
+    sel_thread_wake_key_err = pthread_key_create(&sel_thread_wake_key,
+						 sel_thread_wake_free);
+}
+
+static sel_thread_wake_t *
+sel_thread_wake_find(void)
+{
+    if (pthread_once(&sel_thread_wake_once, sel_thread_wake_key_alloc) ||
+		sel_thread_wake_key_err)
+	return NULL;
+    return pthread_getspecific(sel_thread_wake_key);
+}
+
+static int
+sel_thread_wake_set(sel_thread_wake_t *w)
+{
+    return pthread_setspecific(sel_thread_wake_key, w);
+}
+#else
+static sel_thread_wake_t *sel_the_thread_wake;
+
+static sel_thread_wake_t *
+sel_thread_wake_find(void)
+{
+    return sel_the_thread_wake;
+}
+
+static int
+sel_thread_wake_set(sel_thread_wake_t *w)
+{
+    sel_the_thread_wake = w;
+    return 0;
+}
+#endif
+
+sel_thread_wake_t *
+sel_get_thread_wake(struct selector_s *sel)
+{
+    sel_thread_wake_t *w;
+
+    if (!sel->use_wake_fd)
+	return NULL;
+
+    w = sel_thread_wake_find();
+    if (w)
+	return w;
+
+    w = malloc(sizeof(*w));
+    if (!w)
+	return NULL;
+#ifdef HAVE_EPOLL_PWAIT
+    w->epollfd = -1;
+    w->epoll_id = 0;
+    w->busy = 0;
+#endif
+    if (sel_open_wake_fd(w->fds)) {
+	free(w);
+	return NULL;
+    }
+    if (sel_thread_wake_set(w)) {
+	sel_thread_wake_free(w);
+	return NULL;
+    }
+    return w;
+}
+
+void
+sel_wake_thread(sel_thread_wake_t *w)
+{
+    ssize_t rv;
+#ifdef HAVE_SYS_EVENTFD_H
+    uint64_t val = 1;
+
+    if (w->fds[0] == w->fds[1])
+	rv = write(w->fds[1], &val, sizeof(val));
+    else
+#endif
+	rv = write(w->fds[1], "", 1);
+    /* This can only fail with EAGAIN, and then it's readable anyway. */
+    (void) rv;
+}
+
+/* Consume any wakes for the calling thread. */
+static void
+sel_thread_wake_clear(sel_thread_wake_t *w)
+{
+    char buf[64];
+
+    /* An eventfd is cleared with one read, a pipe may need more. */
+    while (read(w->fds[0], buf, sizeof(buf)) == sizeof(buf))
+	;
+}
+
+/*
+ * After a fork the calling thread's wake fd is shared with the
+ * parent.  Replace it with a new one at the same fd numbers.  Other
+ * threads don't exist in the child.
+ */
+static int
+sel_reopen_wake_fd(struct selector_s *sel)
+{
+    sel_thread_wake_t *w;
+    int fds[2], rv = 0, i;
+
+    if (!sel->use_wake_fd)
+	return 0;
+    w = sel_thread_wake_find();
+    if (!w)
+	return 0;
+
+#ifdef HAVE_EPOLL_PWAIT
+    /* The epoll set is shared with the parent, too, make a new one. */
+    if (w->epollfd != -1) {
+	close(w->epollfd);
+	w->epollfd = -1;
+	w->epoll_id = 0;
+    }
+#endif
+
+    rv = sel_open_wake_fd(fds);
+    if (rv)
+	return rv;
+    if ((fds[0] == fds[1]) != (w->fds[0] == w->fds[1])) {
+	/* Changed type, just use the new one. */
+	sel_close_wake_fd(w->fds);
+	w->fds[0] = fds[0];
+	w->fds[1] = fds[1];
+	return 0;
+    }
+    for (i = 0; i < 2; i++) {
+	if (i == 1 && fds[1] == fds[0])
+	    break;
+	if (dup2(fds[i], w->fds[i]) == -1 ||
+		fcntl(w->fds[i], F_SETFD, FD_CLOEXEC) == -1) {
+	    rv = errno;
+	    break;
+	}
+    }
+    sel_close_wake_fd(fds);
+    return rv;
+}
+
 /* This function will wake the SEL thread.  It must be called with the
    timer lock held, because it messes with timeout.
 
@@ -295,7 +954,12 @@ sel_fd_unlock(struct selector_s *sel)
    zero (causing it to wait zero time).  If select has already been
    called, then the signal send should wake it up.  We only need to do
    this after we have calculated the timeout, but before we have
-   called select, thus only things in the wait list matter. */
+   called select, thus only things in the wait list matter.
+
+   With a wake fd, each thread's wake fd is written instead of
+   sending a signal.  The wake stays until the thread reads it, so a
+   thread that has not called select yet will return from it
+   immediately. */
 static void
 i_wake_sel_thread(struct selector_s *sel)
 {
@@ -303,7 +967,9 @@ i_wake_sel_thread(struct selector_s *sel)
 
     item = sel->wait_list.next;
     while (item != &sel->wait_list) {
-	if (item->send_sig)
+	if (item->wake)
+	    sel_wake_thread(item->wake);
+	else if (item->send_sig)
 	    item->send_sig(item->thread_id, item->send_sig_cb_data);
 	item = item->next;
     }
@@ -317,12 +983,126 @@ sel_wake_all(struct selector_s *sel)
     sel_timer_unlock(sel);
 }
 
+int
+sel_use_wake_fd(struct selector_s *sel)
+{
+    sel->use_wake_fd = 1;
+    /* Make sure it works. */
+    if (!sel_get_thread_wake(sel)) {
+	sel->use_wake_fd = 0;
+	return errno ? errno : ENOMEM;
+    }
+    return 0;
+}
+
+int
+sel_has_wake_fd(struct selector_s *sel)
+{
+    return sel->use_wake_fd;
+}
+
 static void
 wake_timer_sel_thread(struct selector_s *sel, volatile sel_timer_t *old_top)
 {
-    if (old_top != theap_get_top(&sel->timer_heap))
+    if (sel->timer_wheel) {
+	/* If a timer goes off earlier now, restart the waiting thread. */
+	if (sel->timer_wheel->wake) {
+	    sel->timer_wheel->wake = 0;
+	    i_wake_sel_thread(sel);
+	}
+    } else if (old_top != theap_get_top(&sel->timer_heap)) {
 	/* If the top value changed, restart the waiting thread. */
 	i_wake_sel_thread(sel);
+    }
+}
+
+/*
+ * Timer storage, this hides whether the heap or the wheel is in use.
+ * These must be called with the timer lock held.
+ */
+static void
+sel_timers_add(struct selector_s *sel, sel_timer_t *timer)
+{
+    if (sel->timer_wheel) {
+	timer->val.wheel_tick = sel_wheel_tick(&timer->val.timeout);
+	sel_wheel_add(sel->timer_wheel, timer);
+    } else {
+	theap_add(&sel->timer_heap, timer);
+    }
+    timer->val.in_heap = 1;
+}
+
+/* Add a timer that should go off right away. */
+static void
+sel_timers_add_now(struct selector_s *sel, sel_timer_t *timer)
+{
+    sel_get_monotonic_time(&timer->val.timeout);
+    if (sel->timer_wheel)
+	sel_wheel_add_expired(sel->timer_wheel, timer);
+    else
+	theap_add(&sel->timer_heap, timer);
+    timer->val.in_heap = 1;
+}
+
+static void
+sel_timers_remove(struct selector_s *sel, sel_timer_t *timer)
+{
+    if (sel->timer_wheel)
+	sel_wheel_remove(sel->timer_wheel, timer);
+    else
+	theap_remove(&sel->timer_heap, timer);
+    timer->val.in_heap = 0;
+}
+
+/* Return a timer that has expired at now, or NULL if none have. */
+static sel_timer_t *
+sel_timers_get_expired(struct selector_s *sel, struct timeval *now)
+{
+    sel_timer_t *timer;
+
+    if (sel->timer_wheel) {
+	sel_wheel_t *w = sel->timer_wheel;
+
+	if (w->expired.next == &w->expired)
+	    return NULL;
+	return wheel_link_to_timer(w->expired.next);
+    }
+
+    timer = theap_get_top(&sel->timer_heap);
+    if (timer && cmp_timeval(now, &timer->val.timeout) >= 0)
+	return timer;
+    return NULL;
+}
+
+/*
+ * Get the time the next timer goes off (or a time before that) in
+ * next.  Returns false if there are no timers.
+ */
+static int
+sel_timers_get_next(struct selector_s *sel, struct timeval *next)
+{
+    sel_timer_t *timer;
+
+    if (sel->timer_wheel) {
+	sel_wheel_t *w = sel->timer_wheel;
+	uint64_t tick;
+	int rv;
+
+	rv = sel_wheel_next(w, &tick);
+	w->next_tick = rv ? tick : UINT64_MAX;
+	w->wake = 0;
+	if (!rv)
+	    return 0;
+	next->tv_sec = tick / 1000;
+	next->tv_usec = (tick % 1000) * 1000;
+	return 1;
+    }
+
+    timer = theap_get_top(&sel->timer_heap);
+    if (!timer)
+	return 0;
+    *next = timer->val.timeout;
+    return 1;
 }
 
 /* Wait list management.  These *must* be called with the timer list
@@ -337,6 +1117,7 @@ add_sel_wait_list(struct selector_s *sel, sel_wait_list_t *item,
     item->thread_id = thread_id;
     item->send_sig = send_sig;
     item->send_sig_cb_data = cb_data;
+    /* item->wake is set by the caller. */
     item->next = sel->wait_list.next;
     item->prev = &sel->wait_list;
     sel->wait_list.next->prev = item;
@@ -349,22 +1130,62 @@ remove_sel_wait_list(struct selector_s *sel, sel_wait_list_t *item)
     item->prev->next = item->next;
 }
 
-/* Initialize a single file descriptor. */
-static void
-init_fd(fd_control_t *fd)
-{
-    fd->state = NULL;
-    fd->data = NULL;
-    fd->handle_read = NULL;
-    fd->handle_write = NULL;
-    fd->handle_except = NULL;
+/* Initialize a single file descriptor. */
+static void
+init_fd(fd_control_t *fd)
+{
+    fd->state = NULL;
+    fd->data = NULL;
+    fd->handle_read = NULL;
+    fd->handle_write = NULL;
+    fd->handle_except = NULL;
+    fd->enabled = 0;
+#ifdef HAVE_EPOLL_PWAIT
+    fd->edge_triggered = 0;
+    fd->et_running = 0;
+    fd->et_pending = 0;
+#endif
+}
+
+/*
+ * Make sure the fd table can hold the given fd.  Must be called with
+ * the fd lock held.
+ */
+static int
+sel_grow_fds(struct selector_s *sel, int fd)
+{
+    fd_control_t *new_fds;
+    unsigned int new_max = sel->max_fds;
+
+    if (fd < sel->max_fds)
+	return 0;
+
+#ifdef HAVE_EPOLL_PWAIT
+    if (sel->epollfd < 0 && fd >= FD_SETSIZE)
+	return EMFILE;
+#else
+    if (fd >= FD_SETSIZE)
+	return EMFILE;
+#endif
+
+    while (new_max <= fd)
+	new_max *= 2;
+    new_fds = sel_alloc(new_max * sizeof(*new_fds));
+    if (!new_fds)
+	return ENOMEM;
+    memcpy(new_fds, sel->fds, sel->max_fds * sizeof(*new_fds));
+    free(sel->fds);
+    sel->fds = new_fds;
+    sel->max_fds = new_max;
+
+    return 0;
 }
 
 #ifdef HAVE_EPOLL_PWAIT
 static int
 sel_update_fd(struct selector_s *sel, int fd, int op)
 {
-    fd_control_t *fdc = (fd_control_t *) &sel->fds[fd];
+    fd_control_t *fdc = &sel->fds[fd];
     struct epoll_event event;
     int rv;
 
@@ -374,23 +1195,31 @@ sel_update_fd(struct selector_s *sel, int fd, int op)
     memset(&event, 0, sizeof(event));
     event.events = EPOLLONESHOT;
     event.data.fd = fd;
-    if (fdc->saved_events) {
+    if (fdc->edge_triggered) {
+	/*
+	 * Edge-triggered fds are always registered for everything,
+	 * the enables are handled in sel_set_fd_enabled() and
+	 * process_fd_event_et().
+	 */
+	if (op != EPOLL_CTL_DEL)
+	    event.events = EPOLLIN | EPOLLOUT | EPOLLPRI | EPOLLET;
+    } else if (fdc->saved_events) {
 	if (op == EPOLL_CTL_DEL)
 	    return 0;
-	if (!FD_ISSET(fd, &sel->read_set) && !FD_ISSET(fd, &sel->except_set))
+	if (!(fdc->enabled & (SEL_FD_READ | SEL_FD_EXCEPT)))
 	    return 0;
 	fdc->saved_events = 0;
 	op = EPOLL_CTL_ADD;
-	if (FD_ISSET(fd, &sel->read_set))
+	if (fdc->enabled & SEL_FD_READ)
 	    event.events |= EPOLLIN | EPOLLHUP;
-	if (FD_ISSET(fd, &sel->except_set))
+	if (fdc->enabled & SEL_FD_EXCEPT)
 	    event.events |= EPOLLERR | EPOLLPRI;
     } else if (op != EPOLL_CTL_DEL) {
-	if (FD_ISSET(fd, &sel->read_set))
+	if (fdc->enabled & SEL_FD_READ)
 	    event.events |= EPOLLIN | EPOLLHUP;
-	if (FD_ISSET(fd, &sel->write_set))
+	if (fdc->enabled & SEL_FD_WRITE)
 	    event.events |= EPOLLOUT;
-	if (FD_ISSET(fd, &sel->except_set))
+	if (fdc->enabled & SEL_FD_EXCEPT)
 	    event.events |= EPOLLERR | EPOLLPRI;
     }
     /* This should only fail due to system problems, and if that's the case,
@@ -434,6 +1263,10 @@ sel_set_fd_handlers(struct selector_s *sel,
     fd_state_t   *state, *oldstate = NULL;
     void         *olddata = NULL;
     int          added = 1;
+    int          rv;
+
+    if (fd < 0)
+	return EBADF;
 
     state = sel_alloc(sizeof(*state));
     if (!state)
@@ -444,15 +1277,26 @@ sel_set_fd_handlers(struct selector_s *sel,
     state->done_runner.sel = sel;
 
     sel_fd_lock(sel);
-    fdc = (fd_control_t *) &(sel->fds[fd]);
+    rv = sel_grow_fds(sel, fd);
+    if (rv) {
+	sel_fd_unlock(sel);
+	free(state);
+	return rv;
+    }
+    fdc = &sel->fds[fd];
     if (fdc->state) {
 	oldstate = fdc->state;
 	olddata = fdc->data;
 	added = 0;
 #ifdef HAVE_EPOLL_PWAIT
 	fdc->saved_events = 0;
+	/* The new handlers start out level-triggered. */
+	fdc->edge_triggered = 0;
+	fdc->et_running = 0;
+	fdc->et_pending = 0;
 #endif
 	sel->fd_del_count++;
+	fdc->del_count = sel->fd_del_count;
     }
     fdc->state = state;
     fdc->data = data;
@@ -493,7 +1337,11 @@ i_sel_clear_fd_handler(struct selector_s *sel, int fd, int rpt)
     void         *olddata = NULL;
 
     sel_fd_lock(sel);
-    fdc = (fd_control_t *) &(sel->fds[fd]);
+    if (fd < 0 || fd >= sel->max_fds) {
+	sel_fd_unlock(sel);
+	return;
+    }
+    fdc = &sel->fds[fd];
 
     if (fdc->state) {
 	oldstate = fdc->state;
@@ -505,12 +1353,10 @@ i_sel_clear_fd_handler(struct selector_s *sel, int fd, int rpt)
 	fdc->saved_events = 0;
 #endif
 	sel->fd_del_count++;
+	fdc->del_count = sel->fd_del_count;
     }
 
     init_fd(fdc);
-    FD_CLR(fd, &sel->read_set);
-    FD_CLR(fd, &sel->write_set);
-    FD_CLR(fd, &sel->except_set);
 
     /* Move maxfd down if necessary. */
     if (fd == sel->maxfd) {
@@ -549,26 +1395,40 @@ sel_clear_fd_handlers_norpt(struct selector_s *sel, int fd)
     i_sel_clear_fd_handler(sel, fd, 0);
 }
 
-/* Set whether the file descriptor will be monitored for data ready to
-   read on the file descriptor. */
-void
-sel_set_fd_read_handler(struct selector_s *sel, int fd, int state)
+static void
+sel_set_fd_enabled(struct selector_s *sel, int fd, unsigned int which,
+		   int state)
 {
-    fd_control_t *fdc = (fd_control_t *) &(sel->fds[fd]);
+    fd_control_t *fdc;
 
     sel_fd_lock(sel);
+    if (fd < 0 || fd >= sel->max_fds)
+	goto out;
+    fdc = &sel->fds[fd];
     if (!fdc->state)
 	goto out;
 
     if (state == SEL_FD_HANDLER_ENABLED) {
-	if (FD_ISSET(fd, &sel->read_set))
+	if (fdc->enabled & which)
 	    goto out;
-	FD_SET(fd, &sel->read_set);
+	fdc->enabled |= which;
     } else if (state == SEL_FD_HANDLER_DISABLED) {
-	if (!FD_ISSET(fd, &sel->read_set))
+	if (!(fdc->enabled & which))
 	    goto out;
-	FD_CLR(fd, &sel->read_set);
+	fdc->enabled &= ~which;
+    }
+#ifdef HAVE_EPOLL_PWAIT
+    if (fdc->edge_triggered) {
+	/*
+	 * Disabling is done in software.  On an enable the kernel has
+	 * to check the fd again, as any edge that came in while the
+	 * handler was disabled was dropped.
+	 */
+	if (state == SEL_FD_HANDLER_ENABLED)
+	    sel_update_fd(sel, fd, EPOLL_CTL_MOD);
+	goto out;
     }
+#endif
     if (sel_update_fd(sel, fd, EPOLL_CTL_MOD))
 	sel_wake_all(sel);
 
@@ -576,31 +1436,20 @@ sel_set_fd_read_handler(struct selector_s *sel, int fd, int state)
     sel_fd_unlock(sel);
 }
 
+/* Set whether the file descriptor will be monitored for data ready to
+   read on the file descriptor. */
+void
+sel_set_fd_read_handler(struct selector_s *sel, int fd, int state)
+{
+    sel_set_fd_enabled(sel, fd, SEL_FD_READ, state);
+}
+
 /* Set whether the file descriptor will be monitored for when the file
    descriptor can be written to. */
 void
 sel_set_fd_write_handler(struct selector_s *sel, int fd, int state)
 {
-    fd_control_t *fdc = (fd_control_t *) &(sel->fds[fd]);
-
-    sel_fd_lock(sel);
-    if (!fdc->state)
-	goto out;
-
-    if (state == SEL_FD_HANDLER_ENABLED) {
-	if (FD_ISSET(fd, &sel->write_set))
-	    goto out;
-	FD_SET(fd, &sel->write_set);
-    } else if (state == SEL_FD_HANDLER_DISABLED) {
-	if (!FD_ISSET(fd, &sel->write_set))
-	    goto out;
-	FD_CLR(fd, &sel->write_set);
-    }
-    if (sel_update_fd(sel, fd, EPOLL_CTL_MOD))
-	sel_wake_all(sel);
-
- out:
-    sel_fd_unlock(sel);
+    sel_set_fd_enabled(sel, fd, SEL_FD_WRITE, state);
 }
 
 /* Set whether the file descriptor will be monitored for exceptions
@@ -608,26 +1457,7 @@ sel_set_fd_write_handler(struct selector_s *sel, int fd, int state)
 void
 sel_set_fd_except_handler(struct selector_s *sel, int fd, int state)
 {
-    fd_control_t *fdc = (fd_control_t *) &(sel->fds[fd]);
-
-    sel_fd_lock(sel);
-    if (!fdc->state)
-	goto out;
-
-    if (state == SEL_FD_HANDLER_ENABLED) {
-	if (FD_ISSET(fd, &sel->except_set))
-	    goto out;
-	FD_SET(fd, &sel->except_set);
-    } else if (state == SEL_FD_HANDLER_DISABLED) {
-	if (!FD_ISSET(fd, &sel->except_set))
-	    goto out;
-	FD_CLR(fd, &sel->except_set);
-    }
-    if (sel_update_fd(sel, fd, EPOLL_CTL_MOD))
-	sel_wake_all(sel);
-
- out:
-    sel_fd_unlock(sel);
+    sel_set_fd_enabled(sel, fd, SEL_FD_EXCEPT, state);
 }
 
 static void
@@ -698,8 +1528,7 @@ sel_stop_timer_i(struct selector_s *sel, sel_timer_t *timer)
     if (timer->val.in_heap) {
 	volatile sel_timer_t *old_top = theap_get_top(&sel->timer_heap);
 
-	theap_remove(&sel->timer_heap, timer);
-	timer->val.in_heap = 0;
+	sel_timers_remove(sel, timer);
 	wake_timer_sel_thread(sel, old_top);
     }
     timer->val.stopped = 1;
@@ -743,11 +1572,9 @@ sel_start_timer(sel_timer_t    *timer,
 
     timer->val.timeout = *timeout;
 
-    if (!timer->val.in_handler) {
+    if (!timer->val.in_handler)
 	/* Wait until the handler returns to start the timer. */
-	theap_add(&sel->timer_heap, timer);
-	timer->val.in_heap = 1;
-    }
+	sel_timers_add(sel, timer);
     timer->val.stopped = 0;
 
     wake_timer_sel_thread(sel, old_top);
@@ -801,12 +1628,9 @@ sel_stop_timer_with_done(sel_timer_t *timer,
      * heap with an immediate timeout so it will be processed now.
      */
     timer->val.in_handler = 1;
-    if (timer->val.in_heap) {
-	theap_remove(&sel->timer_heap, timer);
-	timer->val.in_heap = 0;
-    }
-    sel_get_monotonic_time(&timer->val.timeout);
-    theap_add(&sel->timer_heap, timer);
+    if (timer->val.in_heap)
+	sel_timers_remove(sel, timer);
+    sel_timers_add_now(sel, timer);
     wake_timer_sel_thread(sel, NULL);
 
  out_unlock:
@@ -835,14 +1659,16 @@ process_timers(struct selector_s       *sel,
 	       unsigned int            *count,
 	       volatile struct timeval *timeout)
 {
-    struct timeval now;
+    struct timeval now, next;
     sel_timer_t    *timer;
 
-    timer = theap_get_top(&sel->timer_heap);
     sel_get_monotonic_time(&now);
-    while (timer && cmp_timeval(&now, &timer->val.timeout) >= 0) {
-	theap_remove(&(sel->timer_heap), timer);
-	timer->val.in_heap = 0;
+    if (sel->timer_wheel)
+	sel_wheel_advance(sel->timer_wheel,
+			  (uint64_t) now.tv_sec * 1000 + now.tv_usec / 1000);
+    timer = sel_timers_get_expired(sel, &now);
+    while (timer) {
+	sel_timers_remove(sel, timer);
 	timer->val.stopped = 1;
 
 	/*
@@ -870,24 +1696,20 @@ process_timers(struct selector_s       *sel,
 	timer->val.in_handler = 0;
 	if (timer->val.freed)
 	    free(timer);
-	else if (!timer->val.stopped) {
+	else if (!timer->val.stopped)
 	    /* We were restarted while in the handler. */
-	    theap_add(&sel->timer_heap, timer);
-	    timer->val.in_heap = 1;
-	}
+	    sel_timers_add(sel, timer);
 
-	timer = theap_get_top(&sel->timer_heap);
+	timer = sel_timers_get_expired(sel, &now);
     }
 
     if (*count) {
 	/* If called, set the timeout to zero. */
 	timeout->tv_sec = 0;
 	timeout->tv_usec = 0;
-    } else if (timer) {
+    } else if (sel_timers_get_next(sel, &next)) {
 	sel_get_monotonic_time(&now);
-	diff_timeval((struct timeval *) timeout,
-		     (struct timeval *) &timer->val.timeout,
-		     &now);
+	diff_timeval((struct timeval *) timeout, &next, &now);
     } else {
 	/* No timers, just set a long time. */
 	timeout->tv_sec = 100000;
@@ -946,6 +1768,13 @@ sel_run(sel_runner_t *runner, sel_runner_func_t func, void *cb_data)
     } else {
 	sel->runner_head = runner;
 	sel->runner_tail = runner;
+	/*
+	 * Waking a thread is cheap with a wake fd, so do it here to
+	 * make a runner started from outside the selector run right
+	 * away.  Without it the runner waits for the next wakeup.
+	 */
+	if (sel->use_wake_fd)
+	    i_wake_sel_thread(sel);
     }
     sel_timer_unlock(sel);
     return 0;
@@ -977,7 +1806,7 @@ process_runners(struct selector_s *sel)
 }
 
 static void
-handle_selector_call(struct selector_s *sel, int i, volatile fd_set *fdset,
+handle_selector_call(struct selector_s *sel, int i, unsigned int which,
 		     sel_fd_handler_t handler)
 {
     void             *data;
@@ -986,11 +1815,11 @@ handle_selector_call(struct selector_s *sel, int i, volatile fd_set *fdset,
     if (handler == NULL) {
 	/* Somehow we don't have a handler for this.
 	   Just shut it down. */
-	FD_CLR(i, fdset);
+	sel->fds[i].enabled &= ~which;
 	return;
     }
 
-    if (!FD_ISSET(i, fdset))
+    if (!(sel->fds[i].enabled & which))
 	/* The value was cleared, ignore it. */
 	return;
 
@@ -1033,7 +1862,8 @@ setup_my_sigmask(sigset_t *sigmask, sigset_t *isigmask)
 static int
 process_fds(struct selector_s	    *sel,
 	    volatile struct timeval *timeout,
-	    sigset_t *isigmask)
+	    sigset_t *isigmask,
+	    sel_thread_wake_t *wake)
 {
     fd_set      tmp_read_set;
     fd_set      tmp_write_set;
@@ -1048,12 +1878,27 @@ process_fds(struct selector_s	    *sel,
 
     setup_my_sigmask(&sigmask, isigmask);
  retry:
+    FD_ZERO(&tmp_read_set);
+    FD_ZERO(&tmp_write_set);
+    FD_ZERO(&tmp_except_set);
     sel_fd_lock(sel);
-    memcpy(&tmp_read_set, (void *) &sel->read_set, sizeof(tmp_read_set));
-    memcpy(&tmp_write_set, (void *) &sel->write_set, sizeof(tmp_write_set));
-    memcpy(&tmp_except_set, (void *) &sel->except_set, sizeof(tmp_except_set));
     num_fds = sel->maxfd + 1;
+    for (i = 0; i < num_fds; i++) {
+	unsigned int enabled = sel->fds[i].enabled;
+
+	if (enabled & SEL_FD_READ)
+	    FD_SET(i, &tmp_read_set);
+	if (enabled & SEL_FD_WRITE)
+	    FD_SET(i, &tmp_write_set);
+	if (enabled & SEL_FD_EXCEPT)
+	    FD_SET(i, &tmp_except_set);
+    }
     sel_fd_unlock(sel);
+    if (wake && wake->fds[0] < FD_SETSIZE) {
+	FD_SET(wake->fds[0], &tmp_read_set);
+	if (wake->fds[0] >= num_fds)
+	    num_fds = wake->fds[0] + 1;
+    }
 
     sigdelset(&sigmask, sel->wake_sig);
     err = pselect(num_fds,
@@ -1068,6 +1913,13 @@ process_fds(struct selector_s	    *sel,
 	goto out;
     }
 
+    if (wake && wake->fds[0] < FD_SETSIZE &&
+		FD_ISSET(wake->fds[0], &tmp_read_set)) {
+	/* It's not a selector fd, don't let it be handled as one. */
+	FD_CLR(wake->fds[0], &tmp_read_set);
+	sel_thread_wake_clear(wake);
+    }
+
     /* We got some I/O. */
     sel_fd_lock(sel);
     if (entry_fd_del_count != sel->fd_del_count)
@@ -1076,13 +1928,13 @@ process_fds(struct selector_s	    *sel,
 	goto out_unlock;
     for (i = 0; i <= sel->maxfd; i++) {
 	if (FD_ISSET(i, &tmp_read_set))
-	    handle_selector_call(sel, i, &sel->read_set,
+	    handle_selector_call(sel, i, SEL_FD_READ,
 				 sel->fds[i].handle_read);
 	if (FD_ISSET(i, &tmp_write_set))
-	    handle_selector_call(sel, i, &sel->write_set,
+	    handle_selector_call(sel, i, SEL_FD_WRITE,
 				 sel->fds[i].handle_write);
 	if (FD_ISSET(i, &tmp_except_set))
-	    handle_selector_call(sel, i, &sel->except_set,
+	    handle_selector_call(sel, i, SEL_FD_EXCEPT,
 				 sel->fds[i].handle_except);
     }
  out_unlock:
@@ -1092,41 +1944,91 @@ out:
 }
 
 #ifdef HAVE_EPOLL_PWAIT
-static int
-process_fds_epoll(struct selector_s *sel, struct timeval *tvtimeout,
-		  sigset_t *isigmask)
+/*
+ * Handle an event on an edge-triggered fd.  The fd is not disabled
+ * while the handlers run, so another thread may get an event for it
+ * at the same time.  In that case the events are left in et_pending
+ * for the thread already running the handlers, so the handlers for
+ * an fd are never run concurrently.  This must be called with the fd
+ * lock held.
+ */
+static void
+process_fd_event_et(struct selector_s *sel, int fd, uint32_t events)
 {
-    int rv, fd;
-    struct epoll_event event;
-    int timeout;
-    sigset_t sigmask;
-    fd_control_t *fdc;
-    unsigned long entry_fd_del_count = sel->fd_del_count;
+    fd_control_t *fdc = &sel->fds[fd];
+    unsigned long del_count = fdc->del_count;
+    uint32_t pending;
+
+    /* Let the read and except handlers see hangups and errors. */
+    if (events & EPOLLHUP)
+	events |= EPOLLIN;
+    if (events & EPOLLERR)
+	events |= EPOLLIN | EPOLLPRI;
+
+    fdc->et_pending |= events;
+    if (fdc->et_running)
+	return;
+    fdc->et_running = 1;
 
-    setup_my_sigmask(&sigmask, isigmask);
+    /*
+     * The fd table may be reallocated while a handler runs, and the
+     * handlers may be cleared or replaced, so check the fd again
+     * after each handler.  If the handlers were changed, the
+     * et_running and et_pending values were reset, so leave them
+     * alone.
+     */
+    while (fdc->et_pending) {
+	pending = fdc->et_pending;
+	fdc->et_pending = 0;
+	if (pending & EPOLLIN) {
+	    handle_selector_call(sel, fd, SEL_FD_READ,
+				 sel->fds[fd].handle_read);
+	    if (sel->fds[fd].del_count != del_count)
+		return;
+	}
+	if (pending & EPOLLOUT) {
+	    handle_selector_call(sel, fd, SEL_FD_WRITE,
+				 sel->fds[fd].handle_write);
+	    if (sel->fds[fd].del_count != del_count)
+		return;
+	}
+	if (pending & EPOLLPRI) {
+	    handle_selector_call(sel, fd, SEL_FD_EXCEPT,
+				 sel->fds[fd].handle_except);
+	    if (sel->fds[fd].del_count != del_count)
+		return;
+	}
+	fdc = &sel->fds[fd];
+    }
+    fdc->et_running = 0;
+}
 
-    if (tvtimeout->tv_sec > 600)
-	 /* Don't wait over 10 minutes, to work around an old epoll bug
-	    and avoid issues with timeout overflowing on 64-bit systems,
-	    which is much larger that 10 minutes, but who cares. */
-	timeout = 600 * 1000;
-    else
-	timeout = ((tvtimeout->tv_sec * 1000) +
-		   (tvtimeout->tv_usec + 999) / 1000);
+/*
+ * Handle a single event returned from epoll.  This must be called with
+ * the fd lock held.
+ */
+static void
+process_fd_event(struct selector_s *sel, struct epoll_event *event,
+		 unsigned long entry_fd_del_count)
+{
+    int fd = event->data.fd;
+    fd_control_t *fdc = &sel->fds[fd];
 
-    sigdelset(&sigmask, sel->wake_sig);
-    rv = epoll_pwait(sel->epollfd, &event, 1, timeout, &sigmask);
-    if (rv <= 0)
-	return rv;
+    if (fdc->edge_triggered) {
+	if (fdc->del_count <= entry_fd_del_count)
+	    process_fd_event_et(sel, fd, event->events);
+	return;
+    }
 
-    sel_fd_lock(sel);
-    fd = event.data.fd;
-    fdc = (fd_control_t *) &sel->fds[fd];
-    if (entry_fd_del_count != sel->fd_del_count)
-	/* Something was deleted from the FD set, don't process this as it
-	   may be from the old fd wakeup. */
+    /*
+     * If the fd was deleted or replaced after we started waiting,
+     * don't process this as it may be from the old fd wakeup.  This
+     * is checked per-fd, as a handler earlier in the batch may have
+     * deleted an fd whose event is later in the batch.
+     */
+    if (fdc->del_count > entry_fd_del_count)
 	goto rearm;
-    if (event.events & (EPOLLHUP | EPOLLERR)) {
+    if (event->events & (EPOLLHUP | EPOLLERR)) {
 	/*
 	 * The crazy people that designed epoll made it so that EPOLLHUP
 	 * and EPOLLERR always wake it up, even if they are not set.  That
@@ -1138,33 +2040,223 @@ process_fds_epoll(struct selector_s *sel, struct timeval *tvtimeout,
 	 * by hand.
 	 */
 	sel_update_fd(sel, fd, EPOLL_CTL_DEL);
-	fdc->saved_events = event.events & (EPOLLHUP | EPOLLERR);
+	fdc->saved_events = event->events & (EPOLLHUP | EPOLLERR);
 	/*
 	 * Have it handle read data, too, so if there is a pending
 	 * error it will get handled.
 	 */
-	event.events |= EPOLLIN;
+	event->events |= EPOLLIN;
     }
-    if (event.events & (EPOLLIN | EPOLLHUP))
-	handle_selector_call(sel, fd, &sel->read_set, fdc->handle_read);
-    if (event.events & EPOLLOUT)
-	handle_selector_call(sel, fd, &sel->write_set, fdc->handle_write);
-    if (event.events & (EPOLLPRI | EPOLLERR))
-	handle_selector_call(sel, fd, &sel->except_set, fdc->handle_except);
+    /*
+     * The fd table may be reallocated while a handler runs, so it
+     * must be looked up again after each handler.
+     */
+    if (event->events & (EPOLLIN | EPOLLHUP))
+	handle_selector_call(sel, fd, SEL_FD_READ, sel->fds[fd].handle_read);
+    if (event->events & EPOLLOUT)
+	handle_selector_call(sel, fd, SEL_FD_WRITE, sel->fds[fd].handle_write);
+    if (event->events & (EPOLLPRI | EPOLLERR))
+	handle_selector_call(sel, fd, SEL_FD_EXCEPT,
+			     sel->fds[fd].handle_except);
+    fdc = &sel->fds[fd];
 
  rearm:
     /* Rearm the event.  Remember it could have been deleted in the handler. */
     if (fdc->state)
 	sel_update_fd(sel, fd, EPOLL_CTL_MOD);
+}
+
+static unsigned long sel_epoll_ids;
+
+static unsigned long
+sel_next_epoll_id(void)
+{
+    return __atomic_add_fetch(&sel_epoll_ids, 1, __ATOMIC_RELAXED);
+}
+
+/*
+ * Set up the calling thread's epoll set to wait on its wake fd and
+ * the selector's epoll fd, see sel_thread_wake_s.
+ */
+static int
+sel_thread_wake_epoll(struct selector_s *sel, sel_thread_wake_t *w)
+{
+    struct epoll_event ev;
+    int rv;
+
+    memset(&ev, 0, sizeof(ev));
+    ev.events = EPOLLIN;
+    if (w->epollfd == -1) {
+	w->epollfd = epoll_create1(EPOLL_CLOEXEC);
+	if (w->epollfd == -1)
+	    return errno;
+	ev.data.fd = w->fds[0];
+	if (epoll_ctl(w->epollfd, EPOLL_CTL_ADD, w->fds[0], &ev) == -1) {
+	    rv = errno;
+	    close(w->epollfd);
+	    w->epollfd = -1;
+	    return rv;
+	}
+	w->epoll_id = 0;
+    }
+    if (w->epoll_id == sel->epoll_id)
+	return 0;
+
+    /*
+     * The thread has moved to another selector.  The old selector's
+     * epoll fd is gone from the set if it was closed, then this fails,
+     * that's fine.
+     */
+    if (w->epoll_id)
+	epoll_ctl(w->epollfd, EPOLL_CTL_DEL, w->sel_epollfd, &ev);
+    w->epoll_id = 0;
+    ev.data.fd = sel->epollfd;
+    if (epoll_ctl(w->epollfd, EPOLL_CTL_ADD, sel->epollfd, &ev) == -1)
+	return errno;
+    w->epoll_id = sel->epoll_id;
+    w->sel_epollfd = sel->epollfd;
+    return 0;
+}
+
+static int
+process_fds_epoll(struct selector_s *sel, struct timeval *tvtimeout,
+		  sigset_t *isigmask, sel_thread_wake_t *wake)
+{
+    int rv, i;
+    struct epoll_event events[SEL_MAX_FD_EVENTS];
+    int timeout;
+    sigset_t sigmask;
+    unsigned long entry_fd_del_count = sel->fd_del_count;
+
+    setup_my_sigmask(&sigmask, isigmask);
+
+    if (tvtimeout->tv_sec > 600)
+	 /* Don't wait over 10 minutes, to work around an old epoll bug
+	    and avoid issues with timeout overflowing on 64-bit systems,
+	    which is much larger that 10 minutes, but who cares. */
+	timeout = 600 * 1000;
+    else
+	timeout = ((tvtimeout->tv_sec * 1000) +
+		   (tvtimeout->tv_usec + 999) / 1000);
+
+    sigdelset(&sigmask, sel->wake_sig);
+    if (!wake) {
+	rv = epoll_pwait(sel->epollfd, events, sel->max_fd_events, timeout,
+			 &sigmask);
+	if (rv <= 0)
+	    return rv;
+    } else {
+	struct epoll_event wevents[2];
+	int sel_ready = 0;
+
+	rv = sel_thread_wake_epoll(sel, wake);
+	if (rv) {
+	    errno = rv;
+	    return -1;
+	}
+
+	rv = 0;
+	if (wake->busy)
+	    rv = epoll_wait(sel->epollfd, events, sel->max_fd_events, 0);
+	if (rv == 0) {
+	    /*
+	     * Wait for the selector's epoll fd or this thread's wake fd,
+	     * then get the events without waiting.  Another thread may
+	     * have gotten the events first, then there is nothing to
+	     * do, but that is not a timeout.
+	     */
+	    wake->busy = 0;
+	    rv = epoll_pwait(wake->epollfd, wevents, 2, timeout, &sigmask);
+	    if (rv <= 0)
+		return rv;
+	    for (i = 0; i < rv; i++) {
+		if (wevents[i].data.fd == wake->fds[0])
+		    sel_thread_wake_clear(wake);
+		else
+		    sel_ready = 1;
+	    }
+	    if (!sel_ready)
+		return 1;
+	    rv = epoll_wait(sel->epollfd, events, sel->max_fd_events, 0);
+	}
+	wake->busy = rv > 0;
+	if (rv <= 0)
+	    return rv < 0 ? rv : 1;
+    }
+
+    /*
+     * Level-triggered fds are registered EPOLLONESHOT, so each one
+     * appears at most once in the batch and no other thread can get
+     * an event for it until we rearm it.  Edge-triggered fds are not
+     * rearmed, process_fd_event_et() keeps their handlers from
+     * running in more than one thread.
+     */
+    sel_fd_lock(sel);
+    for (i = 0; i < rv; i++)
+	process_fd_event(sel, &events[i], entry_fd_del_count);
     sel_fd_unlock(sel);
 
     return rv;
 }
 
+int
+sel_set_max_fd_events(struct selector_s *sel, unsigned int max_events)
+{
+    if (max_events == 0 || max_events > SEL_MAX_FD_EVENTS)
+	return EINVAL;
+    sel->max_fd_events = max_events;
+    return 0;
+}
+
+int
+sel_set_edge_triggered(struct selector_s *sel, int enable)
+{
+    if (sel->epollfd < 0)
+	return ENOTSUP;
+    sel->edge_triggered = enable;
+    return 0;
+}
+
+int
+sel_set_fd_edge_triggered(struct selector_s *sel, int fd)
+{
+    fd_control_t *fdc;
+    int rv = 0;
+    int op = EPOLL_CTL_MOD;
+
+    sel_fd_lock(sel);
+    if (!sel->edge_triggered || sel->epollfd < 0) {
+	rv = ENOTSUP;
+	goto out;
+    }
+    if (fd < 0 || fd >= sel->max_fds || !sel->fds[fd].state) {
+	rv = EBADF;
+	goto out;
+    }
+    fdc = &sel->fds[fd];
+    if (fdc->edge_triggered)
+	goto out;
+
+    /* A saved HUP/ERR means the fd was taken out of the epoll set. */
+    if (fdc->saved_events)
+	op = EPOLL_CTL_ADD;
+    fdc->saved_events = 0;
+    fdc->edge_triggered = 1;
+    sel_update_fd(sel, fd, op);
+ out:
+    sel_fd_unlock(sel);
+    return rv;
+}
+
 int
 sel_setup_forked_process(struct selector_s *sel)
 {
     unsigned int i;
+    int rv;
+
+    rv = sel_reopen_wake_fd(sel);
+    if (rv)
+	return rv;
 
     /*
      * More epoll stupidity.  In a forked process we must create a new
@@ -1178,9 +2270,10 @@ sel_setup_forked_process(struct selector_s *sel)
     if (sel->epollfd == -1) {
 	return errno;
     }
+    sel->epoll_id = sel_next_epoll_id();
 
     for (i = 0; i <= sel->maxfd; i++) {
-	volatile fd_control_t *fdc = &sel->fds[i];
+	fd_control_t *fdc = &sel->fds[i];
 	if (fdc->state)
 	    sel_update_fd(sel, i, EPOLL_CTL_ADD);
     }
@@ -1188,11 +2281,31 @@ sel_setup_forked_process(struct selector_s *sel)
 }
 #else
 int
-sel_setup_forked_process(struct selector_s *sel)
+sel_set_max_fd_events(struct selector_s *sel, unsigned int max_events)
 {
-    /* Nothing to do. */
+    if (max_events == 0 || max_events > SEL_MAX_FD_EVENTS)
+	return EINVAL;
+    /* Nothing to do, select always handles all fds. */
     return 0;
 }
+
+int
+sel_set_edge_triggered(struct selector_s *sel, int enable)
+{
+    return ENOTSUP;
+}
+
+int
+sel_set_fd_edge_triggered(struct selector_s *sel, int fd)
+{
+    return ENOTSUP;
+}
+
+int
+sel_setup_forked_process(struct selector_s *sel)
+{
+    return sel_reopen_wake_fd(sel);
+}
 #endif
 
 int
@@ -1210,6 +2323,15 @@ sel_select_intr_sigmask(struct selector_s *sel,
     struct timeval  end = { 0, 0 }, now;
     int user_timeout = 0;
 
+    wait_entry.wake = NULL;
+    if (sel->use_wake_fd) {
+	wait_entry.wake = sel_get_thread_wake(sel);
+	if (!wait_entry.wake) {
+	    errno = ENOMEM;
+	    return -1;
+	}
+    }
+
     if (timeout) {
 	sel_get_monotonic_time(&now);
 	add_timeval(&end, &now, timeout);
@@ -1229,10 +2351,10 @@ sel_select_intr_sigmask(struct selector_s *sel,
 
 #ifdef HAVE_EPOLL_PWAIT
     if (sel->epollfd >= 0)
-	err = process_fds_epoll(sel, &loc_timeout, sigmask);
+	err = process_fds_epoll(sel, &loc_timeout, sigmask, wait_entry.wake);
     else
 #endif
-	err = process_fds(sel, &loc_timeout, sigmask);
+	err = process_fds(sel, &loc_timeout, sigmask, wait_entry.wake);
 
     old_errno = errno;
     if (!user_timeout && !err) {
@@ -1316,23 +2438,38 @@ sel_select_loop(struct selector_s *sel,
 
 /* Initialize the select code. */
 int
-sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
-			  sel_lock_t *(*sel_lock_alloc)(void *cb_data),
-			  void (*sel_lock_free)(sel_lock_t *),
-			  void (*sel_lock)(sel_lock_t *),
-			  void (*sel_unlock)(sel_lock_t *),
-			  void *cb_data)
+sel_alloc_selector_flags(struct selector_s **new_selector, int wake_sig,
+			 sel_lock_t *(*sel_lock_alloc)(void *cb_data),
+			 void (*sel_lock_free)(sel_lock_t *),
+			 void (*sel_lock)(sel_lock_t *),
+			 void (*sel_unlock)(sel_lock_t *),
+			 void *cb_data, unsigned int flags)
 {
     struct selector_s *sel;
     unsigned int i;
     int rv;
     sigset_t sigset;
+    struct timeval now;
+
+    if (flags & ~SEL_TIMER_WHEEL)
+	return EINVAL;
 
     sel = sel_alloc(sizeof(*sel));
     if (!sel)
 	return ENOMEM;
     memset(sel, 0, sizeof(*sel));
 
+    if (flags & SEL_TIMER_WHEEL) {
+	sel->timer_wheel = sel_alloc(sizeof(*sel->timer_wheel));
+	if (!sel->timer_wheel) {
+	    free(sel);
+	    return ENOMEM;
+	}
+	sel_get_monotonic_time(&now);
+	sel_wheel_init(sel->timer_wheel,
+		       (uint64_t) now.tv_sec * 1000 + now.tv_usec / 1000);
+    }
+
     sel->sel_lock_alloc = sel_lock_alloc;
     sel->sel_lock_free = sel_lock_free;
     sel->sel_lock = sel_lock;
@@ -1344,25 +2481,31 @@ sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
 
     sel->wake_sig = wake_sig;
 
-    FD_ZERO((fd_set *) &sel->read_set);
-    FD_ZERO((fd_set *) &sel->write_set);
-    FD_ZERO((fd_set *) &sel->except_set);
-
-    for (i = 0; i < FD_SETSIZE; i++) {
-	init_fd((fd_control_t *) &(sel->fds[i]));
+    sel->max_fds = SEL_INITIAL_FDS;
+    sel->fds = sel_alloc(sel->max_fds * sizeof(*sel->fds));
+    if (!sel->fds) {
+	free(sel->timer_wheel);
+	free(sel);
+	return ENOMEM;
     }
+    for (i = 0; i < sel->max_fds; i++)
+	init_fd(&sel->fds[i]);
 
     theap_init(&sel->timer_heap);
 
     if (sel->sel_lock_alloc) {
 	sel->timer_lock = sel->sel_lock_alloc(cb_data);
 	if (!sel->timer_lock) {
+	    free(sel->fds);
+	    free(sel->timer_wheel);
 	    free(sel);
 	    return ENOMEM;
 	}
 	sel->fd_lock = sel->sel_lock_alloc(cb_data);
 	if (!sel->fd_lock) {
-	    sel->sel_lock_free(sel->fd_lock);
+	    sel->sel_lock_free(sel->timer_lock);
+	    free(sel->fds);
+	    free(sel->timer_wheel);
 	    free(sel);
 	    return ENOMEM;
 	}
@@ -1377,6 +2520,8 @@ sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
 	    sel->sel_lock_free(sel->fd_lock);
 		sel->sel_lock_free(sel->timer_lock);
 	}
+	free(sel->fds);
+	free(sel->timer_wheel);
 	free(sel);
 	return rv;
     }
@@ -1385,6 +2530,8 @@ sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
     sel->epollfd = epoll_create(32768);
     if (sel->epollfd == -1)
 	syslog(LOG_ERR, "Unable to set up epoll, falling back to select: %m");
+    sel->epoll_id = sel_next_epoll_id();
+    sel->max_fd_events = SEL_DEFAULT_FD_EVENTS;
 #endif
 
     *new_selector = sel;
@@ -1392,6 +2539,19 @@ sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
     return 0;
 }
 
+int
+sel_alloc_selector_thread(struct selector_s **new_selector, int wake_sig,
+			  sel_lock_t *(*sel_lock_alloc)(void *cb_data),
+			  void (*sel_lock_free)(sel_lock_t *),
+			  void (*sel_lock)(sel_lock_t *),
+			  void (*sel_unlock)(sel_lock_t *),
+			  void *cb_data)
+{
+    return sel_alloc_selector_flags(new_selector, wake_sig, sel_lock_alloc,
+				    sel_lock_free, sel_lock, sel_unlock,
+				    cb_data, 0);
+}
+
 int
 sel_alloc_selector_nothread(struct selector_s **new_selector)
 {
@@ -1410,6 +2570,8 @@ sel_free_selector(struct selector_s *sel)
 	free(elem);
 	elem = theap_get_top(&(sel->timer_heap));
     }
+    if (sel->timer_wheel)
+	sel_wheel_free(sel->timer_wheel);
 #ifdef HAVE_EPOLL_PWAIT
     if (sel->epollfd >= 0)
 	close(sel->epollfd);
@@ -1418,6 +2580,7 @@ sel_free_selector(struct selector_s *sel)
 	sel->sel_lock_free(sel->fd_lock);
     if (sel->timer_lock)
 	sel->sel_lock_free(sel->timer_lock);
+    free(sel->fds);
     free(sel);
 
     return 0;
@@ -23,6 +23,8 @@
 struct wait_data {
     pthread_t tid;
     int wake_sig;
+    /* With a wake fd, this thread's wake, used instead of wake_sig. */
+    sel_thread_wake_t *wake;
     struct wait_data *prev;
     struct wait_data *next;
 };
@@ -79,6 +81,7 @@ i_wait_for_waiter_timeout(waiter_t *waiter, unsigned int count,
 
     w.tid = pthread_self();
     w.wake_sig = waiter->wake_sig;
+    w.wake = sel_get_thread_wake(waiter->sel);
     w.next = NULL;
     w.prev = NULL;
 
@@ -125,7 +128,14 @@ wake_waiter(waiter_t *waiter)
     waiter->count++;
     w = waiter->wts.next;
     while (w != &waiter->wts) {
-	pthread_kill(w->tid, w->wake_sig);
+	/*
+	 * The thread may not be in the selector yet, a wake fd stays
+	 * readable until the thread sees it.
+	 */
+	if (w->wake)
+	    sel_wake_thread(w->wake);
+	else
+	    pthread_kill(w->tid, w->wake_sig);
 	w = w->next;
     }
     pthread_mutex_unlock(&waiter->lock);
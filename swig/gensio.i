@@ -111,6 +111,7 @@ wake_curr_waiter(void)
 #endif
 
 #include "gensio_python.h"
+#include "gensio_asyncio.h"
 
 static void
 gensio_do_wait(struct waiter *waiter, unsigned int count,
@@ -135,6 +136,30 @@ gensio_do_wait(struct waiter *waiter, unsigned int count,
     restore_waiter(prev_waiter);
 }
 
+/*
+ * Do a gensio_read_s() with a timeout in milliseconds, a negative
+ * timeout waits forever.  The milliseconds left are returned in r_int.
+ */
+static int
+gensio_do_read_s(struct gensio *io, gensiods *count, char *buf,
+		 gensiods buflen, long timeout, long *r_int)
+{
+    struct timeval tv = { timeout / 1000, (timeout % 1000) * 1000 };
+    struct timeval *rtv = &tv;
+    int rv;
+
+    if (timeout < 0)
+	rtv = NULL;
+    GENSIO_SWIG_C_BLOCK_ENTRY
+    rv = gensio_read_s(io, count, buf, buflen, rtv);
+    GENSIO_SWIG_C_BLOCK_EXIT
+    if (rtv)
+	*r_int = rtv->tv_sec * 1000 + ((rtv->tv_usec + 500) / 1000);
+    else
+	*r_int = 0;
+    return rv;
+}
+
 #ifdef USE_POSIX_THREADS
 struct sel_lock_s {
     pthread_mutex_t lock;
@@ -169,54 +194,60 @@ gensio_unlock(sel_lock_t *lock)
 {
     pthread_mutex_unlock(&lock->lock);
 }
-
-static void
-gensio_thread_sighandler(int sig)
-{
-    /* Nothing to do, signal just wakes things up. */
-}
 #endif
 
-struct gensio_os_funcs *alloc_gensio_selector(swig_cb *log_handler)
+struct gensio_os_funcs *alloc_gensio_selector(swig_cb *log_handler,
+					      bool edge_triggered,
+					      bool timer_wheel)
 {
     struct selector_s *sel;
     struct gensio_os_funcs *o;
     struct os_funcs_data *odata;
+    unsigned int flags = 0;
     int err;
-    int wake_sig;
-#ifdef USE_POSIX_THREADS
-    struct sigaction act;
 
-    wake_sig = SIGUSR1;
-    act.sa_handler = gensio_thread_sighandler;
-    sigemptyset(&act.sa_mask);
-    act.sa_flags = 0;
-    err = sigaction(SIGUSR1, &act, NULL);
-    if (err) {
-	fprintf(stderr, "Unable to setup wake signal: %s, giving up\n",
-		strerror(errno));
-	exit(1);
-    }
+    if (timer_wheel)
+	flags |= SEL_TIMER_WHEEL;
 
-    err = sel_alloc_selector_thread(&sel, SIGUSR1,
-				    gensio_alloc_lock, gensio_free_lock,
-				    gensio_lock, gensio_unlock, NULL);
+    GENSIO_SWIG_C_BLOCK_ENTRY
+#ifdef USE_POSIX_THREADS
+    /*
+     * Threads are woken with a wake fd, not a signal, so no signal
+     * handler has to be installed in the process.
+     */
+    err = sel_alloc_selector_flags(&sel, 0,
+				   gensio_alloc_lock, gensio_free_lock,
+				   gensio_lock, gensio_unlock, NULL, flags);
+    if (!err) {
+	err = sel_use_wake_fd(sel);
+	if (err)
+	    sel_free_selector(sel);
+    }
 #else
-    err = sel_alloc_selector_nothread(&sel);
+    err = sel_alloc_selector_flags(&sel, 0, NULL, NULL, NULL, NULL, NULL,
+				   flags);
 #endif
+    GENSIO_SWIG_C_BLOCK_EXIT
     if (err) {
 	fprintf(stderr, "Unable to allocate selector: %s, giving up\n",
 		strerror(err));
 	exit(1);
     }
+    if (edge_triggered)
+	/* If not supported, fds just stay level-triggered. */
+	sel_set_edge_triggered(sel, 1);
 
     odata = malloc(sizeof(*odata));
     odata->refcount = 1;
+    odata->shards = NULL;
+    odata->nr_shards = 0;
 #ifdef USE_POSIX_THREADS
     pthread_mutex_init(&odata->lock, NULL);
 #endif
 
-    o = gensio_selector_alloc(sel, wake_sig);
+    GENSIO_SWIG_C_BLOCK_ENTRY
+    o = gensio_selector_alloc(sel, 0);
+    GENSIO_SWIG_C_BLOCK_EXIT
     if (!o) {
 	fprintf(stderr, "Unable to allocate gensio os funcs, giving up\n");
 	exit(1);
@@ -267,6 +298,43 @@ struct waiter { };
     ~gensio_os_funcs() {
 	check_os_funcs_free(self);
     }
+
+    void add_shard(struct gensio_os_funcs *shard) {
+	struct os_funcs_data *odata = self->other_data;
+	struct gensio_os_funcs **shards;
+	int rv;
+
+	if (!odata->sel || !((struct os_funcs_data *)
+			     shard->other_data)->sel) {
+	    /* Only selector os funcs can be sharded. */
+	    err_handle("add_shard", GE_NOTSUP);
+	    return;
+	}
+
+	os_funcs_lock(odata);
+	shards = malloc((odata->nr_shards + 1) * sizeof(*shards));
+	if (!shards) {
+	    rv = GE_NOMEM;
+	    goto out_unlock;
+	}
+	rv = gensio_selector_add_shard(self, shard);
+	if (rv) {
+	    free(shards);
+	    goto out_unlock;
+	}
+	if (odata->shards) {
+	    memcpy(shards, odata->shards, odata->nr_shards * sizeof(*shards));
+	    free(odata->shards);
+	}
+	if (shard != self)
+	    /* Don't keep a reference to ourself, it would never go away. */
+	    os_funcs_ref(shard);
+	shards[odata->nr_shards++] = shard;
+	odata->shards = shards;
+    out_unlock:
+	os_funcs_unlock(odata);
+	err_handle("add_shard", rv);
+    }
 }
 
 %constant int GE_NOTSUP = GE_NOTSUP;
@@ -289,6 +357,10 @@ struct waiter { };
 %constant int GENSIO_CONTROL_SERVICE = GENSIO_CONTROL_SERVICE;
 %constant int GENSIO_CONTROL_CERT = GENSIO_CONTROL_CERT;
 %constant int GENSIO_CONTROL_CERT_FINGERPRINT = GENSIO_CONTROL_CERT_FINGERPRINT;
+%constant int GENSIO_CONTROL_SESSION_RESUMED = GENSIO_CONTROL_SESSION_RESUMED;
+%constant int GENSIO_CONTROL_STATS = GENSIO_CONTROL_STATS;
+%constant int GENSIO_CONTROL_PRIORITY = GENSIO_CONTROL_PRIORITY;
+%constant int GENSIO_CONTROL_WEIGHT = GENSIO_CONTROL_WEIGHT;
 
 %extend gensio {
     gensio(struct gensio_os_funcs *o, char *str, swig_cb *handler) {
@@ -300,7 +372,9 @@ struct waiter { };
 	if (!data)
 	    return NULL;
 
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = str_to_gensio(str, o, gensio_child_event, data, &io);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	if (rv) {
 	    free_gensio_data(data);
 	    err_handle("gensio alloc", rv);
@@ -328,7 +402,9 @@ struct waiter { };
 	if (!data)
 	    return NULL;
 
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = str_to_gensio_child(self, str, o, gensio_child_event, data, &io);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	if (rv) {
 	    free_gensio_data(data);
 	    err_handle("gensio alloc", rv);
@@ -339,11 +415,19 @@ struct waiter { };
     void set_cbs(swig_cb *handler) {
 	struct gensio_data *data = gensio_get_user_data(self);
 
+	gensio_data_clear_methods(data);
 	if (data->handler_val)
 	    deref_swig_cb_val(data->handler_val);
 	data->handler_val = ref_swig_cb(handler, read_callback);
     }
 
+    void set_read_memoryview(bool enable) {
+	struct gensio_data *data = gensio_get_user_data(self);
+
+	err_handle("set_read_memoryview",
+		   gensio_set_read_memview(data, enable));
+    }
+
     %rename (remote_id) remote_idt;
     int remote_idt() {
 	int remid;
@@ -388,12 +472,22 @@ struct waiter { };
 
     %rename(open_s) open_st;
     void open_st() {
-	err_handle("open_s", gensio_open_s(self));
+	int rv;
+
+	GENSIO_SWIG_C_BLOCK_ENTRY
+	rv = gensio_open_s(self);
+	GENSIO_SWIG_C_BLOCK_EXIT
+	err_handle("open_s", rv);
     }
 
     %rename(open_nochild_s) open_nochild_st;
     void open_nochild_st() {
-	err_handle("open_nochild_s", gensio_open_nochild_s(self));
+	int rv;
+
+	GENSIO_SWIG_C_BLOCK_ENTRY
+	rv = gensio_open_nochild_s(self);
+	GENSIO_SWIG_C_BLOCK_EXIT
+	err_handle("open_nochild_s", rv);
     }
 
     %newobject alloc_channelt;
@@ -448,7 +542,12 @@ struct waiter { };
 
     %rename(close_s) close_st;
     void close_st() {
-	err_handle("close_s", gensio_close_s(self));
+	int rv;
+
+	GENSIO_SWIG_C_BLOCK_ENTRY
+	rv = gensio_close_s(self);
+	GENSIO_SWIG_C_BLOCK_EXIT
+	err_handle("close_s", rv);
     }
 
     %rename(write) writet;
@@ -457,17 +556,52 @@ struct waiter { };
 	gensiods wr = 0;
 	int rv;
 
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = gensio_write(self, &wr, bytestr, len, auxdata);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	err_handle("write", rv);
 	return wr;
     }
 
+    %rename(write_sg) write_sgt;
+    unsigned int write_sgt(const struct gensio_sg *sg, gensiods sglen,
+			   const char *const *auxdata) {
+	gensiods wr = 0;
+	int rv;
+
+	GENSIO_SWIG_C_BLOCK_ENTRY
+	rv = gensio_write_sg(self, &wr, sg, sglen, auxdata);
+	GENSIO_SWIG_C_BLOCK_EXIT
+	err_handle("write_sg", rv);
+	return wr;
+    }
+
     void read_cb_enable(bool enable) {
 	gensio_set_read_callback_enable(self, enable);
     }
 
     void write_cb_enable(bool enable) {
-	gensio_set_write_callback_enable(self, enable);
+	struct gensio_data *data = gensio_get_user_data(self);
+
+	data->user_write_enabled = enable;
+	/* Leave it on if aio_write() is waiting for it. */
+	if (enable || !data->aio_writer)
+	    gensio_set_write_callback_enable(self, enable);
+    }
+
+    /*
+     * Used by aio_write(), call obj.write_ready(io) on the next write
+     * ready event.
+     */
+    void _aio_write_wait(swig_cb *obj) {
+	struct gensio_data *data = gensio_get_user_data(self);
+
+	if (data->aio_writer) {
+	    err_handle("aio_write", GE_INUSE);
+	    return;
+	}
+	data->aio_writer = ref_swig_cb(obj, write_ready);
+	gensio_set_write_callback_enable(self, true);
     }
 
     %rename(set_sync) set_synct;
@@ -482,12 +616,16 @@ struct waiter { };
 	err_handle("clear_sync", rv);
     }
 
+    %rename(set_sync_readahead) set_sync_readaheadt;
+    void set_sync_readaheadt(int size) {
+	int rv = gensio_set_sync_readahead(self, size);
+	err_handle("set_sync_readahead", rv);
+    }
+
     %rename(read_s) read_st;
     void read_st(char **rbuffer, size_t *rbuffer_len, long *r_int,
 		 unsigned int reqlen, long timeout) {
 	int rv;
-	struct timeval tv = { timeout / 1000, timeout % 1000 };
-	struct timeval *rtv = &tv;
 	char *buf = malloc(reqlen);
 	gensiods count = 0;
 
@@ -495,33 +633,54 @@ struct waiter { };
 	    rv = GE_NOMEM;
 	    goto out;
 	}
-	if (timeout < 0)
-	    rtv = NULL;
-	rv = gensio_read_s(self, &count, buf, reqlen, rtv);
+	rv = gensio_do_read_s(self, &count, buf, reqlen, timeout, r_int);
 	if (rv) {
 	    free(buf);
 	} else {
 	    *rbuffer = buf;
 	    *rbuffer_len = count;
 	}
-	if (rtv)
-	    *r_int = rtv->tv_sec * 1000 + ((rtv->tv_usec + 500) / 1000);
-	else
-	    *r_int = 0;
     out:
 	err_handle("read_s", rv);
     }
 
+    long read_s_into(long *r_int, char *wbuf, my_ssize_t wlen, long timeout) {
+	gensiods count = 0;
+	int rv;
+
+	rv = gensio_do_read_s(self, &count, wbuf, wlen, timeout, r_int);
+	err_handle("read_s_into", rv);
+	return count;
+    }
+
+    /*
+     * Like read_s_into(), but returns -1 if the remote end closed the
+     * connection instead of raising an exception, for SyncStream.
+     */
+    long _read_s_into_eof(long *r_int, char *wbuf, my_ssize_t wlen,
+			  long timeout) {
+	gensiods count = 0;
+	int rv;
+
+	rv = gensio_do_read_s(self, &count, wbuf, wlen, timeout, r_int);
+	if (rv == GE_REMCLOSE)
+	    return -1;
+	err_handle("read_s_into", rv);
+	return count;
+    }
+
     %rename(write_s) write_st;
     long write_st(long *r_int, char *bytestr, my_ssize_t len, long timeout) {
 	int rv;
-	struct timeval tv = { timeout / 1000, timeout % 1000 };
+	struct timeval tv = { timeout / 1000, (timeout % 1000) * 1000 };
 	struct timeval *rtv = &tv;
 	gensiods count = 0;
 
 	if (timeout < 0)
 	    rtv = NULL;
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = gensio_write_s(self, &count, bytestr, len, rtv);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	err_handle("write_s", rv);
 	if (rtv)
 	    *r_int = rtv->tv_sec * 1000 + ((rtv->tv_usec + 500) / 1000);
@@ -539,33 +698,43 @@ struct waiter { };
 	gensiods glen = 0, slen = len;
 
 	if (get) {
+	    gensiods size;
+
 	    /* Pass in a zero length to get the actual length. */
 	    rv = gensio_control(self, depth, get, option, bytestr, &glen);
 	    if (rv)
 		goto out;
+	retry:
 	    /* Allocate the larger of strlen(bytestr) and len) */
-	    if (slen > glen) {
-		data = malloc(slen + 1);
-		glen = slen;
-	    } else {
-		data = malloc(glen + 1);
-	    }
+	    size = glen;
+	    if (slen > size)
+		size = slen;
+	    data = malloc(size + 1);
 	    if (!data) {
 		rv = GE_NOMEM;
 		goto out;
 	    }
-	    data[glen] = '\0';
+	    data[size] = '\0';
 	    data[slen] = '\0';
-	    glen += 1;
 	    if (bytestr) {
 		memcpy(data, bytestr, slen);
 	    } else {
 		data[0] = '\0';
 	    }
+	    glen = size + 1;
 	    rv = gensio_control(self, depth, get, option, data, &glen);
 	    if (rv) {
 		free(data);
 		data = NULL;
+	    } else if (glen > size) {
+		/*
+		 * The value got longer (statistics can) between getting
+		 * the length and getting the value, so it was truncated.
+		 * Try again with the new length.
+		 */
+		free(data);
+		data = NULL;
+		goto retry;
 	    }
 	out:
 	    if (rv == GE_NOTFOUND) /* Return None for ENOENT. */
@@ -679,8 +848,11 @@ struct waiter { };
 	int rv;
 
 	rv = sergensio_b_alloc(self, data->o, &b);
-	if (!rv)
+	if (!rv) {
+	    GENSIO_SWIG_C_BLOCK_ENTRY
 	    rv = sergensio_##name##_b(b, &name);
+	    GENSIO_SWIG_C_BLOCK_EXIT
+	}
 	if (rv)
 	    ser_err_handle("sg_"stringify(name)"_s", rv);
 	if (b)
@@ -820,6 +992,8 @@ struct waiter { };
 
 %constant int GENSIO_ACC_CONTROL_LADDR = GENSIO_ACC_CONTROL_LADDR;
 %constant int GENSIO_ACC_CONTROL_LPORT = GENSIO_ACC_CONTROL_LPORT;
+%constant int GENSIO_ACC_CONTROL_RELOAD_CERTS = GENSIO_ACC_CONTROL_RELOAD_CERTS;
+%constant int GENSIO_ACC_CONTROL_STATS = GENSIO_ACC_CONTROL_STATS;
 
 %extend gensio_accepter {
     gensio_accepter(struct gensio_os_funcs *o, char *str, swig_cb *handler) {
@@ -831,7 +1005,9 @@ struct waiter { };
 	if (!data)
 	    return NULL;
 
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = str_to_gensio_accepter(str, o, gensio_acc_child_event, data, &acc);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	if (rv) {
 	    free_gensio_data(data);
 	    err_handle("gensio_accepter constructor", rv);
@@ -858,8 +1034,10 @@ struct waiter { };
 	if (!data)
 	    return NULL;
 
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = gensio_acc_str_to_gensio(self, str, gensio_child_event, data,
 				      &io);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	if (rv) {
 	    free_gensio_data(data);
 	    err_handle("str to gensio", rv);
@@ -868,6 +1046,27 @@ struct waiter { };
 	return io;
     }
 
+    /* Used by aio_accept() to send new connections to a queue. */
+    void _aio_set_accept_queue(swig_cb *queue) {
+	struct gensio_data *data = gensio_acc_get_user_data(self);
+
+	deref_swig_cb_val(data->aio_accept_q);
+	if (nil_swig_cb(queue))
+	    data->aio_accept_q = NULL;
+	else
+	    data->aio_accept_q = ref_swig_cb(queue, new_connection);
+    }
+
+    PyObject *_aio_get_accept_queue() {
+	struct gensio_data *data = gensio_acc_get_user_data(self);
+	PyObject *queue = data->aio_accept_q;
+
+	if (!queue)
+	    queue = Py_None;
+	Py_INCREF(queue);
+	return queue;
+    }
+
     void startup() {
 	int rv = gensio_acc_startup(self);
 
@@ -888,7 +1087,11 @@ struct waiter { };
     }
 
     void shutdown_s() {
-	int rv = gensio_acc_shutdown_s(self);
+	int rv;
+
+	GENSIO_SWIG_C_BLOCK_ENTRY
+	rv = gensio_acc_shutdown_s(self);
+	GENSIO_SWIG_C_BLOCK_EXIT
 
 	err_handle("shutdown_s", rv);
     }
@@ -902,7 +1105,7 @@ struct waiter { };
     void accept_s_timeout(struct gensio **io, long *r_int,
 			  struct gensio_os_funcs *o,
 			  swig_cb *handler, int timeout) {
-	struct timeval tv = { timeout / 1000, timeout % 1000 };
+	struct timeval tv = { timeout / 1000, (timeout % 1000) * 1000 };
 	int rv;
 	struct gensio_data *data = alloc_gensio_data(o, handler);
 
@@ -912,7 +1115,9 @@ struct waiter { };
 	    rv = GE_NOMEM;
 	    goto out_err;
 	}
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = gensio_acc_accept_s(self, &tv, io);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	if (rv) {
 	    free_gensio_data(data);
 	    if (rv == GE_TIMEDOUT)
@@ -934,7 +1139,9 @@ struct waiter { };
 	struct gensio_data *data = alloc_gensio_data(o, handler);
 	int rv;
 
+	GENSIO_SWIG_C_BLOCK_ENTRY
 	rv = gensio_acc_accept_s(self, NULL, &io);
+	GENSIO_SWIG_C_BLOCK_EXIT
 	if (rv) {
 	    free_gensio_data(data);
 	    err_handle("accept_s", rv);
@@ -1037,7 +1244,13 @@ struct waiter { };
 }
 
 %newobject alloc_gensio_selector;
-struct gensio_os_funcs *alloc_gensio_selector(swig_cb *log_handler);
+struct gensio_os_funcs *alloc_gensio_selector(swig_cb *log_handler,
+					      bool edge_triggered = false,
+					      bool timer_wheel = false);
+
+%newobject alloc_gensio_asyncio;
+struct gensio_os_funcs *alloc_gensio_asyncio(swig_cb *loop,
+					     swig_cb *log_handler);
 
 %constant int GENSIO_LOG_FATAL = GENSIO_LOG_FATAL;
 %constant int GENSIO_LOG_ERR = GENSIO_LOG_ERR;
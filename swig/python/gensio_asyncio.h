@@ -0,0 +1,1130 @@
+/*
+ *  gensio - A library for abstracting stream I/O
+ *  Copyright (C) 2018  Corey Minyard <minyard@acm.org>
+ *
+ *  SPDX-License-Identifier: LGPL-2.1-only
+ */
+
+/*
+ * An os funcs implementation that runs on a Python asyncio event
+ * loop.  File descriptors are handled with the loop's add_reader()
+ * and add_writer(), timers with call_later(), and runners with
+ * call_soon(), so gensios can be used from an asyncio application
+ * without a separate thread.  Everything must be done from the
+ * loop's thread.
+ *
+ * Waiting (for the *_s functions and waiter objects) runs the loop
+ * with run_until_complete(), so it only works when the loop is not
+ * already running.  In a running loop the aio_xxx() functions must be
+ * used instead.
+ */
+
+struct gensio_aio_data {
+    PyObject *loop;
+
+    /* Bound methods of the loop, so they are not looked up each use. */
+    PyObject *add_reader;
+    PyObject *remove_reader;
+    PyObject *add_writer;
+    PyObject *remove_writer;
+    PyObject *call_soon;
+    PyObject *call_later;
+
+    /* Functions the loop calls back into, see gensio_aio_methods. */
+    PyObject *fd_read_cb;
+    PyObject *fd_write_cb;
+    PyObject *fd_cleared_cb;
+    PyObject *timer_cb;
+    PyObject *timer_done_cb;
+    PyObject *runner_cb;
+    PyObject *waiter_timeout_cb;
+
+    /* fd -> capsule holding the struct gensio_aio_fd. */
+    PyObject *fds;
+
+    /* The waiter currently running the loop, if any. */
+    struct gensio_waiter *waiter;
+
+    /*
+     * An exception raised by a callback while waiting.  It is
+     * reported from the wait, as it would be with the selector.
+     */
+    PyObject *exc_type, *exc_value, *exc_tb;
+};
+
+#define GENSIO_AIO_FD_CAPSULE "gensio_aio_fd"
+
+struct gensio_aio_fd {
+    struct gensio_os_funcs *f;
+    int fd;
+    void *cb_data;
+    void (*read_handler)(int fd, void *cb_data);
+    void (*write_handler)(int fd, void *cb_data);
+    void (*cleared_handler)(int fd, void *cb_data);
+    bool read_enabled;
+    bool write_enabled;
+    bool cleared;
+};
+
+/*
+ * Locks for global data in the library are allocated by the first os
+ * funcs that uses it, then used with whatever os funcs comes along.
+ * So this must match the selector os funcs' lock.
+ */
+struct gensio_lock {
+    struct gensio_os_funcs *f;
+#ifdef USE_POSIX_THREADS
+    pthread_mutex_t lock;
+#else
+    int lock;
+#endif
+};
+
+struct gensio_timer {
+    struct gensio_os_funcs *f;
+    void (*handler)(struct gensio_timer *t, void *cb_data);
+    void *cb_data;
+    PyObject *capsule;
+    /* The loop's TimerHandle while the timer is running. */
+    PyObject *handle;
+
+    void (*done_handler)(struct gensio_timer *t, void *cb_data);
+    void *done_cb_data;
+    PyObject *done_handle;
+};
+
+struct gensio_runner {
+    struct gensio_os_funcs *f;
+    void (*handler)(struct gensio_runner *r, void *cb_data);
+    void *cb_data;
+    PyObject *capsule;
+    /* The loop's Handle while the runner is scheduled. */
+    PyObject *handle;
+};
+
+struct gensio_waiter {
+    struct gensio_os_funcs *f;
+    unsigned int count;
+    PyObject *capsule;
+    /* A future the loop is run on while waiting. */
+    PyObject *fut;
+    bool timed_out;
+};
+
+static double
+gensio_aio_timeval_to_secs(struct timeval *tv)
+{
+    return tv->tv_sec + (tv->tv_usec / 1000000.0);
+}
+
+static void
+gensio_aio_secs_to_timeval(double secs, struct timeval *tv)
+{
+    if (secs < 0)
+	secs = 0;
+    tv->tv_sec = (time_t) secs;
+    tv->tv_usec = (secs - tv->tv_sec) * 1000000.0;
+}
+
+/*
+ * Call a method of the loop.  This may be called from gensio code
+ * after a callback raised an exception, so save any pending exception
+ * around the call.  An error from the call itself is reported here.
+ */
+static PyObject *
+gensio_aio_vcall(PyObject *func, const char *fmt, va_list ap)
+{
+    PyObject *type, *value, *traceback, *args, *rv = NULL;
+
+    PyErr_Fetch(&type, &value, &traceback);
+    args = Py_VaBuildValue(fmt, ap);
+    if (args) {
+	rv = PyObject_CallObject(func, args);
+	Py_DECREF(args);
+    }
+    if (!rv)
+	PyErr_Print();
+    PyErr_Restore(type, value, traceback);
+
+    return rv;
+}
+
+static PyObject *
+gensio_aio_call(PyObject *func, const char *fmt, ...)
+{
+    PyObject *rv;
+    va_list ap;
+
+    va_start(ap, fmt);
+    rv = gensio_aio_vcall(func, fmt, ap);
+    va_end(ap);
+
+    return rv;
+}
+
+/* Call func, ignoring the return value. */
+static void
+gensio_aio_call_noerr(PyObject *func, const char *fmt, ...)
+{
+    PyObject *rv;
+    va_list ap;
+
+    va_start(ap, fmt);
+    rv = gensio_aio_vcall(func, fmt, ap);
+    va_end(ap);
+    Py_XDECREF(rv);
+}
+
+/* Cancel and release a loop handle. */
+static void
+gensio_aio_cancel(PyObject **handle)
+{
+    PyObject *type, *value, *traceback, *rv;
+
+    if (!*handle)
+	return;
+    PyErr_Fetch(&type, &value, &traceback);
+    rv = PyObject_CallMethod(*handle, "cancel", NULL);
+    if (rv)
+	Py_DECREF(rv);
+    else
+	PyErr_Print();
+    PyErr_Restore(type, value, traceback);
+    Py_CLEAR(*handle);
+}
+
+/* Make a waiter's loop run return. */
+static void
+gensio_aio_waiter_wakeup(struct gensio_waiter *waiter)
+{
+    PyObject *type, *value, *traceback, *rv;
+
+    if (!waiter->fut)
+	return;
+
+    /* This may be called with an exception pending. */
+    PyErr_Fetch(&type, &value, &traceback);
+    rv = PyObject_CallMethod(waiter->fut, "done", NULL);
+    if (rv && !PyObject_IsTrue(rv)) {
+	Py_DECREF(rv);
+	rv = PyObject_CallMethod(waiter->fut, "set_result", "O", Py_None);
+    }
+    if (rv)
+	Py_DECREF(rv);
+    else
+	PyErr_Clear();
+    PyErr_Restore(type, value, traceback);
+}
+
+/*
+ * Finish a call from the loop.  If a callback raised an exception
+ * while a waiter is running the loop, save it to be raised from the
+ * wait.  Otherwise it is returned to the loop, which reports it.
+ */
+static PyObject *
+gensio_aio_cb_done(struct gensio_aio_data *d)
+{
+    if (PyErr_Occurred()) {
+	if (!d->waiter)
+	    return NULL;
+	if (!d->exc_type)
+	    PyErr_Fetch(&d->exc_type, &d->exc_value, &d->exc_tb);
+	else
+	    PyErr_Clear();
+	gensio_aio_waiter_wakeup(d->waiter);
+    }
+    Py_RETURN_NONE;
+}
+
+static struct gensio_aio_fd *
+gensio_aio_fd_from_capsule(PyObject *capsule)
+{
+    return PyCapsule_GetPointer(capsule, GENSIO_AIO_FD_CAPSULE);
+}
+
+static PyObject *
+gensio_aio_fd_read_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_aio_fd *fdd = gensio_aio_fd_from_capsule(capsule);
+    struct gensio_aio_data *d;
+
+    if (!fdd)
+	return NULL;
+    d = fdd->f->user_data;
+    if (!fdd->cleared && fdd->read_enabled)
+	fdd->read_handler(fdd->fd, fdd->cb_data);
+    return gensio_aio_cb_done(d);
+}
+
+static PyObject *
+gensio_aio_fd_write_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_aio_fd *fdd = gensio_aio_fd_from_capsule(capsule);
+    struct gensio_aio_data *d;
+
+    if (!fdd)
+	return NULL;
+    d = fdd->f->user_data;
+    if (!fdd->cleared && fdd->write_enabled)
+	fdd->write_handler(fdd->fd, fdd->cb_data);
+    return gensio_aio_cb_done(d);
+}
+
+static PyObject *
+gensio_aio_fd_cleared_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_aio_fd *fdd = gensio_aio_fd_from_capsule(capsule);
+    struct gensio_aio_data *d;
+
+    if (!fdd)
+	return NULL;
+    d = fdd->f->user_data;
+    if (fdd->cleared_handler)
+	fdd->cleared_handler(fdd->fd, fdd->cb_data);
+    return gensio_aio_cb_done(d);
+}
+
+static PyObject *
+gensio_aio_timer_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_timer *timer = PyCapsule_GetPointer(capsule, NULL);
+    struct gensio_aio_data *d;
+
+    if (!timer)
+	return NULL;
+    /* The handler may free the timer. */
+    d = timer->f->user_data;
+    Py_CLEAR(timer->handle);
+    timer->handler(timer, timer->cb_data);
+    return gensio_aio_cb_done(d);
+}
+
+static PyObject *
+gensio_aio_timer_done_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_timer *timer = PyCapsule_GetPointer(capsule, NULL);
+    void (*done_handler)(struct gensio_timer *t, void *cb_data);
+    struct gensio_aio_data *d;
+
+    if (!timer)
+	return NULL;
+    d = timer->f->user_data;
+    Py_CLEAR(timer->done_handle);
+    done_handler = timer->done_handler;
+    timer->done_handler = NULL;
+    done_handler(timer, timer->done_cb_data);
+    return gensio_aio_cb_done(d);
+}
+
+static PyObject *
+gensio_aio_runner_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_runner *runner = PyCapsule_GetPointer(capsule, NULL);
+    struct gensio_aio_data *d;
+
+    if (!runner)
+	return NULL;
+    /* The handler may free the runner. */
+    d = runner->f->user_data;
+    Py_CLEAR(runner->handle);
+    runner->handler(runner, runner->cb_data);
+    return gensio_aio_cb_done(d);
+}
+
+static PyObject *
+gensio_aio_waiter_timeout_cb(PyObject *self, PyObject *capsule)
+{
+    struct gensio_waiter *waiter = PyCapsule_GetPointer(capsule, NULL);
+
+    if (!waiter)
+	return NULL;
+    waiter->timed_out = true;
+    gensio_aio_waiter_wakeup(waiter);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef gensio_aio_methods[] = {
+    { "gensio_aio_fd_read", gensio_aio_fd_read_cb, METH_O, NULL },
+    { "gensio_aio_fd_write", gensio_aio_fd_write_cb, METH_O, NULL },
+    { "gensio_aio_fd_cleared", gensio_aio_fd_cleared_cb, METH_O, NULL },
+    { "gensio_aio_timer", gensio_aio_timer_cb, METH_O, NULL },
+    { "gensio_aio_timer_done", gensio_aio_timer_done_cb, METH_O, NULL },
+    { "gensio_aio_runner", gensio_aio_runner_cb, METH_O, NULL },
+    { "gensio_aio_waiter_timeout", gensio_aio_waiter_timeout_cb, METH_O,
+      NULL },
+};
+
+static void *
+gensio_aio_zalloc(struct gensio_os_funcs *f, unsigned int size)
+{
+    void *d = malloc(size);
+
+    if (d)
+	memset(d, 0, size);
+    return d;
+}
+
+static void
+gensio_aio_free(struct gensio_os_funcs *f, void *data)
+{
+    free(data);
+}
+
+static struct gensio_lock *
+gensio_aio_alloc_lock(struct gensio_os_funcs *f)
+{
+    struct gensio_lock *lock = f->zalloc(f, sizeof(*lock));
+
+    if (lock) {
+	lock->f = f;
+#ifdef USE_POSIX_THREADS
+	pthread_mutex_init(&lock->lock, NULL);
+#endif
+    }
+    return lock;
+}
+
+static void
+gensio_aio_free_lock(struct gensio_lock *lock)
+{
+#ifdef USE_POSIX_THREADS
+    pthread_mutex_destroy(&lock->lock);
+#endif
+    lock->f->free(lock->f, lock);
+}
+
+static void
+gensio_aio_lock(struct gensio_lock *lock)
+{
+#ifdef USE_POSIX_THREADS
+    pthread_mutex_lock(&lock->lock);
+#endif
+}
+
+static void
+gensio_aio_unlock(struct gensio_lock *lock)
+{
+#ifdef USE_POSIX_THREADS
+    pthread_mutex_unlock(&lock->lock);
+#endif
+}
+
+static void
+gensio_aio_fd_capsule_free(PyObject *capsule)
+{
+    free(PyCapsule_GetPointer(capsule, GENSIO_AIO_FD_CAPSULE));
+}
+
+/* Returns a borrowed reference to the fd's capsule, or NULL. */
+static PyObject *
+gensio_aio_fd_capsule(struct gensio_aio_data *d, int fd)
+{
+    PyObject *key, *capsule;
+
+    key = PyLong_FromLong(fd);
+    if (!key)
+	return NULL;
+    capsule = PyDict_GetItem(d->fds, key);
+    Py_DECREF(key);
+
+    return capsule;
+}
+
+static int
+gensio_aio_set_fd_handlers(struct gensio_os_funcs *f,
+			   int fd,
+			   void *cb_data,
+			   void (*read_handler)(int fd, void *cb_data),
+			   void (*write_handler)(int fd, void *cb_data),
+			   void (*except_handler)(int fd, void *cb_data),
+			   void (*cleared_handler)(int fd, void *cb_data))
+{
+    struct gensio_aio_data *d = f->user_data;
+    struct gensio_aio_fd *fdd;
+    PyObject *key, *capsule;
+    OI_PY_STATE gstate;
+    int rv = 0;
+
+    gstate = OI_PY_STATE_GET();
+    if (gensio_aio_fd_capsule(d, fd)) {
+	rv = GE_INUSE;
+	goto out;
+    }
+
+    fdd = f->zalloc(f, sizeof(*fdd));
+    if (!fdd) {
+	rv = GE_NOMEM;
+	goto out;
+    }
+    fdd->f = f;
+    fdd->fd = fd;
+    fdd->cb_data = cb_data;
+    fdd->read_handler = read_handler;
+    fdd->write_handler = write_handler;
+    fdd->cleared_handler = cleared_handler;
+    /* The loop has no way to watch for exceptions, except_handler is unused */
+
+    capsule = PyCapsule_New(fdd, GENSIO_AIO_FD_CAPSULE,
+			    gensio_aio_fd_capsule_free);
+    if (!capsule) {
+	f->free(f, fdd);
+	PyErr_Clear();
+	rv = GE_NOMEM;
+	goto out;
+    }
+    key = PyLong_FromLong(fd);
+    if (!key || PyDict_SetItem(d->fds, key, capsule) == -1) {
+	PyErr_Clear();
+	rv = GE_NOMEM;
+    }
+    Py_XDECREF(key);
+    Py_DECREF(capsule);
+ out:
+    OI_PY_STATE_PUT(gstate);
+    return rv;
+}
+
+static void
+gensio_aio_i_clear_fd_handlers(struct gensio_os_funcs *f, int fd, bool report)
+{
+    struct gensio_aio_data *d = f->user_data;
+    struct gensio_aio_fd *fdd;
+    PyObject *key, *capsule;
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    capsule = gensio_aio_fd_capsule(d, fd);
+    if (!capsule)
+	goto out;
+    /* Keep it around for the cleared callback. */
+    Py_INCREF(capsule);
+    fdd = gensio_aio_fd_from_capsule(capsule);
+    fdd->cleared = true;
+    if (fdd->read_enabled)
+	gensio_aio_call_noerr(d->remove_reader, "(i)", fd);
+    if (fdd->write_enabled)
+	gensio_aio_call_noerr(d->remove_writer, "(i)", fd);
+    fdd->read_enabled = false;
+    fdd->write_enabled = false;
+
+    key = PyLong_FromLong(fd);
+    if (key) {
+	if (PyDict_DelItem(d->fds, key) == -1)
+	    PyErr_Print();
+	Py_DECREF(key);
+    }
+
+    /* Like the selector, report it after any handlers are done. */
+    if (report)
+	gensio_aio_call_noerr(d->call_soon, "(OO)", d->fd_cleared_cb, capsule);
+    Py_DECREF(capsule);
+ out:
+    OI_PY_STATE_PUT(gstate);
+}
+
+static void
+gensio_aio_clear_fd_handlers(struct gensio_os_funcs *f, int fd)
+{
+    gensio_aio_i_clear_fd_handlers(f, fd, true);
+}
+
+static void
+gensio_aio_clear_fd_handlers_norpt(struct gensio_os_funcs *f, int fd)
+{
+    gensio_aio_i_clear_fd_handlers(f, fd, false);
+}
+
+static void
+gensio_aio_set_read_handler(struct gensio_os_funcs *f, int fd, bool enable)
+{
+    struct gensio_aio_data *d = f->user_data;
+    struct gensio_aio_fd *fdd;
+    PyObject *capsule;
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    capsule = gensio_aio_fd_capsule(d, fd);
+    if (!capsule)
+	goto out;
+    fdd = gensio_aio_fd_from_capsule(capsule);
+    if (enable && !fdd->read_enabled)
+	gensio_aio_call_noerr(d->add_reader, "(iOO)", fd, d->fd_read_cb,
+			      capsule);
+    else if (!enable && fdd->read_enabled)
+	gensio_aio_call_noerr(d->remove_reader, "(i)", fd);
+    fdd->read_enabled = enable;
+ out:
+    OI_PY_STATE_PUT(gstate);
+}
+
+static void
+gensio_aio_set_write_handler(struct gensio_os_funcs *f, int fd, bool enable)
+{
+    struct gensio_aio_data *d = f->user_data;
+    struct gensio_aio_fd *fdd;
+    PyObject *capsule;
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    capsule = gensio_aio_fd_capsule(d, fd);
+    if (!capsule)
+	goto out;
+    fdd = gensio_aio_fd_from_capsule(capsule);
+    if (enable && !fdd->write_enabled)
+	gensio_aio_call_noerr(d->add_writer, "(iOO)", fd, d->fd_write_cb,
+			      capsule);
+    else if (!enable && fdd->write_enabled)
+	gensio_aio_call_noerr(d->remove_writer, "(i)", fd);
+    fdd->write_enabled = enable;
+ out:
+    OI_PY_STATE_PUT(gstate);
+}
+
+static void
+gensio_aio_set_except_handler(struct gensio_os_funcs *f, int fd, bool enable)
+{
+    /* Not supported by asyncio, out of band data is not reported. */
+}
+
+static struct gensio_timer *
+gensio_aio_alloc_timer(struct gensio_os_funcs *f,
+		       void (*handler)(struct gensio_timer *t, void *cb_data),
+		       void *cb_data)
+{
+    struct gensio_timer *timer;
+    OI_PY_STATE gstate;
+
+    timer = f->zalloc(f, sizeof(*timer));
+    if (!timer)
+	return NULL;
+
+    timer->f = f;
+    timer->handler = handler;
+    timer->cb_data = cb_data;
+
+    gstate = OI_PY_STATE_GET();
+    timer->capsule = PyCapsule_New(timer, NULL, NULL);
+    if (!timer->capsule) {
+	PyErr_Clear();
+	f->free(f, timer);
+	timer = NULL;
+    }
+    OI_PY_STATE_PUT(gstate);
+
+    return timer;
+}
+
+static void
+gensio_aio_free_timer(struct gensio_timer *timer)
+{
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    gensio_aio_cancel(&timer->handle);
+    gensio_aio_cancel(&timer->done_handle);
+    Py_DECREF(timer->capsule);
+    OI_PY_STATE_PUT(gstate);
+    timer->f->free(timer->f, timer);
+}
+
+static int
+gensio_aio_start_timer(struct gensio_timer *timer, struct timeval *timeout)
+{
+    struct gensio_aio_data *d = timer->f->user_data;
+    OI_PY_STATE gstate;
+    int rv = 0;
+
+    gstate = OI_PY_STATE_GET();
+    if (timer->handle || timer->done_handler) {
+	rv = GE_INUSE;
+	goto out;
+    }
+    timer->handle = gensio_aio_call(d->call_later, "(dOO)",
+				    gensio_aio_timeval_to_secs(timeout),
+				    d->timer_cb, timer->capsule);
+    if (!timer->handle)
+	rv = GE_NOMEM;
+ out:
+    OI_PY_STATE_PUT(gstate);
+    return rv;
+}
+
+static int
+gensio_aio_start_timer_abs(struct gensio_timer *timer, struct timeval *timeout)
+{
+    struct timeval now, tv;
+
+    sel_get_monotonic_time(&now);
+    gensio_aio_secs_to_timeval(gensio_aio_timeval_to_secs(timeout) -
+			       gensio_aio_timeval_to_secs(&now), &tv);
+    return gensio_aio_start_timer(timer, &tv);
+}
+
+static int
+gensio_aio_stop_timer(struct gensio_timer *timer)
+{
+    OI_PY_STATE gstate;
+    int rv = 0;
+
+    gstate = OI_PY_STATE_GET();
+    if (!timer->handle)
+	rv = GE_TIMEDOUT;
+    else
+	gensio_aio_cancel(&timer->handle);
+    OI_PY_STATE_PUT(gstate);
+
+    return rv;
+}
+
+static int
+gensio_aio_stop_timer_with_done(struct gensio_timer *timer,
+				void (*done_handler)(struct gensio_timer *t,
+						     void *cb_data),
+				void *cb_data)
+{
+    struct gensio_aio_data *d = timer->f->user_data;
+    OI_PY_STATE gstate;
+    int rv = 0;
+
+    gstate = OI_PY_STATE_GET();
+    if (timer->done_handler) {
+	rv = GE_INUSE;
+	goto out;
+    }
+    if (!timer->handle) {
+	rv = GE_TIMEDOUT;
+	goto out;
+    }
+    timer->done_handle = gensio_aio_call(d->call_soon, "(OO)",
+					 d->timer_done_cb, timer->capsule);
+    if (!timer->done_handle) {
+	rv = GE_NOMEM;
+	goto out;
+    }
+    gensio_aio_cancel(&timer->handle);
+    timer->done_handler = done_handler;
+    timer->done_cb_data = cb_data;
+ out:
+    OI_PY_STATE_PUT(gstate);
+    return rv;
+}
+
+static struct gensio_runner *
+gensio_aio_alloc_runner(struct gensio_os_funcs *f,
+			void (*handler)(struct gensio_runner *r,
+					void *cb_data),
+			void *cb_data)
+{
+    struct gensio_runner *runner;
+    OI_PY_STATE gstate;
+
+    runner = f->zalloc(f, sizeof(*runner));
+    if (!runner)
+	return NULL;
+
+    runner->f = f;
+    runner->handler = handler;
+    runner->cb_data = cb_data;
+
+    gstate = OI_PY_STATE_GET();
+    runner->capsule = PyCapsule_New(runner, NULL, NULL);
+    if (!runner->capsule) {
+	PyErr_Clear();
+	f->free(f, runner);
+	runner = NULL;
+    }
+    OI_PY_STATE_PUT(gstate);
+
+    return runner;
+}
+
+static void
+gensio_aio_free_runner(struct gensio_runner *runner)
+{
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    gensio_aio_cancel(&runner->handle);
+    Py_DECREF(runner->capsule);
+    OI_PY_STATE_PUT(gstate);
+    runner->f->free(runner->f, runner);
+}
+
+static int
+gensio_aio_run(struct gensio_runner *runner)
+{
+    struct gensio_aio_data *d = runner->f->user_data;
+    OI_PY_STATE gstate;
+    int rv = 0;
+
+    gstate = OI_PY_STATE_GET();
+    if (runner->handle) {
+	rv = GE_INUSE;
+	goto out;
+    }
+    runner->handle = gensio_aio_call(d->call_soon, "(OO)", d->runner_cb,
+				     runner->capsule);
+    if (!runner->handle)
+	rv = GE_NOMEM;
+ out:
+    OI_PY_STATE_PUT(gstate);
+    return rv;
+}
+
+static struct gensio_waiter *
+gensio_aio_alloc_waiter(struct gensio_os_funcs *f)
+{
+    struct gensio_waiter *waiter;
+    OI_PY_STATE gstate;
+
+    waiter = f->zalloc(f, sizeof(*waiter));
+    if (!waiter)
+	return NULL;
+
+    waiter->f = f;
+
+    gstate = OI_PY_STATE_GET();
+    waiter->capsule = PyCapsule_New(waiter, NULL, NULL);
+    if (!waiter->capsule) {
+	PyErr_Clear();
+	f->free(f, waiter);
+	waiter = NULL;
+    }
+    OI_PY_STATE_PUT(gstate);
+
+    return waiter;
+}
+
+static void
+gensio_aio_free_waiter(struct gensio_waiter *waiter)
+{
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    Py_DECREF(waiter->capsule);
+    OI_PY_STATE_PUT(gstate);
+    waiter->f->free(waiter->f, waiter);
+}
+
+static int
+gensio_aio_wait(struct gensio_waiter *waiter, unsigned int count,
+		struct timeval *timeout)
+{
+    struct gensio_aio_data *d = waiter->f->user_data;
+    PyObject *tmo_handle = NULL, *o;
+    struct timeval start, now;
+    OI_PY_STATE gstate;
+    int rv = 0, running;
+
+    gstate = OI_PY_STATE_GET();
+
+    o = PyObject_CallMethod(d->loop, "is_running", NULL);
+    if (!o) {
+	rv = GE_INTERRUPTED;
+	goto out;
+    }
+    running = PyObject_IsTrue(o);
+    Py_DECREF(o);
+    if (running || d->waiter) {
+	PyErr_SetString(PyExc_RuntimeError,
+			"gensio: Cannot wait while the asyncio loop is "
+			"running, use the aio_xxx() functions");
+	rv = GE_INUSE;
+	goto out;
+    }
+
+    waiter->timed_out = false;
+    if (timeout) {
+	sel_get_monotonic_time(&start);
+	tmo_handle = gensio_aio_call(d->call_later, "(dOO)",
+				     gensio_aio_timeval_to_secs(timeout),
+				     d->waiter_timeout_cb, waiter->capsule);
+	if (!tmo_handle) {
+	    rv = GE_NOMEM;
+	    goto out;
+	}
+    }
+
+    d->waiter = waiter;
+    while (waiter->count < count && !waiter->timed_out && !d->exc_type) {
+	waiter->fut = PyObject_CallMethod(d->loop, "create_future", NULL);
+	if (!waiter->fut) {
+	    rv = GE_NOMEM;
+	    break;
+	}
+	o = PyObject_CallMethod(d->loop, "run_until_complete", "O",
+				waiter->fut);
+	Py_CLEAR(waiter->fut);
+	if (!o) {
+	    /* KeyboardInterrupt or something like that. */
+	    rv = GE_INTERRUPTED;
+	    break;
+	}
+	Py_DECREF(o);
+    }
+    d->waiter = NULL;
+    gensio_aio_cancel(&tmo_handle);
+
+    if (d->exc_type) {
+	PyErr_Restore(d->exc_type, d->exc_value, d->exc_tb);
+	d->exc_type = NULL;
+	d->exc_value = NULL;
+	d->exc_tb = NULL;
+	rv = GE_INTERRUPTED;
+    } else if (!rv) {
+	if (waiter->count >= count)
+	    waiter->count -= count;
+	else
+	    rv = GE_TIMEDOUT;
+    }
+
+    if (timeout) {
+	/* Return the time left, like the selector does. */
+	sel_get_monotonic_time(&now);
+	gensio_aio_secs_to_timeval(gensio_aio_timeval_to_secs(timeout) -
+				   (gensio_aio_timeval_to_secs(&now) -
+				    gensio_aio_timeval_to_secs(&start)),
+				   timeout);
+    }
+ out:
+    OI_PY_STATE_PUT(gstate);
+    return rv;
+}
+
+static int
+gensio_aio_wait_intr_sigmask(struct gensio_waiter *waiter, unsigned int count,
+			     struct timeval *timeout, sigset_t *sigmask)
+{
+    /* Signals are handled by the loop. */
+    return gensio_aio_wait(waiter, count, timeout);
+}
+
+static void
+gensio_aio_wake(struct gensio_waiter *waiter)
+{
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    waiter->count++;
+    gensio_aio_waiter_wakeup(waiter);
+    OI_PY_STATE_PUT(gstate);
+}
+
+static int
+gensio_aio_service(struct gensio_os_funcs *f, struct timeval *timeout)
+{
+    struct gensio_waiter *waiter;
+    int rv;
+
+    /* Run the loop for the time given. */
+    waiter = f->alloc_waiter(f);
+    if (!waiter)
+	return GE_NOMEM;
+    rv = gensio_aio_wait(waiter, 1, timeout);
+    f->free_waiter(waiter);
+
+    return rv;
+}
+
+static void
+gensio_aio_free_funcs(struct gensio_os_funcs *f)
+{
+    struct gensio_aio_data *d = f->user_data;
+    OI_PY_STATE gstate;
+
+    gstate = OI_PY_STATE_GET();
+    Py_XDECREF(d->loop);
+    Py_XDECREF(d->add_reader);
+    Py_XDECREF(d->remove_reader);
+    Py_XDECREF(d->add_writer);
+    Py_XDECREF(d->remove_writer);
+    Py_XDECREF(d->call_soon);
+    Py_XDECREF(d->call_later);
+    Py_XDECREF(d->fd_read_cb);
+    Py_XDECREF(d->fd_write_cb);
+    Py_XDECREF(d->fd_cleared_cb);
+    Py_XDECREF(d->timer_cb);
+    Py_XDECREF(d->timer_done_cb);
+    Py_XDECREF(d->runner_cb);
+    Py_XDECREF(d->waiter_timeout_cb);
+    Py_XDECREF(d->fds);
+    OI_PY_STATE_PUT(gstate);
+    free(d);
+    free(f);
+}
+
+#ifdef USE_POSIX_THREADS
+static pthread_mutex_t gensio_aio_once_lock = PTHREAD_MUTEX_INITIALIZER;
+#endif
+
+static void
+gensio_aio_call_once(struct gensio_os_funcs *f, struct gensio_once *once,
+		     void (*func)(void *cb_data), void *cb_data)
+{
+    if (once->called)
+	return;
+#ifdef USE_POSIX_THREADS
+    pthread_mutex_lock(&gensio_aio_once_lock);
+#endif
+    if (!once->called) {
+	once->called = true;
+#ifdef USE_POSIX_THREADS
+	pthread_mutex_unlock(&gensio_aio_once_lock);
+#endif
+	func(cb_data);
+    } else {
+#ifdef USE_POSIX_THREADS
+	pthread_mutex_unlock(&gensio_aio_once_lock);
+#endif
+    }
+}
+
+static void
+gensio_aio_get_monotonic_time(struct gensio_os_funcs *f, struct timeval *time)
+{
+    sel_get_monotonic_time(time);
+}
+
+static int
+gensio_aio_handle_fork(struct gensio_os_funcs *f)
+{
+    return 0;
+}
+
+static struct gensio_os_funcs *
+gensio_aio_alloc(PyObject *loop)
+{
+    struct gensio_aio_data *d;
+    struct gensio_os_funcs *o;
+    PyObject **cbs[7];
+    unsigned int i;
+
+    o = malloc(sizeof(*o));
+    if (!o)
+	return NULL;
+    memset(o, 0, sizeof(*o));
+
+    d = malloc(sizeof(*d));
+    if (!d) {
+	free(o);
+	return NULL;
+    }
+    memset(d, 0, sizeof(*d));
+    o->user_data = d;
+
+    Py_INCREF(loop);
+    d->loop = loop;
+    d->add_reader = PyObject_GetAttrString(loop, "add_reader");
+    d->remove_reader = PyObject_GetAttrString(loop, "remove_reader");
+    d->add_writer = PyObject_GetAttrString(loop, "add_writer");
+    d->remove_writer = PyObject_GetAttrString(loop, "remove_writer");
+    d->call_soon = PyObject_GetAttrString(loop, "call_soon");
+    d->call_later = PyObject_GetAttrString(loop, "call_later");
+    if (!d->add_reader || !d->remove_reader || !d->add_writer ||
+		!d->remove_writer || !d->call_soon || !d->call_later)
+	goto out_err;
+
+    /* In the same order as gensio_aio_methods. */
+    cbs[0] = &d->fd_read_cb;
+    cbs[1] = &d->fd_write_cb;
+    cbs[2] = &d->fd_cleared_cb;
+    cbs[3] = &d->timer_cb;
+    cbs[4] = &d->timer_done_cb;
+    cbs[5] = &d->runner_cb;
+    cbs[6] = &d->waiter_timeout_cb;
+    for (i = 0; i < sizeof(cbs) / sizeof(cbs[0]); i++) {
+	*cbs[i] = PyCFunction_New(&gensio_aio_methods[i], NULL);
+	if (!*cbs[i])
+	    goto out_err;
+    }
+
+    d->fds = PyDict_New();
+    if (!d->fds)
+	goto out_err;
+
+    o->zalloc = gensio_aio_zalloc;
+    o->free = gensio_aio_free;
+    o->alloc_lock = gensio_aio_alloc_lock;
+    o->free_lock = gensio_aio_free_lock;
+    o->lock = gensio_aio_lock;
+    o->unlock = gensio_aio_unlock;
+    o->set_fd_handlers = gensio_aio_set_fd_handlers;
+    o->clear_fd_handlers = gensio_aio_clear_fd_handlers;
+    o->clear_fd_handlers_norpt = gensio_aio_clear_fd_handlers_norpt;
+    o->set_read_handler = gensio_aio_set_read_handler;
+    o->set_write_handler = gensio_aio_set_write_handler;
+    o->set_except_handler = gensio_aio_set_except_handler;
+    o->alloc_timer = gensio_aio_alloc_timer;
+    o->free_timer = gensio_aio_free_timer;
+    o->start_timer = gensio_aio_start_timer;
+    o->start_timer_abs = gensio_aio_start_timer_abs;
+    o->stop_timer = gensio_aio_stop_timer;
+    o->stop_timer_with_done = gensio_aio_stop_timer_with_done;
+    o->alloc_runner = gensio_aio_alloc_runner;
+    o->free_runner = gensio_aio_free_runner;
+    o->run = gensio_aio_run;
+    o->alloc_waiter = gensio_aio_alloc_waiter;
+    o->free_waiter = gensio_aio_free_waiter;
+    o->wait = gensio_aio_wait;
+    o->wait_intr = gensio_aio_wait;
+    o->wake = gensio_aio_wake;
+    o->service = gensio_aio_service;
+    o->free_funcs = gensio_aio_free_funcs;
+    o->call_once = gensio_aio_call_once;
+    o->get_monotonic_time = gensio_aio_get_monotonic_time;
+    o->handle_fork = gensio_aio_handle_fork;
+    o->wait_intr_sigmask = gensio_aio_wait_intr_sigmask;
+
+    return o;
+
+ out_err:
+    gensio_aio_free_funcs(o);
+    return NULL;
+}
+
+struct gensio_os_funcs *alloc_gensio_asyncio(swig_cb *loop,
+					     swig_cb *log_handler)
+{
+    struct gensio_os_funcs *o;
+    struct os_funcs_data *odata;
+    PyObject *asyncio, *curr_loop = NULL;
+
+    if (!loop) {
+	/* Use the running event loop. */
+	asyncio = PyImport_ImportModule("asyncio");
+	if (!asyncio)
+	    return NULL;
+	curr_loop = PyObject_CallMethod(asyncio, "get_running_loop", NULL);
+	Py_DECREF(asyncio);
+	if (!curr_loop)
+	    return NULL;
+	loop = curr_loop;
+    }
+
+    odata = malloc(sizeof(*odata));
+    if (!odata) {
+	Py_XDECREF(curr_loop);
+	err_handle("alloc_gensio_asyncio", GE_NOMEM);
+	return NULL;
+    }
+    memset(odata, 0, sizeof(*odata));
+    odata->refcount = 1;
+#ifdef USE_POSIX_THREADS
+    pthread_mutex_init(&odata->lock, NULL);
+#endif
+
+    o = gensio_aio_alloc(loop);
+    Py_XDECREF(curr_loop);
+    if (!o) {
+	free(odata);
+	if (!PyErr_Occurred())
+	    err_handle("alloc_gensio_asyncio", GE_NOMEM);
+	return NULL;
+    }
+    o->other_data = odata;
+    if (log_handler)
+	odata->log_handler = ref_swig_cb(log_handler, gensio_log);
+    o->vlog = gensio_do_vlog;
+
+    return o;
+}
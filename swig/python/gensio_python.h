@@ -14,10 +14,16 @@ typedef struct swig_ref {
 #define nil_swig_cb(v) ((v) == NULL)
 #define invalidate_swig_cb(v) ((v) = NULL)
 
-#ifdef WITH_THREAD
+/*
+ * Python 3.7 and later always have threads and no longer define
+ * WITH_THREAD.
+ */
+#if defined(WITH_THREAD) || PY_VERSION_HEX >= 0x03070000
 static void gensio_swig_init_lang(void)
 {
+#if PY_VERSION_HEX < 0x03070000
     PyEval_InitThreads();
+#endif
 }
 #define OI_PY_STATE PyGILState_STATE
 #define OI_PY_STATE_GET() PyGILState_Ensure()
@@ -118,16 +124,18 @@ deref_swig_cb_val(swig_cb_val *cb)
 	    swig_free_ref(r);						\
 	} while(0)
 
+/*
+ * Call the method p of cb, which was already looked up.  p is NULL if
+ * cb does not have the method.
+ */
 static PyObject *
-swig_finish_call_rv(swig_cb_val *cb, const char *method_name, PyObject *args,
-		    bool optional)
+swig_finish_call_meth_rv(swig_cb_val *cb, PyObject *p, const char *method_name,
+			 PyObject *args, bool optional)
 {
-    PyObject *p, *o = NULL;
+    PyObject *o = NULL;
 
-    if (PyObject_HasAttrString(cb, method_name)) {
-	p = PyObject_GetAttrString(cb, method_name);
+    if (p) {
 	o = PyObject_CallObject(p, args);
-	Py_DECREF(p);
 	if (PyErr_Occurred())
 	    wake_curr_waiter();
     } else if (!optional) {
@@ -146,14 +154,27 @@ swig_finish_call_rv(swig_cb_val *cb, const char *method_name, PyObject *args,
     return o;
 }
 
+static PyObject *
+swig_finish_call_rv(swig_cb_val *cb, const char *method_name, PyObject *args,
+		    bool optional)
+{
+    PyObject *p = NULL, *o;
+
+    if (PyObject_HasAttrString(cb, method_name))
+	p = PyObject_GetAttrString(cb, method_name);
+    o = swig_finish_call_meth_rv(cb, p, method_name, args, optional);
+    if (p)
+	Py_DECREF(p);
+
+    return o;
+}
+
+/* Convert the return value o of a callback to a gensiods and free it. */
 static gensiods
-swig_finish_call_rv_gensiods(swig_cb_val *cb, const char *method_name,
-			     PyObject *args, bool optional)
+swig_rv_to_gensiods(swig_cb_val *cb, const char *method_name, PyObject *o)
 {
-    PyObject *o;
     gensiods rv = 0;
 
-    o = swig_finish_call_rv(cb, method_name, args, optional);
     if (o) {
 	rv = PyLong_AsUnsignedLong(o);
 	if (PyErr_Occurred()) {
@@ -172,14 +193,12 @@ swig_finish_call_rv_gensiods(swig_cb_val *cb, const char *method_name,
     return rv;
 }
 
+/* Convert the return value o of a callback to an int and free it. */
 static int
-swig_finish_call_rv_int(swig_cb_val *cb, const char *method_name,
-			PyObject *args, bool optional)
+swig_rv_to_int(swig_cb_val *cb, const char *method_name, PyObject *o)
 {
-    PyObject *o;
     int rv = GE_NOTSUP;
 
-    o = swig_finish_call_rv(cb, method_name, args, optional);
     if (o) {
 	rv = PyLong_AsUnsignedLong(o);
 	if (PyErr_Occurred()) {
@@ -198,6 +217,14 @@ swig_finish_call_rv_int(swig_cb_val *cb, const char *method_name,
     return rv;
 }
 
+static int
+swig_finish_call_rv_int(swig_cb_val *cb, const char *method_name,
+			PyObject *args, bool optional)
+{
+    return swig_rv_to_int(cb, method_name,
+			  swig_finish_call_rv(cb, method_name, args, optional));
+}
+
 static void
 swig_finish_call(swig_cb_val *cb, const char *method_name, PyObject *args,
 		 bool optional)
@@ -216,6 +243,10 @@ struct os_funcs_data {
     unsigned int refcount;
     struct selector_s *sel;
     swig_cb_val *log_handler;
+
+    /* Shards added with add_shard(), we hold a reference to each. */
+    struct gensio_os_funcs **shards;
+    unsigned int nr_shards;
 };
 
 #ifdef USE_POSIX_THREADS
@@ -253,10 +284,19 @@ check_os_funcs_free(struct gensio_os_funcs *o)
 
     os_funcs_lock(odata);
     if (--odata->refcount == 0) {
+	unsigned int i;
+
 	os_funcs_unlock(odata);
 	if (odata->log_handler)
 	    deref_swig_cb_val(odata->log_handler);
-	sel_free_selector(odata->sel);
+	if (odata->sel)
+	    sel_free_selector(odata->sel);
+	for (i = 0; i < odata->nr_shards; i++) {
+	    if (odata->shards[i] != o)
+		check_os_funcs_free(odata->shards[i]);
+	}
+	if (odata->shards)
+	    free(odata->shards);
 	free(odata);
 	o->free_funcs(o);
     } else {
@@ -264,11 +304,107 @@ check_os_funcs_free(struct gensio_os_funcs *o)
     }
 }
 
+/*
+ * Methods of a gensio's handler.  These are looked up the first time
+ * they are used and cached in the gensio_data until the handler is
+ * changed, so the lookup isn't done for every event.
+ */
+enum gensio_py_method {
+    GENSIO_PY_READ_CALLBACK,
+    GENSIO_PY_WRITE_CALLBACK,
+    GENSIO_PY_NEW_CHANNEL,
+    GENSIO_PY_SEND_BREAK,
+    GENSIO_PY_AUTH_BEGIN,
+    GENSIO_PY_PRECERT_VERIFY,
+    GENSIO_PY_POSTCERT_VERIFY,
+    GENSIO_PY_PASSWORD_VERIFY,
+    GENSIO_PY_REQUEST_PASSWORD,
+    GENSIO_PY_MODEMSTATE,
+    GENSIO_PY_LINESTATE,
+    GENSIO_PY_SIGNATURE,
+    GENSIO_PY_SYNC,
+    GENSIO_PY_FLOWCONTROL_STATE,
+    GENSIO_PY_FLUSH,
+    GENSIO_PY_SBAUD,
+    GENSIO_PY_SDATASIZE,
+    GENSIO_PY_SPARITY,
+    GENSIO_PY_SSTOPBITS,
+    GENSIO_PY_SFLOWCONTROL,
+    GENSIO_PY_SIFLOWCONTROL,
+    GENSIO_PY_SSBREAK,
+    GENSIO_PY_SDTR,
+    GENSIO_PY_SRTS,
+    GENSIO_PY_NR_METHODS
+};
+
+static const char *gensio_py_method_names[GENSIO_PY_NR_METHODS] = {
+    [GENSIO_PY_READ_CALLBACK] = "read_callback",
+    [GENSIO_PY_WRITE_CALLBACK] = "write_callback",
+    [GENSIO_PY_NEW_CHANNEL] = "new_channel",
+    [GENSIO_PY_SEND_BREAK] = "send_break",
+    [GENSIO_PY_AUTH_BEGIN] = "auth_begin",
+    [GENSIO_PY_PRECERT_VERIFY] = "precert_verify",
+    [GENSIO_PY_POSTCERT_VERIFY] = "postcert_verify",
+    [GENSIO_PY_PASSWORD_VERIFY] = "password_verify",
+    [GENSIO_PY_REQUEST_PASSWORD] = "request_password",
+    [GENSIO_PY_MODEMSTATE] = "modemstate",
+    [GENSIO_PY_LINESTATE] = "linestate",
+    [GENSIO_PY_SIGNATURE] = "signature",
+    [GENSIO_PY_SYNC] = "sync",
+    [GENSIO_PY_FLOWCONTROL_STATE] = "flowcontrol_state",
+    [GENSIO_PY_FLUSH] = "flush",
+    [GENSIO_PY_SBAUD] = "sbaud",
+    [GENSIO_PY_SDATASIZE] = "sdatasize",
+    [GENSIO_PY_SPARITY] = "sparity",
+    [GENSIO_PY_SSTOPBITS] = "sstopbits",
+    [GENSIO_PY_SFLOWCONTROL] = "sflowcontrol",
+    [GENSIO_PY_SIFLOWCONTROL] = "siflowcontrol",
+    [GENSIO_PY_SSBREAK] = "ssbreak",
+    [GENSIO_PY_SDTR] = "sdtr",
+    [GENSIO_PY_SRTS] = "srts",
+};
+
+struct gensio_py_rbuf;
+
 struct gensio_data {
     bool tmpval; /* If true, just ignore this on destroy. */
     int refcount;
     swig_cb_val *handler_val;
     struct gensio_os_funcs *o;
+    /*
+     * Pass read data as a memoryview instead of a bytes object.  The
+     * memoryview is on read_rbuf, see struct gensio_py_rbuf.
+     */
+    bool read_memview;
+    struct gensio_py_rbuf *read_rbuf;
+
+    /*
+     * Bound methods of handler_val, NULL if not looked up yet and
+     * Py_None if the handler doesn't have the method.
+     */
+    PyObject *methods[GENSIO_PY_NR_METHODS];
+
+    /*
+     * A Python object for the gensio that is passed to callbacks and
+     * reused for every event.  It holds a refcount on this data like
+     * any other object for the gensio.  It is only kept here while
+     * nothing else references it, see gensio_data_put_io_ref().
+     */
+    PyObject *io_ref;
+
+    /*
+     * For aio_write(), an object whose write_ready() is called on the
+     * next write ready event.  The write callback is enabled for it,
+     * user_write_enabled tracks if the user has it enabled, too.
+     */
+    swig_cb_val *aio_writer;
+    bool user_write_enabled;
+
+    /*
+     * For aio_accept() on an accepter, new connections go to this
+     * object's new_connection() instead of the handler.
+     */
+    swig_cb_val *aio_accept_q;
 };
 
 static struct gensio_data *
@@ -281,6 +417,13 @@ alloc_gensio_data(struct gensio_os_funcs *o, swig_cb *handler)
 	return NULL;
     data->tmpval = false;
     data->refcount = 1;
+    data->read_memview = false;
+    data->read_rbuf = NULL;
+    memset(data->methods, 0, sizeof(data->methods));
+    data->io_ref = NULL;
+    data->aio_writer = NULL;
+    data->user_write_enabled = false;
+    data->aio_accept_q = NULL;
     if (nil_swig_cb(handler))
 	data->handler_val = NULL;
     else
@@ -291,10 +434,28 @@ alloc_gensio_data(struct gensio_os_funcs *o, swig_cb *handler)
     return data;
 }
 
+static void
+gensio_data_clear_methods(struct gensio_data *data)
+{
+    unsigned int i;
+
+    for (i = 0; i < GENSIO_PY_NR_METHODS; i++) {
+	if (data->methods[i]) {
+	    Py_DECREF(data->methods[i]);
+	    data->methods[i] = NULL;
+	}
+    }
+}
+
 static void
 free_gensio_data(struct gensio_data *data)
 {
+    gensio_data_clear_methods(data);
+    if (data->read_rbuf)
+	Py_DECREF((PyObject *) data->read_rbuf);
     deref_swig_cb_val(data->handler_val);
+    deref_swig_cb_val(data->aio_writer);
+    deref_swig_cb_val(data->aio_accept_q);
     check_os_funcs_free(data->o);
     free(data);
 }
@@ -313,6 +474,7 @@ static void
 deref_gensio_data(struct gensio_data *data, struct gensio *io)
 {
     struct os_funcs_data *odata = data->o->other_data;
+    PyObject *io_ref;
 
     os_funcs_lock(odata);
     data->refcount--;
@@ -320,11 +482,137 @@ deref_gensio_data(struct gensio_data *data, struct gensio *io)
 	os_funcs_unlock(odata);
 	gensio_free(io);
 	free_gensio_data(data);
+    } else if (data->refcount == 1 && data->io_ref) {
+	/*
+	 * Only the cached object is left, nothing else can use it so
+	 * let it go.  That frees the gensio.
+	 */
+	io_ref = data->io_ref;
+	data->io_ref = NULL;
+	os_funcs_unlock(odata);
+	Py_DECREF(io_ref);
     } else {
 	os_funcs_unlock(odata);
     }
 }
 
+/*
+ * Get an object for the gensio to pass to a callback.  The cached
+ * object is used if it is available, otherwise a new one is created.
+ * The caller gets two references, one for the args tuple and one to
+ * pass to gensio_data_put_io_ref() when the callback is done.
+ */
+static PyObject *
+gensio_data_get_io_ref(struct gensio_data *data, struct gensio *io)
+{
+    PyObject *io_ref = data->io_ref;
+
+    if (io_ref) {
+	data->io_ref = NULL;
+    } else {
+	io_ref = swig_make_ref(io, gensio).val;
+	ref_gensio_data(data);
+    }
+    Py_INCREF(io_ref);
+
+    return io_ref;
+}
+
+static void
+gensio_data_put_io_ref(struct gensio_data *data, PyObject *io_ref)
+{
+    struct os_funcs_data *odata = data->o->other_data;
+    bool last;
+
+    /*
+     * If the callback kept a reference to the object it can't be
+     * shared, it may be holding the gensio open.  Just let it go.
+     */
+    if (data->io_ref || Py_REFCNT(io_ref) > 1) {
+	Py_DECREF(io_ref);
+	return;
+    }
+
+    os_funcs_lock(odata);
+    last = data->refcount == 1;
+    if (!last)
+	data->io_ref = io_ref;
+    os_funcs_unlock(odata);
+
+    /* If all other references went away in the callback, free it. */
+    if (last)
+	Py_DECREF(io_ref);
+}
+
+/*
+ * Return the method m of the gensio's handler, or NULL if the handler
+ * doesn't have it.  This is a new reference.
+ */
+static PyObject *
+gensio_data_method(struct gensio_data *data, enum gensio_py_method m)
+{
+    PyObject *p = data->methods[m];
+    const char *name = gensio_py_method_names[m];
+
+    if (!p) {
+	if (PyObject_HasAttrString(data->handler_val, name)) {
+	    p = PyObject_GetAttrString(data->handler_val, name);
+	} else {
+	    p = Py_None;
+	    Py_INCREF(p);
+	}
+	data->methods[m] = p;
+    }
+    if (p == Py_None)
+	return NULL;
+    /* The handler may be changed in the call, which drops the cache. */
+    Py_INCREF(p);
+
+    return p;
+}
+
+static PyObject *
+gensio_data_call_rv(struct gensio_data *data, enum gensio_py_method m,
+		    PyObject *args, bool optional)
+{
+    PyObject *p, *o;
+
+    p = gensio_data_method(data, m);
+    o = swig_finish_call_meth_rv(data->handler_val, p,
+				 gensio_py_method_names[m], args, optional);
+    if (p)
+	Py_DECREF(p);
+
+    return o;
+}
+
+static gensiods
+gensio_data_call_rv_gensiods(struct gensio_data *data, enum gensio_py_method m,
+			     PyObject *args, bool optional)
+{
+    return swig_rv_to_gensiods(data->handler_val, gensio_py_method_names[m],
+			       gensio_data_call_rv(data, m, args, optional));
+}
+
+static int
+gensio_data_call_rv_int(struct gensio_data *data, enum gensio_py_method m,
+			PyObject *args, bool optional)
+{
+    return swig_rv_to_int(data->handler_val, gensio_py_method_names[m],
+			  gensio_data_call_rv(data, m, args, optional));
+}
+
+static void
+gensio_data_call(struct gensio_data *data, enum gensio_py_method m,
+		 PyObject *args, bool optional)
+{
+    PyObject *o;
+
+    o = gensio_data_call_rv(data, m, args, optional);
+    if (o)
+	Py_DECREF(o);
+}
+
 static void
 deref_gensio_accepter_data(struct gensio_data *data,
 			   struct gensio_accepter *acc)
@@ -450,10 +738,10 @@ gensio_close_done(struct gensio *io, void *cb_data) {
 }
 
 static void
-sgensio_call(struct gensio *io, long val, char *func)
+sgensio_call(struct gensio *io, long val, enum gensio_py_method m)
 {
     struct gensio_data *data = gensio_get_user_data(io);
-    swig_ref io_ref;
+    PyObject *io_ref;
     PyObject *args, *o;
     OI_PY_STATE gstate;
 
@@ -462,14 +750,14 @@ sgensio_call(struct gensio *io, long val, char *func)
     if (!data->handler_val)
 	goto out_put;
 
-    io_ref = swig_make_ref(io, gensio);
+    io_ref = gensio_data_get_io_ref(data, io);
     args = PyTuple_New(2);
-    ref_gensio_data(data);
-    PyTuple_SET_ITEM(args, 0, io_ref.val);
+    PyTuple_SET_ITEM(args, 0, io_ref);
     o = PyInt_FromLong(val);
     PyTuple_SET_ITEM(args, 1, o);
 
-    swig_finish_call(data->handler_val, func, args, true);
+    gensio_data_call(data, m, args, true);
+    gensio_data_put_io_ref(data, io_ref);
 
  out_put:
     OI_PY_STATE_PUT(gstate);
@@ -478,13 +766,13 @@ sgensio_call(struct gensio *io, long val, char *func)
 static void
 sgensio_modemstate(struct gensio *io, unsigned int modemstate)
 {
-    sgensio_call(io, modemstate, "modemstate");
+    sgensio_call(io, modemstate, GENSIO_PY_MODEMSTATE);
 }
 
 static void
 sgensio_linestate(struct gensio *io, unsigned int linestate)
 {
-    sgensio_call(io, linestate, "linestate");
+    sgensio_call(io, linestate, GENSIO_PY_LINESTATE);
 }
 
 static void
@@ -495,7 +783,7 @@ sgensio_signature(struct gensio *io)
      * to be the server side code that gets a signature.
      */
     struct gensio_data *data = gensio_get_user_data(io);
-    swig_ref io_ref;
+    PyObject *io_ref;
     PyObject *args;
     OI_PY_STATE gstate;
 
@@ -504,12 +792,12 @@ sgensio_signature(struct gensio *io)
     if (!data->handler_val)
 	goto out_put;
 
-    io_ref = swig_make_ref(io, gensio);
+    io_ref = gensio_data_get_io_ref(data, io);
     args = PyTuple_New(1);
-    ref_gensio_data(data);
-    PyTuple_SET_ITEM(args, 0, io_ref.val);
+    PyTuple_SET_ITEM(args, 0, io_ref);
 
-    swig_finish_call(data->handler_val, "signature", args, true);
+    gensio_data_call(data, GENSIO_PY_SIGNATURE, args, true);
+    gensio_data_put_io_ref(data, io_ref);
 
  out_put:
     OI_PY_STATE_PUT(gstate);
@@ -519,7 +807,7 @@ static void
 sgensio_sync(struct gensio *io)
 {
     struct gensio_data *data = gensio_get_user_data(io);
-    swig_ref io_ref;
+    PyObject *io_ref;
     PyObject *args;
     OI_PY_STATE gstate;
 
@@ -528,12 +816,12 @@ sgensio_sync(struct gensio *io)
     if (!data->handler_val)
 	goto out_put;
 
-    io_ref = swig_make_ref(io, gensio);
+    io_ref = gensio_data_get_io_ref(data, io);
     args = PyTuple_New(1);
-    ref_gensio_data(data);
-    PyTuple_SET_ITEM(args, 0, io_ref.val);
+    PyTuple_SET_ITEM(args, 0, io_ref);
 
-    swig_finish_call(data->handler_val, "sync", args, true);
+    gensio_data_call(data, GENSIO_PY_SYNC, args, true);
+    gensio_data_put_io_ref(data, io_ref);
 
  out_put:
     OI_PY_STATE_PUT(gstate);
@@ -543,7 +831,7 @@ static void
 sgensio_flowcontrol_state(struct gensio *io, bool val)
 {
     struct gensio_data *data = gensio_get_user_data(io);
-    swig_ref io_ref;
+    PyObject *io_ref;
     PyObject *args, *o;
     OI_PY_STATE gstate;
 
@@ -552,14 +840,14 @@ sgensio_flowcontrol_state(struct gensio *io, bool val)
     if (!data->handler_val)
 	goto out_put;
 
-    io_ref = swig_make_ref(io, gensio);
+    io_ref = gensio_data_get_io_ref(data, io);
     args = PyTuple_New(2);
-    ref_gensio_data(data);
-    PyTuple_SET_ITEM(args, 0, io_ref.val);
+    PyTuple_SET_ITEM(args, 0, io_ref);
     o = PyBool_FromLong(val);
     PyTuple_SET_ITEM(args, 1, o);
 
-    swig_finish_call(data->handler_val, "flowcontrol_state", args, true);
+    gensio_data_call(data, GENSIO_PY_FLOWCONTROL_STATE, args, true);
+    gensio_data_put_io_ref(data, io_ref);
 
  out_put:
     OI_PY_STATE_PUT(gstate);
@@ -568,61 +856,61 @@ sgensio_flowcontrol_state(struct gensio *io, bool val)
 static void
 sgensio_flush(struct gensio *io, int val)
 {
-    sgensio_call(io, val, "flush");
+    sgensio_call(io, val, GENSIO_PY_FLUSH);
 }
 
 static void
 sgensio_baud(struct gensio *io, int baud)
 {
-    sgensio_call(io, baud, "sbaud");
+    sgensio_call(io, baud, GENSIO_PY_SBAUD);
 }
 
 static void
 sgensio_datasize(struct gensio *io, int datasize)
 {
-    sgensio_call(io, datasize, "sdatasize");
+    sgensio_call(io, datasize, GENSIO_PY_SDATASIZE);
 }
 
 static void
 sgensio_parity(struct gensio *io, int parity)
 {
-    sgensio_call(io, parity, "sparity");
+    sgensio_call(io, parity, GENSIO_PY_SPARITY);
 }
 
 static void
 sgensio_stopbits(struct gensio *io, int stopbits)
 {
-    sgensio_call(io, stopbits, "sstopbits");
+    sgensio_call(io, stopbits, GENSIO_PY_SSTOPBITS);
 }
 
 static void
 sgensio_flowcontrol(struct gensio *io, int flowcontrol)
 {
-    sgensio_call(io, flowcontrol, "sflowcontrol");
+    sgensio_call(io, flowcontrol, GENSIO_PY_SFLOWCONTROL);
 }
 
 static void
 sgensio_iflowcontrol(struct gensio *io, int iflowcontrol)
 {
-    sgensio_call(io, iflowcontrol, "siflowcontrol");
+    sgensio_call(io, iflowcontrol, GENSIO_PY_SIFLOWCONTROL);
 }
 
 static void
 sgensio_sbreak(struct gensio *io, int breakv)
 {
-    sgensio_call(io, breakv, "ssbreak");
+    sgensio_call(io, breakv, GENSIO_PY_SSBREAK);
 }
 
 static void
 sgensio_dtr(struct gensio *io, int dtr)
 {
-    sgensio_call(io, dtr, "sdtr");
+    sgensio_call(io, dtr, GENSIO_PY_SDTR);
 }
 
 static void
 sgensio_rts(struct gensio *io, int rts)
 {
-    sgensio_call(io, rts, "srts");
+    sgensio_call(io, rts, GENSIO_PY_SRTS);
 }
 
 static PyObject *
@@ -644,23 +932,167 @@ gensio_py_handle_auxdata(const char *const *auxdata)
     }
 }
 
+#if PY_VERSION_HEX >= 0x03030000
+/*
+ * The buffer behind a memoryview read.  It exports its memory and
+ * counts the exports, so it is known when nothing uses the memory
+ * any more.
+ *
+ * The library's own buffer can't be exported, it is reused and freed
+ * by the library after the read callback.  A memoryview made from
+ * another memoryview (a slice, for instance) takes the memory
+ * pointer without asking the exporter, so once a view is given out
+ * there is no way to take the memory back from everything that may
+ * have it.  So the data is copied into this buffer.  If nothing
+ * refers to it after the callback it is reused for the next read,
+ * otherwise it is left to whatever has it and freed when that goes
+ * away.
+ */
+struct gensio_py_rbuf {
+    PyObject_HEAD
+    char *buf;
+    Py_ssize_t len;
+    Py_ssize_t size;
+    Py_ssize_t exports;
+};
+
+static int
+gensio_py_rbuf_getbuffer(PyObject *self, Py_buffer *view, int flags)
+{
+    struct gensio_py_rbuf *rb = (struct gensio_py_rbuf *) self;
+
+    if (PyBuffer_FillInfo(view, self, rb->buf, rb->len, 1, flags))
+	return -1;
+    rb->exports++;
+    return 0;
+}
+
+static void
+gensio_py_rbuf_releasebuffer(PyObject *self, Py_buffer *view)
+{
+    ((struct gensio_py_rbuf *) self)->exports--;
+}
+
+static void
+gensio_py_rbuf_dealloc(PyObject *self)
+{
+    free(((struct gensio_py_rbuf *) self)->buf);
+    PyObject_Del(self);
+}
+
+static PyBufferProcs gensio_py_rbuf_as_buffer = {
+    .bf_getbuffer = gensio_py_rbuf_getbuffer,
+    .bf_releasebuffer = gensio_py_rbuf_releasebuffer,
+};
+
+static PyTypeObject gensio_py_rbuf_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "gensio.read_buffer",
+    .tp_basicsize = sizeof(struct gensio_py_rbuf),
+    .tp_dealloc = gensio_py_rbuf_dealloc,
+    .tp_as_buffer = &gensio_py_rbuf_as_buffer,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+};
+#endif
+
+/*
+ * Return an object for read data.  Normally this is a copy of the
+ * data in a bytes object, but in memoryview mode it is a read-only
+ * memoryview on the gensio_data's read buffer.
+ * gensio_py_done_read_buf() must be called after the callback
+ * returns and the memoryview is dereferenced.
+ */
+static PyObject *
+gensio_py_read_buf(struct gensio_data *data, unsigned char *buf,
+		   gensiods buflen)
+{
+#if PY_VERSION_HEX >= 0x03030000
+    struct gensio_py_rbuf *rb = data->read_rbuf;
+    char *nbuf;
+
+    if (!data->read_memview)
+	goto out_bytes;
+
+    if (!rb) {
+	rb = PyObject_New(struct gensio_py_rbuf, &gensio_py_rbuf_type);
+	if (!rb)
+	    goto out_bytes;
+	rb->buf = NULL;
+	rb->len = 0;
+	rb->size = 0;
+	rb->exports = 0;
+	data->read_rbuf = rb;
+    }
+    if ((gensiods) rb->size < buflen) {
+	nbuf = realloc(rb->buf, buflen);
+	if (!nbuf)
+	    goto out_bytes;
+	rb->buf = nbuf;
+	rb->size = buflen;
+    }
+    memcpy(rb->buf, buf, buflen);
+    rb->len = buflen;
+    return PyMemoryView_FromObject((PyObject *) rb);
+
+ out_bytes:
+#endif
+    return PyBytes_FromStringAndSize((char *) buf, buflen);
+}
+
+static int
+gensio_set_read_memview(struct gensio_data *data, bool enable)
+{
+#if PY_VERSION_HEX < 0x03030000
+    if (enable)
+	return GE_NOTSUP;
+#else
+    if (enable && PyType_Ready(&gensio_py_rbuf_type) < 0) {
+	PyErr_Clear();
+	return GE_NOMEM;
+    }
+#endif
+    data->read_memview = enable;
+    return 0;
+}
+
+static void
+gensio_py_done_read_buf(struct gensio_data *data)
+{
+#if PY_VERSION_HEX >= 0x03030000
+    struct gensio_py_rbuf *rb = data->read_rbuf;
+
+    /*
+     * If the callback kept the memoryview, something made from it,
+     * or the buffer itself, leave the buffer with it.  The next read
+     * gets a new one.
+     */
+    if (rb && (rb->exports || Py_REFCNT(rb) > 1)) {
+	data->read_rbuf = NULL;
+	Py_DECREF(rb);
+    }
+#endif
+}
+
 static int
 gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 		   unsigned char *buf, gensiods *buflen,
 		   const char *const *auxdata)
 {
     struct gensio_data *data = user_data;
-    swig_ref io_ref = { .val = NULL }, new_con = { .val = NULL };
-    PyObject *args, *o;
+    swig_ref new_con = { .val = NULL };
+    PyObject *args, *o, *rbuf = NULL, *io_ref = NULL;
     OI_PY_STATE gstate;
     int rv = 0;
     gensiods rsize;
     struct gensio *io2;
     struct gensio_data *iodata;
+    swig_cb_val *aio_writer;
+    bool call_user;
 
     gstate = OI_PY_STATE_GET();
 
-    if (!data->handler_val) {
+    if (!data->handler_val &&
+		!(event == GENSIO_EVENT_WRITE_READY && data->aio_writer)) {
 	rv = GE_NOTSUP;
 	goto out_put;
     }
@@ -669,9 +1101,8 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
     case GENSIO_EVENT_READ:
 	args = PyTuple_New(4);
 
-	io_ref = swig_make_ref(io, gensio);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	io_ref = gensio_data_get_io_ref(data, io);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 
 	if (readerr) {
 	    o = OI_PI_FromString(gensio_err_to_str(readerr));
@@ -682,7 +1113,10 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 	PyTuple_SET_ITEM(args, 1, o);
 
 	if (buf) {
-	    o = PyBytes_FromStringAndSize((char *) buf, *buflen);
+	    o = gensio_py_read_buf(data, buf, *buflen);
+	    /* Keep a reference, args goes away in the call. */
+	    rbuf = o;
+	    Py_INCREF(rbuf);
 	} else {
 	    o = Py_None;
 	    Py_INCREF(Py_None);
@@ -691,19 +1125,38 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 
 	PyTuple_SET_ITEM(args, 3, gensio_py_handle_auxdata(auxdata));
 
-	rsize = swig_finish_call_rv_gensiods(data->handler_val,
-					     "read_callback", args, false);
+	rsize = gensio_data_call_rv_gensiods(data, GENSIO_PY_READ_CALLBACK,
+					     args, false);
+	if (rbuf) {
+	    Py_DECREF(rbuf);
+	    gensio_py_done_read_buf(data);
+	}
 	if (!PyErr_Occurred() && buflen)
 	    *buflen = rsize;
 	break;
 
     case GENSIO_EVENT_WRITE_READY:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
+	if (data->aio_writer) {
+	    aio_writer = data->aio_writer;
+	    data->aio_writer = NULL;
+	    call_user = data->user_write_enabled && data->handler_val;
+	    if (!data->user_write_enabled)
+		gensio_set_write_callback_enable(io, false);
+	    if (call_user)
+		/* The user's callback needs a reference, too. */
+		Py_INCREF(io_ref);
+	    args = PyTuple_New(1);
+	    PyTuple_SET_ITEM(args, 0, io_ref);
+	    swig_finish_call(aio_writer, "write_ready", args, false);
+	    deref_swig_cb_val(aio_writer);
+	    if (!call_user)
+		break;
+	}
 	args = PyTuple_New(1);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 
-	swig_finish_call(data->handler_val, "write_callback", args, false);
+	gensio_data_call(data, GENSIO_PY_WRITE_CALLBACK, args, false);
 	break;
 
     case GENSIO_EVENT_NEW_CHANNEL:
@@ -713,53 +1166,47 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 
 	args = PyTuple_New(3);
 
-	ref_gensio_data(data);
-
-	io_ref = swig_make_ref(io, gensio);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	io_ref = gensio_data_get_io_ref(data, io);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 
 	new_con = swig_make_ref(io2, gensio);
 	PyTuple_SET_ITEM(args, 1, new_con.val);
 
 	PyTuple_SET_ITEM(args, 2, gensio_py_handle_auxdata(auxdata));
 
-	swig_finish_call(data->handler_val, "new_channel", args, false);
+	gensio_data_call(data, GENSIO_PY_NEW_CHANNEL, args, false);
 	break;
 
     case GENSIO_EVENT_SEND_BREAK:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
 	args = PyTuple_New(1);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 
-	swig_finish_call(data->handler_val, "send_break", args, true);
+	gensio_data_call(data, GENSIO_PY_SEND_BREAK, args, true);
 	break;
 
     case GENSIO_EVENT_AUTH_BEGIN:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
 	args = PyTuple_New(1);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 
-	rv = swig_finish_call_rv_int(data->handler_val, "auth_begin",
+	rv = gensio_data_call_rv_int(data, GENSIO_PY_AUTH_BEGIN,
 				     args, true);
 	break;
 
     case GENSIO_EVENT_PRECERT_VERIFY:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
 	args = PyTuple_New(1);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 
-	rv = swig_finish_call_rv_int(data->handler_val, "precert_verify",
+	rv = gensio_data_call_rv_int(data, GENSIO_PY_PRECERT_VERIFY,
 				     args, true);
 	break;
 
     case GENSIO_EVENT_POSTCERT_VERIFY:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
 	args = PyTuple_New(3);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 	o = PyInt_FromLong(readerr);
 	PyTuple_SET_ITEM(args, 1, o);
 	if (auxdata && auxdata[0]) {
@@ -770,15 +1217,14 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 	}
 	PyTuple_SET_ITEM(args, 2, o);
 
-	rv = swig_finish_call_rv_int(data->handler_val, "postcert_verify",
+	rv = gensio_data_call_rv_int(data, GENSIO_PY_POSTCERT_VERIFY,
 				     args, true);
 	break;
 
     case GENSIO_EVENT_PASSWORD_VERIFY:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
 	args = PyTuple_New(2);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
+	PyTuple_SET_ITEM(args, 0, io_ref);
 	/*
 	 * FIXME - is there a way to make this a secure python string
 	 * that gets wiped on free?
@@ -786,16 +1232,15 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 	o = OI_PI_FromString((const char *) buf);
 	PyTuple_SET_ITEM(args, 1, o);
 
-	rv = swig_finish_call_rv_int(data->handler_val, "password_verify",
+	rv = gensio_data_call_rv_int(data, GENSIO_PY_PASSWORD_VERIFY,
 				     args, true);
 	break;
 
     case GENSIO_EVENT_REQUEST_PASSWORD:
-	io_ref = swig_make_ref(io, gensio);
+	io_ref = gensio_data_get_io_ref(data, io);
 	args = PyTuple_New(1);
-	ref_gensio_data(data);
-	PyTuple_SET_ITEM(args, 0, io_ref.val);
-	o = swig_finish_call_rv(data->handler_val, "request_password",
+	PyTuple_SET_ITEM(args, 0, io_ref);
+	o = gensio_data_call_rv(data, GENSIO_PY_REQUEST_PASSWORD,
 				args, true);
 	rv = GE_NOTSUP;
 	if (o) {
@@ -879,6 +1324,10 @@ gensio_child_event(struct gensio *io, void *user_data, int event, int readerr,
 	break;
     }
 
+    /* This may free the gensio, data must not be used after this. */
+    if (io_ref)
+	gensio_data_put_io_ref(data, io_ref);
+
  out_put:
     OI_PY_STATE_PUT(gstate);
 
@@ -1002,7 +1451,8 @@ gensio_acc_child_event(struct gensio_accepter *accepter, void *user_data,
 
     case GENSIO_ACC_EVENT_NEW_CONNECTION:
 	io = cdata;
-	iodata = alloc_gensio_data(data->o, NULL);
+	/* The connection may be on a shard of the accepter's os funcs. */
+	iodata = alloc_gensio_data(gensio_get_os_funcs(io), NULL);
 	gensio_set_callback(cdata /*io*/, gensio_child_event, iodata);
 
 	gstate = OI_PY_STATE_GET();
@@ -1014,7 +1464,10 @@ gensio_acc_child_event(struct gensio_accepter *accepter, void *user_data,
 	PyTuple_SET_ITEM(args, 0, acc_ref.val);
 	PyTuple_SET_ITEM(args, 1, io_ref.val);
 
-	swig_finish_call(data->handler_val, "new_connection", args, false);
+	if (data->aio_accept_q)
+	    swig_finish_call(data->aio_accept_q, "new_connection", args, false);
+	else
+	    swig_finish_call(data->handler_val, "new_connection", args, false);
 
 	OI_PY_STATE_PUT(gstate);
 	return 0;
@@ -1195,6 +1648,99 @@ add_python_result(PyObject *result, PyObject *val)
     return result;
 }
 
+/*
+ * Get the data for a write from o, which may be a string or anything
+ * supporting the buffer protocol.  The buffer must be contiguous.
+ * The view must be released with PyBuffer_Release().
+ */
+static int
+gensio_py_get_write_buf(PyObject *o, Py_buffer *view)
+{
+    char *buf;
+    my_ssize_t len;
+
+    if (OI_PI_BytesCheck(o)) {
+	if (OI_PI_AsBytesAndSize(o, &buf, &len) == -1 || !buf)
+	    return -1;
+	return PyBuffer_FillInfo(view, o, buf, len, 1, PyBUF_SIMPLE);
+    }
+    if (!PyObject_CheckBuffer(o)) {
+	PyErr_SetString(PyExc_TypeError,
+			"Must be a byte string or support the buffer protocol");
+	return -1;
+    }
+    return PyObject_GetBuffer(o, view, PyBUF_SIMPLE);
+}
+
+/*
+ * Convert a sequence of buffers into a gensio_sg array for
+ * gensio_write_sg().  The views are held until
+ * gensio_py_put_write_sg() is called.
+ */
+static int
+gensio_py_get_write_sg(PyObject *seq, struct gensio_sg **rsg,
+		       Py_buffer **rviews, gensiods *rlen)
+{
+    struct gensio_sg *sg = NULL;
+    Py_buffer *views = NULL;
+    PyObject *o;
+    my_ssize_t i, len;
+    int rv;
+
+    if (!PySequence_Check(seq)) {
+	PyErr_SetString(PyExc_TypeError, "Expecting a sequence of buffers");
+	return -1;
+    }
+    len = PySequence_Length(seq);
+    if (len < 0)
+	return -1;
+    if (len > 0) {
+	sg = malloc(sizeof(*sg) * len);
+	views = malloc(sizeof(*views) * len);
+	if (!sg || !views) {
+	    free(sg);
+	    free(views);
+	    PyErr_NoMemory();
+	    return -1;
+	}
+    }
+
+    for (i = 0; i < len; i++) {
+	o = PySequence_GetItem(seq, i);
+	if (!o)
+	    goto out_err;
+	rv = gensio_py_get_write_buf(o, &views[i]);
+	Py_DECREF(o);
+	if (rv == -1)
+	    goto out_err;
+	sg[i].buf = views[i].buf;
+	sg[i].buflen = views[i].len;
+    }
+
+    *rsg = sg;
+    *rviews = views;
+    *rlen = len;
+    return 0;
+
+ out_err:
+    while (i > 0)
+	PyBuffer_Release(&views[--i]);
+    free(sg);
+    free(views);
+    return -1;
+}
+
+static void
+gensio_py_put_write_sg(struct gensio_sg *sg, Py_buffer *views, gensiods len)
+{
+    gensiods i;
+
+    for (i = 0; i < len; i++)
+	PyBuffer_Release(&views[i]);
+    free(sg);
+    free(views);
+}
+
 static bool check_for_err(int err)
 {
     bool rv;
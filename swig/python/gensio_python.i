@@ -75,7 +75,7 @@
 
     if (*$1) {
 	r = SWIG_NewPointerObj((void *) *$1, SWIGTYPE_p_gensio,
-			       SWIG_POINTER_NEW);
+			       SWIG_POINTER_OWN);
     } else {
 	Py_INCREF(Py_None);
 	r = Py_None;
@@ -90,21 +90,51 @@
     PyTuple_SetItem($result, 0, r);
 }
 
-%typemap(in) (char *bytestr, my_ssize_t len) {
+%typemap(in) (char *bytestr, my_ssize_t len) (Py_buffer view,
+						  bool got_view = false) {
     if ($input == Py_None) {
 	$1 = NULL;
 	$2 = 0;
-    } else if (OI_PI_BytesCheck($input)) {
-	OI_PI_AsBytesAndSize($input, &$1, &$2);
-    } else if (PyByteArray_Check($input)) {
-	$1 = PyByteArray_AsString($input);
-	$2 = PyByteArray_Size($input);
     } else {
-        PyErr_SetString(PyExc_TypeError, "Must be a byte string or array");
-        SWIG_fail;
+	if (gensio_py_get_write_buf($input, &view) == -1)
+	    SWIG_fail;
+	got_view = true;
+	$1 = view.buf;
+	$2 = view.len;
     }
 }
 
+%typemap(freearg) (char *bytestr, my_ssize_t len) {
+    if (got_view$argnum)
+	PyBuffer_Release(&view$argnum);
+}
+
+%typemap(in) (char *wbuf, my_ssize_t wlen) (Py_buffer view,
+					      bool got_view = false) {
+    if (PyObject_GetBuffer($input, &view, PyBUF_WRITABLE) == -1)
+	SWIG_fail;
+    got_view = true;
+    $1 = view.buf;
+    $2 = view.len;
+}
+
+%typemap(freearg) (char *wbuf, my_ssize_t wlen) {
+    if (got_view$argnum)
+	PyBuffer_Release(&view$argnum);
+}
+
+%typemap(in) (const struct gensio_sg *sg, gensiods sglen)
+					(Py_buffer *views = NULL) {
+    if (gensio_py_get_write_sg($input, (struct gensio_sg **) &$1, &views,
+			       &$2) == -1)
+	SWIG_fail;
+}
+
+%typemap(freearg) (const struct gensio_sg *sg, gensiods sglen) {
+    if (views$argnum)
+	gensio_py_put_write_sg((struct gensio_sg *) $1, views$argnum, $2);
+}
+
 %typemap(in) const char *const *auxdata {
     unsigned int i;
     unsigned int len;
@@ -157,3 +187,175 @@
 	free($1);
     }
 }
+
+%pythoncode %{
+import io as _io
+
+class SyncStream(_io.RawIOBase):
+    """A raw file-like object for a gensio, using its sync I/O.  It
+    can be wrapped in io.BufferedReader, io.BufferedWriter, etc.
+
+    gio -- The gensio, set_sync() is done on it here.
+    timeout -- Milliseconds to wait for each read or write, -1 (the
+        default) waits forever.  If a read times out, readinto()
+        returns None, like a non-blocking file.
+    close_io -- Close the gensio when this is closed.
+    """
+    def __init__(self, gio, timeout = -1, close_io = True):
+        _io.RawIOBase.__init__(self)
+        gio.set_sync()
+        self.gio = gio
+        self.timeout = timeout
+        self.close_io = close_io
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, b):
+        (count, time) = self.gio._read_s_into_eof(b, self.timeout)
+        if count < 0:
+            return 0
+        if count == 0 and len(b) > 0:
+            # Timed out.
+            return None
+        return count
+
+    def write(self, b):
+        (count, time) = self.gio.write_s(b, self.timeout)
+        return count
+
+    def close(self):
+        if not self.closed and self.close_io:
+            self.gio.close_s()
+        _io.RawIOBase.close(self)
+
+def _stats_to_dict(s):
+    if isinstance(s, bytes):
+        s = s.decode()
+    d = {}
+    for i in s.split():
+        (name, val) = i.split("=", 1)
+        d[name] = int(val)
+    return d
+
+def gensio_stats(io, depth = 0):
+    return _stats_to_dict(io.control(depth, True, GENSIO_CONTROL_STATS, None))
+
+# The constants are defined after this code, so default depth is
+# resolved when called.
+def gensio_stats_reset(io, depth = None):
+    if depth is None:
+        depth = GENSIO_CONTROL_DEPTH_ALL
+    io.control(depth, False, GENSIO_CONTROL_STATS, None)
+
+def gensio_acc_stats(acc, depth = 0):
+    return _stats_to_dict(acc.control(depth, True, GENSIO_ACC_CONTROL_STATS,
+                                      ""))
+
+def gensio_acc_stats_reset(acc, depth = None):
+    if depth is None:
+        depth = GENSIO_CONTROL_DEPTH_ALL
+    acc.control(depth, False, GENSIO_ACC_CONTROL_STATS, "")
+
+# Awaitable versions of the callback-based calls, for gensios using
+# os funcs from alloc_gensio_asyncio().  Each returns an asyncio
+# future for the running event loop, so they must be called from a
+# coroutine.
+
+class _AioDone:
+    def __init__(self, fut):
+        self.fut = fut
+
+    def open_done(self, io, err):
+        if self.fut.done():
+            return
+        if err:
+            self.fut.set_exception(Exception("gensio:open: " + err))
+        else:
+            self.fut.set_result(None)
+
+    def close_done(self, io):
+        if not self.fut.done():
+            self.fut.set_result(None)
+
+class _AioWriter:
+    def __init__(self, fut, data, auxdata):
+        self.fut = fut
+        if isinstance(data, str):
+            # write() sends and counts the UTF-8 encoding.
+            data = data.encode()
+        # Count bytes, not items, and slice without copying.
+        self.data = memoryview(data).cast("B")
+        self.auxdata = auxdata
+        self.count = 0
+
+    def try_write(self, io):
+        try:
+            while self.count < len(self.data):
+                l = io.write(self.data[self.count:], self.auxdata)
+                if l == 0:
+                    break
+                self.count += l
+            if self.count < len(self.data):
+                io._aio_write_wait(self)
+                return
+        except Exception as e:
+            self.fut.set_exception(e)
+            return
+        self.fut.set_result(self.count)
+
+    def write_ready(self, io):
+        if not self.fut.done():
+            self.try_write(io)
+
+class _AioAcceptQueue:
+    def __init__(self):
+        import collections
+        self.ios = collections.deque()
+        self.waiters = collections.deque()
+
+    def new_connection(self, acc, io):
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(io)
+                return
+        self.ios.append(io)
+
+    def accept(self, fut):
+        if self.ios:
+            fut.set_result(self.ios.popleft())
+        else:
+            self.waiters.append(fut)
+
+def _aio_future():
+    import asyncio
+    return asyncio.get_running_loop().create_future()
+
+def aio_open(io):
+    fut = _aio_future()
+    io.open(_AioDone(fut))
+    return fut
+
+def aio_close(io):
+    fut = _aio_future()
+    io.close(_AioDone(fut))
+    return fut
+
+def aio_write(io, data, auxdata = None):
+    fut = _aio_future()
+    _AioWriter(fut, data, auxdata).try_write(io)
+    return fut
+
+def aio_accept(acc):
+    q = acc._aio_get_accept_queue()
+    if q is None:
+        q = _AioAcceptQueue()
+        acc._aio_set_accept_queue(q)
+    fut = _aio_future()
+    q.accept(fut)
+    return fut
+%}
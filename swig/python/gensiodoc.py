@@ -8,6 +8,8 @@
 # This file documents the python interface to gensio via the normal
 # python documentation method.  It is not functional.
 
+import io
+
 class LogHandler:
     """A template class used by gensio_os_funcs to generate logs."""
     def gensio_log(self, level, log):
@@ -24,16 +26,90 @@ class gensio_os_funcs:
     "struct gensio_os_funcs" in the C interface.  If you need a custom
     one, you might have to provide a Python/C interface to allocate it.
     """
+    def add_shard(self, shard):
+        """Spread new connections from accepters using this os funcs
+        over the shards added here, round-robin.  Each shard should be
+        allocated with alloc_gensio_selector() and have its own thread
+        waiting on it, then all the callbacks for a connection will
+        come from that thread.  Add this os funcs to itself if it
+        should get connections, too.
+
+        shard -- A gensio_os_funcs to add.
+        """
 
-def alloc_gensio_selector(h):
+def alloc_gensio_selector(h, edge_triggered = False, timer_wheel = False):
     """Allocate a default gensio_os_funcs for your platform.
 
     h -- A LogHandler class for receiving logs.
+    edge_triggered -- If True, use edge-triggered epoll for the fds
+           that support it, which saves a system call per event.  If
+           epoll is not available this is ignored.
+    timer_wheel -- If True, keep timers in a timer wheel instead of a
+           heap.  Starting and stopping timers is faster if there are
+           a lot of them, but timers may go off up to a millisecond
+           late.
+
+    Threads waiting on the os funcs are woken through an eventfd (or a
+    pipe), so no signal handler is installed in the process.
+
+    Returns a gensio_os_funcs object.
+    """
+    return gensio_os_funcs()
+
+def alloc_gensio_asyncio(loop, h):
+    """Allocate a gensio_os_funcs that runs on an asyncio event loop.
+    File descriptors are watched with the loop's add_reader() and
+    add_writer(), timers use call_later(), and deferred operations
+    use call_soon(), so all callbacks come from the loop.  Everything
+    using this os funcs must be done from the loop's thread.
+
+    loop -- The asyncio event loop to use.  If None, the one from
+           asyncio.get_running_loop() is used, so this must be called
+           from a coroutine.
+    h -- A LogHandler class for receiving logs.
+
+    Blocking calls (open_s(), close_s(), waiter objects, etc.) run
+    the loop until they complete, so they can only be used when the
+    loop is not running, they raise RuntimeError otherwise.  In a
+    coroutine use the aio_xxx() functions below.  If a callback
+    raises an exception while a blocking call is running the loop,
+    the exception is raised from the blocking call.  Exceptions on
+    fds are not reported, asyncio has no way to watch for them.
 
     Returns a gensio_os_funcs object.
     """
     return gensio_os_funcs()
 
+def aio_open(io):
+    """Open the gensio.  Returns a future that completes when the open
+    is done, an open error is set as an exception on the future.
+    """
+    return
+
+def aio_close(io):
+    """Close the gensio.  Returns a future that completes when the
+    close is done.
+    """
+    return
+
+def aio_write(io, bytestr, auxdata = None):
+    """Write all of bytestr to the gensio.  Returns a future whose
+    result is the number of bytes written, once they have all been
+    written.  The data is written as the gensio is ready for it,
+    independent of write_cb_enable() and the handler's
+    write_callback().  Only one aio_write() may be waiting on a gensio
+    at a time.  A str is written UTF-8 encoded and counted in bytes.
+    """
+    return
+
+def aio_accept(acc):
+    """Returns a future whose result is the next new connection on the
+    gensio_accepter.  Once this is called, new connections are queued
+    for aio_accept() and are no longer passed to the accepter's
+    handler.  The new gensio has no handler, use set_cbs() on it.
+    """
+    return
+
 class EventHandler:
     """A template class for handling events from a gensio.  All the
     possible callback events are here, they are the same as the C
@@ -50,7 +126,9 @@ class EventHandler:
                it is a string.  Some are not really errors, for instance
                "Remote end closed connection" just means the other end
                did a close.
-        data -- A byte string holding the read data.
+        data -- A byte string holding the read data.  If memoryview
+               reads are enabled with set_read_memoryview(), this is a
+               read-only memoryview instead, see that method.
         auxdata -- Auxilliary data describing the read.  This is a sequence
                of strings. Some interfaces will have an "oob" string for
                out-of-bounds data (TCP and SCTP).  SCTP can have a
@@ -386,10 +464,38 @@ class gensio:
         """Change the callback handler for the gensio.  This should
         only be done when all I/O is disabled.
 
+        The methods of the handler are looked up the first time they
+        are needed and remembered until set_cbs() is called again, so
+        replacing a method on the handler object afterwards has no
+        effect.  The gensio object passed to the callbacks is reused
+        between callbacks if the callback does not keep a reference to
+        it.
+
         handler -- An EventHandler object to receive events.
         """
         return
 
+    def set_read_memoryview(self, enable):
+        """Pass read data to read_callback() as a read-only memoryview
+        instead of a new byte string.  The data is still copied for
+        every read, the only thing saved is allocating a new byte
+        string each time, the buffer is reused.  Expect little or no
+        gain in throughput over byte strings, measure it with
+        tests/bench/pyreadbench.py before using this.
+
+        If the callback keeps the memoryview, something made from it
+        (like a slice), or something that refers to its memory, the
+        buffer is left with it and the data in it does not change.  A
+        new buffer is used for the next read.  So keeping the data is
+        safe, but it costs an allocation on the next read.  The return
+        value of read_callback() still gives the number of bytes
+        consumed.
+
+        enable -- A boolean, whether to use memoryviews or byte strings.
+               Byte strings are the default.
+        """
+        return
+
     def remote_id(self):
         """Return the remote_id value for this gensio.  See the specific
         gensio for the meaning.
@@ -474,7 +580,10 @@ class gensio:
     def write(self, bytestr, auxdata):
         """Write the given byte string.
 
-        bytestr -- The data to write.
+        bytestr -- The data to write.  This may be a string, bytes,
+            or any object supporting the buffer protocol with contiguous
+            data (bytearray, memoryview, array, mmap, etc.).  The same
+            goes for data passed to write_s() and write_sg().
         auxdata -- A sequence of strings holding gensio-specific auxilliary
             data.  May be None if it's not applicable.
 
@@ -484,6 +593,20 @@ class gensio:
         """
         return 0
 
+    def write_sg(self, bufs, auxdata):
+        """Write the given buffers as if they were one piece of data,
+        without joining them together first.  The gensio will do a
+        single writev() or the like, if it can.
+
+        bufs -- A sequence of buffers, see write() for what they may be.
+        auxdata -- The same as for write().
+
+        Returns the actual number of bytes written, counting through
+        the buffers in order.  Like write(), this may be less than the
+        total.
+        """
+        return 0
+
     def read_cb_enable(self, enable):
         """Allow read events from the gensio.  When the gensio is opened read
         is disabled, you must call this to get read events to
@@ -523,6 +646,20 @@ class gensio:
         """
         return
 
+    def set_sync_readahead(self, size):
+        """Set the size of a read-ahead buffer for synchronous reads.
+        With this, data is read into the buffer while nobody is
+        waiting in read_s() or read_s_into(), and those return data
+        from the buffer immediately if there is any.  This helps
+        latency for request/response protocols.  Message boundaries
+        would not be kept, so this is not supported on packet gensios.
+        Must be called after set_sync(), a size of 0 disables
+        read-ahead.
+
+        size -- The size of the buffer in bytes.
+        """
+        return
+
     def read_s(self, reqlen, timeout):
         """Read data from the gensio synchronously.  This will read up to
         reqlen bytes and may have a timeout.  Note that this will
@@ -553,6 +690,23 @@ class gensio:
         """
         return { 0, 0 }
 
+    def read_s_into(self, buffer, timeout):
+        """Read data from the gensio synchronously into a writable buffer
+        object, like a bytearray or a memoryview on one.  This works
+        like read_s(), but the data goes straight into the buffer
+        instead of into a newly allocated byte string.
+
+        buffer -- The buffer to fill.  Up to len(buffer) bytes are read.
+        timeout -- The number of milliseconds to wait for the data.  If -1,
+            the timeout is disabled.
+
+        Returns a sequence with the number of bytes read as the first
+        item and the number of milliseconds left on the timeout as
+        the second item.  If the returned timeout is 0, the operation
+        timed out.
+        """
+        return { 0, 0 }
+
     def control(self, depth, get, option, data):
         """Do a gensio-specific control operation.  See the specific gensios
         and the C interface for specific gensio controls.
@@ -996,6 +1150,26 @@ class gensio_accepter:
         """
         return True
 
+class SyncStream(io.RawIOBase):
+    """A raw I/O stream on top of a gensio, so it can be used with the
+    standard io module (io.BufferedReader, io.BufferedWriter,
+    shutil.copyfileobj(), etc.).  This calls set_sync() on the gensio,
+    the gensio must already be open.
+
+    readinto() returns 0 when the remote end closes the connection and
+    None if the timeout expires with no data.
+    """
+
+    def __init__(self, gio, timeout = -1, close_io = True):
+        """Create a stream.
+
+        gio -- The gensio to do I/O on.
+        timeout -- The timeout for each read and write in milliseconds,
+            -1 to disable the timeout.
+        close_io -- If true, close() will call close_s() on the gensio.
+        """
+        return
+
 class waiter:
     """An object that can be used to wait for wakeups in gensios.  You
     should use this interface to wait for operations to finish, it
@@ -1044,3 +1218,33 @@ def gensio_get_log_mask():
     """Return the current log mask.  See gensio_set_log_mask() above
     for details."""
     return 0
+
+def gensio_stats(io, depth = 0):
+    """Return the statistics counters for a gensio in the stack as a
+    dictionary of integers, see GENSIO_CONTROL_STATS in
+    gensio_control(3) for the names.  Every gensio keeps these.
+
+    io -- The gensio to get the statistics from.
+    depth -- Which gensio in the stack to get, 0 is the top one.
+    """
+    return {}
+
+def gensio_stats_reset(io, depth = None):
+    """Set the statistics counters for a gensio to zero.  If depth
+    is None, all the gensios in the stack are reset.
+    """
+    return
+
+def gensio_acc_stats(acc, depth = 0):
+    """Return the statistics counters for an accepter as a dictionary
+    of integers, the number of connections accepted ("accepts") and
+    the microseconds since the accepter was started up
+    ("uptime_usec").
+    """
+    return {}
+
+def gensio_acc_stats_reset(acc, depth = None):
+    """Zero the accept count and restart the uptime for an accepter,
+    all the accepters in the stack if depth is None.
+    """
+    return
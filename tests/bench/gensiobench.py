@@ -0,0 +1,697 @@
+#
+#  gensio - A library for abstracting stream I/O
+#  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+#
+#  SPDX-License-Identifier: LGPL-2.1-only
+#
+# Benchmark the built-in gensio types from Python.
+#
+# For each gensio type, this measures bulk throughput (MB/s) and
+# small message round trips (messages/s and the p50/p99 round trip
+# latency), all over loopback.  Each measurement is done twice, once
+# with the normal callback interface and once with the synchronous
+# read_s()/write_s() interface.  Unreliable gensios (udp) only do the
+# round trip test, and lost messages are counted instead of failing.
+# A throughput test stops writing after -T seconds (10 by default) so a
+# slow gensio doesn't hold up the run, the bytes actually transferred
+# are reported.
+#
+# Results are printed as a table, and as JSON if -o is given, so they
+# can be kept and compared across releases.  Gensio types that can't
+# be set up here (no sctp in the kernel, no keys for ssl, etc.) are
+# reported as skipped with the error.
+#
+# Run it with "make bench" in the tests directory, which sets up the
+# paths and the keys, or run it by hand with PYTHONPATH pointing to
+# the gensio python module.
+#
+# Usage: gensiobench.py [-s <size in MB>] [-n <messages>] [-m <msgsize>]
+#            [-c <chunksize>] [-T <seconds>] [-t <type>[,<type>...]]
+#            [-a callback|sync] [-k <keydir>] [-o <json file>] [-l]
+#
+
+import os
+import sys
+import time
+import json
+import getopt
+import tempfile
+import platform
+import threading
+import gensio
+
+keydir = os.getenv("keydir")
+if not keydir:
+    keydir = "ca"
+
+class Logger:
+    def gensio_log(self, level, log):
+        print("***%s log: %s" % (level, log))
+
+class BenchException(Exception):
+    pass
+
+#
+# The gensio types to run.  "acc" is the accepter string and "con" the
+# string to connect to it, "%s" in both is replaced with the address
+# (the port or unix socket path).  Types without "acc" are a single
+# gensio that sends back what is written to it.  "maxchunk" limits the
+# write size for packet gensios that can't take a full chunk.
+#
+bench_types = [
+    { "name": "echo", "con": "echo" },
+    { "name": "stdio", "con": "stdio,cat" },
+    { "name": "tcp", "acc": "tcp,localhost,0", "con": "tcp,localhost,%s" },
+    { "name": "unix", "acc": "unix,%s", "con": "unix,%s",
+      "unix": True },
+    { "name": "udp", "acc": "udp,localhost,0", "con": "udp,localhost,%s" },
+    { "name": "sctp", "acc": "sctp,localhost,0",
+      "con": "sctp,localhost,%s" },
+    { "name": "ssl,tcp",
+      "acc": "ssl(key=%(k)s/key.pem,cert=%(k)s/cert.pem),tcp,localhost,0",
+      "con": "ssl(CA=%(k)s/CA.pem),tcp,localhost,%%s",
+      "keys": True },
+    { "name": "certauth,ssl,tcp",
+      "acc": ("certauth(CA=%(k)s/clientcert.pem),"
+              "ssl(key=%(k)s/key.pem,cert=%(k)s/cert.pem),tcp,localhost,0"),
+      "con": ("certauth(cert=%(k)s/clientcert.pem,key=%(k)s/clientkey.pem,"
+              "username=testuser),ssl(CA=%(k)s/CA.pem),tcp,localhost,%%s"),
+      "keys": True },
+    { "name": "telnet,tcp", "acc": "telnet,tcp,localhost,0",
+      "con": "telnet,tcp,localhost,%s" },
+    { "name": "mux,tcp", "acc": "mux,tcp,localhost,0",
+      "con": "mux,tcp,localhost,%s" },
+    { "name": "msgdelim,tcp", "acc": "msgdelim,tcp,localhost,0",
+      "con": "msgdelim,tcp,localhost,%s", "maxchunk": 128 },
+    { "name": "relpkt,udp", "acc": "relpkt,udp,localhost,0",
+      "con": "relpkt,udp,localhost,%s", "maxchunk": 123 },
+]
+
+def percentile(vals, p):
+    if not vals:
+        return None
+    vals = sorted(vals)
+    i = int(round((len(vals) - 1) * p / 100.0))
+    return vals[i]
+
+class Acceptor:
+    """Accepter handler for the callback tests, new connections get
+    the server handler and are saved."""
+
+    def __init__(self, o, server):
+        self.waiter = gensio.waiter(o)
+        self.server = server
+        self.io = None
+
+    def new_connection(self, acc, io):
+        self.io = io
+        io.set_cbs(self.server)
+        io.read_cb_enable(True)
+        self.waiter.wake()
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+class SyncAcceptor:
+    """Accepter handler for the sync tests.  Connections come from
+    accept_s, but the accepter still needs a handler for logs and for
+    the optional authentication calls some gensios (certauth) make."""
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+class Writer:
+    """Write buffered data to a gensio from the write callback.
+    write_done() may start the next write, that is picked up by the
+    loop in do_write() instead of recursing."""
+
+    def init_writer(self):
+        self.wbuf = None
+        self.wpos = 0
+        self.in_write = False
+
+    def start_write(self, io, data):
+        self.wbuf = data
+        self.wpos = 0
+        if not self.in_write:
+            self.do_write(io)
+
+    def do_write(self, io):
+        self.in_write = True
+        try:
+            while self.wbuf is not None:
+                count = io.write(memoryview(self.wbuf)[self.wpos:], None)
+                self.wpos += count
+                if self.wpos < len(self.wbuf):
+                    io.write_cb_enable(True)
+                    return
+                self.wbuf = None
+                self.write_done(io)
+            io.write_cb_enable(False)
+        finally:
+            self.in_write = False
+
+    def write_callback(self, io):
+        self.do_write(io)
+
+    def write_done(self, io):
+        pass
+
+class EchoServer(Writer):
+    """Send everything read back, stop reading while a write is
+    pending."""
+
+    def __init__(self):
+        self.init_writer()
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            return 0
+        io.read_cb_enable(False)
+        self.start_write(io, bytes(data))
+        return len(data)
+
+    def write_done(self, io):
+        io.read_cb_enable(True)
+
+class SinkServer:
+    """Count what is read, wake when all the data is in."""
+
+    def __init__(self, o):
+        self.waiter = gensio.waiter(o)
+        self.total = 0
+        self.count = 0
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            raise BenchException("Reader: " + err)
+        self.count += len(data)
+        if self.total and self.count >= self.total:
+            self.total = 0
+            self.waiter.wake()
+        return len(data)
+
+    def set_total(self, total):
+        self.total = total
+        if self.count >= total:
+            self.total = 0
+            self.waiter.wake()
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+class BulkWriter(Writer):
+    """Write total bytes in chunks, or until the deadline passes.  If
+    reader is set, this is an echo type gensio so the data comes back
+    here."""
+
+    def __init__(self, o, total, chunk, deadline, reader = None):
+        self.init_writer()
+        self.waiter = gensio.waiter(o)
+        self.total = total
+        self.chunk = chunk
+        self.deadline = deadline
+        self.written = 0
+        self.reader = reader
+
+    def start(self, io):
+        self.next_chunk(io)
+
+    def next_chunk(self, io):
+        if (self.written >= self.total or
+                time.perf_counter() >= self.deadline):
+            self.waiter.wake()
+            return
+        l = min(len(self.chunk), self.total - self.written)
+        self.written += l
+        self.start_write(io, self.chunk[:l])
+
+    def write_done(self, io):
+        self.next_chunk(io)
+
+    def read_callback(self, io, err, data, auxdata):
+        if self.reader:
+            return self.reader.read_callback(io, err, data, auxdata)
+        return len(data)
+
+class PingClient(Writer):
+    """Send one message and wake when it has all come back."""
+
+    def __init__(self, o, msgsize):
+        self.init_writer()
+        self.waiter = gensio.waiter(o)
+        self.msgsize = msgsize
+        self.count = 0
+
+    def ping(self, io, msg):
+        self.count = 0
+        io.read_cb_enable(True)
+        self.start_write(io, msg)
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            raise BenchException("Ping client: " + err)
+        self.count += len(data)
+        if self.count >= self.msgsize:
+            self.waiter.wake()
+        return len(data)
+
+def ping_timeout(reliable):
+    """Milliseconds to wait for a ping to come back.  A reliable
+    gensio may take a while to recover a lost packet, that's part of
+    its latency, but an unreliable one has just lost it."""
+    if reliable:
+        return 10000
+    return 1000
+
+def wait_or_fail(waiter, ms, what):
+    if waiter.wait_timeout(1, ms) == 0:
+        raise BenchException("Timed out waiting for " + what)
+
+class Bench:
+    def __init__(self, o, btype, opts):
+        self.o = o
+        self.btype = btype
+        self.opts = opts
+        self.tmpdir = None
+        self.acc = None
+        self.io1 = None
+        self.io2 = None
+
+    def deadline(self):
+        return time.perf_counter() + self.opts["maxtime"]
+
+    def acc_str(self):
+        s = self.btype["acc"]
+        if "keys" in self.btype:
+            s = s % { "k": keydir }
+        if "unix" in self.btype:
+            self.tmpdir = tempfile.mkdtemp()
+            self.addr = os.path.join(self.tmpdir, "sock")
+            s = s % self.addr
+        return s
+
+    def con_str(self):
+        s = self.btype["con"]
+        if "keys" in self.btype:
+            s = s % { "k": keydir }
+        if "acc" not in self.btype:
+            return s
+        return s % self.addr
+
+    def chunksize(self):
+        return min(self.opts["chunksize"],
+                   self.btype.get("maxchunk", self.opts["chunksize"]))
+
+    def start_acc(self, handler, sync):
+        acc = gensio.gensio_accepter(self.o, self.acc_str(), handler)
+        if sync:
+            acc.set_sync()
+        acc.startup()
+        self.acc = acc
+        if "unix" not in self.btype:
+            self.addr = acc.control(gensio.GENSIO_CONTROL_DEPTH_FIRST, True,
+                                    gensio.GENSIO_ACC_CONTROL_LPORT, "0")
+
+    def cleanup(self):
+        for io in (self.io1, self.io2):
+            if io is not None:
+                try:
+                    io.close_s()
+                except Exception:
+                    pass
+        self.io1 = None
+        self.io2 = None
+        if self.acc is not None:
+            try:
+                self.acc.shutdown_s()
+            except Exception:
+                pass
+            self.acc = None
+        if self.tmpdir:
+            try:
+                os.unlink(self.addr)
+            except OSError:
+                pass
+            os.rmdir(self.tmpdir)
+            self.tmpdir = None
+
+    #
+    # Callback interface.
+    #
+    def cb_setup(self, server):
+        if "acc" not in self.btype:
+            self.io1 = gensio.gensio(self.o, self.con_str(), None)
+            self.io1.open_s()
+            return
+        acch = Acceptor(self.o, server)
+        self.start_acc(acch, False)
+        self.io1 = gensio.gensio(self.o, self.con_str(), None)
+        self.io1.open_s()
+        self.acch = acch
+        if self.io1.is_reliable():
+            wait_or_fail(acch.waiter, 5000, "connection")
+            self.io2 = acch.io
+
+    def cb_throughput(self):
+        total = self.opts["size"]
+        chunk = b"x" * self.chunksize()
+        sink = SinkServer(self.o)
+        try:
+            self.cb_setup(sink)
+            if self.io2 is None:
+                w = BulkWriter(self.o, total, chunk, self.deadline(), sink)
+            else:
+                w = BulkWriter(self.o, total, chunk, self.deadline())
+            self.io1.set_cbs(w)
+            start = time.perf_counter()
+            if self.io2 is None:
+                self.io1.read_cb_enable(True)
+            w.start(self.io1)
+            wait_or_fail(w.waiter, 60000, "bulk write")
+            sink.set_total(w.written)
+            wait_or_fail(sink.waiter, 60000, "bulk read")
+            elapsed = time.perf_counter() - start
+        finally:
+            self.cleanup()
+        return (w.written, elapsed)
+
+    def cb_pingpong(self):
+        n = self.opts["msgs"]
+        msg = b"p" * self.opts["msgsize"]
+        rtts = []
+        lost = 0
+        try:
+            self.cb_setup(EchoServer())
+            reliable = self.io1.is_reliable()
+            c = PingClient(self.o, len(msg))
+            self.io1.set_cbs(c)
+            start = time.perf_counter()
+            for i in range(0, n):
+                t = time.perf_counter()
+                c.ping(self.io1, msg)
+                if c.waiter.wait_timeout(1, ping_timeout(reliable)) == 0:
+                    if reliable:
+                        raise BenchException("Timed out waiting for ping")
+                    lost += 1
+                    continue
+                rtts.append(time.perf_counter() - t)
+            elapsed = time.perf_counter() - start
+        finally:
+            self.cleanup()
+        return (n / elapsed, rtts, lost)
+
+    #
+    # Sync interface, the other end runs in its own thread.
+    #
+    def sync_setup(self, server, args):
+        self.errs = []
+        self.thread = None
+        if "acc" in self.btype:
+            self.start_acc(SyncAcceptor(), True)
+            self.thread = threading.Thread(target = self.sync_server,
+                                           args = (server, args))
+            self.thread.start()
+        self.io1 = gensio.gensio(self.o, self.con_str(), None)
+        self.io1.open_s()
+        self.io1.set_sync()
+
+    def sync_server(self, server, args):
+        try:
+            (io, t) = self.acc.accept_s_timeout(self.o, None, 10000)
+            if io is None:
+                raise BenchException("Timed out waiting for connection")
+            self.io2 = io
+            io.set_sync()
+            server(io, *args)
+        except Exception as e:
+            self.errs.append(e)
+
+    def sync_finish(self):
+        if self.thread:
+            self.thread.join()
+        if self.errs:
+            raise self.errs[0]
+
+    def sync_sink(self, io, total):
+        """Read until total bytes are in, or until the writer is done
+        and everything it wrote has come in."""
+        buf = bytearray(self.opts["chunksize"])
+        count = 0
+        idle = 0
+        while count < total:
+            (l, t) = io.read_s_into(buf, 1000)
+            if l == 0:
+                idle += 1
+                if idle >= 10:
+                    raise BenchException("Timed out in sync read")
+            else:
+                idle = 0
+            count += l
+            if self.written is not None and count >= self.written:
+                break
+        self.received = count
+
+    def sync_writer(self, io, total, deadline):
+        chunk = b"x" * self.chunksize()
+        written = 0
+        try:
+            while written < total and time.perf_counter() < deadline:
+                l = min(len(chunk), total - written)
+                (count, t) = io.write_s(chunk[:l], 10000)
+                written += count
+                if count < l:
+                    raise BenchException("Timed out in sync write")
+        except Exception as e:
+            self.errs.append(e)
+        self.written = written
+
+    def sync_throughput(self):
+        total = self.opts["size"]
+        self.written = None
+        self.received = 0
+        try:
+            self.sync_setup(self.sync_sink, (total,))
+            start = time.perf_counter()
+            if self.thread:
+                self.sync_writer(self.io1, total, self.deadline())
+                self.sync_finish()
+            else:
+                # Echo type, write in a thread and read here.
+                w = threading.Thread(target = self.sync_writer,
+                                     args = (self.io1, total,
+                                             self.deadline()))
+                w.start()
+                try:
+                    self.sync_sink(self.io1, total)
+                finally:
+                    w.join()
+                if self.errs:
+                    raise self.errs[0]
+            elapsed = time.perf_counter() - start
+        finally:
+            self.cleanup()
+        return (self.received, elapsed)
+
+    def sync_read_msg(self, io, buf, timeout):
+        view = memoryview(buf)
+        count = 0
+        while count < len(buf):
+            (l, t) = io.read_s_into(view[count:], timeout)
+            if l == 0:
+                return False
+            count += l
+        return True
+
+    def sync_echo(self, io, n, msgsize):
+        buf = bytearray(msgsize)
+        for i in range(0, n):
+            if not self.sync_read_msg(io, buf,
+                                      ping_timeout(io.is_reliable()) * 2):
+                # Messages were lost on an unreliable gensio.
+                break
+            io.write_s(buf, 2000)
+
+    def sync_pingpong(self):
+        n = self.opts["msgs"]
+        msg = b"p" * self.opts["msgsize"]
+        buf = bytearray(len(msg))
+        rtts = []
+        lost = 0
+        try:
+            self.sync_setup(self.sync_echo, (n, len(msg)))
+            reliable = self.io1.is_reliable()
+            start = time.perf_counter()
+            for i in range(0, n):
+                t = time.perf_counter()
+                self.io1.write_s(msg, 1000)
+                if not self.sync_read_msg(self.io1, buf,
+                                          ping_timeout(reliable)):
+                    if reliable:
+                        raise BenchException("Timed out waiting for ping")
+                    lost += 1
+                    continue
+                rtts.append(time.perf_counter() - t)
+            elapsed = time.perf_counter() - start
+            self.sync_finish()
+        finally:
+            self.cleanup()
+        return (n / elapsed, rtts, lost)
+
+def run_type(o, btype, opts):
+    result = { "type": btype["name"] }
+    if "keys" in btype and not os.path.exists(os.path.join(keydir,
+                                                           "CA.pem")):
+        result["skipped"] = "No keys in %s" % keydir
+        return [ result ]
+    results = []
+    for api in opts["apis"]:
+        r = dict(result)
+        r["api"] = api
+        b = Bench(o, btype, opts)
+        try:
+            if api == "callback":
+                (msgs, rtts, lost) = b.cb_pingpong()
+            else:
+                (msgs, rtts, lost) = b.sync_pingpong()
+            r["msgs_per_sec"] = round(msgs, 1)
+            r["msg_size"] = opts["msgsize"]
+            r["latency_usec"] = {
+                "p50": round(percentile(rtts, 50) * 1000000.0, 1),
+                "p99": round(percentile(rtts, 99) * 1000000.0, 1),
+            }
+            r["lost"] = lost
+            if btype["name"] != "udp":
+                if api == "callback":
+                    (size, elapsed) = b.cb_throughput()
+                else:
+                    (size, elapsed) = b.sync_throughput()
+                r["MBps"] = round(size / elapsed / 1000000.0, 2)
+                r["bytes"] = size
+        except Exception as e:
+            b.cleanup()
+            if "msgs_per_sec" not in r:
+                # Couldn't even do the first test, this type probably
+                # isn't available.
+                r = dict(result)
+                r["api"] = api
+                r["skipped"] = str(e)
+            else:
+                r["error"] = str(e)
+        results.append(r)
+    return results
+
+def print_result(r):
+    if "skipped" in r:
+        print("%-18s %-8s skipped: %s" % (r["type"], r.get("api", ""),
+                                          r["skipped"]))
+        return
+    mbps = "-"
+    if "MBps" in r:
+        mbps = "%.1f" % r["MBps"]
+    print("%-18s %-8s %10s %10.0f %10.1f %10.1f %6d%s" %
+          (r["type"], r["api"], mbps, r["msgs_per_sec"],
+           r["latency_usec"]["p50"], r["latency_usec"]["p99"], r["lost"],
+           "  error: " + r["error"] if "error" in r else ""))
+
+def usage():
+    print("Usage: %s [-s <size in MB>] [-n <messages>] [-m <msgsize>]\n"
+          "           [-c <chunksize>] [-T <seconds>]"
+          " [-t <type>[,<type>...]]\n"
+          "           [-a callback|sync] [-k <keydir>] [-o <json file>] [-l]"
+          % sys.argv[0])
+    sys.exit(1)
+
+opts = {
+    "size": 16 * 1000000,
+    "msgs": 2000,
+    "msgsize": 64,
+    "chunksize": 65536,
+    "maxtime": 10.0,
+    "apis": [ "callback", "sync" ],
+}
+types = None
+outfile = None
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], "s:n:m:c:T:t:a:k:o:lh")
+except getopt.GetoptError:
+    usage()
+if args:
+    usage()
+for opt, arg in optlist:
+    if opt == "-s":
+        opts["size"] = int(float(arg) * 1000000)
+    elif opt == "-n":
+        opts["msgs"] = int(arg)
+    elif opt == "-m":
+        opts["msgsize"] = int(arg)
+    elif opt == "-c":
+        opts["chunksize"] = int(arg)
+    elif opt == "-T":
+        opts["maxtime"] = float(arg)
+    elif opt == "-t":
+        types = arg.split(",")
+    elif opt == "-a":
+        if arg not in ("callback", "sync"):
+            usage()
+        opts["apis"] = [ arg ]
+    elif opt == "-k":
+        keydir = arg
+    elif opt == "-o":
+        outfile = arg
+    elif opt == "-l":
+        for t in bench_types:
+            print(t["name"])
+        sys.exit(0)
+    else:
+        usage()
+
+to_run = bench_types
+if types:
+    # Type names have commas, so match them up a piece at a time.
+    names = [ t["name"] for t in bench_types ]
+    to_run = []
+    i = 0
+    while i < len(types):
+        for j in range(len(types), i, -1):
+            name = ",".join(types[i:j])
+            if name in names:
+                to_run.append(bench_types[names.index(name)])
+                i = j
+                break
+        else:
+            print("Unknown gensio type: %s" % types[i])
+            sys.exit(1)
+
+o = gensio.alloc_gensio_selector(Logger())
+
+print("%-18s %-8s %10s %10s %10s %10s %6s" %
+      ("type", "api", "MB/s", "msgs/s", "p50 usec", "p99 usec", "lost"))
+results = []
+for t in to_run:
+    for r in run_type(o, t, opts):
+        print_result(r)
+        results.append(r)
+
+if outfile:
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "options": {
+            "size": opts["size"],
+            "msgs": opts["msgs"],
+            "msgsize": opts["msgsize"],
+            "chunksize": opts["chunksize"],
+            "maxtime": opts["maxtime"],
+        },
+        "results": results,
+    }
+    if outfile == "-":
+        json.dump(report, sys.stdout, indent = 2)
+        print("")
+    else:
+        with open(outfile, "w") as f:
+            json.dump(report, f, indent = 2)
+            f.write("\n")
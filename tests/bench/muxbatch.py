@@ -0,0 +1,235 @@
+#
+#  gensio - A library for abstracting stream I/O
+#  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+#
+#  SPDX-License-Identifier: LGPL-2.1-only
+#
+# Measure how many writes mux does to the gensio below it.
+#
+# This runs mux over ssl over tcp on the local host, opens a number
+# of channels and writes small messages on all of them at once, then
+# prints the throughput and the writes per MB of data to the ssl and
+# tcp gensios below the mux.  Each write to the ssl gensio is an
+# SSL_write(), so at least one SSL record, and each write to the tcp
+# gensio is a system call.  Each channel count is run with each mux
+# writebatch value, 0 is one mux message per write.
+#
+# Run it by hand in the tests directory with PYTHONPATH pointing to
+# the gensio python module, like:
+#
+#   python3 bench/muxbatch.py -c 1,10,100
+#
+# Usage: muxbatch.py [-s <size in KB>] [-m <msgsize>]
+#            [-c <channels>[,<channels>...]] [-b <writebatch>[,...]]
+#            [-k <keydir>] [-n] [-T <seconds>] [-o <json file>]
+#
+
+import os
+import sys
+import time
+import json
+import getopt
+import gensio
+
+class Logger:
+    def gensio_log(self, level, log):
+        print("***%s log: %s" % (level, log))
+
+class BenchException(Exception):
+    pass
+
+class Sink:
+    """The server end, count everything read on all the channels and
+    wake when it has all arrived."""
+
+    def __init__(self, o, total):
+        self.waiter = gensio.waiter(o)
+        self.total = total
+        self.count = 0
+        self.ios = []
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            return 0
+        self.count += len(data)
+        if self.count >= self.total:
+            self.total = 0
+            self.waiter.wake()
+        return len(data)
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+    def new_channel(self, io1, io2, auxdata):
+        self.ios.append(io2)
+        io2.set_cbs(self)
+        io2.read_cb_enable(True)
+        return 0
+
+class Acceptor:
+    def __init__(self, o, sink):
+        self.waiter = gensio.waiter(o)
+        self.sink = sink
+        self.io = None
+
+    def new_connection(self, acc, io):
+        self.io = io
+        io.set_cbs(self.sink)
+        io.read_cb_enable(True)
+        self.waiter.wake()
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+class ChanWriter:
+    """Write total bytes on a channel, msg at a time, from the write
+    callback.  Each write is a separate mux message."""
+
+    def __init__(self, total, msg):
+        self.total = total
+        self.msg = msg
+        self.written = 0
+
+    def write_callback(self, io):
+        while self.written < self.total:
+            l = min(len(self.msg), self.total - self.written)
+            count = io.write(self.msg[:l], None)
+            if count == 0:
+                return
+            self.written += count
+        io.write_cb_enable(False)
+
+    def read_callback(self, io, err, data, auxdata):
+        return len(data)
+
+def stack_strs(opts, batch):
+    mux = "mux(writebatch=%d)" % batch
+    if opts["nossl"]:
+        return (mux + ",tcp,localhost,0", mux + ",tcp,localhost,%s")
+    k = opts["keydir"]
+    return (mux + ",ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,localhost,0"
+            % (k, k),
+            mux + ",ssl(CA=%s/CA.pem),tcp,localhost,%%s" % k)
+
+def run_one(o, nchans, batch, opts):
+    total = opts["size"]
+    (accstr, constr) = stack_strs(opts, batch)
+    sink = Sink(o, total)
+    acch = Acceptor(o, sink)
+    acc = gensio.gensio_accepter(o, accstr, acch)
+    acc.startup()
+    port = acc.control(gensio.GENSIO_CONTROL_DEPTH_FIRST, True,
+                       gensio.GENSIO_ACC_CONTROL_LPORT, "0")
+    chans = []
+    try:
+        io = gensio.gensio(o, constr % port, None)
+        io.open_s()
+        chans.append(io)
+        if acch.waiter.wait_timeout(1, 5000) == 0:
+            raise BenchException("Timed out waiting for connection")
+        for i in range(1, nchans):
+            c = io.alloc_channel(None, None)
+            c.open_s()
+            chans.append(c)
+
+        # Don't count the setup.
+        gensio.gensio_stats_reset(io)
+
+        msg = b"x" * opts["msgsize"]
+        per_chan = total // nchans
+        start = time.perf_counter()
+        for i, c in enumerate(chans):
+            l = per_chan
+            if i == 0:
+                l += total - per_chan * nchans
+            c.set_cbs(ChanWriter(l, msg))
+            c.write_cb_enable(True)
+        if sink.waiter.wait_timeout(1, int(opts["maxtime"] * 1000)) == 0:
+            raise BenchException("Timed out, got %d of %d bytes" %
+                                 (sink.count, total))
+        elapsed = time.perf_counter() - start
+
+        mux = gensio.gensio_stats(io, 0)
+        if opts["nossl"]:
+            below = [ None, gensio.gensio_stats(io, 1) ]
+        else:
+            below = [ gensio.gensio_stats(io, d) for d in (1, 2) ]
+    finally:
+        for c in reversed(chans):
+            try:
+                c.close_s()
+            except Exception:
+                pass
+        acc.shutdown_s()
+
+    mb = total / 1000000.0
+    result = { "channels": nchans, "writebatch": batch,
+               "msgsize": opts["msgsize"], "size": total,
+               "seconds": elapsed, "MBps": mb / elapsed,
+               "tcp_writes_per_MB": below[1]["writes"] / mb }
+    if below[0]:
+        result["ssl_writes_per_MB"] = below[0]["writes"] / mb
+    return result
+
+def usage():
+    print("Usage: %s [-s <size in KB>] [-m <msgsize>]\n"
+          "           [-c <channels>[,<channels>...]] [-b <writebatch>[,...]]\n"
+          "           [-k <keydir>] [-n] [-T <seconds>] [-o <json file>]"
+          % sys.argv[0])
+    sys.exit(1)
+
+opts = {
+    "size": 1000 * 1000,
+    "msgsize": 64,
+    "channels": [ 1, 10, 100 ],
+    "batches": [ 0, 16384 ],
+    "keydir": os.getenv("keydir") or "ca",
+    "nossl": False,
+    "maxtime": 60.0,
+}
+outfile = None
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], "s:m:c:b:k:nT:o:h")
+except getopt.GetoptError:
+    usage()
+if args:
+    usage()
+for opt, arg in optlist:
+    if opt == "-s":
+        opts["size"] = int(float(arg) * 1000)
+    elif opt == "-m":
+        opts["msgsize"] = int(arg)
+    elif opt == "-c":
+        opts["channels"] = [ int(i) for i in arg.split(",") ]
+    elif opt == "-b":
+        opts["batches"] = [ int(i) for i in arg.split(",") ]
+    elif opt == "-k":
+        opts["keydir"] = arg
+    elif opt == "-n":
+        opts["nossl"] = True
+    elif opt == "-T":
+        opts["maxtime"] = float(arg)
+    elif opt == "-o":
+        outfile = arg
+    else:
+        usage()
+
+o = gensio.alloc_gensio_selector(Logger())
+
+print("%8s %10s %8s %14s %14s" %
+      ("channels", "writebatch", "MB/s", "ssl writes/MB", "tcp writes/MB"))
+results = []
+for nchans in opts["channels"]:
+    for batch in opts["batches"]:
+        r = run_one(o, nchans, batch, opts)
+        ssl = "-"
+        if "ssl_writes_per_MB" in r:
+            ssl = "%.0f" % r["ssl_writes_per_MB"]
+        print("%8d %10d %8.2f %14s %14.0f" %
+              (nchans, batch, r["MBps"], ssl, r["tcp_writes_per_MB"]))
+        results.append(r)
+
+if outfile:
+    with open(outfile, "w") as f:
+        json.dump({ "options": opts, "results": results }, f, indent = 2)
+        f.write("\n")
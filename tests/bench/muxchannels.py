@@ -0,0 +1,211 @@
+#
+#  gensio - A library for abstracting stream I/O
+#  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+#
+#  SPDX-License-Identifier: LGPL-2.1-only
+#
+# Measure how fast mux opens and demuxes traffic on a lot of channels.
+#
+# This runs mux over tcp (or ssl over tcp) on the local host, opens a
+# large number of channels, then writes a number of small messages on
+# every channel at once.  The mux interleaves the channels, so each
+# message that arrives is for a different channel than the last one.
+# It prints the time to open the channels and the rate that messages
+# arrive at the other end.
+#
+# Run it by hand in the tests directory with PYTHONPATH pointing to
+# the gensio python module, like:
+#
+#   python3 bench/muxchannels.py -c 100,1000,10000
+#
+# Usage: muxchannels.py [-c <channels>[,<channels>...]] [-r <messages>]
+#            [-m <msgsize>] [-k <keydir>] [-s] [-T <seconds>]
+#            [-o <json file>]
+#
+
+import os
+import sys
+import time
+import json
+import getopt
+import gensio
+
+class Logger:
+    def gensio_log(self, level, log):
+        print("***%s log: %s" % (level, log))
+
+class BenchException(Exception):
+    pass
+
+class Sink:
+    """The server end, count the messages read on all the channels and
+    wake when they have all arrived."""
+
+    def __init__(self, o):
+        self.waiter = gensio.waiter(o)
+        self.total = 0
+        self.count = 0
+        self.ios = []
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            return 0
+        self.count += len(data)
+        if self.total and self.count >= self.total:
+            self.total = 0
+            self.waiter.wake()
+        return len(data)
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+    def new_channel(self, io1, io2, auxdata):
+        self.ios.append(io2)
+        io2.set_cbs(self)
+        io2.read_cb_enable(True)
+        return 0
+
+class Acceptor:
+    def __init__(self, o, sink):
+        self.waiter = gensio.waiter(o)
+        self.sink = sink
+        self.io = None
+
+    def new_connection(self, acc, io):
+        self.io = io
+        io.set_cbs(self.sink)
+        io.read_cb_enable(True)
+        self.waiter.wake()
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+class ChanWriter:
+    """Write count messages on a channel from the write callback."""
+
+    def __init__(self, count, msg):
+        self.count = count
+        self.msg = msg
+
+    def write_callback(self, io):
+        while self.count > 0:
+            if io.write(self.msg, None) == 0:
+                return
+            self.count -= 1
+        io.write_cb_enable(False)
+
+    def read_callback(self, io, err, data, auxdata):
+        return len(data)
+
+def stack_strs(opts, nchans):
+    # Small channel buffers, each channel allocates them.
+    mux = "mux(max_channels=%d,readbuf=1024,writebuf=1024)" % nchans
+    tcp = "tcp(nodelay),localhost,"
+    if not opts["ssl"]:
+        return (mux + "," + tcp + "0", mux + "," + tcp + "%s")
+    k = opts["keydir"]
+    return (mux + ",ssl(key=%s/key.pem,cert=%s/cert.pem)," % (k, k) + tcp + "0",
+            mux + ",ssl(CA=%s/CA.pem)," % k + tcp + "%s")
+
+def run_one(o, nchans, opts):
+    (accstr, constr) = stack_strs(opts, nchans)
+    sink = Sink(o)
+    acch = Acceptor(o, sink)
+    acc = gensio.gensio_accepter(o, accstr, acch)
+    acc.startup()
+    port = acc.control(gensio.GENSIO_CONTROL_DEPTH_FIRST, True,
+                       gensio.GENSIO_ACC_CONTROL_LPORT, "0")
+    chans = []
+    try:
+        io = gensio.gensio(o, constr % port, None)
+        io.open_s()
+        chans.append(io)
+        if acch.waiter.wait_timeout(1, 5000) == 0:
+            raise BenchException("Timed out waiting for connection")
+
+        start = time.perf_counter()
+        for i in range(1, nchans):
+            c = io.alloc_channel(None, None)
+            c.open_s()
+            chans.append(c)
+        open_time = time.perf_counter() - start
+
+        msg = b"x" * opts["msgsize"]
+        nmsgs = opts["msgs"] * nchans
+        sink.total = nmsgs * len(msg)
+        start = time.perf_counter()
+        for c in chans:
+            c.set_cbs(ChanWriter(opts["msgs"], msg))
+            c.write_cb_enable(True)
+        if sink.waiter.wait_timeout(1, int(opts["maxtime"] * 1000)) == 0:
+            raise BenchException("Timed out, got %d of %d bytes" %
+                                 (sink.count, nmsgs * len(msg)))
+        elapsed = time.perf_counter() - start
+    finally:
+        for c in reversed(chans):
+            try:
+                c.close_s()
+            except Exception:
+                pass
+        acc.shutdown_s()
+
+    return { "channels": nchans, "messages": nmsgs,
+             "msgsize": opts["msgsize"],
+             "open_usec_per_channel": open_time * 1000000.0 / nchans,
+             "seconds": elapsed, "msgs_per_sec": nmsgs / elapsed }
+
+def usage():
+    print("Usage: %s [-c <channels>[,<channels>...]] [-r <messages>]\n"
+          "           [-m <msgsize>] [-k <keydir>] [-s] [-T <seconds>]\n"
+          "           [-o <json file>]" % sys.argv[0])
+    sys.exit(1)
+
+opts = {
+    "channels": [ 10, 100, 1000, 10000 ],
+    "msgs": 20,
+    "msgsize": 16,
+    "keydir": os.getenv("keydir") or "ca",
+    "ssl": False,
+    "maxtime": 120.0,
+}
+outfile = None
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], "c:r:m:k:sT:o:h")
+except getopt.GetoptError:
+    usage()
+if args:
+    usage()
+for opt, arg in optlist:
+    if opt == "-c":
+        opts["channels"] = [ int(i) for i in arg.split(",") ]
+    elif opt == "-r":
+        opts["msgs"] = int(arg)
+    elif opt == "-m":
+        opts["msgsize"] = int(arg)
+    elif opt == "-k":
+        opts["keydir"] = arg
+    elif opt == "-s":
+        opts["ssl"] = True
+    elif opt == "-T":
+        opts["maxtime"] = float(arg)
+    elif opt == "-o":
+        outfile = arg
+    else:
+        usage()
+
+o = gensio.alloc_gensio_selector(Logger())
+
+print("%8s %10s %18s %12s" %
+      ("channels", "messages", "open usec/channel", "msgs/sec"))
+results = []
+for nchans in opts["channels"]:
+    r = run_one(o, nchans, opts)
+    print("%8d %10d %18.1f %12.0f" %
+          (nchans, r["messages"], r["open_usec_per_channel"],
+           r["msgs_per_sec"]))
+    results.append(r)
+
+if outfile:
+    with open(outfile, "w") as f:
+        json.dump({ "options": opts, "results": results }, f, indent = 2)
+        f.write("\n")
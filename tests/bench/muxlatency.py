@@ -0,0 +1,282 @@
+#
+#  gensio - A library for abstracting stream I/O
+#  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+#
+#  SPDX-License-Identifier: LGPL-2.1-only
+#
+# Measure the latency of an interactive mux channel while bulk
+# channels on the same mux are sending as fast as they can.
+#
+# This runs mux over ssl over tcp on the local host.  The bulk
+# channels write large messages to a sink on the other end, and the
+# interactive channel sends small messages to an echo on the other
+# end one at a time and times the round trip.  It is run with no bulk
+# channels, then with the interactive channel at the same priority as
+# the bulk channels, then with it at a higher priority, and prints the
+# round trip latencies and the bulk throughput for each.
+#
+# Run it by hand in the tests directory with PYTHONPATH pointing to
+# the gensio python module, like:
+#
+#   python3 bench/muxlatency.py -b 4
+#
+# Usage: muxlatency.py [-b <bulk channels>] [-p <pings>] [-m <bulk msgsize>]
+#            [-w <mux buffer size>] [-P <priority>] [-k <keydir>] [-n]
+#            [-o <json file>]
+#
+
+import os
+import sys
+import time
+import json
+import getopt
+import gensio
+
+class Logger:
+    def gensio_log(self, level, log):
+        print("***%s log: %s" % (level, log))
+
+class BenchException(Exception):
+    pass
+
+def percentile(vals, p):
+    if not vals:
+        return None
+    vals = sorted(vals)
+    i = int(round((len(vals) - 1) * p / 100.0))
+    return vals[i]
+
+class Sink:
+    """Server end of a bulk channel, throw the data away."""
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            return 0
+        return len(data)
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+class Echo:
+    """Server end of the interactive channel, send everything back."""
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            return 0
+        return io.write(data, None)
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+class Server(Sink):
+    """Accepter handler, and the sink for the first channel.  New
+    channels come here, the channel's service says what it is."""
+
+    def __init__(self, o):
+        self.waiter = gensio.waiter(o)
+        self.io = None
+        self.ios = []
+
+    def new_connection(self, acc, io):
+        self.io = io
+        io.set_cbs(self)
+        io.read_cb_enable(True)
+        self.waiter.wake()
+
+    def new_channel(self, io1, io2, auxdata):
+        self.ios.append(io2)
+        if auxdata and auxdata[0] == "echo":
+            io2.set_cbs(Echo())
+        else:
+            io2.set_cbs(Sink())
+        io2.read_cb_enable(True)
+        return 0
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+class BulkWriter:
+    """Write msg on a channel from the write callback until stopped."""
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.written = 0
+
+    def write_callback(self, io):
+        while True:
+            count = io.write(self.msg, None)
+            if count == 0:
+                return
+            self.written += count
+
+    def read_callback(self, io, err, data, auxdata):
+        return len(data)
+
+class Pinger:
+    """Send a small message, wait for it to come back, repeat."""
+
+    def __init__(self, o, io, count):
+        self.waiter = gensio.waiter(o)
+        self.io = io
+        self.count = count
+        self.msg = b"p" * 8
+        self.got = 0
+        self.rtts = []
+
+    def start(self):
+        self.got = 0
+        self.start_time = time.perf_counter()
+        self.io.write(self.msg, None)
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            self.waiter.wake()
+            return 0
+        self.got += len(data)
+        if self.got >= len(self.msg):
+            self.rtts.append(time.perf_counter() - self.start_time)
+            if len(self.rtts) >= self.count:
+                self.waiter.wake()
+            else:
+                self.start()
+        return len(data)
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+def stack_strs(opts):
+    # nodelay, like an interactive program would use, so the small
+    # messages aren't held up waiting for tcp acks.
+    mux = "mux(readbuf=%d,writebuf=%d)" % (opts["bufsize"], opts["bufsize"])
+    tcp = "tcp(nodelay),localhost,"
+    if opts["nossl"]:
+        return (mux + "," + tcp + "0", mux + "," + tcp + "%s")
+    k = opts["keydir"]
+    return (mux + ",ssl(key=%s/key.pem,cert=%s/cert.pem)," % (k, k) + tcp + "0",
+            mux + ",ssl(CA=%s/CA.pem)," % k + tcp + "%s")
+
+def run_one(o, nbulk, priority, opts):
+    (accstr, constr) = stack_strs(opts)
+    server = Server(o)
+    acc = gensio.gensio_accepter(o, accstr, server)
+    acc.startup()
+    port = acc.control(gensio.GENSIO_CONTROL_DEPTH_FIRST, True,
+                       gensio.GENSIO_ACC_CONTROL_LPORT, "0")
+    chans = []
+    try:
+        io = gensio.gensio(o, constr % port, None)
+        io.open_s()
+        chans.append(io)
+        if server.waiter.wait_timeout(1, 5000) == 0:
+            raise BenchException("Timed out waiting for connection")
+        bulk = []
+        for i in range(0, nbulk):
+            c = io.alloc_channel(["service=bulk"], None)
+            c.open_s()
+            chans.append(c)
+            bulk.append(c)
+        ic = io.alloc_channel(["service=echo", "priority=%d" % priority],
+                              None)
+        ic.open_s()
+        chans.append(ic)
+        # The first pings are done while the bulk channels get
+        # going, they are thrown away.
+        skip = opts["pings"] // 10
+        pinger = Pinger(o, ic, opts["pings"] + skip)
+        ic.set_cbs(pinger)
+        ic.read_cb_enable(True)
+
+        writers = []
+        msg = b"b" * opts["msgsize"]
+        for c in bulk:
+            w = BulkWriter(msg)
+            writers.append(w)
+            c.set_cbs(w)
+            c.write_cb_enable(True)
+
+        start = time.perf_counter()
+        pinger.start()
+        if pinger.waiter.wait_timeout(1, 60000) == 0:
+            raise BenchException("Timed out, got %d of %d pings" %
+                                 (len(pinger.rtts), opts["pings"] + skip))
+        elapsed = time.perf_counter() - start
+        bbytes = sum(w.written for w in writers)
+        for c in bulk:
+            c.write_cb_enable(False)
+    finally:
+        for c in reversed(chans):
+            try:
+                c.close_s()
+            except Exception:
+                pass
+        acc.shutdown_s()
+
+    rtts = pinger.rtts[skip:]
+    return { "bulk_channels": nbulk, "priority": priority,
+             "pings": len(rtts), "seconds": elapsed,
+             "bulk_MBps": bbytes / 1000000.0 / elapsed,
+             "rtt_usec": {
+                 "p50": round(percentile(rtts, 50) * 1000000.0, 1),
+                 "p99": round(percentile(rtts, 99) * 1000000.0, 1),
+                 "max": round(max(rtts) * 1000000.0, 1) } }
+
+def usage():
+    print("Usage: %s [-b <bulk channels>] [-p <pings>] [-m <bulk msgsize>]\n"
+          "           [-w <mux buffer size>] [-P <priority>] [-k <keydir>]"
+          " [-n]\n"
+          "           [-o <json file>]" % sys.argv[0])
+    sys.exit(1)
+
+opts = {
+    "bulk": 4,
+    "pings": 500,
+    "msgsize": 16384,
+    "bufsize": 65536,
+    "priority": 7,
+    "keydir": os.getenv("keydir") or "ca",
+    "nossl": False,
+}
+outfile = None
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], "b:p:m:w:P:k:no:h")
+except getopt.GetoptError:
+    usage()
+if args:
+    usage()
+for opt, arg in optlist:
+    if opt == "-b":
+        opts["bulk"] = int(arg)
+    elif opt == "-p":
+        opts["pings"] = int(arg)
+    elif opt == "-m":
+        opts["msgsize"] = int(arg)
+    elif opt == "-w":
+        opts["bufsize"] = int(arg)
+    elif opt == "-P":
+        opts["priority"] = int(arg)
+    elif opt == "-k":
+        opts["keydir"] = arg
+    elif opt == "-n":
+        opts["nossl"] = True
+    elif opt == "-o":
+        outfile = arg
+    else:
+        usage()
+
+o = gensio.alloc_gensio_selector(Logger())
+
+print("%5s %8s %10s %10s %10s %10s" %
+      ("bulk", "priority", "p50 usec", "p99 usec", "max usec", "bulk MB/s"))
+results = []
+for (nbulk, priority) in ((0, 0), (opts["bulk"], 0),
+                          (opts["bulk"], opts["priority"])):
+    r = run_one(o, nbulk, priority, opts)
+    print("%5d %8d %10.1f %10.1f %10.1f %10.2f" %
+          (nbulk, priority, r["rtt_usec"]["p50"], r["rtt_usec"]["p99"],
+           r["rtt_usec"]["max"], r["bulk_MBps"]))
+    results.append(r)
+
+if outfile:
+    with open(outfile, "w") as f:
+        json.dump({ "options": opts, "results": results }, f, indent = 2)
+        f.write("\n")
@@ -0,0 +1,163 @@
+#
+#  gensio - A library for abstracting stream I/O
+#  Copyright (C) 2018  Corey Minyard <minyard@acm.org>
+#
+#  SPDX-License-Identifier: LGPL-2.1-only
+#
+# Measure the throughput of read delivery to Python, comparing data
+# passed to read_callback() as a new byte string with data passed as
+# a memoryview on a reused buffer.  Both copy the data, the memoryview
+# only saves the allocation.
+#
+# Run it by hand in the tests directory with PYTHONPATH pointing to
+# the gensio python module.
+#
+# Usage: bench/pyreadbench.py [-s <size in MB>] [-p <port>] [-r <runs>]
+#            [-b <readbuf>] [-t <touch>]
+#
+# "readbuf" is the read buffer size of the receiving gensio, the larger
+# it is the more data is delivered in each callback.
+# "touch" is what the read callback does with the data, "none" just
+# returns the length, "sum" adds up a byte from every 4K so the memory
+# is actually looked at.
+
+import sys
+import time
+import getopt
+import gensio
+
+class Logger:
+    def gensio_log(self, level, log):
+        print("***%s log: %s" % (level, log))
+
+class Reader:
+    def __init__(self, o, total, touch):
+        self.waiter = gensio.waiter(o)
+        self.total = total
+        self.count = 0
+        self.sum = 0
+        self.touch = touch
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            raise Exception("Reader: " + err)
+        l = len(data)
+        if self.touch:
+            for i in range(0, l, 4096):
+                self.sum += data[i]
+        self.count += l
+        if self.count >= self.total:
+            io.read_cb_enable(False)
+            self.waiter.wake()
+        return l
+
+    def write_callback(self, io):
+        return
+
+class Writer:
+    def __init__(self, o, total, chunksize):
+        self.waiter = gensio.waiter(o)
+        self.total = total
+        self.chunk = b"x" * chunksize
+        self.pos = 0
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            raise Exception("Writer: " + err)
+        return len(data)
+
+    def write_callback(self, io):
+        while self.pos < self.total:
+            l = io.write(self.chunk, None)
+            if l == 0:
+                return
+            self.pos += l
+        io.write_cb_enable(False)
+        self.waiter.wake()
+
+class Acceptor:
+    def __init__(self, o):
+        self.waiter = gensio.waiter(o)
+        self.io = None
+
+    def new_connection(self, acc, io):
+        self.io = io
+        self.waiter.wake()
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+def run(o, port, readbuf, size, memview, touch):
+    acch = Acceptor(o)
+    acc = gensio.gensio_accepter(o, "tcp(readbuf=%d),localhost,%d" %
+                                 (readbuf, port), acch)
+    acc.startup()
+    w = Writer(o, size, 65536)
+    io1 = gensio.gensio(o, "tcp,localhost,%d" % port, w)
+    io1.open_s()
+    if acch.waiter.wait_timeout(1, 5000) == 0:
+        raise Exception("Timed out waiting for connection")
+    io2 = acch.io
+    r = Reader(o, size, touch)
+    io2.set_cbs(r)
+    io2.set_read_memoryview(memview)
+
+    start = time.time()
+    io2.read_cb_enable(True)
+    io1.write_cb_enable(True)
+    w.waiter.wait(1)
+    r.waiter.wait(1)
+    elapsed = time.time() - start
+
+    io1.close_s()
+    io2.close_s()
+    acc.shutdown_s()
+    return elapsed
+
+def usage():
+    print("Usage: %s [-s <size in MB>] [-p <port>] [-r <runs>] "
+          "[-b <readbuf>] [-t none|sum]" % sys.argv[0])
+    sys.exit(1)
+
+size = 256
+port = 3023
+runs = 5
+readbuf = 65536
+touch = False
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "s:p:r:b:t:h")
+except getopt.GetoptError:
+    usage()
+for opt, arg in opts:
+    if opt == "-s":
+        size = int(arg)
+    elif opt == "-p":
+        port = int(arg)
+    elif opt == "-r":
+        runs = int(arg)
+    elif opt == "-b":
+        readbuf = int(arg)
+    elif opt == "-t":
+        if arg == "none":
+            touch = False
+        elif arg == "sum":
+            touch = True
+        else:
+            usage()
+    else:
+        usage()
+
+o = gensio.alloc_gensio_selector(Logger())
+nbytes = size * 1024 * 1024
+for memview in (False, True):
+    best = None
+    for i in range(0, runs):
+        t = run(o, port, readbuf, nbytes, memview, touch)
+        if best is None or t < best:
+            best = t
+    if memview:
+        name = "memoryview"
+    else:
+        name = "bytes"
+    print("%-10s %d MB in %.3fs, %.1f MB/s" % (name, size, best,
+                                              size / best))
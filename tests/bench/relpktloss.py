@@ -0,0 +1,256 @@
+#
+#  gensio - A library for abstracting stream I/O
+#  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+#
+#  SPDX-License-Identifier: LGPL-2.1-only
+#
+# Measure relpkt goodput over a lossy, slow link.
+#
+# This runs relpkt over udp on the local host, with a udp proxy in
+# between that drops a percentage of the packets and delays the rest
+# (in both directions, so acks are lost and delayed too).  For each
+# loss rate the given amount of data is sent from one end to the
+# other and the goodput (data delivered to the user, not counting
+# retransmits) is printed, along with the relpkt statistics from the
+# sending end if the gensio python module has them.
+#
+# Run it by hand in the tests directory with PYTHONPATH pointing to
+# the gensio python module, like:
+#
+#   python3 bench/relpktloss.py -l 0,1,5 -d 2
+#
+# Usage: relpktloss.py [-s <size in KB>] [-l <loss %>[,<loss %>...]]
+#            [-d <delay ms>] [-j <jitter ms>] [-r <seed>] [-T <seconds>]
+#            [-a <relpkt options>] [-o <json file>]
+#
+
+import os
+import sys
+import time
+import json
+import heapq
+import random
+import select
+import socket
+import getopt
+import threading
+import gensio
+
+class Logger:
+    def gensio_log(self, level, log):
+        print("***%s log: %s" % (level, log))
+
+class SyncAcceptor:
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s" % (level, logstr))
+
+class BenchException(Exception):
+    pass
+
+class LossyProxy:
+    """A udp proxy that drops and delays packets.  The first address
+    that sends to the proxy port is the client, everything from it
+    goes to the server port and everything from the server goes back
+    to it."""
+
+    def __init__(self, server_port, loss, delay, jitter, seed):
+        self.loss = loss / 100.0
+        self.delay = delay / 1000.0
+        self.jitter = jitter / 1000.0
+        self.rand = random.Random(seed)
+        self.server_addr = ("127.0.0.1", server_port)
+        self.client_addr = None
+        self.csock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.csock.bind(("127.0.0.1", 0))
+        self.port = self.csock.getsockname()[1]
+        self.ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ssock.bind(("127.0.0.1", 0))
+        self.queue = []
+        self.seq = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.done = False
+        self.thread = threading.Thread(target = self.run)
+        self.thread.start()
+
+    def stop(self):
+        self.done = True
+        self.thread.join()
+        self.csock.close()
+        self.ssock.close()
+
+    def queue_pkt(self, sock, data, addr):
+        if self.rand.random() < self.loss:
+            self.dropped += 1
+            return
+        when = time.monotonic() + self.delay
+        if self.jitter:
+            when += self.rand.uniform(0, self.jitter)
+        self.seq += 1
+        heapq.heappush(self.queue, (when, self.seq, sock, data, addr))
+
+    def run(self):
+        while not self.done:
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                (when, seq, sock, data, addr) = heapq.heappop(self.queue)
+                sock.sendto(data, addr)
+                self.forwarded += 1
+            timeout = 0.1
+            if self.queue:
+                timeout = min(timeout, self.queue[0][0] - now)
+            (r, w, x) = select.select([self.csock, self.ssock], [], [],
+                                      timeout)
+            if self.csock in r:
+                (data, addr) = self.csock.recvfrom(65536)
+                if self.client_addr is None:
+                    self.client_addr = addr
+                if addr == self.client_addr:
+                    self.queue_pkt(self.ssock, data, self.server_addr)
+            if self.ssock in r:
+                (data, addr) = self.ssock.recvfrom(65536)
+                if self.client_addr is not None:
+                    self.queue_pkt(self.csock, data, self.client_addr)
+
+def get_stats(io):
+    # Older versions of the module don't have statistics.
+    if not hasattr(gensio, "gensio_stats"):
+        return None
+    return gensio.gensio_stats(io)
+
+def run_one(o, loss, opts):
+    args = ""
+    if opts["relpkt"]:
+        args = "(" + opts["relpkt"] + ")"
+    acc = gensio.gensio_accepter(o, "relpkt%s,udp,localhost,0" % args,
+                                 SyncAcceptor())
+    acc.set_sync()
+    acc.startup()
+    port = int(acc.control(gensio.GENSIO_CONTROL_DEPTH_FIRST, True,
+                           gensio.GENSIO_ACC_CONTROL_LPORT, "0"))
+    proxy = LossyProxy(port, loss, opts["delay"], opts["jitter"],
+                       opts["seed"])
+    total = opts["size"]
+    result = { "loss": loss, "delay_ms": opts["delay"],
+               "jitter_ms": opts["jitter"], "size": total }
+    errs = []
+    received = [0]
+
+    def reader():
+        try:
+            (io, t) = acc.accept_s_timeout(o, None, 10000)
+            if io is None:
+                raise BenchException("Timed out waiting for connection")
+            io.set_sync()
+            buf = bytearray(1024)
+            deadline = time.monotonic() + opts["maxtime"]
+            while received[0] < total and time.monotonic() < deadline:
+                (l, t) = io.read_s_into(buf, 1000)
+                received[0] += l
+            io.close_s()
+        except Exception as e:
+            errs.append(e)
+
+    thread = threading.Thread(target = reader)
+    thread.start()
+    io = None
+    try:
+        io = gensio.gensio(o, "relpkt%s,udp,localhost,%d" % (args, proxy.port),
+                           None)
+        io.open_s()
+        io.set_sync()
+        chunk = b"x" * 1024
+        start = time.monotonic()
+        deadline = start + opts["maxtime"]
+        written = 0
+        while written < total and time.monotonic() < deadline:
+            (count, t) = io.write_s(chunk[:min(len(chunk), total - written)],
+                                    1000)
+            written += count
+        thread.join()
+        elapsed = time.monotonic() - start
+        result["stats"] = get_stats(io)
+    finally:
+        thread.join()
+        if io is not None:
+            try:
+                io.close_s()
+            except Exception:
+                pass
+        proxy.stop()
+        acc.shutdown_s()
+    if errs:
+        raise errs[0]
+    result["received"] = received[0]
+    result["seconds"] = elapsed
+    result["KBps"] = received[0] / elapsed / 1000.0
+    result["dropped"] = proxy.dropped
+    result["forwarded"] = proxy.forwarded
+    return result
+
+def usage():
+    print("Usage: %s [-s <size in KB>] [-l <loss %%>[,<loss %%>...]]\n"
+          "           [-d <delay ms>] [-j <jitter ms>] [-r <seed>]"
+          " [-T <seconds>]\n"
+          "           [-a <relpkt options>] [-o <json file>]" % sys.argv[0])
+    sys.exit(1)
+
+opts = {
+    "size": 1000 * 1000,
+    "losses": [ 0.0, 1.0, 5.0 ],
+    "delay": 1.0,
+    "jitter": 0.0,
+    "seed": 1,
+    "maxtime": 60.0,
+    "relpkt": "",
+}
+outfile = None
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], "s:l:d:j:r:T:a:o:h")
+except getopt.GetoptError:
+    usage()
+if args:
+    usage()
+for opt, arg in optlist:
+    if opt == "-s":
+        opts["size"] = int(float(arg) * 1000)
+    elif opt == "-l":
+        opts["losses"] = [ float(i) for i in arg.split(",") ]
+    elif opt == "-d":
+        opts["delay"] = float(arg)
+    elif opt == "-j":
+        opts["jitter"] = float(arg)
+    elif opt == "-r":
+        opts["seed"] = int(arg)
+    elif opt == "-T":
+        opts["maxtime"] = float(arg)
+    elif opt == "-a":
+        opts["relpkt"] = arg
+    elif opt == "-o":
+        outfile = arg
+    else:
+        usage()
+
+o = gensio.alloc_gensio_selector(Logger())
+
+print("%6s %8s %10s %10s %8s %8s  %s" %
+      ("loss %", "delay ms", "KB", "KB/s", "seconds", "dropped", "stats"))
+# The relpkt statistics from the sender.
+statnames = [ "retransmits", "fast_retransmits", "rto_expires", "srtt_usec",
+              "cwnd" ]
+results = []
+for loss in opts["losses"]:
+    r = run_one(o, loss, opts)
+    stats = ""
+    if r["stats"]:
+        stats = " ".join([ "%s=%d" % (i, r["stats"][i]) for i in statnames
+                           if i in r["stats"] ])
+    print("%6.1f %8.1f %10.1f %10.1f %8.2f %8d  %s" %
+          (loss, opts["delay"], r["received"] / 1000.0, r["KBps"],
+           r["seconds"], r["dropped"], stats))
+    results.append(r)
+
+if outfile:
+    with open(outfile, "w") as f:
+        json.dump({ "options": opts, "results": results }, f, indent = 2)
+        f.write("\n")
@@ -0,0 +1,692 @@
+/*
+ *  gensio - A library for abstracting stream I/O
+ *  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+ *
+ *  SPDX-License-Identifier: GPL-2.0-only
+ */
+
+/*
+ * Benchmarks for the selector.
+ *
+ * The "fds" benchmark creates a number of socket pairs, registers one
+ * end of each with the selector, then in each round writes a byte to
+ * the other end of every pair and runs the selector until every read
+ * handler has been called.  It reports the number of selector wakeups
+ * per delivered event and the time per event.  With epoll, each
+ * wakeup is one epoll_pwait() call and each delivered event is one
+ * read() plus one epoll_ctl() to rearm the fd.  With -e the fds are
+ * edge-triggered, so there is no rearm, but the handler has to read
+ * until it gets EAGAIN.  With -w the selector wakes threads with a
+ * wake fd (see sel_use_wake_fd()) instead of a signal, this shows
+ * what waiting on the wake fd too costs.  Run this under "strace -c"
+ * to see the full syscall breakdown.
+ *
+ * The "wake" benchmark measures waking a thread waiting in the
+ * selector from another thread, with a signal and with a wake fd (see
+ * sel_use_wake_fd()).  One thread sits in the selector and a foreign
+ * thread repeatedly either wakes a waiter the selector thread is
+ * waiting on or starts a runner, then waits on a semaphore the
+ * selector thread posts when it sees the wakeup.  It reports the
+ * round trip time and the number of wakeups per second.  With a
+ * signal, a runner does not wake the selector by itself, so the
+ * signal case does sel_wake_all() after starting it.
+ *
+ * The "timers" benchmark keeps a number of timers running with random
+ * timeouts of 1 to 10 seconds and restarts random ones, stopping them
+ * and starting them with a new timeout, running the selector after
+ * every 64 restarts.  This is what happens with lots of connections
+ * that restart a timer on every packet.  It reports the time per
+ * restart with the timer heap and with the timer wheel (see
+ * SEL_TIMER_WHEEL).  Then it starts every timer with a timeout
+ * of up to 50ms and runs the selector until they all go off, checking
+ * that none went off early and reporting how late the latest was.
+ */
+
+#include "config.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <sys/resource.h>
+#include <gensio/selector.h>
+#ifdef USE_PTHREADS
+#include <pthread.h>
+#include <semaphore.h>
+#include <signal.h>
+#include <gensio/waiter.h>
+#endif
+
+struct bench_conn {
+    int fd[2];
+};
+
+static unsigned long events;
+static int edge_triggered;
+static int use_wake_fd;
+
+static void
+usage(void)
+{
+    fprintf(stderr,
+	    "Usage: selbench [-b <batch>] [-e] [-w] [-r <rounds>] fds [<nconn> ...]\n"
+	    "       selbench [-r <rounds>] wake\n"
+	    "       selbench [-r <rounds>] timers [<ntimers> ...]\n"
+	    "  -b - Set the number of fd events handled per wakeup, by\n"
+	    "       default both 1 and %d are run.\n"
+	    "  -e - Use edge-triggered fds.\n"
+	    "  -w - Use a wake fd instead of a signal.\n"
+	    "  -r - Number of rounds to run, default 20 for fds and\n"
+	    "       timers (restarts per timer) and 100000 for wake.\n",
+	    SEL_DEFAULT_FD_EVENTS);
+    exit(1);
+}
+
+static double
+tv_diff_usec(struct timeval *start, struct timeval *end)
+{
+    return ((end->tv_sec - start->tv_sec) * 1000000.0 +
+	    (end->tv_usec - start->tv_usec));
+}
+
+static void
+conn_read(int fd, void *cb_data)
+{
+    char buf[16];
+
+    if (read(fd, buf, sizeof(buf)) <= 0)
+	return;
+    events++;
+    if (edge_triggered) {
+	/* Must read until empty. */
+	while (read(fd, buf, sizeof(buf)) > 0)
+	    ;
+    }
+}
+
+static int
+raise_fd_limit(unsigned int nfds)
+{
+    struct rlimit rl;
+
+    if (getrlimit(RLIMIT_NOFILE, &rl) == -1)
+	return errno;
+    if (rl.rlim_cur >= nfds)
+	return 0;
+    if (rl.rlim_max < nfds) {
+	fprintf(stderr, "Need %u file descriptors, hard limit is %lu\n",
+		nfds, (unsigned long) rl.rlim_max);
+	return EMFILE;
+    }
+    rl.rlim_cur = nfds;
+    if (setrlimit(RLIMIT_NOFILE, &rl) == -1)
+	return errno;
+    return 0;
+}
+
+static int
+bench_fds(unsigned int nconn, unsigned int batch, unsigned int rounds)
+{
+    struct selector_s *sel;
+    struct bench_conn *conns;
+    struct timeval start, end, tv;
+    unsigned long wakeups = 0, target;
+    unsigned int i, r;
+    double usecs;
+    int rv;
+
+    rv = raise_fd_limit(nconn * 2 + 64);
+    if (rv)
+	return rv;
+
+    rv = sel_alloc_selector_nothread(&sel);
+    if (rv) {
+	fprintf(stderr, "Unable to allocate selector: %s\n", strerror(rv));
+	return rv;
+    }
+    rv = sel_set_max_fd_events(sel, batch);
+    if (rv) {
+	fprintf(stderr, "Invalid batch size %u: %s\n", batch, strerror(rv));
+	goto out_free_sel;
+    }
+    if (use_wake_fd) {
+	rv = sel_use_wake_fd(sel);
+	if (rv) {
+	    fprintf(stderr, "Unable to set up wake fd: %s\n", strerror(rv));
+	    goto out_free_sel;
+	}
+    }
+    if (edge_triggered) {
+	rv = sel_set_edge_triggered(sel, 1);
+	if (rv) {
+	    fprintf(stderr, "Edge-triggered not supported: %s\n",
+		    strerror(rv));
+	    goto out_free_sel;
+	}
+    }
+
+    conns = calloc(nconn, sizeof(*conns));
+    if (!conns) {
+	rv = ENOMEM;
+	goto out_free_sel;
+    }
+    for (i = 0; i < nconn; i++)
+	conns[i].fd[0] = conns[i].fd[1] = -1;
+
+    for (i = 0; i < nconn; i++) {
+	if (socketpair(AF_UNIX, SOCK_STREAM, 0, conns[i].fd) == -1) {
+	    rv = errno;
+	    fprintf(stderr, "socketpair failed: %s\n", strerror(rv));
+	    goto out;
+	}
+	fcntl(conns[i].fd[0], F_SETFL, O_NONBLOCK);
+	rv = sel_set_fd_handlers(sel, conns[i].fd[0], &conns[i], conn_read,
+				 NULL, NULL, NULL);
+	if (rv) {
+	    fprintf(stderr, "Unable to register fd %d: %s\n",
+		    conns[i].fd[0], strerror(rv));
+	    goto out;
+	}
+	if (edge_triggered) {
+	    rv = sel_set_fd_edge_triggered(sel, conns[i].fd[0]);
+	    if (rv) {
+		fprintf(stderr, "Unable to set fd %d edge-triggered: %s\n",
+			conns[i].fd[0], strerror(rv));
+		goto out;
+	    }
+	}
+	sel_set_fd_read_handler(sel, conns[i].fd[0], SEL_FD_HANDLER_ENABLED);
+    }
+
+    events = 0;
+    gettimeofday(&start, NULL);
+    for (r = 0; r < rounds; r++) {
+	for (i = 0; i < nconn; i++) {
+	    if (write(conns[i].fd[1], "x", 1) != 1) {
+		rv = errno;
+		fprintf(stderr, "write failed: %s\n", strerror(rv));
+		goto out;
+	    }
+	}
+	target = (unsigned long) (r + 1) * nconn;
+	while (events < target) {
+	    tv.tv_sec = 5;
+	    tv.tv_usec = 0;
+	    rv = sel_select(sel, NULL, 0, NULL, &tv);
+	    if (rv < 0) {
+		rv = errno;
+		fprintf(stderr, "select failed: %s\n", strerror(rv));
+		goto out;
+	    }
+	    if (rv == 0) {
+		fprintf(stderr, "Timed out waiting for events\n");
+		rv = ETIMEDOUT;
+		goto out;
+	    }
+	    wakeups++;
+	}
+    }
+    gettimeofday(&end, NULL);
+    rv = 0;
+
+    usecs = tv_diff_usec(&start, &end);
+    printf("%8u %6u %10lu %10lu %12.4f %12.3f\n", nconn, batch, events,
+	   wakeups, (double) wakeups / events, usecs / events);
+
+ out:
+    for (i = 0; i < nconn; i++) {
+	if (conns[i].fd[0] != -1) {
+	    sel_clear_fd_handlers_norpt(sel, conns[i].fd[0]);
+	    close(conns[i].fd[0]);
+	}
+	if (conns[i].fd[1] != -1)
+	    close(conns[i].fd[1]);
+    }
+    free(conns);
+ out_free_sel:
+    sel_free_selector(sel);
+    return rv;
+}
+
+static int
+bench_fds_batches(unsigned int nconn, unsigned int batch, unsigned int rounds)
+{
+    int rv;
+
+    if (batch)
+	return bench_fds(nconn, batch, rounds);
+
+    rv = bench_fds(nconn, 1, rounds);
+    if (!rv)
+	rv = bench_fds(nconn, SEL_DEFAULT_FD_EVENTS, rounds);
+    return rv;
+}
+
+struct bench_timer {
+    sel_timer_t *timer;
+    struct timeval expires;
+};
+
+static unsigned long timers_fired;
+static unsigned long timers_early;
+static double timers_max_late;
+
+static void
+bench_timeout(struct selector_s *sel, sel_timer_t *timer, void *cb_data)
+{
+    struct bench_timer *t = cb_data;
+    struct timeval now;
+    double late;
+
+    sel_get_monotonic_time(&now);
+    late = tv_diff_usec(&t->expires, &now);
+    if (late < 0)
+	timers_early++;
+    else if (late > timers_max_late)
+	timers_max_late = late;
+    timers_fired++;
+}
+
+static void
+bench_timer_start(struct bench_timer *t, struct timeval *now,
+		  unsigned long max_msec)
+{
+    unsigned long msec = 1 + random() % max_msec;
+
+    t->expires.tv_sec = now->tv_sec + msec / 1000;
+    t->expires.tv_usec = now->tv_usec + (msec % 1000) * 1000;
+    if (t->expires.tv_usec >= 1000000) {
+	t->expires.tv_usec -= 1000000;
+	t->expires.tv_sec++;
+    }
+    sel_start_timer(t->timer, &t->expires);
+}
+
+static int
+bench_timers(unsigned int ntimers, int wheel, unsigned int rounds)
+{
+    struct selector_s *sel;
+    struct bench_timer *timers;
+    struct timeval start, end, now, tv;
+    unsigned long i, restarts = (unsigned long) ntimers * rounds;
+    double usecs;
+    int rv;
+
+    rv = sel_alloc_selector_flags(&sel, 0, NULL, NULL, NULL, NULL, NULL,
+				  wheel ? SEL_TIMER_WHEEL : 0);
+    if (rv) {
+	fprintf(stderr, "Unable to allocate selector: %s\n", strerror(rv));
+	return rv;
+    }
+
+    timers = calloc(ntimers, sizeof(*timers));
+    if (!timers) {
+	rv = ENOMEM;
+	goto out_free_sel;
+    }
+    for (i = 0; i < ntimers; i++) {
+	rv = sel_alloc_timer(sel, bench_timeout, &timers[i], &timers[i].timer);
+	if (rv) {
+	    fprintf(stderr, "Unable to allocate timer: %s\n", strerror(rv));
+	    goto out;
+	}
+    }
+
+    /* Use the same sequence for the heap and the wheel. */
+    srandom(1);
+    sel_get_monotonic_time(&now);
+    for (i = 0; i < ntimers; i++)
+	bench_timer_start(&timers[i], &now, 10000);
+
+    gettimeofday(&start, NULL);
+    for (i = 0; i < restarts; i++) {
+	struct bench_timer *t = &timers[random() % ntimers];
+
+	sel_stop_timer(t->timer);
+	bench_timer_start(t, &now, 10000);
+	if (i % 64 == 63) {
+	    tv.tv_sec = 0;
+	    tv.tv_usec = 0;
+	    sel_select(sel, NULL, 0, NULL, &tv);
+	    sel_get_monotonic_time(&now);
+	}
+    }
+    gettimeofday(&end, NULL);
+    usecs = tv_diff_usec(&start, &end);
+
+    /* Now let them all go off. */
+    timers_fired = 0;
+    timers_early = 0;
+    timers_max_late = 0;
+    sel_get_monotonic_time(&now);
+    for (i = 0; i < ntimers; i++) {
+	sel_stop_timer(timers[i].timer);
+	bench_timer_start(&timers[i], &now, 50);
+    }
+    while (timers_fired < ntimers) {
+	tv.tv_sec = 5;
+	tv.tv_usec = 0;
+	rv = sel_select(sel, NULL, 0, NULL, &tv);
+	if (rv < 0) {
+	    rv = errno;
+	    fprintf(stderr, "select failed: %s\n", strerror(rv));
+	    goto out;
+	}
+	if (rv == 0) {
+	    fprintf(stderr, "Timed out waiting for timers\n");
+	    rv = ETIMEDOUT;
+	    goto out;
+	}
+    }
+    rv = 0;
+    if (timers_early) {
+	fprintf(stderr, "%lu timers went off early\n", timers_early);
+	rv = EINVAL;
+    }
+
+    printf("%8u %6s %10lu %14.1f %10.3f\n", ntimers, wheel ? "wheel" : "heap",
+	   restarts, usecs * 1000 / restarts, timers_max_late / 1000);
+
+ out:
+    for (i = 0; i < ntimers; i++) {
+	if (timers[i].timer)
+	    sel_free_timer(timers[i].timer);
+    }
+    free(timers);
+ out_free_sel:
+    sel_free_selector(sel);
+    return rv;
+}
+
+static int
+bench_timers_both(unsigned int ntimers, unsigned int rounds)
+{
+    int rv;
+
+    rv = bench_timers(ntimers, 0, rounds);
+    if (!rv)
+	rv = bench_timers(ntimers, 1, rounds);
+    return rv;
+}
+
+#ifdef USE_PTHREADS
+struct sel_lock_s {
+    pthread_mutex_t lock;
+};
+
+static sel_lock_t *
+bench_lock_alloc(void *cb_data)
+{
+    sel_lock_t *l = malloc(sizeof(*l));
+
+    if (l)
+	pthread_mutex_init(&l->lock, NULL);
+    return l;
+}
+
+static void
+bench_lock_free(sel_lock_t *l)
+{
+    pthread_mutex_destroy(&l->lock);
+    free(l);
+}
+
+static void
+bench_lock(sel_lock_t *l)
+{
+    pthread_mutex_lock(&l->lock);
+}
+
+static void
+bench_unlock(sel_lock_t *l)
+{
+    pthread_mutex_unlock(&l->lock);
+}
+
+static void
+bench_sighandler(int sig)
+{
+    /* Nothing to do, the signal just wakes things up. */
+}
+
+enum wake_test { WAKE_WAITER, WAKE_RUNNER };
+
+struct wake_bench {
+    struct selector_s *sel;
+    int use_fd;
+    enum wake_test test;
+    waiter_t *waiter;
+    sel_runner_t *runner;
+    sem_t done;
+    volatile int stop;
+};
+
+static void
+wake_send_sig(long thread_id, void *cb_data)
+{
+    pthread_kill(*((pthread_t *) cb_data), SIGUSR1);
+}
+
+static void
+wake_runner(sel_runner_t *runner, void *cb_data)
+{
+    struct wake_bench *b = cb_data;
+
+    sem_post(&b->done);
+}
+
+static void
+wake_bench_wake(struct wake_bench *b)
+{
+    if (b->test == WAKE_WAITER) {
+	wake_waiter(b->waiter);
+    } else {
+	sel_run(b->runner, wake_runner, b);
+	if (!b->use_fd)
+	    sel_wake_all(b->sel);
+    }
+}
+
+static void *
+wake_sel_thread(void *cb_data)
+{
+    struct wake_bench *b = cb_data;
+    pthread_t self = pthread_self();
+
+    while (!b->stop) {
+	if (b->test == WAKE_WAITER) {
+	    wait_for_waiter(b->waiter, 1);
+	    sem_post(&b->done);
+	} else {
+	    sel_select(b->sel, wake_send_sig, (long) self, &self, NULL);
+	}
+    }
+    return NULL;
+}
+
+static int
+bench_wake(int use_fd, enum wake_test test, unsigned int rounds)
+{
+    struct wake_bench b;
+    struct timeval start, end;
+    pthread_t thread;
+    unsigned int i;
+    double usecs;
+    int rv;
+
+    memset(&b, 0, sizeof(b));
+    b.use_fd = use_fd;
+    b.test = test;
+    rv = sel_alloc_selector_thread(&b.sel, use_fd ? 0 : SIGUSR1,
+				   bench_lock_alloc, bench_lock_free,
+				   bench_lock, bench_unlock, NULL);
+    if (rv) {
+	fprintf(stderr, "Unable to allocate selector: %s\n", strerror(rv));
+	return rv;
+    }
+    if (use_fd) {
+	rv = sel_use_wake_fd(b.sel);
+	if (rv) {
+	    fprintf(stderr, "Unable to set up wake fd: %s\n", strerror(rv));
+	    goto out_free_sel;
+	}
+    }
+    b.waiter = alloc_waiter(b.sel, use_fd ? 0 : SIGUSR1);
+    if (!b.waiter) {
+	rv = ENOMEM;
+	goto out_free_sel;
+    }
+    rv = sel_alloc_runner(b.sel, &b.runner);
+    if (rv)
+	goto out_free_waiter;
+    sem_init(&b.done, 0, 0);
+
+    rv = pthread_create(&thread, NULL, wake_sel_thread, &b);
+    if (rv) {
+	fprintf(stderr, "Unable to create thread: %s\n", strerror(rv));
+	goto out_free_runner;
+    }
+
+    gettimeofday(&start, NULL);
+    for (i = 0; i < rounds; i++) {
+	wake_bench_wake(&b);
+	sem_wait(&b.done);
+    }
+    gettimeofday(&end, NULL);
+
+    b.stop = 1;
+    wake_bench_wake(&b);
+    pthread_join(thread, NULL);
+
+    usecs = tv_diff_usec(&start, &end);
+    printf("%8s %8s %10u %12.3f %12.0f\n", use_fd ? "fd" : "signal",
+	   test == WAKE_WAITER ? "waiter" : "runner", rounds,
+	   usecs / rounds, rounds / usecs * 1000000.0);
+
+ out_free_runner:
+    sem_destroy(&b.done);
+    sel_free_runner(b.runner);
+ out_free_waiter:
+    free_waiter(b.waiter);
+ out_free_sel:
+    sel_free_selector(b.sel);
+    return rv;
+}
+
+static int
+bench_wakes(unsigned int rounds)
+{
+    struct sigaction act;
+    int rv = 0;
+
+    memset(&act, 0, sizeof(act));
+    act.sa_handler = bench_sighandler;
+    sigemptyset(&act.sa_mask);
+    if (sigaction(SIGUSR1, &act, NULL) == -1) {
+	rv = errno;
+	fprintf(stderr, "Unable to set up signal: %s\n", strerror(rv));
+	return rv;
+    }
+
+    printf("%8s %8s %10s %12s %12s\n", "wake", "test", "rounds",
+	   "usec/wake", "wakes/sec");
+    rv |= bench_wake(0, WAKE_WAITER, rounds);
+    rv |= bench_wake(1, WAKE_WAITER, rounds);
+    rv |= bench_wake(0, WAKE_RUNNER, rounds);
+    rv |= bench_wake(1, WAKE_RUNNER, rounds);
+    return rv;
+}
+#else
+static int
+bench_wakes(unsigned int rounds)
+{
+    fprintf(stderr, "The wake benchmark requires threads\n");
+    return ENOTSUP;
+}
+#endif
+
+int
+main(int argc, char *argv[])
+{
+    static unsigned int default_conns[] = { 1000, 10000 };
+    unsigned int batch = 0, rounds = 0, nconn;
+    unsigned int i;
+    int rv = 0;
+    char *end;
+
+    for (i = 1; i < argc; i++) {
+	if (argv[i][0] != '-')
+	    break;
+	if (strcmp(argv[i], "-b") == 0) {
+	    if (++i >= argc)
+		usage();
+	    batch = strtoul(argv[i], &end, 0);
+	    if (*end || batch == 0)
+		usage();
+	} else if (strcmp(argv[i], "-e") == 0) {
+	    edge_triggered = 1;
+	} else if (strcmp(argv[i], "-w") == 0) {
+	    use_wake_fd = 1;
+	} else if (strcmp(argv[i], "-r") == 0) {
+	    if (++i >= argc)
+		usage();
+	    rounds = strtoul(argv[i], &end, 0);
+	    if (*end || rounds == 0)
+		usage();
+	} else {
+	    usage();
+	}
+    }
+
+    if (i >= argc)
+	usage();
+    if (strcmp(argv[i], "wake") == 0) {
+	if (i + 1 != argc)
+	    usage();
+	return !!bench_wakes(rounds ? rounds : 100000);
+    }
+    if (!rounds)
+	rounds = 20;
+    if (strcmp(argv[i], "timers") == 0) {
+	static unsigned int default_timers[] = { 1000, 10000, 100000 };
+
+	i++;
+	printf("%8s %6s %10s %14s %10s\n", "timers", "store", "restarts",
+	       "nsec/restart", "max late ms");
+	if (i == argc) {
+	    for (i = 0; i < sizeof(default_timers) / sizeof(default_timers[0]);
+		 i++)
+		rv |= bench_timers_both(default_timers[i], rounds);
+	} else {
+	    for (; i < argc; i++) {
+		nconn = strtoul(argv[i], &end, 0);
+		if (*end || nconn == 0)
+		    usage();
+		rv |= bench_timers_both(nconn, rounds);
+	    }
+	}
+	return !!rv;
+    }
+    if (strcmp(argv[i], "fds") != 0)
+	usage();
+    i++;
+
+    printf("%8s %6s %10s %10s %12s %12s\n", "conns", "batch", "events",
+	   "wakeups", "wakeups/evt", "usec/evt");
+    if (i == argc) {
+	for (i = 0; i < sizeof(default_conns) / sizeof(default_conns[0]); i++)
+	    rv |= bench_fds_batches(default_conns[i], batch, rounds);
+    } else {
+	for (; i < argc; i++) {
+	    nconn = strtoul(argv[i], &end, 0);
+	    if (*end || nconn == 0)
+		usage();
+	    rv |= bench_fds_batches(nconn, batch, rounds);
+	}
+    }
+
+    return !!rv;
+}
@@ -0,0 +1,280 @@
+/*
+ *  gensio - A library for abstracting stream I/O
+ *  Copyright (C) 2020  Corey Minyard <minyard@acm.org>
+ *
+ *  SPDX-License-Identifier: GPL-2.0-only
+ */
+
+/*
+ * Latency benchmark for small synchronous writes and reads.
+ *
+ * For each transport, this sets up a synchronous gensio pair (for
+ * "echo" both ends are the same gensio, for "tcp" it is a connection
+ * to a local accepter) and does a number of rounds of small messages.
+ * It reports the average time for a gensio_write_s() call by itself
+ * and the average time for a full round trip, where the message is
+ * written on one end, read on the other, written back, and read again.
+ * Everything runs in one thread, each sync call runs the event loop
+ * as it needs to.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/time.h>
+#include <gensio/gensio.h>
+
+static void
+usage(void)
+{
+    fprintf(stderr,
+	    "Usage: syncbench [-r <rounds>] [-s <size>] [echo|tcp ...]\n"
+	    "  -r - Number of messages to send, default 10000.\n"
+	    "  -s - Size of each message, default 64.\n"
+	    "With no transports given, both echo and tcp are run.\n");
+    exit(1);
+}
+
+static double
+tv_diff_usec(struct timeval *start, struct timeval *end)
+{
+    return ((end->tv_sec - start->tv_sec) * 1000000.0 +
+	    (end->tv_usec - start->tv_usec));
+}
+
+static void
+do_vlog(struct gensio_os_funcs *f, enum gensio_log_levels level,
+	const char *log, va_list args)
+{
+    fprintf(stderr, "gensio %s log: ", gensio_log_level_to_str(level));
+    vfprintf(stderr, log, args);
+    fprintf(stderr, "\n");
+}
+
+static int
+acc_event(struct gensio_accepter *accepter, void *user_data, int event,
+	  void *data)
+{
+    return GE_NOTSUP;
+}
+
+static int
+read_all(struct gensio *io, unsigned char *buf, gensiods len)
+{
+    gensiods pos = 0, count;
+    int rv;
+
+    while (pos < len) {
+	rv = gensio_read_s(io, &count, buf + pos, len - pos, NULL);
+	if (rv)
+	    return rv;
+	pos += count;
+    }
+    return 0;
+}
+
+static int
+write_all(struct gensio *io, unsigned char *buf, gensiods len)
+{
+    gensiods count;
+    int rv;
+
+    rv = gensio_write_s(io, &count, buf, len, NULL);
+    if (!rv && count != len)
+	rv = GE_TIMEDOUT;
+    return rv;
+}
+
+static int
+setup_tcp(struct gensio_os_funcs *o, struct gensio_accepter **racc,
+	  struct gensio **rio1, struct gensio **rio2)
+{
+    struct gensio_accepter *acc = NULL;
+    struct gensio *io1 = NULL, *io2 = NULL;
+    char port[16], str[64];
+    gensiods len = sizeof(port);
+    int rv;
+
+    rv = str_to_gensio_accepter("tcp,localhost,0", o, acc_event, NULL, &acc);
+    if (rv)
+	goto out_err;
+    rv = gensio_acc_set_sync(acc);
+    if (rv)
+	goto out_err;
+    rv = gensio_acc_startup(acc);
+    if (rv)
+	goto out_err;
+    strcpy(port, "0");
+    rv = gensio_acc_control(acc, GENSIO_CONTROL_DEPTH_FIRST, true,
+			    GENSIO_ACC_CONTROL_LPORT, port, &len);
+    if (rv)
+	goto out_err;
+    snprintf(str, sizeof(str), "tcp,localhost,%s", port);
+    rv = str_to_gensio(str, o, NULL, NULL, &io1);
+    if (rv)
+	goto out_err;
+    rv = gensio_open_s(io1);
+    if (rv)
+	goto out_err;
+    rv = gensio_acc_accept_s(acc, NULL, &io2);
+    if (rv)
+	goto out_err;
+    rv = gensio_set_sync(io2);
+    if (rv)
+	goto out_err;
+    *racc = acc;
+    *rio1 = io1;
+    *rio2 = io2;
+    return 0;
+
+ out_err:
+    fprintf(stderr, "Unable to set up tcp: %s\n", gensio_err_to_str(rv));
+    if (io2)
+	gensio_free(io2);
+    if (io1)
+	gensio_free(io1);
+    if (acc)
+	gensio_acc_free(acc);
+    return rv;
+}
+
+static int
+bench(struct gensio_os_funcs *o, const char *name, unsigned int rounds,
+      gensiods size)
+{
+    struct gensio_accepter *acc = NULL;
+    struct gensio *io1 = NULL, *io2;
+    struct timeval start, end;
+    unsigned char *wbuf, *rbuf;
+    double write_usecs = 0, rt_usecs;
+    unsigned int i;
+    int rv;
+
+    wbuf = malloc(size);
+    rbuf = malloc(size);
+    if (!wbuf || !rbuf) {
+	rv = GE_NOMEM;
+	goto out;
+    }
+    memset(wbuf, 'x', size);
+
+    if (strcmp(name, "echo") == 0) {
+	rv = str_to_gensio("echo", o, NULL, NULL, &io1);
+	if (rv) {
+	    fprintf(stderr, "Unable to allocate echo: %s\n",
+		    gensio_err_to_str(rv));
+	    goto out;
+	}
+	rv = gensio_open_s(io1);
+	if (rv) {
+	    fprintf(stderr, "Unable to open echo: %s\n",
+		    gensio_err_to_str(rv));
+	    goto out;
+	}
+	io2 = io1;
+    } else if (strcmp(name, "tcp") == 0) {
+	rv = setup_tcp(o, &acc, &io1, &io2);
+	if (rv)
+	    goto out;
+    } else {
+	usage();
+    }
+    rv = gensio_set_sync(io1);
+    if (rv)
+	goto out_err;
+
+    gettimeofday(&start, NULL);
+    for (i = 0; i < rounds; i++) {
+	struct timeval wstart, wend;
+
+	gettimeofday(&wstart, NULL);
+	rv = write_all(io1, wbuf, size);
+	gettimeofday(&wend, NULL);
+	if (rv)
+	    goto out_err;
+	write_usecs += tv_diff_usec(&wstart, &wend);
+	rv = read_all(io2, rbuf, size);
+	if (rv)
+	    goto out_err;
+	if (io2 != io1) {
+	    rv = write_all(io2, rbuf, size);
+	    if (rv)
+		goto out_err;
+	    rv = read_all(io1, rbuf, size);
+	    if (rv)
+		goto out_err;
+	}
+    }
+    gettimeofday(&end, NULL);
+    rt_usecs = tv_diff_usec(&start, &end);
+
+    printf("%6s %8u %6lu %14.2f %14.2f\n", name, rounds,
+	   (unsigned long) size, write_usecs / rounds, rt_usecs / rounds);
+
+ out_err:
+    if (rv)
+	fprintf(stderr, "%s failed: %s\n", name, gensio_err_to_str(rv));
+    gensio_close_s(io1);
+    gensio_free(io1);
+    if (acc) {
+	gensio_close_s(io2);
+	gensio_free(io2);
+	gensio_acc_shutdown_s(acc);
+	gensio_acc_free(acc);
+    }
+ out:
+    free(wbuf);
+    free(rbuf);
+    return rv;
+}
+
+int
+main(int argc, char *argv[])
+{
+    struct gensio_os_funcs *o;
+    unsigned int rounds = 10000;
+    gensiods size = 64;
+    unsigned int i;
+    int rv = 0;
+    char *end;
+
+    for (i = 1; i < argc; i++) {
+	if (argv[i][0] != '-')
+	    break;
+	if (strcmp(argv[i], "-r") == 0) {
+	    if (++i >= argc)
+		usage();
+	    rounds = strtoul(argv[i], &end, 0);
+	    if (*end || rounds == 0)
+		usage();
+	} else if (strcmp(argv[i], "-s") == 0) {
+	    if (++i >= argc)
+		usage();
+	    size = strtoul(argv[i], &end, 0);
+	    if (*end || size == 0)
+		usage();
+	} else {
+	    usage();
+	}
+    }
+
+    rv = gensio_default_os_hnd(0, &o);
+    if (rv) {
+	fprintf(stderr, "Could not allocate OS handler: %s\n",
+		gensio_err_to_str(rv));
+	return 1;
+    }
+    o->vlog = do_vlog;
+
+    printf("%6s %8s %6s %14s %14s\n", "gensio", "rounds", "size",
+	   "usec/write_s", "usec/roundtrip");
+    if (i == argc) {
+	rv |= bench(o, "echo", rounds, size);
+	rv |= bench(o, "tcp", rounds, size);
+    } else {
+	for (; i < argc; i++)
+	    rv |= bench(o, argv[i], rounds, size);
+    }
+
+    return !!rv;
+}
@@ -9,6 +9,10 @@ import utils
 import gensio
 import sys
 import os
+import threading
+import gc
+import shutil
+import time
 from serialsim import *
 
 class Logger:
@@ -17,6 +21,7 @@ class Logger:
 
 gensio.gensio_set_log_mask(gensio.GENSIO_LOG_MASK_ALL)
 o = gensio.alloc_gensio_selector(Logger());
+oet = gensio.alloc_gensio_selector(Logger(), True)
 
 def check_raddr(io, testname, expected):
     r = io.raddr()
@@ -185,6 +190,101 @@ def ta_ssl_tcp():
         i = i + 1
     ta.close()
 
+class MultiAccept:
+    def __init__(self, o, iostr):
+        self.o = o
+        self.name = iostr
+        self.io2 = None
+        self.waiter = gensio.waiter(o)
+        self.acc = gensio.gensio_accepter(o, iostr, self);
+        self.acc.startup()
+
+    def connect(self, iostr, tester):
+        io1 = utils.alloc_io(self.o, iostr, do_open = False)
+        io1.open_s()
+        self.waiter.wait(1)
+        tester(io1, self.io2)
+        io1.read_cb_enable(False)
+        self.io2.read_cb_enable(False)
+        utils.io_close(io1)
+        utils.io_close(self.io2)
+        self.io2 = None
+
+    def close(self):
+        self.acc.shutdown_s()
+        del self.acc
+
+    def new_connection(self, acc, io):
+        utils.HandleData(self.o, None, io = io, name = self.name)
+        self.io2 = io
+        self.waiter.wake()
+
+    def accepter_log(self, acc, level, logstr):
+        print("***%s LOG: %s: %s" % (level, self.name, logstr))
+
+def ta_ssl_tcp_reload():
+    print("Test ssl-tcp accepter certificate reload")
+    ta = MultiAccept(o, "ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" %
+                     (utils.keydir, utils.keydir))
+    iostr = "ssl(CA=%s/CA.pem),tcp,localhost,3023" % utils.keydir
+    ta.connect(iostr, do_test)
+    ta.connect(iostr, do_test)
+    ta.acc.control(0, False, gensio.GENSIO_ACC_CONTROL_RELOAD_CERTS, None)
+    ta.connect(iostr, do_test)
+    try:
+        ta.acc.control(gensio.GENSIO_CONTROL_DEPTH_FIRST, True,
+                       gensio.GENSIO_ACC_CONTROL_RELOAD_CERTS, "")
+        raise Exception("Get of reload certs did not fail")
+    except Exception as E:
+        if str(E) != "gensio:control: Operation not supported":
+            raise
+    ta.close()
+
+def check_resumed(io1, io2, expected):
+    do_test(io1, io2)
+    for io in (io1, io2):
+        r = io.control(0, True, gensio.GENSIO_CONTROL_SESSION_RESUMED, None)
+        if r != expected:
+            raise Exception("Session resumed was %s, expected %s" %
+                            (r, expected))
+
+def ta_ssl_tcp_resume():
+    print("Test ssl-tcp session resumption")
+    ta = MultiAccept(o, "ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" %
+                     (utils.keydir, utils.keydir))
+    iostr = "ssl(CA=%s/CA.pem),tcp,localhost,3023" % utils.keydir
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "0"))
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "1"))
+    # A new context cannot resume the old sessions.
+    ta.acc.control(0, False, gensio.GENSIO_ACC_CONTROL_RELOAD_CERTS, None)
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "0"))
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "1"))
+    noresume = "ssl(CA=%s/CA.pem,session-cache=false),tcp,localhost,3023"
+    ta.connect(noresume % utils.keydir,
+               lambda io1, io2: check_resumed(io1, io2, "0"))
+    ta.close()
+
+def ta_ssl_tcp_resume_os_funcs():
+    print("Test ssl-tcp session cache after its os funcs is freed")
+    # The session cache is process wide, it must not depend on the os
+    # funcs that first saved a session in it.
+    o2 = gensio.alloc_gensio_selector(Logger())
+    ta = MultiAccept(o2, "ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" %
+                     (utils.keydir, utils.keydir))
+    iostr = "ssl(CA=%s/CA.pem),tcp,localhost,3023" % utils.keydir
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "0"))
+    ta.close()
+    del ta
+    del o2
+    gc.collect()
+    ta = MultiAccept(o, "ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" %
+                     (utils.keydir, utils.keydir))
+    # A new accepter has a new context, so this finds the old session
+    # but cannot resume it.
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "0"))
+    ta.connect(iostr, lambda io1, io2: check_resumed(io1, io2, "1"))
+    ta.close()
+
 def ta_certauth_tcp():
     print("Test accept certauth-ssl-tcp")
     io1 = utils.alloc_io(o, "certauth(cert=%s/clientcert.pem,key=%s/clientkey.pem,username=testuser,service=myservice),ssl(CA=%s/CA.pem),tcp,localhost,3023" % (utils.keydir, utils.keydir, utils.keydir), do_open = False)
@@ -211,6 +311,104 @@ def ta_certauth_tcp():
             "Invalid service, expected %s, got %s" % ("myservice", service))
     ta.close()
 
+def same_size_certs(file1, file2):
+    """Read two certificates and pad them to the same size"""
+    with open(file1) as f:
+        cert1 = f.read()
+    with open(file2) as f:
+        cert2 = f.read()
+    size = max(len(cert1), len(cert2))
+    return (cert1 + "\n" * (size - len(cert1)),
+            cert2 + "\n" * (size - len(cert2)))
+
+def ta_certauth_tcp_ca_change():
+    print("Test certauth-ssl-tcp accepter CA file change")
+    cafile = os.path.join(utils.keydir, "certauth_cache_CA.pem")
+    # The same size, so only the times show the change.  The changes
+    # are likely in the same second, too.
+    (clientcert, cert) = same_size_certs(
+        os.path.join(utils.keydir, "clientcert.pem"),
+        os.path.join(utils.keydir, "cert.pem"))
+    with open(cafile, "w") as f:
+        f.write(clientcert)
+    ta = MultiAccept(o, "certauth(CA=%s),ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" % (cafile, utils.keydir, utils.keydir))
+    iostr = "certauth(cert=%s/clientcert.pem,key=%s/clientkey.pem,username=testuser),ssl(CA=%s/CA.pem),tcp,localhost,3023" % (utils.keydir, utils.keydir, utils.keydir)
+    try:
+        ta.connect(iostr, do_test)
+        ta.connect(iostr, do_test)
+
+        # The client cert is no longer trusted, this must be noticed.
+        with open(cafile, "w") as f:
+            f.write(cert)
+        goterr = False
+        try:
+            ta.connect(iostr, do_test)
+        except Exception as E:
+            print("  Success checking changed CA: " + str(E))
+            goterr = True
+        if not goterr:
+            raise Exception("Connect succeeded with a CA that was changed")
+
+        with open(cafile, "w") as f:
+            f.write(clientcert)
+        ta.connect(iostr, do_test)
+    finally:
+        os.remove(cafile)
+        ta.close()
+
+def ta_certauth_tcp_cadir_change():
+    print("Test certauth-ssl-tcp accepter CA directory change")
+    cadir = os.path.join(utils.keydir, "certauth_cache_CAdir")
+    shutil.copytree(os.path.join(utils.keydir, "clientCAdir"), cadir)
+    cafile = os.path.join(cadir, os.listdir(cadir)[0])
+    (clientcert, cert) = same_size_certs(
+        cafile, os.path.join(utils.keydir, "cert.pem"))
+    with open(cafile, "w") as f:
+        f.write(clientcert)
+    ta = MultiAccept(o, "certauth(CA=%s/),ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" % (cadir, utils.keydir, utils.keydir))
+    iostr = "certauth(cert=%s/clientcert.pem,key=%s/clientkey.pem,username=testuser),ssl(CA=%s/CA.pem),tcp,localhost,3023" % (utils.keydir, utils.keydir, utils.keydir)
+    try:
+        ta.connect(iostr, do_test)
+
+        ta.connect(iostr, do_test)
+
+        # Rewriting the file in place doesn't change the directory,
+        # it still must be noticed.
+        with open(cafile, "w") as f:
+            f.write(cert)
+        goterr = False
+        try:
+            ta.connect(iostr, do_test)
+        except Exception as E:
+            print("  Success checking changed CA: " + str(E))
+            goterr = True
+        if not goterr:
+            raise Exception("Connect succeeded with a CA that was changed")
+
+        with open(cafile, "w") as f:
+            f.write(clientcert)
+        ta.connect(iostr, do_test)
+    finally:
+        shutil.rmtree(cadir)
+        ta.close()
+
+def ta_certauth_tcp_os_funcs():
+    print("Test certauth-ssl-tcp cache after its os funcs is freed")
+    # The certauth cache is process wide, it must not depend on the os
+    # funcs that first loaded something into it.
+    accstr = "certauth(CA=%s/clientcert.pem),ssl(key=%s/key.pem,cert=%s/cert.pem),tcp,3023" % (utils.keydir, utils.keydir, utils.keydir)
+    iostr = "certauth(cert=%s/clientcert.pem,key=%s/clientkey.pem,username=testuser),ssl(CA=%s/CA.pem),tcp,localhost,3023" % (utils.keydir, utils.keydir, utils.keydir)
+    o2 = gensio.alloc_gensio_selector(Logger())
+    ta = MultiAccept(o2, accstr)
+    ta.connect(iostr, do_test)
+    ta.close()
+    del ta
+    del o2
+    gc.collect()
+    ta = MultiAccept(o, accstr)
+    ta.connect(iostr, do_test)
+    ta.close()
+
 def ta_mux_sctp():
     print("Test accept mux-tcp")
     io1 = utils.alloc_io(o, "mux(service=myservice),sctp,localhost,3023",
@@ -494,6 +692,47 @@ def do_large_test(io1, io2):
     utils.test_dataxfer_simul(io1, io2, rb, timeout=30000)
     print("  Success!")
 
+def do_crc_stream_test(io1, io2):
+    # An odd size so the pattern doesn't line up with the reads.
+    pattern = os.urandom(65521)
+    size = 64 * 1024 * 1024
+    io1.handler.chunksize = 65536
+    io2.handler.chunksize = 65536
+    print("  testing %d bytes io1 to io2" % size)
+    utils.test_dataxfer_crc(io1, io2, pattern, size, timeout=60000)
+    print("  testing %d bytes io2 to io1" % size)
+    utils.test_dataxfer_crc(io2, io1, pattern, size, timeout=60000)
+    print("  Success!")
+
+def do_write_sg_test(io1, io2):
+    import array
+    hdr = b"\x01\x02hdr"
+    payload = os.urandom(1000)
+    ints = array.array("B", range(0, 100))
+    bufs = [ hdr, memoryview(payload), bytearray(b"mid"), ints, b"" ]
+    data = hdr + payload + b"mid" + ints.tobytes()
+    io2.handler.set_compare(data)
+    # This is small enough to always be written in one go.
+    count = io1.write_sg(bufs, None)
+    if count != len(data):
+        raise Exception("write_sg: Wrote %d bytes, expected %d" %
+                        (count, len(data)))
+    try:
+        io1.write_sg([ hdr, 1 ], None)
+    except TypeError:
+        pass
+    else:
+        raise Exception("write_sg: Non-buffer item was accepted")
+    if io2.handler.wait_timeout(2000) == 0:
+        raise Exception("write_sg: Timed out waiting for read at byte %d" %
+                        io2.handler.compared)
+    print("  Success!")
+
+def test_tcp_write_sg():
+    print("Test tcp write_sg and buffer writes")
+    io1 = utils.alloc_io(o, "tcp,localhost,3023", do_open = False)
+    ta = TestAccept(o, io1, "tcp,3023", do_write_sg_test)
+
 def test_tcp_small():
     print("Test tcp small")
     io1 = utils.alloc_io(o, "tcp,localhost,3023", do_open = False,
@@ -532,6 +771,424 @@ def test_mux_tcp_large():
                          chunksize = 64)
     ta = TestAccept(o, io1, "mux,tcp,3023", do_large_test)
 
+def test_mux_tcp_nobatch():
+    print("Test mux tcp large without write batching")
+    io1 = utils.alloc_io(o, "mux(writebatch=0),tcp,localhost,3023",
+                         do_open = False, chunksize = 64)
+    ta = TestAccept(o, io1, "mux(writebatch=0),tcp,3023", do_large_test)
+
+def test_tcp_edge_triggered():
+    print("Test tcp edge-triggered")
+    io1 = utils.alloc_io(oet, "tcp,localhost,3023", do_open = False,
+                         chunksize = 64)
+    ta = TestAccept(oet, io1, "tcp,3023", do_large_test)
+
+def test_tcp_crc_stream():
+    print("Test tcp large stream with CRC check")
+    io1 = utils.alloc_io(o, "tcp,localhost,3023", do_open = False)
+    ta = TestAccept(o, io1, "tcp,3023", do_crc_stream_test)
+
+def check_stats(name, stats, expected):
+    for i in expected:
+        if stats[i] < expected[i]:
+            raise Exception("%s: stat %s was %d, expected at least %d" %
+                            (name, i, stats[i], expected[i]))
+
+class ToggleReader:
+    """Disable and enable reads in the read callback"""
+    def __init__(self):
+        self.waiter = gensio.waiter(o)
+
+    def read_callback(self, io, err, data, auxdata):
+        io.read_cb_enable(False)
+        io.read_cb_enable(True)
+        self.waiter.wake()
+        return len(data)
+
+    def write_callback(self, io):
+        return
+
+def test_mux_tcp_stats():
+    print("Test mux tcp statistics")
+    io1 = utils.alloc_io(o, "mux,tcp,localhost,3023", do_open = False)
+    ta = TestAccept(o, io1, "mux,tcp,3023", do_small_test, do_close = False)
+    datalen = len("Hello There")
+    s = gensio.gensio_stats(ta.io1)
+    check_stats("mux", s, { "writes": 1, "write_bytes": datalen,
+                            "read_callbacks": 1, "read_bytes": datalen,
+                            "opens": 1 })
+    if s["write_errs"] != 0 or s["read_errs"] != 0:
+        raise Exception("Unexpected errors in stats: %s" % str(s))
+    s = gensio.gensio_stats(ta.io1, 1)
+    # The tcp layer carries the mux headers, so it has more.
+    check_stats("tcp", s, { "write_bytes": datalen + 1,
+                            "read_bytes": datalen + 1, "opens": 1 })
+    s = gensio.gensio_acc_stats(ta.acc)
+    check_stats("accepter", s, { "accepts": 1 })
+    s = gensio.gensio_acc_stats(ta.acc, 1)
+    check_stats("tcp accepter", s, { "accepts": 1 })
+
+    gensio.gensio_stats_reset(ta.io1)
+    gensio.gensio_acc_stats_reset(ta.acc)
+    for depth in (0, 1):
+        s = gensio.gensio_stats(ta.io1, depth)
+        if s["read_bytes"] != 0 or s["write_bytes"] != 0 or s["opens"] != 0:
+            raise Exception("Stats not reset: %s" % str(s))
+    if gensio.gensio_acc_stats(ta.acc)["accepts"] != 0:
+        raise Exception("Accepter stats not reset")
+
+    # The stall time in progress keeps growing, so the length of the
+    # statistics can change while they are fetched.
+    ta.io1.read_cb_enable(True)
+    ta.io1.read_cb_enable(False)
+    end = time.time() + 0.2
+    while time.time() < end:
+        s = gensio.gensio_stats(ta.io1)
+    if s["read_stalls"] != 1 or s["read_stall_usec"] < 100000:
+        raise Exception("Bad read stall stats: %s" % str(s))
+
+    # Turning reads off and on in the read callback isn't a stall.
+    gensio.gensio_stats_reset(ta.io1)
+    tr = ToggleReader()
+    ta.io1.set_cbs(tr)
+    ta.io1.read_cb_enable(True)
+    ta.io2.write("Hello", None)
+    if tr.waiter.wait_timeout(1, 1000) == 0:
+        raise Exception("Timed out waiting for toggle read")
+    s = gensio.gensio_stats(ta.io1)
+    if s["read_callbacks"] != 1 or s["read_stalls"] != 0:
+        raise Exception("Bad toggle read stall stats: %s" % str(s))
+    ta.io1.set_cbs(ta.io1.handler)
+    ta.close()
+    print("  Success!")
+
+def test_mux_tcp_priority():
+    print("Test mux tcp channel priority and weight")
+    io1 = utils.alloc_io(o, "mux(priority=2,weight=3),tcp,localhost,3023",
+                         do_open = False)
+    ta = TestAccept(o, io1, "mux,tcp,3023", do_small_test, do_close = False)
+    for (op, v) in ((gensio.GENSIO_CONTROL_PRIORITY, "2"),
+                    (gensio.GENSIO_CONTROL_WEIGHT, "3")):
+        s = ta.io1.control(0, True, op, None)
+        if s != v:
+            raise Exception("Control %d was %s, expected %s" % (op, s, v))
+    # Change the priority while the channel has data to send.  io2
+    # doesn't read, so the data backs up in io1's channel.
+    data = os.urandom(100000)
+    ta.io1.handler.set_write_data(data)
+    ta.io2.handler.set_compare(data, start_reader = False)
+    if ta.io1.handler.wait_timeout(100) != 0:
+        raise Exception("All the data was sent with the reader stopped")
+    ta.io1.control(0, False, gensio.GENSIO_CONTROL_PRIORITY, "7")
+    ta.io1.control(0, False, gensio.GENSIO_CONTROL_WEIGHT, "10")
+    ta.io2.read_cb_enable(True)
+    if ta.io1.handler.wait_timeout(2000) == 0:
+        raise Exception("Timed out writing after the priority change")
+    if ta.io2.handler.wait_timeout(2000) == 0:
+        raise Exception("Timed out reading after the priority change")
+    utils.test_dataxfer(ta.io1, ta.io2, "This is a test string!")
+    utils.test_dataxfer(ta.io2, ta.io1, "This is a test string!")
+    if ta.io1.control(0, True, gensio.GENSIO_CONTROL_PRIORITY, None) != "7":
+        raise Exception("Priority was not changed")
+    for (op, v) in ((gensio.GENSIO_CONTROL_PRIORITY, "8"),
+                    (gensio.GENSIO_CONTROL_WEIGHT, "0")):
+        try:
+            ta.io1.control(0, False, op, v)
+        except Exception as E:
+            if str(E) != "gensio:control: Invalid data to parameter":
+                raise
+        else:
+            raise Exception("Invalid value %s for control %d accepted" %
+                            (v, op))
+    ta.close()
+    print("  Success!")
+
+def test_relpkt_udp_stats():
+    print("Test relpkt udp statistics")
+    io1 = utils.alloc_io(o, "relpkt,udp,localhost,3023", do_open = False)
+    ta = TestAccept(o, io1, "relpkt,udp,localhost,3023", do_small_test,
+                    do_close = False)
+    s = gensio.gensio_stats(ta.io1)
+    # relpkt appends its own statistics to the generic ones.
+    check_stats("relpkt", s, { "writes": 1, "cwnd": 1, "rto_usec": 1 })
+    if "retransmits" not in s or "fast_retransmits" not in s:
+        raise Exception("relpkt stats missing: %s" % str(s))
+    gensio.gensio_stats_reset(ta.io1)
+    s = gensio.gensio_stats(ta.io1)
+    if s["writes"] != 0 or s["retransmits"] != 0:
+        raise Exception("Stats not reset: %s" % str(s))
+    ta.close()
+    print("  Success!")
+
+def test_relpkt_udp_version():
+    print("Test relpkt udp protocol versions")
+    # A version 0 end must still work with a version 1 end.
+    io1 = utils.alloc_io(o, "relpkt(version=0),udp,localhost,3023",
+                         do_open = False)
+    TestAccept(o, io1, "relpkt,udp,localhost,3023", do_medium_test)
+    # A window larger than version 0 can handle.
+    io1 = utils.alloc_io(o, "relpkt(max_packets=512),udp,localhost,3023",
+                         do_open = False)
+    TestAccept(o, io1, "relpkt(max_packets=512),udp,localhost,3023",
+               do_medium_test)
+    print("  Success!")
+
+def test_relpkt_udp_timer_wheel():
+    print("Test relpkt udp with a timer wheel")
+    # relpkt runs timers for acks and retransmits all the time.
+    owh = gensio.alloc_gensio_selector(Logger(), False, True)
+    io1 = utils.alloc_io(owh, "relpkt,udp,localhost,3023", do_open = False)
+    ta = TestAccept(owh, io1, "relpkt,udp,localhost,3023", do_medium_test)
+    # Nothing else runs owh, let the udp socket finish closing.
+    del ta
+    del io1
+    gensio.waiter(owh).wait_timeout(1, 100)
+    print("  Success!")
+
+class KeepReadData:
+    def __init__(self, o):
+        self.waiter = gensio.waiter(o)
+        self.kept = []
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            raise Exception("memoryview read: " + err)
+        # Keep the view and things made from it in different ways.
+        self.kept.append((bytes(data), data, data[1:], memoryview(data),
+                          memoryview(data.obj)))
+        io.read_cb_enable(False)
+        self.waiter.wake()
+        return len(data)
+
+def do_memoryview_test(io1, io2):
+    io1.set_read_memoryview(True)
+    io2.set_read_memoryview(True)
+    do_large_test(io1, io2)
+
+    # Make sure kept data is not changed by later reads.
+    h = KeepReadData(o)
+    io2.set_cbs(h)
+    for s in (b"abc", b"def"):
+        io2.read_cb_enable(True)
+        io1.write(s, None)
+        if h.waiter.wait_timeout(1, 1000) == 0:
+            raise Exception("memoryview: Timed out waiting for read")
+    io2.set_cbs(io2.handler)
+    for (s, k) in zip((b"abc", b"def"), h.kept):
+        if k[0] != s:
+            raise Exception("memoryview: got %s, expected %s" %
+                            (str(k[0]), str(s)))
+        if not isinstance(k[1], memoryview):
+            raise Exception("memoryview: read data was a %s" % type(k[1]))
+        for (v, e) in zip(k[1:], (s, s[1:], s, s)):
+            if bytes(v) != e:
+                raise Exception("memoryview: kept %s, expected %s" %
+                                (str(bytes(v)), str(e)))
+
+def test_tcp_memoryview():
+    print("Test tcp memoryview reads")
+    io1 = utils.alloc_io(o, "tcp,localhost,3023", do_open = False)
+    ta = TestAccept(o, io1, "tcp,3023", do_memoryview_test)
+
+class IoReuseHandler:
+    def __init__(self, o):
+        self.waiter = gensio.waiter(o)
+        self.ios = []
+        self.err = None
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            self.err = err
+            io.read_cb_enable(False)
+            self.waiter.wake()
+            return 0
+        self.ios.append(id(io))
+        self.waiter.wake()
+        return len(data)
+
+def do_io_reuse_test(io1, io2):
+    h = IoReuseHandler(o)
+    io2.set_cbs(h)
+    io2.read_cb_enable(True)
+    for i in range(0, 5):
+        io1.write(b"x", None)
+        if h.waiter.wait_timeout(1, 1000) == 0:
+            raise Exception("io reuse: Timed out waiting for read")
+    io2.read_cb_enable(False)
+    io2.set_cbs(io2.handler)
+    if len(h.ios) != 5 or len(set(h.ios)) != 1:
+        raise Exception("io reuse: callbacks got %d objects for %d reads" %
+                        (len(set(h.ios)), len(h.ios)))
+
+def test_tcp_io_reuse():
+    print("Test tcp io object reuse in callbacks")
+    io1 = utils.alloc_io(o, "tcp,localhost,3023", do_open = False)
+    ta = TestAccept(o, io1, "tcp,3023", do_io_reuse_test, do_close = False)
+
+    # Dropping all references to io2 must still free (and close) it,
+    # even though an object for it is cached for the callbacks.
+    h = IoReuseHandler(o)
+    io1.set_cbs(h)
+    io1.read_cb_enable(True)
+    io2 = ta.io2
+    ta.io2 = None
+    del io2.handler.io
+    del io2.handler
+    del io2
+    if h.waiter.wait_timeout(1, 1000) == 0:
+        raise Exception("io reuse: io2 was not freed")
+    io1.set_cbs(io1.handler)
+    ta.close()
+    print("  Success!")
+
+class AioReader:
+    """Complete a future when a given amount of data has been read"""
+    def __init__(self, fut, size):
+        self.fut = fut
+        self.size = size
+        self.data = b""
+
+    def read_callback(self, io, err, data, auxdata):
+        if err:
+            self.fut.set_exception(Exception("aio read: " + err))
+            return 0
+        self.data += data
+        if len(self.data) >= self.size:
+            io.read_cb_enable(False)
+            self.fut.set_result(self.data)
+        return len(data)
+
+    def write_callback(self, io):
+        return
+
+def test_tcp_asyncio():
+    import asyncio
+    print("Test tcp with the asyncio os funcs")
+
+    async def aio_test():
+        ao = gensio.alloc_gensio_asyncio(None, Logger())
+        acc = gensio.gensio_accepter(ao, "tcp,localhost,3023", None)
+        acc.startup()
+        io1 = gensio.gensio(ao, "tcp,localhost,3023", None)
+        accf = gensio.aio_accept(acc)
+        await gensio.aio_open(io1)
+        io2 = await asyncio.wait_for(accf, 5)
+
+        # Enough data that the write has to wait for the other end.
+        # The str is multi-byte UTF-8, so partial writes must be
+        # counted in bytes.
+        for data in (os.urandom(1024 * 1024), "\u00e9\u20ac" * 200000):
+            if isinstance(data, str):
+                edata = data.encode()
+            else:
+                edata = data
+            readf = asyncio.get_running_loop().create_future()
+            io2.set_cbs(AioReader(readf, len(edata)))
+            io2.read_cb_enable(True)
+            count = await asyncio.wait_for(gensio.aio_write(io1, data), 5)
+            rdata = await asyncio.wait_for(readf, 5)
+            if count != len(edata) or rdata != edata:
+                raise Exception("asyncio: Data mismatch, wrote %d, read %d" %
+                                (count, len(rdata)))
+
+        await gensio.aio_close(io1)
+        await gensio.aio_close(io2)
+        return (ao, acc)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    (ao, acc) = loop.run_until_complete(aio_test())
+    # Blocking calls work while the loop is not running.
+    acc.shutdown_s()
+    del acc, ao
+    asyncio.set_event_loop(None)
+    loop.close()
+    print("  Success!")
+
+class ShardThread:
+    """An os funcs with its own thread servicing it"""
+    def __init__(self):
+        self.o = gensio.alloc_gensio_selector(Logger())
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.start()
+
+    def run(self):
+        w = gensio.waiter(self.o)
+        while self.running:
+            w.wait_timeout(1, 100)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+class ShardAccept(TestAccept):
+    def new_connection(self, acc, io):
+        self.thread_name = threading.current_thread().name
+        TestAccept.new_connection(self, acc, io)
+
+def test_tcp_shards():
+    print("Test tcp accepter shards")
+    oacc = gensio.alloc_gensio_selector(Logger())
+    shards = [ ShardThread(), ShardThread() ]
+    for s in shards:
+        oacc.add_shard(s.o)
+    names = []
+    for i in range(0, 4):
+        io1 = utils.alloc_io(oacc, "tcp,localhost,3023", do_open = False,
+                             chunksize = 64)
+        ta = ShardAccept(oacc, io1, "tcp,3023", do_small_test)
+        names.append(ta.thread_name)
+    for s in shards:
+        s.stop()
+    expected = [ s.thread.name for s in shards ] * 2
+    if names != expected:
+        raise Exception("Connections were on threads %s, expected %s" %
+                        (str(names), str(expected)))
+
+class WakeBusy:
+    """Wake the waiter for the thread running the read callback, then
+    stay busy in the callback and measure the CPU time used."""
+    def __init__(self, waiters):
+        self.waiters = waiters
+        self.cpu = None
+
+    def read_callback(self, io, err, data, auxdata):
+        if self.cpu is None:
+            self.waiters[threading.current_thread().name].wake()
+            t = time.process_time()
+            time.sleep(0.5)
+            self.cpu = time.process_time() - t
+        return len(data)
+
+    def write_callback(self, io):
+        io.write_cb_enable(False)
+
+def test_wake_busy_thread():
+    print("Test waking a thread busy in a callback")
+    # A wake for a thread that is busy must not make the other threads
+    # waiting in the selector spin until the busy one gets to it.
+    o2 = gensio.alloc_gensio_selector(Logger())
+    waiters = { "wake1": gensio.waiter(o2), "wake2": gensio.waiter(o2) }
+    h = WakeBusy(waiters)
+    io = gensio.gensio(o2, "echo", h)
+    io.open_s()
+    threads = []
+    for name in waiters:
+        t = threading.Thread(target = waiters[name].wait_timeout,
+                             args = (1, 1500), name = name)
+        t.start()
+        threads.append(t)
+    time.sleep(0.1)
+    io.write(b"x", None)
+    io.read_cb_enable(True)
+    for t in threads:
+        t.join()
+    io.close_s()
+    if h.cpu is None or h.cpu > 0.25:
+        raise Exception("Used %s seconds of CPU waiting" % str(h.cpu))
+    print("  Success!")
+
 def do_stream_test(io1, io2):
     rb = os.urandom(10)
     print("  testing io1 to io2")
@@ -713,6 +1370,11 @@ def test_udp_acc_connect():
     TestAcceptConnect(o, "udp,3023", "udp,3024", "udp,localhost,3023",
                       do_small_test, io1_dummy_write = "A")
 
+def test_udp_edge_triggered():
+    print("Test udp edge-triggered")
+    TestAcceptConnect(oet, "udp,3023", "udp,3024", "udp,localhost,3023",
+                      do_small_test, io1_dummy_write = "A")
+
 def test_sctp_acc_connect():
     print("Test sctp accepter connect")
     TestAcceptConnect(o, "sctp,3023", "sctp,3024", "sctp,localhost,3023",
@@ -1137,10 +1799,29 @@ ta_tcp()
 ta_udp()
 ta_telnet()
 ta_ssl_tcp()
+ta_ssl_tcp_reload()
+ta_ssl_tcp_resume()
+ta_ssl_tcp_resume_os_funcs()
 ta_certauth_tcp()
+ta_certauth_tcp_ca_change()
+ta_certauth_tcp_cadir_change()
+ta_certauth_tcp_os_funcs()
 ta_sctp()
 test_tcp_small()
 test_tcp_urgent()
+test_tcp_edge_triggered()
+test_tcp_crc_stream()
+test_mux_tcp_stats()
+test_mux_tcp_priority()
+test_relpkt_udp_stats()
+test_relpkt_udp_version()
+test_relpkt_udp_timer_wheel()
+test_tcp_memoryview()
+test_tcp_io_reuse()
+test_tcp_asyncio()
+test_tcp_write_sg()
+test_tcp_shards()
+test_wake_busy_thread()
 test_telnet_small()
 test_sctp_small()
 test_sctp_streams()
@@ -1151,6 +1832,7 @@ test_modemstate()
 
 test_tcp_acc_connect()
 test_udp_acc_connect()
+test_udp_edge_triggered()
 test_sctp_acc_connect()
 test_telnet_sctp_acc_connect()
 test_ssl_sctp_acc_connect()
@@ -1164,6 +1846,7 @@ test_mux_limits()
 ta_mux_sctp()
 test_mux_sctp_small()
 test_mux_tcp_large()
+test_mux_tcp_nobatch()
 test_mux_oob()
 
 tc_relpkt()
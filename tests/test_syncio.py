@@ -51,6 +51,255 @@ def test_sync_gensio(o):
     g.close_s()
     return
 
+def test_sync_read_into(o):
+    g = gensio.gensio(o, "echo(readbuf=10)", None)
+    g.set_sync()
+    g.open_s()
+
+    (count, time) = g.write_s("Hello", 1000)
+    if count != 5 or time < 500:
+        raise Exception("Invalid write return: %d %d\n" % (count, time))
+    buf = bytearray(10)
+    (count, time) = g.read_s_into(buf, 1000)
+    if count != 5 or buf[0:5] != b"Hello" or time < 500:
+        raise Exception("Invalid read_s_into return: '%s' %d %d\n" %
+                        (str(buf), count, time))
+
+    # Read into the part of the buffer after the data.
+    (count, time) = g.write_s("World", 1000)
+    (count, time) = g.read_s_into(memoryview(buf)[5:], 1000)
+    if count != 5 or buf != b"HelloWorld":
+        raise Exception("Invalid read_s_into return: '%s' %d\n" %
+                        (str(buf), count))
+
+    # This should time out, no data
+    (count, time) = g.read_s_into(buf, 250)
+    if count != 0 or time != 0:
+        raise Exception("Invalid read_s_into timeout return: %d %d\n" %
+                        (count, time))
+
+    try:
+        g.read_s_into(b"readonly", 250)
+    except BufferError:
+        pass
+    else:
+        raise Exception("read_s_into accepted a read-only buffer")
+
+    g.close_s()
+    return
+
+def test_sync_readahead(o):
+    g = gensio.gensio(o, "echo(readbuf=10)", None)
+    g.set_sync()
+    g.set_sync_readahead(8)
+    g.open_s()
+
+    # The first read waits, the rest of the data goes into the
+    # read-ahead buffer and is returned without waiting.
+    (count, time) = g.write_s("Hello", 1000)
+    if count != 5:
+        raise Exception("Invalid write return: %d %d\n" % (count, time))
+    (buf, time) = g.read_s(2, 1000)
+    if buf != b"He":
+        raise Exception("Invalid read return: '%s' %d\n" % (str(buf), time))
+
+    # Shrinking the buffer must not throw away data.
+    try:
+        g.set_sync_readahead(2)
+    except Exception as e:
+        if str(e) != "gensio:set_sync_readahead: Value was too large for data":
+            raise
+    else:
+        raise Exception("set_sync_readahead threw away data")
+
+    (buf, time) = g.read_s(10, 0)
+    if buf != b"llo":
+        raise Exception("Invalid read-ahead return: '%s' %d\n" %
+                        (str(buf), time))
+
+    # More than fits in the read-ahead buffer, the rest stays in the
+    # echo gensio until there is room.
+    (count, time) = g.write_s("0123456789", 1000)
+    if count != 10:
+        raise Exception("Invalid write return: %d %d\n" % (count, time))
+    buf = b""
+    while len(buf) < 10:
+        (buf2, time) = g.read_s(3, 1000)
+        if buf2 == b"":
+            raise Exception("read-ahead read timed out")
+        buf += buf2
+    if buf != b"0123456789":
+        raise Exception("Invalid read-ahead return: '%s' %d\n" %
+                        (str(buf), time))
+    g.set_sync_readahead(0)
+
+    # This should time out, no data
+    (buf, time) = g.read_s(10, 250)
+    if buf != b"" or time != 0:
+        raise Exception("Invalid read timeout return: '%s' %d\n" %
+                        (str(buf), time))
+
+    g.close_s()
+
+    # The buffer can't keep message boundaries.
+    g = gensio.gensio(o, "udp,localhost,1234", None)
+    g.set_sync()
+    try:
+        g.set_sync_readahead(8)
+    except Exception as e:
+        if str(e) != "gensio:set_sync_readahead: Operation not supported":
+            raise
+    else:
+        raise Exception("set_sync_readahead worked on a packet gensio")
+    g.set_sync_readahead(0)
+    return
+
+def test_sync_stream(o):
+    import io
+    import os
+    import shutil
+
+    a = gensio.gensio_accepter(o, "tcp,localhost,0", None)
+    a.set_sync()
+    a.startup()
+    port = a.control(0, True, gensio.GENSIO_ACC_CONTROL_LPORT, "0")
+    g = gensio.gensio(o, "tcp,localhost," + port, None)
+    g.open_s()
+    (io2, time) = a.accept_s_timeout(o, None, 1000)
+    if io2 == None:
+        raise Exception("accept_s_timeout timed out");
+
+    # Small enough to fit in the socket buffers, this is all one thread.
+    data = os.urandom(65536)
+    w = io.BufferedWriter(gensio.SyncStream(g, 1000))
+    w.write(data)
+    w.close()
+
+    r = io.BufferedReader(gensio.SyncStream(io2, 1000))
+    out = io.BytesIO()
+    shutil.copyfileobj(r, out)
+    r.close()
+    if out.getvalue() != data:
+        raise Exception("SyncStream: Read %d bytes, expected %d" %
+                        (len(out.getvalue()), len(data)))
+    a.shutdown_s()
+    return
+
+def sync_tcp_pair(o):
+    a = gensio.gensio_accepter(o, "tcp,localhost,0", None)
+    a.set_sync()
+    a.startup()
+    port = a.control(0, True, gensio.GENSIO_ACC_CONTROL_LPORT, "0")
+    g = gensio.gensio(o, "tcp,localhost," + port, None)
+    g.open_s()
+    (io2, time) = a.accept_s_timeout(o, None, 1000)
+    if io2 == None:
+        raise Exception("accept_s_timeout timed out");
+    g.set_sync()
+    io2.set_sync()
+    return (a, g, io2)
+
+def sync_writer(g, data, errs):
+    try:
+        pos = 0
+        while pos < len(data):
+            (count, time) = g.write_s(data[pos:], 5000)
+            if count == 0:
+                raise Exception("write_s timed out")
+            pos += count
+    except Exception as e:
+        errs.append(e)
+
+def sync_reader(g, size, result, errs):
+    try:
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            (count, time) = g.read_s_into(view[pos:], 5000)
+            if count == 0:
+                raise Exception("read_s_into timed out")
+            pos += count
+        result.append(bytes(buf))
+    except Exception as e:
+        errs.append(e)
+
+def run_sync_transfers(o, nr_pairs, data):
+    import threading
+    import time
+
+    pairs = []
+    for i in range(0, nr_pairs):
+        pairs.append(sync_tcp_pair(o))
+    errs = []
+    results = []
+    threads = []
+    for (a, g, io2) in pairs:
+        threads.append(threading.Thread(target = sync_writer,
+                                        args = (g, data, errs)))
+        r = []
+        results.append(r)
+        threads.append(threading.Thread(target = sync_reader,
+                                        args = (io2, len(data), r, errs)))
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    if errs:
+        raise errs[0]
+    for r in results:
+        if len(r) != 1 or r[0] != data:
+            raise Exception("Sync transfer data mismatch")
+    for (a, g, io2) in pairs:
+        g.close_s()
+        io2.close_s()
+        a.shutdown_s()
+    return elapsed
+
+def test_sync_threads(o):
+    import os
+    import threading
+    import time
+
+    # Blocked sync calls must not hold the GIL, otherwise these run
+    # one after the other.
+    gios = []
+    for i in range(0, 4):
+        g = gensio.gensio(o, "echo", None)
+        g.set_sync()
+        g.open_s()
+        gios.append(g)
+    errs = []
+    def do_timeout(g):
+        (buf, time) = g.read_s(10, 500)
+        if buf != b"" or time != 0:
+            errs.append(Exception("read_s didn't time out"))
+    threads = [ threading.Thread(target = do_timeout, args = (g,))
+                for g in gios ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    if errs:
+        raise errs[0]
+    if elapsed > 1.5:
+        raise Exception("Parallel read_s timeouts took %.2fs, the GIL "
+                        "is probably held" % elapsed)
+    for g in gios:
+        g.close_s()
+
+    # Now parallel transfers on separate gensios.
+    data = os.urandom(1024 * 1024)
+    for nr_pairs in (1, 4):
+        elapsed = run_sync_transfers(o, nr_pairs, data)
+        print("  %d parallel sync transfers of %d bytes: %.3fs" %
+              (nr_pairs, len(data), elapsed))
+    return
+
 class SyncEvent:
     def __init__(self):
         self.opened = False
@@ -63,7 +312,7 @@ class SyncEvent:
         io.write_callback_enable(false);
         return
 
-    def open_done(self, io):
+    def open_done(self, io, err):
         self.opened = True
         return
 
@@ -90,4 +339,8 @@ def test_sync_gensio_accepter(o):
 o = gensio.alloc_gensio_selector(Logger())
 
 test_sync_gensio(o)
+test_sync_read_into(o)
+test_sync_readahead(o)
 test_sync_gensio_accepter(o)
+test_sync_stream(o)
+test_sync_threads(o)
@@ -20,6 +20,7 @@ import time
 import curses.ascii
 import sys
 import sysconfig
+import zlib
 
 debug = 0
 
@@ -42,6 +43,31 @@ class HandlerException(Exception):
     def __str__(self):
         return str(self.value)
 
+def first_diff(a, b):
+    """Return the index of the first byte that differs in a and b,
+    which must be the same length and not equal."""
+    lo = 0
+    hi = len(a)
+    # Bisect on slice compares so a large mismatch doesn't go byte
+    # by byte in python.
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[lo:mid] != b[lo:mid]:
+            hi = mid
+        else:
+            lo = mid
+    return lo
+
+def pattern_crc(pattern, length):
+    """Return the CRC32 of length bytes of pattern repeated, what
+    set_write_pattern() sends and set_compare_crc() checks."""
+    pattern = conv_to_bytes(pattern)
+    crc = 0
+    while length >= len(pattern):
+        crc = zlib.crc32(pattern, crc)
+        length -= len(pattern)
+    return zlib.crc32(pattern[:length], crc)
+
 def find_sergensio(io):
     sio = io.cast_to_sergensio();
     while sio is None:
@@ -55,7 +81,9 @@ class HandleData:
     This is designed to handle input and output from gensio.  To write
     data, call set_write_data() to set some data and write it.  To wait
     for data to be read, call set_compare() to wait for the given data
-    to be read.
+    to be read.  For streams too large to keep in memory, use
+    set_write_pattern() and set_compare_crc() instead, those only keep
+    a running CRC of the data.
 
     This just starts things up and runs asynchronously.  You can wait
     for a completion with wait() or wait_timeout().
@@ -75,9 +103,14 @@ class HandleData:
         self.to_write = None
         self.compared = 0
         self.to_compare = None
+        self.compare_crc = None
+        self.compare_len = 0
+        self.expected_crc = 0
         self.compared_oob = 0
         self.to_compare_oob = None
         self.to_waitfor = None
+        self.waitfor_tail = b""
+        self.write_pattern = False
         self.expecting_modemstate = False
         self.expecting_linestate = False
         self.expecting_remclose = expect_remclose
@@ -107,11 +140,32 @@ class HandleData:
         """
         self.compared = 0
         self.stream = stream
+        self.compare_crc = None
         self.to_compare = conv_to_bytes(to_compare);
         if (start_reader):
             self.io.read_cb_enable(True)
         return
 
+    def set_compare_crc(self, length, crc, start_reader = True,
+                        stream = None):
+        """Read length bytes and check their CRC32 against crc
+
+        The data is not kept, only a running CRC, so this works for
+        any amount of data.  Use pattern_crc() to get the crc for
+        data written with set_write_pattern().  If start_reader is
+        true (default), it enable the read callback.  If the CRC does
+        not match when all the data is in, an exception is raised.
+        """
+        self.compared = 0
+        self.stream = stream
+        self.to_compare = None
+        self.compare_len = length
+        self.expected_crc = crc
+        self.compare_crc = 0
+        if (start_reader):
+            self.io.read_cb_enable(True)
+        return
+
     def set_compare_oob(self, to_compare, start_reader = True, stream = None):
         """Set some oob data to compare
 
@@ -133,6 +187,7 @@ class HandleData:
         """
         self.compared = 0
         self.to_waitfor = conv_to_bytes(waitfor)
+        self.waitfor_tail = b""
         if (start_reader):
             self.io.read_cb_enable(True)
         return
@@ -143,11 +198,28 @@ class HandleData:
         self.wrpos = 0
         self.wrlen = len(to_write)
         self.to_write = conv_to_bytes(to_write)
+        self.write_pattern = False
         self.write_auxdata = auxdata
         if (start_writer):
             self.io.write_cb_enable(True)
         return
 
+    def set_write_pattern(self, pattern, length, start_writer = True,
+                          close_on_done = False, auxdata = None):
+        """Write length bytes of pattern repeated over and over
+
+        Only the pattern is kept in memory, so this can write any
+        amount of data.  A pattern at least chunksize long keeps the
+        writes full size.
+        """
+        self.set_write_data(pattern, start_writer = False,
+                            close_on_done = close_on_done, auxdata = auxdata)
+        self.wrlen = length
+        self.write_pattern = True
+        if (start_writer):
+            self.io.write_cb_enable(True)
+        return
+
     def close(self):
         self.ignore_input = True
         self.io.close(self)
@@ -165,6 +237,8 @@ class HandleData:
     def read_callback(self, io, err, buf, auxdata):
         if self.to_compare:
             iolen = len(self.to_compare)
+        elif self.compare_crc is not None:
+            iolen = self.compare_len
         elif self.to_waitfor:
             iolen = len(self.to_waitfor)
         else:
@@ -194,15 +268,18 @@ class HandleData:
             return len(buf)
 
         if (self.to_waitfor):
-            for i in range(0, len(buf)):
-                if buf[i] == self.to_waitfor[self.compared]:
-                    self.compared += 1
-                    if (len(self.to_waitfor) == self.compared):
-                        self.to_waitfor = None
-                        io.read_cb_enable(False)
-                        self.waiter.wake()
-                else:
-                    self.compared = 0
+            # Keep the end of the previous data so a match split
+            # across reads is found.
+            data = self.waitfor_tail + bytes(buf)
+            if data.find(self.to_waitfor) >= 0:
+                self.to_waitfor = None
+                self.waitfor_tail = b""
+                io.read_cb_enable(False)
+                self.waiter.wake()
+            else:
+                keep = len(self.to_waitfor) - 1
+                self.waitfor_tail = data[max(0, len(data) - keep):]
+            self.compared += len(buf)
             return len(buf)
 
         oob = False;
@@ -232,6 +309,8 @@ class HandleData:
             compared = self.compared_oob
             compare_with = self.to_compare_oob
             oob = "oob "
+        elif self.compare_crc is not None:
+            return self.read_crc(io, buf)
         else:
             if not self.to_compare:
                 if (debug):
@@ -242,22 +321,18 @@ class HandleData:
             compare_with = self.to_compare
             oob = ""
 
-        if (len(buf) > len(compare_with)):
-            count = len(compare_with)
-        else:
-            count = len(buf)
+        count = min(len(buf), len(compare_with) - compared, self.chunksize)
 
-        if count > self.chunksize:
-            count = self.chunksize
-
-        for i in range(0, count):
-            if (buf[i] != compare_with[compared]):
-                raise HandlerException("%s: %scompare failure on byte %d, "
-                                       "expected %x, got %x" %
-                                       (self.name, oob, compared,
-                                        ord(compare_with[compared]),
-                                        ord(buf[i])))
-            compared += 1
+        # Compare whole slices, memoryviews keep from copying the data.
+        got = memoryview(buf)[:count]
+        expected = memoryview(compare_with)[compared:compared + count]
+        if got != expected:
+            i = first_diff(got, expected)
+            raise HandlerException("%s: %scompare failure on byte %d, "
+                                   "expected %x, got %x" %
+                                   (self.name, oob, compared + i,
+                                    expected[i], got[i]))
+        compared += count
 
         if oob == "oob ":
             self.compared_oob = compared
@@ -274,6 +349,24 @@ class HandleData:
 
         return count
 
+    def read_crc(self, io, buf):
+        count = min(len(buf), self.compare_len - self.compared,
+                    self.chunksize)
+        self.compare_crc = zlib.crc32(memoryview(buf)[:count],
+                                      self.compare_crc)
+        self.compared += count
+        if (self.compared >= self.compare_len):
+            crc = self.compare_crc
+            self.compare_crc = None
+            io.read_cb_enable(False)
+            if crc != self.expected_crc:
+                raise HandlerException("%s: CRC mismatch after %d bytes, "
+                                       "expected %x, got %x" %
+                                       (self.name, self.compared,
+                                        self.expected_crc, crc))
+            self.waiter.wake()
+        return count
+
     def write_callback(self, io):
         if (not self.to_write):
             if (debug or self.debug):
@@ -281,10 +374,13 @@ class HandleData:
             io.write_cb_enable(False)
             return
 
-        if (self.wrpos + self.chunksize > self.wrlen):
-            wrdata = self.to_write[self.wrpos:]
+        count = min(self.chunksize, self.wrlen - self.wrpos)
+        if self.write_pattern:
+            pos = self.wrpos % len(self.to_write)
+            count = min(count, len(self.to_write) - pos)
         else:
-            wrdata = self.to_write[self.wrpos:self.wrpos + self.chunksize]
+            pos = self.wrpos
+        wrdata = memoryview(self.to_write)[pos:pos + count]
         count = io.write(wrdata, self.write_auxdata)
         if (debug or self.debug):
             print(self.name + ": wrote %d bytes" % count)
@@ -592,6 +688,25 @@ def test_dataxfer_simul(io1, io2, data, timeout = 10000):
                          io1.handler.compared, io2.handler.compared))
     return
 
+def test_dataxfer_crc(io1, io2, pattern, length, timeout = 10000):
+    """Test a transfer of length bytes of pattern repeated from io1 to io2
+
+    The data is checked with a CRC as it comes in, so length can be
+    much larger than what would fit in memory.  If the transfer does
+    not complete by "timeout" milliseconds, raise an exception.
+    """
+    io1.handler.set_write_pattern(pattern, length)
+    io2.handler.set_compare_crc(length, pattern_crc(pattern, length))
+    if (io1.handler.wait_timeout(timeout) == 0):
+        raise Exception(("%s: %s: " % ("test_dataxfer_crc", io1.handler.name)) +
+                        ("Timed out waiting for write completion at byte %d" %
+                         io1.handler.wrpos))
+    if (io2.handler.wait_timeout(timeout) == 0):
+        raise Exception(("%s: %s: " % ("test_dataxfer_crc", io2.handler.name)) +
+                        ("Timed out waiting for read completion at byte %d" %
+                         io2.handler.compared))
+    return
+
 def test_write_drain(io1, io2, data, timeout = 1000):
     """Test that a close does not loose data.
 